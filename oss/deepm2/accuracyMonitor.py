@@ -1,5 +1,5 @@
 import numpy as np
-from deepmedic.genericHelpers import strFl4fNA, strFl5fNA, strListFl4fNA, strListFl5fNA, getMeanOfListExclNA
+from deepmedic.genericHelpers import strFl4fNA, strFl5fNA, strListFl4fNA, strListFl5fNA, getMeanOfListExclNA, replaceNaWithNone
 
 class AccuracyOfEpochMonitorSegmentation(object) :
     
@@ -164,6 +164,14 @@ class AccuracyOfEpochMonitorSegmentation(object) :
                                "\t=> TrueNeg/RealNeg = "+str(numOfTnInSubep)+"/"+str(numOfRnInSubep))
             self.logger.print3(logStrClass+"\t mean Dice:       \t"+ strFl4fNA(meanDiceOfSubep, self.NA_PATTERN))
             
+        # Per class: [accuracy, sensitivity, specificity, dice]. Class-0 is the whole foreground.
+        self.logger.logRecord("accuracyOfSubepoch", session=trainOrValString, epoch=self.epoch, subepoch=currSubep,
+                              meanAccuracy=replaceNaWithNone(self.meanEmpiricalAccuracyOfEachSubep[currSubep], self.NA_PATTERN),
+                              meanCost=replaceNaWithNone(self.meanCostOfEachSubep[currSubep], self.NA_PATTERN) \
+                                                                        if self.training0orValidation1 == 0 else None,
+                              perClassAccSensSpecDsc=replaceNaWithNone([self.listPerSubepForegrMeanAccSensSpecDsc[currSubep]] + \
+                                                        list(self.listPerSubepPerClassMeanAccSensSpecDsc[currSubep][1:]),
+                                                        self.NA_PATTERN) )
             
     def reportMeanAccyracyOfEpoch(self) :
         trainOrValString = "TRAINING" if self.training0orValidation1 == 0 else "VALIDATION"
@@ -187,6 +195,7 @@ class AccuracyOfEpochMonitorSegmentation(object) :
                                 strListFl5fNA(self.meanCostOfEachSubep, self.NA_PATTERN) )
             
         # Report for each class.
+        perClassMeanAccSensSpecDscOfEp = []
         for class_i in xrange(self.numberOfClasses) :
             classString = "Class-"+str(class_i)
             extraDescription = "[Whole Foreground (Pos) Vs Background (Neg)]" if class_i == 0 else \
@@ -218,6 +227,7 @@ class AccuracyOfEpochMonitorSegmentation(object) :
             meanSensOfEp = getMeanOfListExclNA(meanSensPerSubep, self.NA_PATTERN)
             meanSpecOfEp = getMeanOfListExclNA(meanSpecPerSubep, self.NA_PATTERN)
             meanDscOfEp = getMeanOfListExclNA(meanDscPerSubep, self.NA_PATTERN)
+            perClassMeanAccSensSpecDscOfEp.append([meanAccOfEp, meanSensOfEp, meanSpecOfEp, meanDscOfEp])
             
             logStrClass = logStr + ", " + classString + ":"
             self.logger.print3(logStrClass + "\t mean accuracy of epoch:\t"+ strFl4fNA(meanAccOfEp, self.NA_PATTERN) +\
@@ -238,6 +248,10 @@ class AccuracyOfEpochMonitorSegmentation(object) :
             self.logger.print3(logStrClass + "\t mean Dice of each subepoch:    \t" + \
                                strListFl4fNA(meanDscPerSubep, self.NA_PATTERN) )
             
+        self.logger.logRecord("accuracyOfEpoch", session=trainOrValString, epoch=self.epoch,
+                              meanAccuracy=replaceNaWithNone(meanEmpiricalAccOfEp, self.NA_PATTERN),
+                              meanCost=replaceNaWithNone(meanCostOfEp, self.NA_PATTERN) if self.training0orValidation1 == 0 else None,
+                              perClassAccSensSpecDsc=replaceNaWithNone(perClassMeanAccSensSpecDscOfEp, self.NA_PATTERN) )
         self.logger.print3( ">>>>>>>>>>>>>>>>>>>>>>>>> End Of Accuracy Report at the end of Epoch <<<<<<<<<<<<<<<<<<<<<<<<<<<<<<" )
         self.logger.print3( ">>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>><<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<" )
         
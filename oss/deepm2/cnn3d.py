@@ -19,6 +19,7 @@ from deepmedic.pathways import NormalPathway, SubsampledPathway, FcPathway
 from deepmedic.cnnLayerTypes import SoftmaxLayer
 
 from deepmedic.cnnHelpers import calcReceptiveFieldDims
+from deepmedic.convolutionBackends import ConvolutionBackendSelector
 
 #-----helper functions that I use in here---
 
@@ -71,8 +72,9 @@ class Cnn3d(object):
         #=== Compiled Functions for API ====
         self.cnnTrainModel = ""
         self.cnnValidateModel = ""
-        self.cnnTestModel = ""
+        self.cnnTestModel = "" # Only the predictions. See compileTestFunction().
         self.cnnVisualiseFmFunction = ""
+        self.cnnTestAndVisualiseAllFmsFunction = "" # Also all the feature maps. Compiled only to save them.
         
         #=====================================
         self.recFieldCnn = ""
@@ -102,6 +104,9 @@ class Cnn3d(object):
         self.indicesOfLowerRankLayersPerPathway = ""
         self.ranksOfLowerRankLayersForEachPathway = ""
         
+        # The arguments given to make_cnn_model(). Saved in checkpoints, to rebuild the model. See cnnCheckpoint.py.
+        self.argumentsOfMakeCnnModel = None
+        
         
         # ======= Shared Variables with X and Y data for training/validation/testing ======
         self._initializedSharedVarsTrain = False
@@ -115,6 +120,10 @@ class Cnn3d(object):
         self._initializedSharedVarsTest = False
         self.sharedInpXTest = ""
         self.sharedInpXPerSubsListTest = []
+        # Streaming: The shared variables of training/validation hold a ring of batches, loaded one at a time.
+        self.numberOfBatchSlotsForStreaming = 0
+        self.cnnLoadBatchInSlotFunctionTrainVal = ["", ""]
+        self._nextSlotForStreamingTrainVal = [0, 0]
         
         
         #============= ATTRIBUTES SPECIFIC TO THE TRAINING STATE ============
@@ -157,9 +166,12 @@ class Cnn3d(object):
         #======= tensors, input to the CNN. Needed to be saved for later compilation after loading =======
         # Symbolic variables, which stand for the input. Will be loaded by the compiled trainining/val/test function. 
         #Can also be pre-set by an existing tensor if required in future extensions.
+        # One graph serves training, validation and testing. Its batch size and dims are symbolic, and the \
+        # functions differ by the constant they give to the flag (1 for training, 0 otherwise).
         self.inputTensorsXToCnnInitialized = False
-        self.inputTensorNormTrain = None; self.inputTensorNormVal = None; self.inputTensorNormTest = None;
-        self.listInputTensorPerSubsTrain = []; self.listInputTensorPerSubsVal = []; self.listInputTensorPerSubsTest = [];
+        self.inputTensorNorm = None
+        self.listInputTensorPerSubs = []
+        self.isTrainingFlag = None
         
     def getNumSubsPathways(self):
         count = 0
@@ -262,6 +274,9 @@ class Cnn3d(object):
         self.sharedLabelsYVal = theano.shared(np.zeros([1, 1, 1, 1], dtype="float32") , borrow=self.borrowFlag)
         
     def _initializeSharedVarsForInputsTest(self) :
+        # The testing and the visualisation functions share them.
+        if self._initializedSharedVarsTest :
+            return
         self._initializedSharedVarsTest = True
         self.sharedInpXTest = theano.shared(np.zeros([1, 1, 1, 1, 1], dtype="float32"), borrow=self.borrowFlag)
         for subsPath_i in xrange(self.numSubsPaths) :
@@ -292,17 +307,6 @@ class Cnn3d(object):
     def checkTrainingStateAttributesInitialized(self):
         return self._trainingStateAttributesInitialized
     
-    # for inference with batch-normalization. Every training batch, 
-    #this is called to update an internal matrix of each layer, with the last mus and vars, 
-    #so that I can compute the rolling average for inference.
-    def updateTheMatricesOfTheLayersWithTheLastMusAndVarsForTheMovingAverageOfTheBatchNormInference(self) :
-        self._updateMatricesOfBnRollingAverageForInference()
-        
-    def _updateMatricesOfBnRollingAverageForInference(self):
-        for pathway in self.pathways :
-            for layer in pathway.getLayers() :
-                layer.updateTheMatricesWithTheLastMusAndVarsForTheRollingAverageOfBNInference()  # Will do nothing if no BN.
-                
     #========================================OPTIMIZERS========================================
     """
     From https://github.com/lisa-lab/pylearn2/pull/136#issuecomment-10381617 :
@@ -536,21 +540,61 @@ class Cnn3d(object):
         
         self._trainingStateAttributesInitialized = True
         
-    def _getUpdatesForBnRollingAverage(self) :
+    #========================================CHECKPOINTS========================================
+    # Python attributes of the training state. The rest of it is in the shared variables of getNamedSharedVariables().
+    _namesOfTrainingStateAttributes = [ "_trainingStateAttributesInitialized", "numberOfEpochsTrained",
+                                        "indicesOfLayersPerPathwayTypeToFreeze", "costFunctionLetter",
+                                        "initialLearningRate", "classicMomentum0OrNesterov1", "initialMomentum",
+                                        "momentumTypeNONNormalized0orNormalized1", "sgd0orAdam1orRmsProp2",
+                                        "b1_adam", "b2_adam", "epsilonForAdam", "rho_rmsProp", "epsilonForRmsProp",
+                                        "L1_reg_constant", "L2_reg_constant",
+                                        "topMeanValidationAccuracyAchievedInEpoch", "lastEpochAtTheEndOfWhichLrWasLowered" ]
+    
+    def getTrainingStateAttributes(self) :
+        return dict([ [name, getattr(self, name)] for name in self._namesOfTrainingStateAttributes ])
+    
+    def setTrainingStateAttributes(self, myLogger, trainingStateAttributes) :
+        # After make_cnn_model(). If the state was initialized, makes the shared variables of the optimizer, \
+        # so that their values can be given afterwards.
+        for name in self._namesOfTrainingStateAttributes :
+            setattr(self, name, trainingStateAttributes[name])
+        if self._trainingStateAttributesInitialized :
+            self._initializeSharedVariablesOfOptimizer(myLogger)
+            
+    def getNamedSharedVariables(self) :
+        # [[name, sharedVariable], ...] with the parameters of all layers, the statistics of BN and the state of \
+        # the optimizer. The names depend only on the architecture and the optimizer. For checkpoints.
+        namedSharedVariables = [ ["learning_rate", self.learning_rate], ["momentum", self.momentum], ["i_adam", self.i_adam] ]
+        for pathway_i in xrange(len(self.pathways)) :
+            for layer_i in xrange(len(self.pathways[pathway_i].getLayers())) :
+                namedSharedVariables += self.pathways[pathway_i].getLayer(layer_i).getNamedSharedVariables(
+                                                            "pathway" + str(pathway_i) + "_layer" + str(layer_i) + "_")
+        namedSharedVariables += self.finalTargetLayer.getNamedSharedVariables("finalTargetLayer_")
+        for [nameOfList, listOfSharedVariables] in [ ["velocities_forMom", self.velocities_forMom],
+                                                     ["m_listForAllParamsAdam", self.m_listForAllParamsAdam],
+                                                     ["v_listForAllParamsAdam", self.v_listForAllParamsAdam],
+                                                     ["accuGradSquare_listForAllParamsRmsProp",
+                                                      self.accuGradSquare_listForAllParamsRmsProp] ] :
+            for var_i in xrange(len(listOfSharedVariables)) :
+                namedSharedVariables.append([nameOfList + "_" + str(var_i), listOfSharedVariables[var_i]])
+        return namedSharedVariables
+    
+    def _getUpdatesForBnRollingAverage(self, momentumOfExponentialMovingAverageForBn) :
         # These are not the variables of the normalization of the FMs' distributions that are optimized during training. 
-        #These are only the Mu and Stds that are used during inference,
-        # ... and here we update the sharedVariable which is used "from the outside during do_training()" to 
-        #update the rolling-average-matrix for inference. Do for all layers.
+        #These are only the Mu and Stds that are used during inference. The training function itself writes the \
+        # mu and var of each batch in the rolling-average-matrix of each layer, so no call is needed after each batch.
         updatesForBnRollingAverage = []
         for pathway in self.pathways :
             for layer in pathway.getLayers() :
                 #CAREFUL: WARN, PROBLEM, THEANO BUG! If a layer has only 1FM, the .newMu_B ends up being of type (true,) 
                 #instead of vector!!! Error!!!
-                updatesForBnRollingAverage.extend(layer.getUpdatesForBnRollingAverage())  
+                updatesForBnRollingAverage.extend(layer.getUpdatesForBnRollingAverage(momentumOfExponentialMovingAverageForBn))
         return updatesForBnRollingAverage
     
     # NOTE: compileTrainFunction() changes the self.initialLearningRate. Which is used for the exponential schedule!
-    def compileTrainFunction(self, myLogger) :
+    def compileTrainFunction(self, myLogger, momentumOfExponentialMovingAverageForBn=None) :
+        # momentumOfExponentialMovingAverageForBn: If None, the statistics of BN for inference are the average of \
+        # the last rollingAverageForBNOverThatManyBatches batches. Otherwise their exponential moving average.
         # At the next stage of the refactoring:
         # 1. Take an additional variable that says whether to "initialize" new training, or to "resume" training
         # 2. Build model here. Which internally LOADS the weights, array made by newModel. Dont initialize a model here. 
@@ -567,8 +611,7 @@ class Cnn3d(object):
         
         # symbolic variables needed:
         index = T.lscalar()
-        x = self.inputTensorNormTrain
-        listXPerSubs = self.listInputTensorPerSubsTrain
+        [x, listXPerSubs] = self._getInputTensorsOfTrain0OrVal1OrTest2(0)
         
         y = T.itensor4('y')  # Input of the theano-compiled-function. Dimensions of y labels: [batchSize, r, c, z]
         # When storing data on the GPU it has to be stored as floats (floatX). Thus the sharedVariable is FloatX/32. 
@@ -593,7 +636,7 @@ class Cnn3d(object):
         updates = self._getUpdatesOfTrainableParameters(myLogger, cost)
         
         #================BATCH NORMALIZATION ROLLING AVERAGE UPDATES======================
-        updates = updates + self._getUpdatesForBnRollingAverage()
+        updates = updates + self._getUpdatesForBnRollingAverage(momentumOfExponentialMovingAverageForBn)
         
         #========================COMPILATION OF FUNCTIONS =================
         givensSet = { x: self.sharedInpXTrain[index * self.batchSize: (index + 1) * self.batchSize] }
@@ -603,6 +646,7 @@ class Cnn3d(object):
             givensSet.update({ xSub: sharedInpXSubTrain[index * self.batchSize: (index + 1) * self.batchSize] })
         givensSet.update({  y: intCastSharedLabelsYTrain[index * self.batchSize: (index + 1) * self.batchSize],
                             weightPerClass: inputVectorWeightsOfClassesInCostFunction })
+        givensSet.update(self._getGivensOfFlagsOfTrain0OrVal1OrTest2(0))
         
         myLogger.print3("...Compiling the function for training... (This may take a few minutes...)")
         self.cnnTrainModel = theano.function(
@@ -620,8 +664,7 @@ class Cnn3d(object):
         
         # symbolic variables needed:
         index = T.lscalar()
-        x = self.inputTensorNormVal
-        listXPerSubs = self.listInputTensorPerSubsVal
+        [x, listXPerSubs] = self._getInputTensorsOfTrain0OrVal1OrTest2(1)
         y = T.itensor4('y')  # Input of the theano-compiled-function. Dimensions of y labels: [batchSize, r, c, z]
         # When storing data on the GPU it has to be stored as floats (floatX). Thus the sharedVariable is FloatX/32. 
         #Here this variable is cast as "int", to be used correctly in computations.
@@ -635,25 +678,166 @@ class Cnn3d(object):
                                                                         self.batchSizeValidation] })
         givensSet.update({ y: intCastSharedLabelsYVal[index * self.batchSizeValidation: (index + 1) * \
                                                                         self.batchSizeValidation] })
+        givensSet.update(self._getGivensOfFlagsOfTrain0OrVal1OrTest2(1))
         
         myLogger.print3("...Compiling the function for validation... (This may take a few minutes...)")
+        # No default updates: The random streams of dropout are only used by the training function.
         self.cnnValidateModel = theano.function(
                                     [index],
                                     self.finalTargetLayer.getRpRnTpTnForTrain0OrVal1(y, 1),
-                                    givens=givensSet
+                                    givens=givensSet,
+                                    no_default_updates=True
                                     )
         myLogger.print3("The validation function was compiled.")
         
         
+    def compileFunctionsToLoadBatchesInSlots(self, myLogger, numberOfBatchSlots) :
+        # For streaming, after the training and validation functions. Their shared variables become rings of \
+        # numberOfBatchSlots batches, and each batch is written in its slot on the device, with set_subtensor. \
+        # The training and validation functions are the same: The index they take is the slot of the batch.
+        myLogger.print3("...Compiling the functions that load batches in a ring of [" + str(numberOfBatchSlots) + \
+                        "] slots for training and validation...")
+        self.numberOfBatchSlotsForStreaming = numberOfBatchSlots
+        self._nextSlotForStreamingTrainVal = [0, 0]
+        self.cnnLoadBatchInSlotFunctionTrainVal = ["", ""]
+        tensor5 = T.TensorType(dtype='float32', broadcastable=(False, False, False, False, False))
+        for train0orValidation1 in [0, 1] :
+            if not [self._initializedSharedVarsTrain, self._initializedSharedVarsVal][train0orValidation1] :
+                continue # Its function was not compiled.
+            [sharedInpX, sharedInpXPerSubsList, sharedLabelsY, batchSize] = self._getSharedVarsAndBatchSizeOfTrainOrVal(train0orValidation1)
+            slot_i = T.lscalar()
+            inputsOfFunction = [slot_i]
+            updates = []
+            for sharedVar in [sharedInpX] + sharedInpXPerSubsList :
+                xOfBatch = tensor5()
+                inputsOfFunction.append(xOfBatch)
+                updates.append((sharedVar, T.set_subtensor(sharedVar[slot_i * batchSize: (slot_i + 1) * batchSize], xOfBatch)))
+            yOfBatch = T.ftensor4() # Labels are stored as floats, like with set_value.
+            inputsOfFunction.append(yOfBatch)
+            updates.append((sharedLabelsY, T.set_subtensor(sharedLabelsY[slot_i * batchSize: (slot_i + 1) * batchSize], yOfBatch)))
+            self.cnnLoadBatchInSlotFunctionTrainVal[train0orValidation1] = theano.function(inputsOfFunction, [], updates=updates)
+        myLogger.print3("The functions that load batches in slots were compiled.")
+        
+    def _getSharedVarsAndBatchSizeOfTrainOrVal(self, train0orValidation1) :
+        if train0orValidation1 == 0 :
+            return [self.sharedInpXTrain, self.sharedInpXPerSubsListTrain, self.sharedLabelsYTrain, self.batchSize]
+        return [self.sharedInpXVal, self.sharedInpXPerSubsListVal, self.sharedLabelsYVal, self.batchSizeValidation]
+    
+    def _allocateBatchSlotsIfNeeded(self, train0orValidation1) :
+        # The ring is allocated at the first batch, and again if the shared variables were freed meanwhile.
+        [sharedInpX, sharedInpXPerSubsList, sharedLabelsY, batchSize] = self._getSharedVarsAndBatchSizeOfTrainOrVal(train0orValidation1)
+        numberOfRows = self.numberOfBatchSlotsForStreaming * batchSize
+        if sharedInpX.get_value(borrow=True, return_internal_type=True).shape[0] == numberOfRows :
+            return
+        for pathway_i in xrange(self.getNumPathwaysThatRequireInput()) :
+            sharedVar = ([sharedInpX] + sharedInpXPerSubsList)[pathway_i]
+            shapeOfInput = self.pathways[pathway_i].getShapeOfInput()[train0orValidation1]
+            sharedVar.set_value(np.zeros([numberOfRows] + list(shapeOfInput[1:]), dtype="float32"), borrow=self.borrowFlag)
+        shapeOfOutput = [self.finalTargetLayer.outputShapeTrain, self.finalTargetLayer.outputShapeVal][train0orValidation1]
+        sharedLabelsY.set_value(np.zeros([numberOfRows] + list(shapeOfOutput[2:]), dtype="float32"), borrow=self.borrowFlag)
+        
+    def loadBatchInNextSlot(self, train0orValidation1, listOfArraysOfBatch) :
+        # listOfArraysOfBatch: float32 [batchSize, channels, r, c, z] per pathway that takes input, and the labels last.
+        # Returns the slot where the batch was loaded, to give as index to cnnTrainModel or cnnValidateModel. \
+        # The calls on the device run in order, so a slot is overwritten only after the batch in it was used.
+        self._allocateBatchSlotsIfNeeded(train0orValidation1)
+        slot_i = self._nextSlotForStreamingTrainVal[train0orValidation1]
+        self._nextSlotForStreamingTrainVal[train0orValidation1] = (slot_i + 1) % self.numberOfBatchSlotsForStreaming
+        self.cnnLoadBatchInSlotFunctionTrainVal[train0orValidation1](slot_i, *listOfArraysOfBatch)
+        return slot_i
+        
+    def _getGivensForTest(self, index) :
+        # The batch size is shared, so that setBatchSizeTesting() does not need the functions compiled again.
+        [x, listXPerSubs] = self._getInputTensorsOfTrain0OrVal1OrTest2(2)
+        batchSize = self._getSharedBatchSizeTesting() if self._graphIsSharedByTheFunctions() else self.batchSizeTesting
+        givensSet = { x: self.sharedInpXTest[index * batchSize: (index + 1) * batchSize] }
+        for subPath_i in xrange(self.numSubsPaths) : # if there are subsampled paths...
+            xSub = listXPerSubs[subPath_i]
+            sharedInpXSubTest = self.sharedInpXPerSubsListTest[subPath_i]
+            givensSet.update({ xSub: sharedInpXSubTest[index * batchSize: (index + 1) * batchSize] })
+        givensSet.update(self._getGivensOfFlagsOfTrain0OrVal1OrTest2(2))
+        return givensSet
+    
+    def _getSharedBatchSizeTesting(self) :
+        # Made with the first testing function.
+        if getattr(self, "_sharedBatchSizeTesting", None) is None :
+            self._sharedBatchSizeTesting = theano.shared(np.int64(self.batchSizeTesting))
+        return self._sharedBatchSizeTesting
+    
+    def canChangeBatchSizeTesting(self) :
+        # Otherwise each call of the testing functions must be given exactly batchSizeTesting segments.
+        return self._graphIsSharedByTheFunctions()
+
+    def setBatchSizeTesting(self, myLogger, batchSizeTesting) :
+        # The number of segments per call of the testing functions, without making the model or compiling them again. \
+        # A call may also be given fewer, eg for the last batch of a subject.
+        if not self.canChangeBatchSizeTesting() :
+            myLogger.print3("ERROR: The model was made before its graph was shared by training, validation and " + \
+                            "testing, and its testing graph is for batches of [" + str(self.batchSizeTesting) + \
+                            "] segments. It cannot be changed. Exiting!"); exit(1)
+        self.batchSizeTesting = batchSizeTesting
+        self._getSharedBatchSizeTesting().set_value(np.int64(batchSizeTesting))
+        shapesOfTesting = [ self.finalTargetLayer.inputShapeTest, self.finalTargetLayer.outputShapeTest ]
+        for pathway in self.pathways :
+            shapesOfTesting += [ pathway.getShapeOfInput()[2], pathway.getShapeOfOutput()[2],
+                                 pathway.getShapeOfOutputAtNormalRes()[2] ]
+            for layer in pathway.getLayers() :
+                shapesOfTesting += [ layer.inputShapeTest, layer.outputShapeTest ]
+        for shape in shapesOfTesting : # Python lists, some shared by consecutive layers.
+            shape[0] = batchSizeTesting
+        myLogger.print3("The batch size for testing was set to [" + str(batchSizeTesting) + "] segments.")
+        
+    def _graphIsSharedByTheFunctions(self) :
+        # Models pickled before, have a graph with its own inputs per function.
+        return hasattr(self, "inputTensorNorm")
+    
+    def _getInputTensorsOfTrain0OrVal1OrTest2(self, train0OrVal1OrTest2) :
+        # [x, listXPerSubs], that the compiled function gives its batches to.
+        if self._graphIsSharedByTheFunctions() :
+            return [self.inputTensorNorm, self.listInputTensorPerSubs]
+        return [ [self.inputTensorNormTrain, self.listInputTensorPerSubsTrain],
+                 [self.inputTensorNormVal, self.listInputTensorPerSubsVal],
+                 [self.inputTensorNormTest, self.listInputTensorPerSubsTest] ][train0OrVal1OrTest2]
+    
+    def _getGivensOfFlagsOfTrain0OrVal1OrTest2(self, train0OrVal1OrTest2) :
+        # Given as a constant, the optimization of the graph keeps only the branch of dropout and BN of the function.
+        if not self._graphIsSharedByTheFunctions() :
+            return {}
+        return { self.isTrainingFlag : T.constant(np.int8(1 if train0OrVal1OrTest2 == 0 else 0)) }
+    
+    def compileTestFunction(self, myLogger, typeOfOutput="probabilities") :
+        # The lean function for inference. Returns only the output for the central voxels of the segments:
+        # "probabilities": [batch, classes, r, c, z] float32. "float16": The same, cast on the device, to transfer \
+        # half the bytes. "labels": [batch, r, c, z] int16, the argmax over the classes, computed on the device.
+        # The feature maps of all layers are only returned by the function of compileTestAndVisualisationFunction().
+        myLogger.print3("...Building the function for testing, which returns the [" + str(typeOfOutput) + "]...")
+        
+        self._initializeSharedVarsForInputsTest()
+        
+        index = T.lscalar()
+        predictionProbabilities = self.finalTargetLayer.predictionProbabilities()
+        if typeOfOutput == "probabilities" :
+            output = predictionProbabilities
+        elif typeOfOutput == "float16" :
+            output = T.cast(predictionProbabilities, "float16")
+        elif typeOfOutput == "labels" :
+            output = T.cast(T.argmax(predictionProbabilities, axis=1), "int16")
+        else :
+            myLogger.print3("ERROR: The type of output of the testing function should be one of \"probabilities\", " + \
+                            "\"float16\" or \"labels\". Given: [" + str(typeOfOutput) + "]. Exiting!"); exit(1)
+            
+        myLogger.print3("...Compiling the function for testing...")
+        self.cnnTestModel = theano.function([index], output, givens=self._getGivensForTest(index), no_default_updates=True)
+        myLogger.print3("The function for testing was compiled.")
+        
     def compileTestAndVisualisationFunction(self, myLogger) :
+        # Only needed to save the feature maps. For the segmentation alone, compileTestFunction() is lighter.
         myLogger.print3("...Building the function for testing and visualisation of FMs...")
         
         self._initializeSharedVarsForInputsTest()
         
         # symbolic variables needed:
         index = T.lscalar()
-        x = self.inputTensorNormTest
-        listXPerSubs = self.listInputTensorPerSubsTest
         
         funcList_AllFmActs_Preds = []
         for pathway in self.pathways :
@@ -662,18 +846,12 @@ class Cnn3d(object):
                 
         funcList_AllFmActs_Preds.append(self.finalTargetLayer.predictionProbabilities())
         
-        givensSet = { x: self.sharedInpXTest[index * self.batchSizeTesting: (index + 1) * self.batchSizeTesting] }
-        for subPath_i in xrange(self.numSubsPaths) : # if there are subsampled paths...
-            xSub = listXPerSubs[subPath_i]
-            sharedInpXSubTest = self.sharedInpXPerSubsListTest[subPath_i]
-            givensSet.update({ xSub: sharedInpXSubTest[index * self.batchSizeTesting: (index + 1) * \
-                                                                        self.batchSizeTesting] })
-            
         myLogger.print3("...Compiling the function for testing and visualisation of FMs... (This may take a few minutes...)")
         self.cnnTestAndVisualiseAllFmsFunction = theano.function(
                                                         [index],
                                                         funcList_AllFmActs_Preds,
-                                                        givens=givensSet
+                                                        givens=self._getGivensForTest(index),
+                                                        no_default_updates=True
                                                         )
         myLogger.print3("The function for testing and visualisation of FMs was compiled.")
         
@@ -683,20 +861,16 @@ class Cnn3d(object):
             #Will be loaded by the compiled trainining/val/test function. 
             #Can also be pre-set by an existing tensor if required in future extensions.
             tensor5 = T.TensorType(dtype='float32', broadcastable=(False, False, False, False, False))
-            # Actually, for these 3, a single tensor5() could be used, as long as I reshape it separately for each afterwards. 
-            #The actual value is loaded by the compiled functions.
-            self.inputTensorNormTrain = tensor5()  
-            self.inputTensorNormVal = tensor5()  # myTensor.reshape(inputImageShapeValidation)
-            self.inputTensorNormTest = tensor5()
+            # One for all the functions. Each gives its batches to it, of its own size and dims.
+            self.inputTensorNorm = tensor5()
             # For the multiple subsampled pathways.
             for subsPath_i in xrange(self.numSubsPaths) :
-                self.listInputTensorPerSubsTrain.append(tensor5())  # Actually, for these 3, a single tensor5() could be used.
-                self.listInputTensorPerSubsVal.append(tensor5())  # myTensor.reshape(inputImageSubsampledShapeValidation)
-                self.listInputTensorPerSubsTest.append(tensor5())
+                self.listInputTensorPerSubs.append(tensor5())
+            # Whether dropout and BN behave as in training. Given as a constant by each compiled function.
+            self.isTrainingFlag = T.bscalar("isTraining")
             self.inputTensorsXToCnnInitialized = True
             
-        return (self.inputTensorNormTrain, self.inputTensorNormVal, self.inputTensorNormTest,
-                self.listInputTensorPerSubsTrain, self.listInputTensorPerSubsVal, self.listInputTensorPerSubsTest)
+        return (self.inputTensorNorm, self.listInputTensorPerSubs, self.isTrainingFlag)
         
     def _getClassificationLayer(self):
         return SoftmaxLayer()
@@ -762,6 +936,11 @@ class Cnn3d(object):
                         #=== various ====
                         borrowFlag,
                         dataTypeX='float32',
+                        #=== Convolution ===
+                        convolutionBackend="conv3d2d", # One of CONVOLUTION_BACKENDS, or AUTO_BACKEND.
+                        # [[[inputShape, withGradients], ...], filterShape, backend] chosen by AUTO_BACKEND when the \
+                        # model was made, to rebuild it with the same backends without benchmarking them again.
+                        chosenConvolutionBackendPerShape=None
                         ):
         """
         maxPoolingParamsStructure: The padding of the function further below adds zeros. 
@@ -770,6 +949,10 @@ class Cnn3d(object):
         it still reduces the dimension of the image by 1. That's why I need this. To keep the dimensions stable.
         It mirrors the last elements of each dimension as many times as it is given as arg.
         """
+        argumentsOfMakeCnnModel = dict(locals()) # Before any other local is defined.
+        del argumentsOfMakeCnnModel["self"], argumentsOfMakeCnnModel["myLogger"]
+        self.argumentsOfMakeCnnModel = argumentsOfMakeCnnModel
+        
         self.cnnModelName = cnnModelName
         
         # ============= Model Parameters Passed as arguments ================
@@ -810,6 +993,9 @@ class Cnn3d(object):
         #==============================
         rng = numpy.random.RandomState(23455)
         
+        convolutionBackendSelector = ConvolutionBackendSelector(convolutionBackend, chosenConvolutionBackendPerShape,
+                                                                myLogger)
+        
         ######################
         # BUILD ACTUAL MODEL #
         ######################
@@ -817,18 +1003,14 @@ class Cnn3d(object):
         
         # Symbolic variables, which stand for the input. Will be loaded by the compiled trainining/val/test function. 
         #Can also be pre-set by an existing tensor if required in future extensions.
-        (inputTensorNormTrain, inputTensorNormVal, inputTensorNormTest,
-        listInputTensorPerSubsTrain, listInputTensorPerSubsVal, \
-                                    listInputTensorPerSubsTest) = self._getInputTensorsXToCnn()
+        (inputTensorNorm, listInputTensorPerSubs, isTrainingFlag) = self._getInputTensorsXToCnn()
         
         #=======================Make the NORMAL PATHWAY of the CNN=======================
         thisPathway = NormalPathway()
         self.pathways.append(thisPathway)
         pwType = thisPathway.pType()
         
-        inputToPathwayTrain = inputTensorNormTrain
-        inputToPathwayVal = inputTensorNormVal
-        inputToPathwayTest = inputTensorNormTest
+        inputToPathway = inputTensorNorm
         inputToPathwayShapeTrain = [self.batchSize, numberOfImageChannelsPath1] + imagePartDimensionsTraining
         inputToPathwayShapeVal = [self.batchSizeValidation, numberOfImageChannelsPath1] + imagePartDimensionsValidation
         inputToPathwayShapeTest = [self.batchSizeTesting, numberOfImageChannelsPath1] + imagePartDimensionsTesting
@@ -846,12 +1028,11 @@ class Cnn3d(object):
         thisPathwayActivFuncPerLayer[0] = -1 if pwType <> pt.FC else actFuncToUseRelu0orPrelu1  
         
         thisPathway.makeLayersAndReturnDimsOfOutputFM(myLogger,
-                                                                         inputToPathwayTrain,
-                                                                         inputToPathwayVal,
-                                                                         inputToPathwayTest,
+                                                                         inputToPathway,
                                                                          inputToPathwayShapeTrain,
                                                                          inputToPathwayShapeVal,
                                                                          inputToPathwayShapeTest,
+                                                                         isTrainingFlag,
                                                                          
                                                                          pwNKerns,
                                                                          pwKernelDims,
@@ -866,7 +1047,8 @@ class Cnn3d(object):
                                                                          
                                                             indicesOfLowerRankLayersPerPathway[pwType],
                                                             ranksOfLowerRankLayersForEachPathway[pwType],
-                                                            indicesOfLayersToConnectResidualsInOutput[pwType]
+                                                            indicesOfLayersToConnectResidualsInOutput[pwType],
+                                                            convolutionBackendSelector
                                                                          )
         # Skip connections to end of pathway.
         thisPathway.makeMultiscaleConnectionsForLayerType(\
@@ -883,9 +1065,7 @@ class Cnn3d(object):
             self.pathways.append(thisPathway) 
             pwType = thisPathway.pType()
             
-            inputToPathwayTrain = listInputTensorPerSubsTrain[subPath_i]
-            inputToPathwayVal = listInputTensorPerSubsVal[subPath_i]
-            inputToPathwayTest = listInputTensorPerSubsTest[subPath_i]
+            inputToPathway = listInputTensorPerSubs[subPath_i]
             
             pwNKerns = nkernsSubsampled[subPath_i]
             pwKernelDims = kernelDimensionsSubsampled
@@ -910,12 +1090,11 @@ class Cnn3d(object):
 #             print('inputToPathwayShapeTrain',inputToPathwayShapeTrain,inputToPathwayShapeVal,inputToPathwayShapeTest)
 #             print('dimsOfOutputFrom1stPathwayTrain',dimsOfOutputFrom1stPathwayTrain,dimsOfOutputFrom1stPathwayVal,dimsOfOutputFrom1stPathwayTest)
             thisPathway.makeLayersAndReturnDimsOfOutputFM(myLogger,
-                                                                     inputToPathwayTrain,
-                                                                     inputToPathwayVal,
-                                                                     inputToPathwayTest,
+                                                                     inputToPathway,
                                                                      inputToPathwayShapeTrain,
                                                                      inputToPathwayShapeVal,
                                                                      inputToPathwayShapeTest,
+                                                                     isTrainingFlag,
                                                                      pwNKerns,
                                                                      pwKernelDims,
                                                                      
@@ -929,7 +1108,8 @@ class Cnn3d(object):
                                                                      
                                                             indicesOfLowerRankLayersPerPathway[pwType],
                                                             ranksOfLowerRankLayersForEachPathway[pwType],
-                                                            indicesOfLayersToConnectResidualsInOutput[pwType]
+                                                            indicesOfLayersToConnectResidualsInOutput[pwType],
+                                                            convolutionBackendSelector
                                                                      )
             # Skip connections to end of pathway.
             thisPathway.makeMultiscaleConnectionsForLayerType(\
@@ -939,24 +1119,19 @@ class Cnn3d(object):
             thisPathway.upsampleOutputToNormalRes(upsamplingScheme="repeat",
                                                   shapeToMatchInRczTrain=dimsOfOutputFrom1stPathwayTrain,
                                                   shapeToMatchInRczVal=dimsOfOutputFrom1stPathwayVal,
-                                                  shapeToMatchInRczTest=dimsOfOutputFrom1stPathwayTest)
+                                                  shapeToMatchInRczTest=dimsOfOutputFrom1stPathwayTest,
+                                                  fmsToMatchInRcz=self.pathways[0].getOutput())
             
             
         #====================================CONCATENATE the output of the 2 cnn-pathways=============================
-        inputToFirstFcLayerTrain = None; inputToFirstFcLayerVal = None; 
-        inputToFirstFcLayerTest = None; numberOfFmsOfInputToFirstFcLayer = 0
+        inputToFirstFcLayer = None; numberOfFmsOfInputToFirstFcLayer = 0
         for path_i in xrange(len(self.pathways)) :
-            [outputNormResOfPathTrain, outputNormResOfPathVal, outputNormResOfPathTest] = \
-                                            self.pathways[path_i].getOutputAtNormalRes()
+            outputNormResOfPath = self.pathways[path_i].getOutputAtNormalRes()
             [dimsOfOutputNormResOfPathTrain, dimsOfOutputNormResOfPathVal, dimsOfOutputNormResOfPathTest] = \
                                                     self.pathways[path_i].getShapeOfOutputAtNormalRes()
             
-            inputToFirstFcLayerTrain =  T.concatenate([inputToFirstFcLayerTrain, outputNormResOfPathTrain], axis=1) if \
-                                                                        path_i <> 0 else outputNormResOfPathTrain
-            inputToFirstFcLayerVal = T.concatenate([inputToFirstFcLayerVal, outputNormResOfPathVal], axis=1) if \
-                                                                        path_i <> 0 else outputNormResOfPathVal
-            inputToFirstFcLayerTest = T.concatenate([inputToFirstFcLayerTest, outputNormResOfPathTest], axis=1) if \
-                                                                        path_i <> 0 else outputNormResOfPathTest
+            inputToFirstFcLayer = T.concatenate([inputToFirstFcLayer, outputNormResOfPath], axis=1) if \
+                                                                        path_i <> 0 else outputNormResOfPath
             numberOfFmsOfInputToFirstFcLayer += dimsOfOutputNormResOfPathTrain[1]
             
         #======================= Make the Fully Connected Layers =======================
@@ -976,9 +1151,7 @@ class Cnn3d(object):
                         str(firstFcLayerAfterConcatKernelShape))
         myLogger.print3("DEBUG: Input to the FC Pathway will be padded by that many voxels per dimension: " + \
                         str(voxelsToPadPerDim))
-        inputToPathwayTrain = padImgWithMirror(inputToFirstFcLayerTrain, voxelsToPadPerDim)
-        inputToPathwayVal = padImgWithMirror(inputToFirstFcLayerVal, voxelsToPadPerDim)
-        inputToPathwayTest = padImgWithMirror(inputToFirstFcLayerTest, voxelsToPadPerDim)
+        inputToPathway = padImgWithMirror(inputToFirstFcLayer, voxelsToPadPerDim)
         inputToPathwayShapeTrain = [self.batchSize, numberOfFmsOfInputToFirstFcLayer] + \
                                             dimsOfOutputFrom1stPathwayTrain[2:5]
         inputToPathwayShapeVal = [self.batchSizeValidation, numberOfFmsOfInputToFirstFcLayer] + \
@@ -1004,12 +1177,11 @@ class Cnn3d(object):
                 actFuncToUseRelu0orPrelu1  # To not apply activation on raw input. -1 is linear activation.
         
         thisPathway.makeLayersAndReturnDimsOfOutputFM(myLogger,
-                                                                         inputToPathwayTrain,
-                                                                         inputToPathwayVal,
-                                                                         inputToPathwayTest,
+                                                                         inputToPathway,
                                                                          inputToPathwayShapeTrain,
                                                                          inputToPathwayShapeVal,
                                                                          inputToPathwayShapeTest,
+                                                                         isTrainingFlag,
                                                                          
                                                                          pwNKerns,
                                                                          pwKernelDims,
@@ -1025,6 +1197,7 @@ class Cnn3d(object):
                                                                 indicesOfLowerRankLayersPerPathway[pwType],
                                                                 ranksOfLowerRankLayersForEachPathway[pwType],
                                                                 indicesOfLayersToConnectResidualsInOutput[pwType],
+                                                                convolutionBackendSelector
                                                                          )
         
         # =========== Make the final Target Layer (softmax, regression, whatever) ==========
@@ -1033,6 +1206,9 @@ class Cnn3d(object):
         self.finalTargetLayer = self._getClassificationLayer()
         self.finalTargetLayer.makeLayer(rng, self.getFcPathway().getLayer(-1), softmaxTemperature)
         
+        # Kept with the model, and in its checkpoints.
+        self.argumentsOfMakeCnnModel["chosenConvolutionBackendPerShape"] = convolutionBackendSelector.getChosenBackendPerShape()
+        
         myLogger.print3("Finished building the CNN's model.")
         
         
\ No newline at end of file
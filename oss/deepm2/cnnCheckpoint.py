@@ -0,0 +1,174 @@
+# Copyright (c) 2016, Konstantinos Kamnitsas
+# All rights reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the BSD license. See the accompanying LICENSE file
+# or read the terms at https://opensource.org/licenses/BSD-3-Clause.
+
+import os
+import json
+import threading
+import numpy as np
+
+from deepmedic.cnn3d import Cnn3d
+from deepmedic.cnnHelpers import dump_cnn_to_gzip_file_dotSave
+from deepmedic.genericHelpers import load_object_from_gzip_file
+from deepmedic.stageTimers import stageTimers
+
+# A checkpoint of a Cnn3d is two files. <prefix>.json has the version of the format, the arguments of make_cnn_model() \
+# and the python attributes of the training state. <prefix>.npz has the values of all the shared variables of the \
+# model (parameters, BN statistics, state of the optimizer), uncompressed. Loading rebuilds the model from the \
+# arguments and then sets the values. So, unlike the pickles of dump_cnn_to_gzip_file_dotSave(), checkpoints do not \
+# depend on the layout of the classes. The pickles can still be loaded with load_cnn_from_file().
+
+CHECKPOINT_FORMAT_VERSION = 1
+EXTENSION_OF_METADATA = ".json"
+EXTENSION_OF_ARRAYS = ".npz"
+
+def _print(logger, string) :
+    if logger <> None :
+        logger.print3(string)
+    else :
+        print string
+
+def getPrefixOfCheckpoint(filepath) :
+    # The checkpoint can be given by the filepath of its .json, of its .npz, or by their common prefix.
+    for extension in [EXTENSION_OF_METADATA, EXTENSION_OF_ARRAYS] :
+        if filepath.endswith(extension) :
+            return filepath[:-len(extension)]
+    return filepath
+
+def isCheckpoint(filepath) :
+    return os.path.isfile(getPrefixOfCheckpoint(filepath) + EXTENSION_OF_METADATA)
+
+def _convertToJsonSerializable(obj) :
+    if hasattr(obj, "tolist") : # numpy arrays and scalars.
+        return obj.tolist()
+    raise TypeError("Object of type [" + str(type(obj)) + "] cannot be saved in the metadata of a checkpoint.")
+
+def _convertUnicodeToStr(obj) :
+    # json gives unicode strings. Theano and the rest of the code expect str.
+    if isinstance(obj, unicode) :
+        return str(obj)
+    if isinstance(obj, list) :
+        return [ _convertUnicodeToStr(element) for element in obj ]
+    if isinstance(obj, dict) :
+        return dict([ [_convertUnicodeToStr(key), _convertUnicodeToStr(value)] for [key, value] in obj.items() ])
+    return obj
+
+def getContentsOfCheckpoint(cnnInstance) :
+    # Returns [metadata, arrays]. The values are copied out of the model (and the GPU), so training can go on \
+    # while they are written. Requires a model made with make_cnn_model() after checkpoints were introduced.
+    metadata = { "formatVersion" : CHECKPOINT_FORMAT_VERSION,
+                 "cnnModelName" : cnnInstance.cnnModelName,
+                 "argumentsOfMakeCnnModel" : cnnInstance.argumentsOfMakeCnnModel,
+                 "trainingStateAttributes" : cnnInstance.getTrainingStateAttributes() }
+    arrays = dict([ [name, sharedVariable.get_value(borrow=False)] \
+                                        for [name, sharedVariable] in cnnInstance.getNamedSharedVariables() ])
+    return [metadata, arrays]
+
+def writeContentsOfCheckpoint(metadata, arrays, prefixOfCheckpoint) :
+    # Both files are written to temporary files and renamed when complete, the .json last. \
+    # So an interrupted save never leaves a checkpoint that looks complete but is not.
+    filepathOfTempFile = prefixOfCheckpoint + EXTENSION_OF_ARRAYS + ".tmp" + str(os.getpid())
+    f = open(filepathOfTempFile, "wb") # A file object, otherwise savez appends .npz to the name.
+    try :
+        np.savez(f, **arrays)
+    finally :
+        f.close()
+    os.rename(filepathOfTempFile, prefixOfCheckpoint + EXTENSION_OF_ARRAYS)
+
+    filepathOfTempFile = prefixOfCheckpoint + EXTENSION_OF_METADATA + ".tmp" + str(os.getpid())
+    f = open(filepathOfTempFile, "w")
+    try :
+        json.dump(metadata, f, indent=4, sort_keys=True, default=_convertToJsonSerializable)
+    finally :
+        f.close()
+    os.rename(filepathOfTempFile, prefixOfCheckpoint + EXTENSION_OF_METADATA)
+    return prefixOfCheckpoint + EXTENSION_OF_METADATA
+
+def canBeSavedAsCheckpoint(cnnInstance) :
+    # Models pickled before checkpoints were introduced do not know the arguments they were made with.
+    return getattr(cnnInstance, "argumentsOfMakeCnnModel", None) <> None
+
+def save_cnn_to_checkpoint(cnnInstance, filenameWithPathToSaveTo, logger=None) :
+    # Returns the filepath of the .json, which is the one to give for loading the model.
+    if not canBeSavedAsCheckpoint(cnnInstance) :
+        _print(logger, "WARN: The model was made before checkpoints were introduced. Saving it as a pickle instead.")
+        return dump_cnn_to_gzip_file_dotSave(cnnInstance, filenameWithPathToSaveTo, logger)
+    prefixOfCheckpoint = os.path.abspath(filenameWithPathToSaveTo + ".ckpt")
+    _print(logger, "Saving network to: " + prefixOfCheckpoint + EXTENSION_OF_METADATA)
+    [metadata, arrays] = getContentsOfCheckpoint(cnnInstance)
+    filepathOfCheckpoint = writeContentsOfCheckpoint(metadata, arrays, prefixOfCheckpoint)
+    _print(logger, "Model saved.")
+    return filepathOfCheckpoint
+
+class CheckpointSaverInBackground(object):
+    # Saves checkpoints in a background thread, so that training is not blocked while they are written. \
+    # Only the copy of the values out of the model is done by the caller. At most one save is pending: \
+    # A new save first waits for the previous one to be written.
+    def __init__(self, logger=None) :
+        self._logger = logger
+        self._thread = None
+
+    def _writeAndReport(self, metadata, arrays, prefixOfCheckpoint) :
+        try :
+            with stageTimers.timeStage("writingCheckpoint") :
+                writeContentsOfCheckpoint(metadata, arrays, prefixOfCheckpoint)
+            _print(self._logger, "Model saved to: " + prefixOfCheckpoint + EXTENSION_OF_METADATA)
+        except (IOError, OSError), e :
+            _print(self._logger, "ERROR: Saving the model to [" + prefixOfCheckpoint + EXTENSION_OF_METADATA + \
+                                 "] failed with: " + str(e))
+
+    def save(self, cnnInstance, filenameWithPathToSaveTo) :
+        # Returns the filepath the checkpoint will have. Falls back to a (blocking) pickle for old models.
+        if not canBeSavedAsCheckpoint(cnnInstance) :
+            return save_cnn_to_checkpoint(cnnInstance, filenameWithPathToSaveTo, self._logger)
+        self.waitForPendingSave()
+        prefixOfCheckpoint = os.path.abspath(filenameWithPathToSaveTo + ".ckpt")
+        _print(self._logger, "Saving network in the background to: " + prefixOfCheckpoint + EXTENSION_OF_METADATA)
+        [metadata, arrays] = getContentsOfCheckpoint(cnnInstance)
+        self._thread = threading.Thread(target=self._writeAndReport, args=(metadata, arrays, prefixOfCheckpoint))
+        self._thread.start() # Not daemon: The process does not exit before the checkpoint is written.
+        return prefixOfCheckpoint + EXTENSION_OF_METADATA
+
+    def waitForPendingSave(self) :
+        if self._thread <> None :
+            self._thread.join()
+            self._thread = None
+
+def load_cnn_from_checkpoint(filepath, myLogger) :
+    prefixOfCheckpoint = getPrefixOfCheckpoint(filepath)
+    f = open(prefixOfCheckpoint + EXTENSION_OF_METADATA, "r")
+    try :
+        metadata = _convertUnicodeToStr(json.load(f))
+    finally :
+        f.close()
+    if metadata["formatVersion"] > CHECKPOINT_FORMAT_VERSION :
+        myLogger.print3("ERROR: The checkpoint [" + prefixOfCheckpoint + EXTENSION_OF_METADATA + "] has format version [" + \
+                        str(metadata["formatVersion"]) + "], newer than the supported [" + \
+                        str(CHECKPOINT_FORMAT_VERSION) + "]. Exiting!"); exit(1)
+
+    cnnInstance = Cnn3d()
+    cnnInstance.make_cnn_model(myLogger, **metadata["argumentsOfMakeCnnModel"])
+    cnnInstance.setTrainingStateAttributes(myLogger, metadata["trainingStateAttributes"])
+
+    arrays = np.load(prefixOfCheckpoint + EXTENSION_OF_ARRAYS)
+    try :
+        namedSharedVariables = cnnInstance.getNamedSharedVariables()
+        namesMissing = [ name for [name, sharedVariable] in namedSharedVariables if name not in arrays.files ]
+        if len(namesMissing) > 0 :
+            myLogger.print3("ERROR: The checkpoint [" + prefixOfCheckpoint + EXTENSION_OF_ARRAYS + "] does not have " + \
+                            "values for the variables: " + str(namesMissing) + ". Exiting!"); exit(1)
+        for [name, sharedVariable] in namedSharedVariables :
+            sharedVariable.set_value(arrays[name])
+    finally :
+        arrays.close()
+    return cnnInstance
+
+def load_cnn_from_file(filepath, myLogger) :
+    # A checkpoint (given by its .json, .npz or prefix), or a model pickled by dump_cnn_to_gzip_file_dotSave().
+    if isCheckpoint(filepath) :
+        return load_cnn_from_checkpoint(filepath, myLogger)
+    return load_object_from_gzip_file(filepath)
+
@@ -58,6 +58,11 @@ def dump_cnn_to_gzip_file_dotSave(cnnInstance, filenameWithPathToSaveTo, logger=
     compiledFunctionVal = cnnInstance.cnnValidateModel; cnnInstance.cnnValidateModel = ""
     compiledFunctionTest = cnnInstance.cnnTestModel; cnnInstance.cnnTestModel = ""
     compiledFunctionVisualise = cnnInstance.cnnVisualiseFmFunction; cnnInstance.cnnVisualiseFmFunction = ""
+    compiledFunctionTestAndVisualiseAllFms = getattr(cnnInstance, "cnnTestAndVisualiseAllFmsFunction", "")
+    cnnInstance.cnnTestAndVisualiseAllFmsFunction = ""
+    # Models saved before streaming was added do not have these.
+    compiledFunctionsLoadBatchInSlot = getattr(cnnInstance, "cnnLoadBatchInSlotFunctionTrainVal", ["", ""])
+    cnnInstance.cnnLoadBatchInSlotFunctionTrainVal = ["", ""]
     
     if logger <> None :
         logger.print3("Saving network to: "+str(filenameWithPathToSaveToDotSave))
@@ -76,6 +81,8 @@ def dump_cnn_to_gzip_file_dotSave(cnnInstance, filenameWithPathToSaveTo, logger=
     cnnInstance.cnnValidateModel = compiledFunctionVal
     cnnInstance.cnnTestModel = compiledFunctionTest
     cnnInstance.cnnVisualiseFmFunction = compiledFunctionVisualise
+    cnnInstance.cnnTestAndVisualiseAllFmsFunction = compiledFunctionTestAndVisualiseAllFms
+    cnnInstance.cnnLoadBatchInSlotFunctionTrainVal = compiledFunctionsLoadBatchInSlot
     
     return filenameWithPathToSaveToDotSave
 
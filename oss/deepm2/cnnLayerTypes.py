@@ -13,36 +13,37 @@ import theano
 import theano.tensor as T
 
 from theano.tensor.nnet import conv
-import theano.tensor.nnet.conv3d2d #conv3d2d fixed in bleeding edge version of theano.
 
 
 from sys import maxint as MAX_INT
 
 from deepmedic.maxPoolingModule import myMaxPooling3d
+from deepmedic.convolutionBackends import convolve3d, getShapeOfOutputOfConvolution
 
 ###############################################################
 # Functions used by layers but do not change Layer Attributes #
 ###############################################################
 
-def applyDropout(rng, dropoutRate, inputTrainShape, inputTrain, inputInference, inputTesting) :
+def applyDropout(rng, dropoutRate, inputToDropout, isTrainingFlag) :
+    # isTrainingFlag: Symbolic int8 scalar of the model. Given as constant 1 by the training function and 0 by the \
+    # others, so that each keeps only its branch. The mask is made only by the training function.
     #Below 0.001 I take it as if there is no dropout at all. 
     #(To avoid float problems with == 0.0. Although my tries show it actually works fine.)
     if dropoutRate > 0.001 : 
         probabilityOfStayingActivated = (1-dropoutRate)
         srng = T.shared_randomstreams.RandomStreams(rng.randint(999999))
-        dropoutMask = srng.binomial(n=1, size=inputTrainShape, p=probabilityOfStayingActivated, \
+        dropoutMask = srng.binomial(n=1, size=inputToDropout.shape, p=probabilityOfStayingActivated, \
                                     dtype=theano.config.floatX)
-        inputImgAfterDropout = inputTrain * dropoutMask
-        inputImgAfterDropoutInference = inputInference * probabilityOfStayingActivated
-        inputImgAfterDropoutTesting = inputTesting * probabilityOfStayingActivated
+        inputImgAfterDropout = T.switch(isTrainingFlag, inputToDropout * dropoutMask,
+                                        inputToDropout * probabilityOfStayingActivated)
     else :
-        inputImgAfterDropout = inputTrain
-        inputImgAfterDropoutInference = inputInference
-        inputImgAfterDropoutTesting = inputTesting
-    return (inputImgAfterDropout, inputImgAfterDropoutInference, inputImgAfterDropoutTesting)
+        inputImgAfterDropout = inputToDropout
+    return inputImgAfterDropout
 
 
-def applyBn(rollingAverageForBNOverThatManyBatches, inputTrain, inputVal, inputTest, inputShapeTrain) :
+def applyBn(rollingAverageForBNOverThatManyBatches, inputToBn, inputShapeTrain, isTrainingFlag) :
+    # isTrainingFlag: As in applyDropout(). Training normalizes with the statistics of the batch, the others with \
+    # the rolling average.
     numberOfChannels = inputShapeTrain[1]
     
     gBn_values = np.ones( (numberOfChannels), dtype = 'float32' )
@@ -55,18 +56,16 @@ def applyBn(rollingAverageForBNOverThatManyBatches, inputTrain, inputVal, inputT
                                                            numberOfChannels), dtype = 'float32' ), borrow=True)
     varBnsArrayForRollingAverage = theano.shared(np.ones( (rollingAverageForBNOverThatManyBatches, \
                                                            numberOfChannels), dtype = 'float32' ), borrow=True)
-    sharedNewMu_B = theano.shared(np.zeros( (numberOfChannels), dtype = 'float32'), borrow=True)
-    sharedNewVar_B = theano.shared(np.ones( (numberOfChannels), dtype = 'float32'), borrow=True)
     
     e1 = np.finfo(np.float32).tiny 
     #WARN, PROBLEM, THEANO BUG. The below was returning (True,) instead of a vector, 
     #if I have only 1 FM. (Vector is (False,)). Think I corrected this bug.
-    mu_B = inputTrain.mean(axis=[0,2,3,4]) #average over all axis but the 2nd, which is the FM axis.
+    mu_B = inputToBn.mean(axis=[0,2,3,4]) #average over all axis but the 2nd, which is the FM axis.
     #The above was returning a broadcastable (True,) tensor when FM-number=1. Here I make it a broadcastable (False,), 
-    #which is the "vector" type. This is the same type with the sharedNewMu_B, which we are updating with this. 
+    #which is the "vector" type. This is the same type with the rows of the rolling-average array, written with this. 
     #They need to be of the same type.
     mu_B = T.unbroadcast(mu_B, (0)) 
-    var_B = inputTrain.var(axis=[0,2,3,4])
+    var_B = inputToBn.var(axis=[0,2,3,4])
     var_B = T.unbroadcast(var_B, (0))
     var_B_plusE = var_B + e1
     
@@ -78,70 +77,50 @@ def applyBn(rollingAverageForBNOverThatManyBatches, inputTrain, inputVal, inputT
     var_RollingAverage_plusE = var_RollingAverage + e1
     
     #OUTPUT FOR TRAINING
-    normXi_train = (inputTrain - \
+    normXi_train = (inputToBn - \
                     mu_B.dimshuffle('x', 0, 'x', 'x', 'x')) /  T.sqrt(var_B_plusE.dimshuffle('x', 0, 'x', 'x', 'x')) 
-    # dimshuffle makes b broadcastable.
-    normYi_train = gBn.dimshuffle('x', 0, 'x', 'x', 'x') * normXi_train + bBn.dimshuffle('x', 0, 'x', 'x', 'x') 
-    #OUTPUT FOR VALIDATION
-    normXi_val = (inputVal - mu_RollingAverage.dimshuffle('x', 0, 'x', 'x', 'x')) /  \
-                    T.sqrt(var_RollingAverage_plusE.dimshuffle('x', 0, 'x', 'x', 'x')) 
-    normYi_val = gBn.dimshuffle('x', 0, 'x', 'x', 'x') * normXi_val + bBn.dimshuffle('x', 0, 'x', 'x', 'x')
-    #OUTPUT FOR TESTING
-    normXi_test = (inputTest - mu_RollingAverage.dimshuffle('x', 0, 'x', 'x', 'x')) /  \
+    #OUTPUT FOR VALIDATION AND TESTING
+    normXi_inference = (inputToBn - mu_RollingAverage.dimshuffle('x', 0, 'x', 'x', 'x')) /  \
                     T.sqrt(var_RollingAverage_plusE.dimshuffle('x', 0, 'x', 'x', 'x')) 
-    normYi_test = gBn.dimshuffle('x', 0, 'x', 'x', 'x') * normXi_test + bBn.dimshuffle('x', 0, 'x', 'x', 'x')
+    normXi = T.switch(isTrainingFlag, normXi_train, normXi_inference)
+    # dimshuffle makes b broadcastable.
+    normYi = gBn.dimshuffle('x', 0, 'x', 'x', 'x') * normXi + bBn.dimshuffle('x', 0, 'x', 'x', 'x') 
     
-    return (normYi_train,
-            normYi_val,
-            normYi_test,
+    return (normYi,
             gBn,
             bBn,
             # For rolling average
             muBnsArrayForRollingAverage,
             varBnsArrayForRollingAverage,
-            sharedNewMu_B,
-            sharedNewVar_B,
             # this is the current value of muB calculated in this training iteration. 
-            #It will be saved in the "sharedNewMu_B" (update), in order to be used for updating the rolling average. 
-            #Something could be simplified here.
+            #The training function writes it in the rolling-average array (update).
             mu_B, 
             var_B
             )
     
     
-def makeBiasParamsAndApplyToFms( fmsTrain, fmsVal, fmsTest, numberOfFms ) :
+def makeBiasParamsAndApplyToFms( fms, numberOfFms ) :
     b_values = np.zeros( (numberOfFms), dtype = 'float32')
     b = theano.shared(value=b_values, borrow=True)
-    fmsWithBiasAppliedTrain = fmsTrain + b.dimshuffle('x', 0, 'x', 'x', 'x')
-    fmsWithBiasAppliedVal = fmsVal + b.dimshuffle('x', 0, 'x', 'x', 'x')
-    fmsWithBiasAppliedTest = fmsTest + b.dimshuffle('x', 0, 'x', 'x', 'x')
-    return (b, fmsWithBiasAppliedTrain, fmsWithBiasAppliedVal, fmsWithBiasAppliedTest)
+    fmsWithBiasApplied = fms + b.dimshuffle('x', 0, 'x', 'x', 'x')
+    return (b, fmsWithBiasApplied)
 
-def applyRelu(inputTrain, inputVal, inputTest):
+def applyRelu(inputToRelu):
     #input is a tensor of shape (batchSize, FMs, r, c, z)
-    outputTrain= T.maximum(0, inputTrain)
-    outputVal = T.maximum(0, inputVal)
-    outputTest = T.maximum(0, inputTest)
-    return ( outputTrain, outputVal, outputTest )
+    return T.maximum(0, inputToRelu)
 
-def applyPrelu( inputTrain, inputVal, inputTest, numberOfInputChannels ) :
+def applyPrelu( inputToPrelu, numberOfInputChannels ) :
     #input is a tensor of shape (batchSize, FMs, r, c, z)
     #"Delving deep into rectifiers" initializes it like this. LeakyRelus are at 0.01
     aPreluValues = np.ones( (numberOfInputChannels), dtype = 'float32' )*0.01 
     aPrelu = theano.shared(value=aPreluValues, borrow=True) #One separate a (activation) per feature map.
     aPreluBroadCastedForMultiplWithChannels = aPrelu.dimshuffle('x', 0, 'x', 'x', 'x')
     
-    posTrain = T.maximum(0, inputTrain)
-    negTrain = aPreluBroadCastedForMultiplWithChannels * (inputTrain - abs(inputTrain)) * 0.5
-    outputTrain = posTrain + negTrain
-    posVal = T.maximum(0, inputVal)
-    negVal = aPreluBroadCastedForMultiplWithChannels * (inputVal - abs(inputVal)) * 0.5
-    outputVal = posVal + negVal
-    posTest = T.maximum(0, inputTest)
-    negTest = aPreluBroadCastedForMultiplWithChannels * (inputTest - abs(inputTest)) * 0.5
-    outputTest = posTest + negTest
+    pos = T.maximum(0, inputToPrelu)
+    neg = aPreluBroadCastedForMultiplWithChannels * (inputToPrelu - abs(inputToPrelu)) * 0.5
+    output = pos + neg
     
-    return ( aPrelu, outputTrain, outputVal, outputTest )
+    return ( aPrelu, output )
 
 def createAndInitializeWeightsTensor(filterShape, initializationTechniqueClassic0orDelvingInto1, rng) :
     # filterShape of dimensions: [#FMs in this layer, #FMs in input, rKernelDim, cKernelDim, zKernelDim]
@@ -162,80 +141,31 @@ def createAndInitializeWeightsTensor(filterShape, initializationTechniqueClassic
     # W shape: [#FMs of this layer, #FMs of Input, rKernFims, cKernDims, zKernDims]
     return W
 
-def convolveWithGivenWeightMatrix(W, filterShape, inputToConvTrain, inputToConvVal, inputToConvTest, \
-                                  inputToConvShapeTrain, inputToConvShapeVal, inputToConvShapeTest) :
+def convolveWithGivenWeightMatrix(W, filterShape, inputToConv, \
+                                  inputToConvShapeTrain, inputToConvShapeVal, inputToConvShapeTest, \
+                                  convolutionBackendSelector=None) :
     # input weight matrix W has shape: 
     #[ Number of filters (outputFMs), number of input channels, rKernelDim, cKernelDim, zKernelDim ] == filterShape
     # filterShape is the shape of W.
-    
-    # Conv3d2d requires in in shape: 
-    #[Number_of_output_filters, zKernelDim, Numb_of_input_Channels, rKernelDim, cKernelDim]
-    wReshapedForConv = W.dimshuffle(0,4,1,2,3)
-    wReshapedForConvShape = (filterShape[0], filterShape[4], filterShape[1], filterShape[2], filterShape[3])
-    
-    #Reshape image for what conv3d2d needs:
-    inputToConvReshapedTrain = inputToConvTrain.dimshuffle(0, 4, 1, 2, 3)
-    # batch_size, time, num_of_input_channels, rows, columns
-    inputToConvReshapedShapeTrain = (inputToConvShapeTrain[0], inputToConvShapeTrain[4], inputToConvShapeTrain[1], \
-                                     inputToConvShapeTrain[2], inputToConvShapeTrain[3]) 
-    outputOfConvTrain = \
-        T.nnet.conv3d2d.conv3d(signals = inputToConvReshapedTrain, # batch_size, time, num_of_input_channels, rows, columns
-                                  filters = wReshapedForConv, # Number_of_output_filters, Z, Numb_of_input_Channels, r, c
-                                  signals_shape = inputToConvReshapedShapeTrain,
-                                  filters_shape = wReshapedForConvShape,
-                                  border_mode = 'valid')
-    #Output is in the shape of the input image (signals_shape).
-    
-    #Validation
-    inputToConvReshapedVal = inputToConvVal.dimshuffle(0, 4, 1, 2, 3)
-    inputToConvReshapedShapeVal = (inputToConvShapeVal[0], inputToConvShapeVal[4], inputToConvShapeVal[1], \
-                                   inputToConvShapeVal[2], inputToConvShapeVal[3])
-    outputOfConvVal = \
-        T.nnet.conv3d2d.conv3d(signals = inputToConvReshapedVal, # batch_size, time, num_of_input_channels, rows, columns
-         filters = wReshapedForConv, # Number_of_output_filters, Time, Numb_of_input_Channels, Height/rows, Width/columns
-                                  signals_shape = inputToConvReshapedShapeVal,
-                                  filters_shape = wReshapedForConvShape,
-                                  border_mode = 'valid')
-    #Testing
-    inputToConvReshapedTest = inputToConvTest.dimshuffle(0, 4, 1, 2, 3)
-    inputToConvReshapedShapeTest = (inputToConvShapeTest[0], inputToConvShapeTest[4], inputToConvShapeTest[1], \
-                                    inputToConvShapeTest[2], inputToConvShapeTest[3])
-    outputOfConvTest = \
-        T.nnet.conv3d2d.conv3d(signals = inputToConvReshapedTest, # batch_size, time, num_of_input_channels, rows, columns
-          filters = wReshapedForConv, # Number_of_output_filters, Time, Numb_of_input_Channels, Height/rows, Width/columns
-                                  signals_shape = inputToConvReshapedShapeTest,
-                                  filters_shape = wReshapedForConvShape,
-                                  border_mode = 'valid')
-    
-    #reshape the result, to have the dimensions as the input image: [BatchSize, #FMsInThisLayer, r, c, z]
-    outputTrain = outputOfConvTrain.dimshuffle(0, 2, 3, 4, 1) 
-    outputVal = outputOfConvVal.dimshuffle(0, 2, 3, 4, 1)
-    outputTest = outputOfConvTest.dimshuffle(0, 2, 3, 4, 1)
-    
-    outputShapeTrain = [inputToConvShapeTrain[0],
-                        filterShape[0],
-                        inputToConvShapeTrain[2]-filterShape[2]+1,
-                        inputToConvShapeTrain[3]-filterShape[3]+1,
-                        inputToConvShapeTrain[4]-filterShape[4]+1]
-    outputShapeVal = [  inputToConvShapeVal[0],
-                        filterShape[0],
-                        inputToConvShapeVal[2]-filterShape[2]+1,
-                        inputToConvShapeVal[3]-filterShape[3]+1,
-                        inputToConvShapeVal[4]-filterShape[4]+1]
-    outputShapeTest = [ inputToConvShapeTest[0],
-                        filterShape[0],
-                        inputToConvShapeTest[2]-filterShape[2]+1,
-                        inputToConvShapeTest[3]-filterShape[3]+1,
-                        inputToConvShapeTest[4]-filterShape[4]+1]
-    
-    return (outputTrain, outputVal, outputTest, outputShapeTrain, outputShapeVal, outputShapeTest)
+    # The shapes of the input are those it has in training, validation and testing. The graph serves all.
+    # convolutionBackendSelector: Gives the backend per layer (see convolutionBackends.py). If None, conv3d2d.
+    
+    backend = convolutionBackendSelector.getBackend([ [inputToConvShapeTrain, True], [inputToConvShapeVal, False],
+                                                      [inputToConvShapeTest, False] ], filterShape) if \
+                convolutionBackendSelector <> None else "conv3d2d"
+    output = convolve3d(backend, inputToConv, W, filterShape)
+    
+    return (output,
+            getShapeOfOutputOfConvolution(inputToConvShapeTrain, filterShape),
+            getShapeOfOutputOfConvolution(inputToConvShapeVal, filterShape),
+            getShapeOfOutputOfConvolution(inputToConvShapeTest, filterShape))
 
 def checkDimsOfYpredAndYEqual(y, yPred, stringTrainOrVal) :
     if y.ndim != yPred.ndim:
         raise TypeError( "ERROR! y did not have the same shape as y_pred during " + stringTrainOrVal,
                         ('y', y.type, 'y_pred', yPred.type) )
         
-def applySoftmaxToFmAndReturnProbYandPredY( inputToSoftmax, inputToSoftmaxShape, numberOfOutputClasses, softmaxTemperature):
+def applySoftmaxToFmAndReturnProbYandPredY( inputToSoftmax, numberOfOutputClasses, softmaxTemperature):
     # The softmax function works on 2D tensors (matrices). It computes the softmax for each row. 
     # Rows are independent, eg different samples in the batch. Columns are the input features, eg class-scores.
     # Softmax's input 2D matrix should have shape like: [ datasamples, #Classess ]
@@ -250,6 +180,8 @@ def applySoftmaxToFmAndReturnProbYandPredY( inputToSoftmax, inputToSoftmaxShape,
     # flatten is "Row-major" 'C' style. ie, starts from index [0,0,0] and 
     #grabs elements in order such that last dim index increases first and first index increases last. 
     # (first row flattened, then second follows, etc)
+    # The shape is symbolic, so the graph serves any batch size and dims.
+    inputToSoftmaxShape = T.shape(inputToSoftmax)
     numberOfVoxelsDenselyClassified = inputToSoftmaxShape[2]*inputToSoftmaxShape[3]*inputToSoftmaxShape[4]
     firstDimOfInputToSoftmax2d = inputToSoftmaxShape[0]*numberOfVoxelsDenselyClassified # batchSize*r*c*z.
     # Reshape works in "Row-major", ie 'C' style too.
@@ -258,7 +190,7 @@ def applySoftmaxToFmAndReturnProbYandPredY( inputToSoftmax, inputToSoftmaxShape,
     p_y_given_x_2d = T.nnet.softmax(inputToSoftmax2d/softmaxTemperature)
     #Result: batchSize, R,C,Z, Classes.
     p_y_given_x_classMinor = p_y_given_x_2d.reshape((inputToSoftmaxShape[0], inputToSoftmaxShape[2], \
-                                                     inputToSoftmaxShape[3], inputToSoftmaxShape[4], inputToSoftmaxShape[1])) 
+                                                     inputToSoftmaxShape[3], inputToSoftmaxShape[4], numberOfOutputClasses)) 
     p_y_given_x = p_y_given_x_classMinor.dimshuffle(0,4,1,2,3) #Result: batchSize, Class, R, C, Z
     
     # Classification (EM) for each voxel
@@ -277,9 +209,9 @@ class Block(object):
     
     def __init__(self) :
         # === Input to the layer ===
-        self.inputTrain = None
-        self.inputVal = None
-        self.inputTest = None
+        # One symbolic input and output, of the one graph that the training, validation and testing functions share. \
+        # Their shapes are symbolic. The shapes each function uses them with are kept per function.
+        self.input = None
         self.inputShapeTrain = None
         self.inputShapeVal = None
         self.inputShapeTest = None
@@ -302,39 +234,30 @@ class Block(object):
         self._gBn = None # ONLY WHEN BN is applied
         self._aPrelu = None # ONLY WHEN PreLu
         
-        # ONLY WHEN BN! All of these are for the rolling average! If I fix this, only 2 will remain!
+        # ONLY WHEN BN! All of these are for the rolling average!
         self._muBnsArrayForRollingAverage = None # Array
         self._varBnsArrayForRollingAverage = None # Arrays
         self._rollingAverageForBatchNormalizationOverThatManyBatches = None
-        self._indexWhereRollingAverageIs = 0 #Index in the rolling-average matrices of the layers, \
-        #of the entry to update in the next batch.
-        self._sharedNewMu_B = None # last value shared, to update the rolling average array.
-        self._sharedNewVar_B = None
-        self._newMu_B = None # last value tensor, to update the corresponding shared.
+        self._sharedIndexWhereRollingAverageIs = None #Index in the rolling-average matrices of the layers, \
+        #of the entry to update in the next batch. Shared, to be updated by the training function.
+        self._newMu_B = None # last value tensor, written in the rolling average array by the training function.
         self._newVar_B = None
         
         
         # === Output of the block ===
-        self.outputTrain = None
-        self.outputVal = None
-        self.outputTest = None
+        self.output = None
         self.outputShapeTrain = None
         self.outputShapeVal = None
         self.outputShapeTest = None
         # New and probably temporary, for the residual connections to be "visible".
-        self.outputAfterResidualConnIfAnyAtOutpTrain = None
-        self.outputAfterResidualConnIfAnyAtOutpVal = None
-        self.outputAfterResidualConnIfAnyAtOutpTest = None
+        self.outputAfterResidualConnIfAnyAtOutp = None
         
         # ==== Target Block Connected to that layer (softmax, regression, auxiliary loss etc), if any ======
         self.targetBlock = None
         
     # Setters
-    def _setBlocksInputAttributes(self, inputToLayerTrain, inputToLayerVal, inputToLayerTest, inputToLayerShapeTrain, \
-                                  inputToLayerShapeVal, inputToLayerShapeTest) :
-        self.inputTrain = inputToLayerTrain
-        self.inputVal = inputToLayerVal
-        self.inputTest = inputToLayerTest
+    def _setBlocksInputAttributes(self, inputToLayer, inputToLayerShapeTrain, inputToLayerShapeVal, inputToLayerShapeTest) :
+        self.input = inputToLayer
         self.inputShapeTrain = inputToLayerShapeTrain
         self.inputShapeVal = inputToLayerShapeVal
         self.inputShapeTest = inputToLayerShapeTest
@@ -344,18 +267,13 @@ class Block(object):
         assert self.inputShapeTrain[1] == filterShape[1]
         self._poolingParameters = poolingParameters
         
-    def _setBlocksOutputAttributes(self, outputTrain, outputVal, outputTest, outputShapeTrain, \
-                                   outputShapeVal, outputShapeTest) :
-        self.outputTrain = outputTrain
-        self.outputVal = outputVal
-        self.outputTest = outputTest
+    def _setBlocksOutputAttributes(self, output, outputShapeTrain, outputShapeVal, outputShapeTest) :
+        self.output = output
         self.outputShapeTrain = outputShapeTrain
         self.outputShapeVal = outputShapeVal
         self.outputShapeTest = outputShapeTest
         # New and probably temporary, for the residual connections to be "visible".
-        self.outputAfterResidualConnIfAnyAtOutpTrain = self.outputTrain
-        self.outputAfterResidualConnIfAnyAtOutpVal = self.outputVal
-        self.outputAfterResidualConnIfAnyAtOutpTest = self.outputTest
+        self.outputAfterResidualConnIfAnyAtOutp = self.output
         
     def setTargetBlock(self, targetBlockInstance):
         # targetBlockInstance : eg softmax layer. Future: Regression layer, or other auxiliary classifiers.
@@ -364,8 +282,10 @@ class Block(object):
     def getNumberOfFeatureMaps(self):
         return self._numberOfFeatureMaps
     def fmsActivations(self, indices_of_fms_in_layer_to_visualise_from_to_exclusive) :
-        return self.outputTest[:, indices_of_fms_in_layer_to_visualise_from_to_exclusive[0] : \
-                               indices_of_fms_in_layer_to_visualise_from_to_exclusive[1], :, :, :]
+        # Models pickled before the graph was shared by training, validation and testing have an output per function.
+        output = self.output if hasattr(self, "output") else self.outputTest
+        return output[:, indices_of_fms_in_layer_to_visualise_from_to_exclusive[0] : \
+                          indices_of_fms_in_layer_to_visualise_from_to_exclusive[1], :, :, :]
     
     # Other API
     def getL1RegCost(self) : #Called for L1 weigths regularisation
@@ -378,28 +298,41 @@ class Block(object):
         else :
             return self.params + self.targetBlock.getTrainableParams()
         
-    def updateTheMatricesWithTheLastMusAndVarsForTheRollingAverageOfBNInference(self):
-        # This function should be erazed when I reimplement the Rolling average.
-        if self._appliedBnInLayer :
-            muArrayValue = self._muBnsArrayForRollingAverage.get_value()
-            muArrayValue[self._indexWhereRollingAverageIs] = self._sharedNewMu_B.get_value()
-            self._muBnsArrayForRollingAverage.set_value(muArrayValue, borrow=True)
-            
-            varArrayValue = self._varBnsArrayForRollingAverage.get_value()
-            varArrayValue[self._indexWhereRollingAverageIs] = self._sharedNewVar_B.get_value()
-            self._varBnsArrayForRollingAverage.set_value(varArrayValue, borrow=True)
-            self._indexWhereRollingAverageIs = \
-                (self._indexWhereRollingAverageIs + 1) % self._rollingAverageForBatchNormalizationOverThatManyBatches
-            
-    def getUpdatesForBnRollingAverage(self) :
-        # This function or something similar should stay, even if I clean the BN rolling average.
+    def getNamedSharedVariables(self, prefixOfNames) :
+        # [[name, sharedVariable], ...] of the parameters and the BN statistics of the block. For checkpoints.
+        namedSharedVariables = [ [prefixOfNames + "param" + str(param_i), self.params[param_i]] \
+                                                                    for param_i in xrange(len(self.params)) ]
         if self._appliedBnInLayer :
-            #CAREFUL: WARN, PROBLEM, THEANO BUG! If a layer has only 1FM, 
-            #the .newMu_B ends up being of type (true,) instead of vector!!! Error!!!
-            return [(self._sharedNewMu_B, self._newMu_B),
-                    (self._sharedNewVar_B, self._newVar_B) ]
-        else :
+            namedSharedVariables += [ [prefixOfNames + "muBnsArrayForRollingAverage", self._muBnsArrayForRollingAverage],
+                                      [prefixOfNames + "varBnsArrayForRollingAverage", self._varBnsArrayForRollingAverage],
+                                      [prefixOfNames + "indexWhereRollingAverageIs", self._getSharedIndexWhereRollingAverageIs()] ]
+        return namedSharedVariables
+    
+    def _getSharedIndexWhereRollingAverageIs(self) :
+        # Made at the first compilation of a training function. Models saved before it kept the index in python.
+        if getattr(self, "_sharedIndexWhereRollingAverageIs", None) is None :
+            self._sharedIndexWhereRollingAverageIs = theano.shared(np.int32(getattr(self, "_indexWhereRollingAverageIs", 0)))
+        return self._sharedIndexWhereRollingAverageIs
+    
+    def getUpdatesForBnRollingAverage(self, momentumOfExponentialMovingAverageForBn=None) :
+        # Updates of the training function, that write the mu and var of the batch in the matrices for inference.
+        # Default: Circular write in the next row of the matrices, whose mean is the rolling average over their length.
+        # If momentumOfExponentialMovingAverageForBn is given, all rows become the exponential moving average \
+        # instead (m*previous + (1-m)*new). The inference graph takes the mean over the rows, so it is the same for both.
+        if not self._appliedBnInLayer :
             return []
+        #CAREFUL: WARN, PROBLEM, THEANO BUG! If a layer has only 1FM, 
+        #the .newMu_B ends up being of type (true,) instead of vector!!! Error!!!
+        if momentumOfExponentialMovingAverageForBn <> None :
+            m = momentumOfExponentialMovingAverageForBn
+            return [(self._muBnsArrayForRollingAverage, T.cast(
+                        m * self._muBnsArrayForRollingAverage + (1 - m) * self._newMu_B.dimshuffle('x', 0), 'float32')),
+                    (self._varBnsArrayForRollingAverage, T.cast(
+                        m * self._varBnsArrayForRollingAverage + (1 - m) * self._newVar_B.dimshuffle('x', 0), 'float32')) ]
+        index = self._getSharedIndexWhereRollingAverageIs()
+        return [(self._muBnsArrayForRollingAverage, T.set_subtensor(self._muBnsArrayForRollingAverage[index], self._newMu_B)),
+                (self._varBnsArrayForRollingAverage, T.set_subtensor(self._varBnsArrayForRollingAverage[index], self._newVar_B)),
+                (index, (index + 1) % self._rollingAverageForBatchNormalizationOverThatManyBatches) ]
         
 class ConvLayer(Block):
     
@@ -409,12 +342,11 @@ class ConvLayer(Block):
         
     def _processInputWithBnNonLinearityDropoutPooling(self,
                 rng,
-                inputToLayerTrain,
-                inputToLayerVal,
-                inputToLayerTest,
+                inputToLayer,
                 inputToLayerShapeTrain,
                 inputToLayerShapeVal,
                 inputToLayerShapeTest,
+                isTrainingFlag,
                 useBnFlag, # Must be true to do BN. Used to not allow doing BN on first layers straight on image, 
                 # even if rollingAvForBnOverThayManyBatches > 0.
                 rollingAverageForBNOverThatManyBatches, #If this is <= 0, we are not using BatchNormalization, 
@@ -433,20 +365,15 @@ class ConvLayer(Block):
             self._appliedBnInLayer = True
             self._rollingAverageForBatchNormalizationOverThatManyBatches = \
                 rollingAverageForBNOverThatManyBatches
-            (inputToNonLinearityTrain,
-            inputToNonLinearityVal,
-            inputToNonLinearityTest,
+            (inputToNonLinearity,
             self._gBn,
             self._b,
             # For rolling average :
             self._muBnsArrayForRollingAverage,
             self._varBnsArrayForRollingAverage,
-            self._sharedNewMu_B,
-            self._sharedNewVar_B,
             self._newMu_B,
             self._newVar_B
-            ) = applyBn( rollingAverageForBNOverThatManyBatches, inputToLayerTrain, inputToLayerVal, \
-                         inputToLayerTest, inputToLayerShapeTrain)
+            ) = applyBn( rollingAverageForBNOverThatManyBatches, inputToLayer, inputToLayerShapeTrain, isTrainingFlag)
             self.params = self.params + [self._gBn, self._b]
         else : #Not using batch normalization
             self._appliedBnInLayer = False
@@ -454,10 +381,7 @@ class ConvLayer(Block):
             numberOfInputChannels = inputToLayerShapeTrain[1]
             
             (self._b,
-            inputToNonLinearityTrain,
-            inputToNonLinearityVal,
-            inputToNonLinearityTest) = makeBiasParamsAndApplyToFms( inputToLayerTrain, inputToLayerVal, \
-                                                                    inputToLayerTest, numberOfInputChannels )
+            inputToNonLinearity) = makeBiasParamsAndApplyToFms( inputToLayer, numberOfInputChannels )
             self.params = self.params + [self._b]
             
         #--------------------------------------------------------
@@ -466,52 +390,42 @@ class ConvLayer(Block):
         # -1 stands for "no nonlinearity". Used for input layers of the pathway.
         if activationFunctionToUseRelu0orPrelu1orMinus1ForLinear == -1 : 
             self._activationFunctionType = "linear"
-            ( inputToDropoutTrain, inputToDropoutVal, inputToDropoutTest ) = \
-                (inputToNonLinearityTrain, inputToNonLinearityVal, inputToNonLinearityTest)
+            inputToDropout = inputToNonLinearity
         elif activationFunctionToUseRelu0orPrelu1orMinus1ForLinear == 0 :
             #print "Layer: Activation function used = ReLu"
             self._activationFunctionType = "relu"
-            ( inputToDropoutTrain, inputToDropoutVal, inputToDropoutTest ) = \
-                applyRelu(inputToNonLinearityTrain, inputToNonLinearityVal, inputToNonLinearityTest)
+            inputToDropout = applyRelu(inputToNonLinearity)
         elif activationFunctionToUseRelu0orPrelu1orMinus1ForLinear == 1 :
             #print "Layer: Activation function used = PReLu"
             self._activationFunctionType = "prelu"
             numberOfInputChannels = inputToLayerShapeTrain[1]
-            ( self._aPrelu, inputToDropoutTrain, inputToDropoutVal, inputToDropoutTest ) = \
-                applyPrelu(inputToNonLinearityTrain, inputToNonLinearityVal, inputToNonLinearityTest, numberOfInputChannels)
+            ( self._aPrelu, inputToDropout ) = applyPrelu(inputToNonLinearity, numberOfInputChannels)
             self.params = self.params + [self._aPrelu]
             
         #------------------------------------
         #------------- Dropout --------------
         #------------------------------------
-        (inputToPoolTrain, inputToPoolVal, inputToPoolTest) = applyDropout(rng, dropoutRate, inputToLayerShapeTrain, \
-                                                            inputToDropoutTrain, inputToDropoutVal, inputToDropoutTest)
+        inputToPool = applyDropout(rng, dropoutRate, inputToDropout, isTrainingFlag)
         
         #-------------------------------------------------------
         #-----------  Pooling ----------------------------------
         #-------------------------------------------------------
         if self._poolingParameters == [] : #no max pooling before this conv
-            inputToConvTrain = inputToPoolTrain
-            inputToConvVal = inputToPoolVal
-            inputToConvTest = inputToPoolTest
+            inputToConv = inputToPool
             
             inputToConvShapeTrain = inputToLayerShapeTrain
             inputToConvShapeVal = inputToLayerShapeVal
             inputToConvShapeTest = inputToLayerShapeTest
         else : #Max pooling is actually happening here...
-            (inputToConvTrain, inputToConvShapeTrain) = myMaxPooling3d(inputToPoolTrain, inputToLayerShapeTrain, \
-                                                                       self._poolingParameters)
-            (inputToConvVal, inputToConvShapeVal) = myMaxPooling3d(inputToPoolVal, inputToLayerShapeVal, \
-                                                                       self._poolingParameters)
-            (inputToConvTest, inputToConvShapeTest) = myMaxPooling3d(inputToPoolTest, inputToLayerShapeTest, \
-                                                                       self._poolingParameters)
+            (inputToConv, [inputToConvShapeTrain, inputToConvShapeVal, inputToConvShapeTest]) = \
+                myMaxPooling3d(inputToPool, [inputToLayerShapeTrain, inputToLayerShapeVal, inputToLayerShapeTest], \
+                               self._poolingParameters, isTrainingFlag)
             
-        return (inputToConvTrain, inputToConvVal, inputToConvTest,
-                inputToConvShapeTrain, inputToConvShapeVal, inputToConvShapeTest )
+        return (inputToConv, inputToConvShapeTrain, inputToConvShapeVal, inputToConvShapeTest)
         
     def _createWeightsTensorAndConvolve(self, rng, filterShape, initializationTechniqueClassic0orDelvingInto1, 
-                                        inputToConvTrain, inputToConvVal, inputToConvTest,
-                                        inputToConvShapeTrain, inputToConvShapeVal, inputToConvShapeTest) :
+                                        inputToConv, inputToConvShapeTrain, inputToConvShapeVal, inputToConvShapeTest,
+                                        convolutionBackendSelector=None) :
         #-----------------------------------------------
         #------------------ Convolution ----------------
         #-----------------------------------------------
@@ -521,21 +435,20 @@ class ConvLayer(Block):
         self.params = [self._W] + self.params
         
         #---------- Convolve --------------
-        tupleWithOuputAndShapeTrValTest = convolveWithGivenWeightMatrix(self._W, filterShape, inputToConvTrain, \
-                                                                    inputToConvVal, inputToConvTest, inputToConvShapeTrain, \
-                                                                    inputToConvShapeVal, inputToConvShapeTest)
+        tupleWithOuputAndShapesTrValTest = convolveWithGivenWeightMatrix(self._W, filterShape, inputToConv, \
+                                                                    inputToConvShapeTrain, inputToConvShapeVal, \
+                                                                    inputToConvShapeTest, convolutionBackendSelector)
         
-        return tupleWithOuputAndShapeTrValTest
+        return tupleWithOuputAndShapesTrValTest
     
     # The main function that builds this.
     def makeLayer(self,
                 rng,
-                inputToLayerTrain,
-                inputToLayerVal,
-                inputToLayerTest,
+                inputToLayer,
                 inputToLayerShapeTrain,
                 inputToLayerShapeVal,
                 inputToLayerShapeTest,
+                isTrainingFlag, # Symbolic int8 scalar of the model. 1 in the training function, 0 in the others.
                 filterShape,
                 poolingParameters, # Can be []
                 initializationTechniqueClassic0orDelvingInto1,
@@ -544,14 +457,15 @@ class ConvLayer(Block):
                 rollingAverageForBNOverThatManyBatches, #If this is <= 0, we are not using \
                 # BatchNormalization, even if above is True.
                 activationFunctionToUseRelu0orPrelu1orMinus1ForLinear=0,
-                dropoutRate=0.0):
+                dropoutRate=0.0,
+                convolutionBackendSelector=None): # Gives the backend of the convolutions. None for conv3d2d.
         """
         type rng: numpy.random.RandomState
         param rng: a random number generator used to initialize weights
         
         type inputToLayer:  tensor5 = theano.tensor.TensorType(dtype='float32', broadcastable= \
                 (False, False, False, False, False))
-        param inputToLayer: symbolic image tensor, of shape inputToLayerShape
+        param inputToLayer: symbolic image tensor, of shape inputToLayerShape in training, validation or testing
         
         type filterShape: tuple or list of length 5
         param filterShape: (number of filters, num input feature maps,
@@ -561,32 +475,29 @@ class ConvLayer(Block):
         param inputToLayerShape: (batch size, num input feature maps,
                             image height, image width, filter depth)
         """
-        self._setBlocksInputAttributes(inputToLayerTrain, inputToLayerVal, inputToLayerTest, inputToLayerShapeTrain, \
-                                       inputToLayerShapeVal, inputToLayerShapeTest)
+        self._setBlocksInputAttributes(inputToLayer, inputToLayerShapeTrain, inputToLayerShapeVal, inputToLayerShapeTest)
         self._setBlocksArchitectureAttributes(filterShape, poolingParameters)
         
         # Apply all the straightforward operations on the input, such as BN, activation function, dropout, pooling        
-        (inputToConvTrain, inputToConvVal, inputToConvTest,
-        inputToConvShapeTrain, inputToConvShapeVal, inputToConvShapeTest) = \
+        (inputToConv, inputToConvShapeTrain, inputToConvShapeVal, inputToConvShapeTest) = \
             self._processInputWithBnNonLinearityDropoutPooling( rng,
-                                                                                        inputToLayerTrain,
-                                                                                        inputToLayerVal,
-                                                                                        inputToLayerTest,
-                                                                                        inputToLayerShapeTrain,
-                                                                                        inputToLayerShapeVal,
-                                                                                        inputToLayerShapeTest,
-                                                                                        useBnFlag,
+                                                                inputToLayer,
+                                                                inputToLayerShapeTrain,
+                                                                inputToLayerShapeVal,
+                                                                inputToLayerShapeTest,
+                                                                isTrainingFlag,
+                                                                useBnFlag,
                                                                 rollingAverageForBNOverThatManyBatches,
                                                                 activationFunctionToUseRelu0orPrelu1orMinus1ForLinear,
                                                                 dropoutRate)
         
-        tupleWithOuputAndShapeTrValTest = self._createWeightsTensorAndConvolve( rng, filterShape, \
+        tupleWithOuputAndShapesTrValTest = self._createWeightsTensorAndConvolve( rng, filterShape, \
                                                                         initializationTechniqueClassic0orDelvingInto1, \
-                                                                        inputToConvTrain, inputToConvVal, inputToConvTest,\
-                                                                        inputToConvShapeTrain, inputToConvShapeVal, \
-                                                                        inputToConvShapeTest)
+                                                                        inputToConv, inputToConvShapeTrain, \
+                                                                        inputToConvShapeVal, inputToConvShapeTest, \
+                                                                        convolutionBackendSelector)
         
-        self._setBlocksOutputAttributes(*tupleWithOuputAndShapeTrValTest)
+        self._setBlocksOutputAttributes(*tupleWithOuputAndShapesTrValTest)
         
     # Override parent's abstract classes.
     def getL1RegCost(self) : #Called for L1 weigths regularisation
@@ -605,36 +516,41 @@ class LowRankConvLayer(ConvLayer):
         del(self._W) # The ._W of the Block parent is not used.
         self._rank = rank # 1 or 2 dimensions
         
-    def _cropSubconvOutputsToSameDimsAndConcatenateFms( self,
-                                                        rSubconvOutput, rSubconvOutputShape,
-                                                        cSubconvOutput, cSubconvOutputShape,
-                                                        zSubconvOutput, zSubconvOutputShape,
-                                                        filterShape) :
+    def _getShapeOfConcatenatedSubconvOutputs(self, rSubconvOutputShape, cSubconvOutputShape, zSubconvOutputShape) :
         assert (rSubconvOutputShape[0] == cSubconvOutputShape[0]) and \
             (cSubconvOutputShape[0] == zSubconvOutputShape[0]) # same batch size.
         
-        concatOutputShape = [ rSubconvOutputShape[0],
-                                rSubconvOutputShape[1] + cSubconvOutputShape[1] + zSubconvOutputShape[1],
-                                rSubconvOutputShape[2],
-                                cSubconvOutputShape[3],
-                                zSubconvOutputShape[4]
-                                ]
-        rCropSlice = slice( (filterShape[2]-1)/2, (filterShape[2]-1)/2 + concatOutputShape[2] )
-        cCropSlice = slice( (filterShape[3]-1)/2, (filterShape[3]-1)/2 + concatOutputShape[3] )
-        zCropSlice = slice( (filterShape[4]-1)/2, (filterShape[4]-1)/2 + concatOutputShape[4] )
+        return [ rSubconvOutputShape[0],
+                 rSubconvOutputShape[1] + cSubconvOutputShape[1] + zSubconvOutputShape[1],
+                 rSubconvOutputShape[2],
+                 cSubconvOutputShape[3],
+                 zSubconvOutputShape[4]
+                 ]
+        
+    def _cropSubconvOutputsToSameDimsAndConcatenateFms( self,
+                                                        rSubconvOutput,
+                                                        cSubconvOutput,
+                                                        zSubconvOutput,
+                                                        filterShape) :
+        # The dims to crop to are symbolic, as the graph serves inputs of any dims. \
+        # Those of the subconv that is not cropped in each axis, as in _getShapeOfConcatenatedSubconvOutputs().
+        concatOutputRczDims = [ T.shape(rSubconvOutput)[2], T.shape(cSubconvOutput)[3], T.shape(zSubconvOutput)[4] ]
+        rCropSlice = slice( (filterShape[2]-1)/2, (filterShape[2]-1)/2 + concatOutputRczDims[0] )
+        cCropSlice = slice( (filterShape[3]-1)/2, (filterShape[3]-1)/2 + concatOutputRczDims[1] )
+        zCropSlice = slice( (filterShape[4]-1)/2, (filterShape[4]-1)/2 + concatOutputRczDims[2] )
         rSubconvOutputCropped = rSubconvOutput[:,:, :, cCropSlice if self._rank == 1 else slice(0, MAX_INT), zCropSlice  ]
         cSubconvOutputCropped = cSubconvOutput[:,:, rCropSlice, :, zCropSlice if self._rank == 1 else slice(0, MAX_INT) ]
         zSubconvOutputCropped = zSubconvOutput[:,:, rCropSlice if self._rank == 1 else slice(0, MAX_INT), cCropSlice, : ]
         concatSubconvOutputs = T.concatenate([rSubconvOutputCropped, \
                                               cSubconvOutputCropped, zSubconvOutputCropped], axis=1) #concatenate the FMs
         
-        return (concatSubconvOutputs, concatOutputShape)
+        return concatSubconvOutputs
     
     # Overload the ConvLayer's function. Called from makeLayer. The only different behaviour, because BN, ActivationFunc, 
     # DropOut and Pooling are done on a per-FM fashion.        
     def _createWeightsTensorAndConvolve(self, rng, filterShape, initializationTechniqueClassic0orDelvingInto1, 
-                                        inputToConvTrain, inputToConvVal, inputToConvTest,
-                                        inputToConvShapeTrain, inputToConvShapeVal, inputToConvShapeTest) :
+                                        inputToConv, inputToConvShapeTrain, inputToConvShapeVal, inputToConvShapeTest,
+                                        convolutionBackendSelector=None) :
         # Behaviour: Create W, set self._W, set self.params, convolve, return ouput and outputShape.
         # The created filters are either 1-dimensional (rank=1) or 2-dim (rank=2), depending  on the self._rank
         # If 1-dim: rSubconv is the input convolved with the row-1dimensional filter.
@@ -648,27 +564,26 @@ class LowRankConvLayer(ConvLayer):
                                self._rank == 1 else filterShape[3], 1 ]
         rSubconvW = createAndInitializeWeightsTensor(rSubconvFilterShape, \
                                                      initializationTechniqueClassic0orDelvingInto1, rng)
-        rSubconvTupleWithOuputAndShapeTrValTest = convolveWithGivenWeightMatrix(rSubconvW, rSubconvFilterShape, \
-                                                            inputToConvTrain, inputToConvVal, inputToConvTest, \
-                                                            inputToConvShapeTrain, inputToConvShapeVal, \
-                                                            inputToConvShapeTest)
+        rSubconvTupleWithOuputAndShapesTrValTest = convolveWithGivenWeightMatrix(rSubconvW, rSubconvFilterShape, \
+                                                            inputToConv, inputToConvShapeTrain, inputToConvShapeVal, \
+                                                            inputToConvShapeTest, convolutionBackendSelector)
         
         cSubconvFilterShape = [ filterShape[0]/3, filterShape[1], 1, filterShape[3], 1 if \
                                                     self._rank == 1 else filterShape[4] ]
         cSubconvW = createAndInitializeWeightsTensor(cSubconvFilterShape, \
                                                      initializationTechniqueClassic0orDelvingInto1, rng)
-        cSubconvTupleWithOuputAndShapeTrValTest = convolveWithGivenWeightMatrix(cSubconvW, cSubconvFilterShape, \
-                                                        inputToConvTrain, inputToConvVal, inputToConvTest, \
-                                                        inputToConvShapeTrain, inputToConvShapeVal, inputToConvShapeTest)
+        cSubconvTupleWithOuputAndShapesTrValTest = convolveWithGivenWeightMatrix(cSubconvW, cSubconvFilterShape, \
+                                                            inputToConv, inputToConvShapeTrain, inputToConvShapeVal, \
+                                                            inputToConvShapeTest, convolutionBackendSelector)
         
         numberOfFmsForTotalToBeExact = filterShape[0] - 2*(filterShape[0]/3) # Cause of possibly inexact integer division.
         zSubconvFilterShape = [ numberOfFmsForTotalToBeExact, filterShape[1], 1 if \
                                self._rank == 1 else filterShape[2], 1, filterShape[4] ]
         zSubconvW = createAndInitializeWeightsTensor(zSubconvFilterShape, \
                                                      initializationTechniqueClassic0orDelvingInto1, rng)
-        zSubconvTupleWithOuputAndShapeTrValTest = convolveWithGivenWeightMatrix(zSubconvW, zSubconvFilterShape, \
-                                                        inputToConvTrain, inputToConvVal, inputToConvTest, \
-                                                        inputToConvShapeTrain, inputToConvShapeVal, inputToConvShapeTest)
+        zSubconvTupleWithOuputAndShapesTrValTest = convolveWithGivenWeightMatrix(zSubconvW, zSubconvFilterShape, \
+                                                            inputToConv, inputToConvShapeTrain, inputToConvShapeVal, \
+                                                            inputToConvShapeTest, convolutionBackendSelector)
         
         # Set the W attribute and trainable parameters.
         # Bear in mind that these sub tensors have different shapes! Treat carefully.
@@ -676,33 +591,16 @@ class LowRankConvLayer(ConvLayer):
         self.params = self._WperSubconv + self.params
         
         # concatenate together.
-        (concatSubconvOutputsTrain, concatOutputShapeTrain) = \
-            self._cropSubconvOutputsToSameDimsAndConcatenateFms(rSubconvTupleWithOuputAndShapeTrValTest[0], \
-                                                                rSubconvTupleWithOuputAndShapeTrValTest[3],\
-                                                                cSubconvTupleWithOuputAndShapeTrValTest[0], \
-                                                                cSubconvTupleWithOuputAndShapeTrValTest[3],\
-                                                                zSubconvTupleWithOuputAndShapeTrValTest[0], \
-                                                                zSubconvTupleWithOuputAndShapeTrValTest[3],\
-                                                                                                        filterShape)
-        (concatSubconvOutputsVal, concatOutputShapeVal) = \
-            self._cropSubconvOutputsToSameDimsAndConcatenateFms(rSubconvTupleWithOuputAndShapeTrValTest[1], \
-                                                                rSubconvTupleWithOuputAndShapeTrValTest[4],\
-                                                                cSubconvTupleWithOuputAndShapeTrValTest[1], \
-                                                                cSubconvTupleWithOuputAndShapeTrValTest[4],\
-                                                                zSubconvTupleWithOuputAndShapeTrValTest[1], \
-                                                                zSubconvTupleWithOuputAndShapeTrValTest[4],\
-                                                                                                        filterShape)
-        (concatSubconvOutputsTest, concatOutputShapeTest) = \
-            self._cropSubconvOutputsToSameDimsAndConcatenateFms(rSubconvTupleWithOuputAndShapeTrValTest[2], \
-                                                                rSubconvTupleWithOuputAndShapeTrValTest[5],\
-                                                                cSubconvTupleWithOuputAndShapeTrValTest[2], \
-                                                                cSubconvTupleWithOuputAndShapeTrValTest[5],\
-                                                                zSubconvTupleWithOuputAndShapeTrValTest[2], \
-                                                                zSubconvTupleWithOuputAndShapeTrValTest[5],\
-                                                                                                        filterShape)
-        
-        return (concatSubconvOutputsTrain, concatSubconvOutputsVal, concatSubconvOutputsTest, \
-                concatOutputShapeTrain, concatOutputShapeVal, concatOutputShapeTest)
+        concatSubconvOutputs = self._cropSubconvOutputsToSameDimsAndConcatenateFms(rSubconvTupleWithOuputAndShapesTrValTest[0],
+                                                                                    cSubconvTupleWithOuputAndShapesTrValTest[0],
+                                                                                    zSubconvTupleWithOuputAndShapesTrValTest[0],
+                                                                                    filterShape)
+        concatOutputShapesTrValTest = [ self._getShapeOfConcatenatedSubconvOutputs(rSubconvTupleWithOuputAndShapesTrValTest[i],
+                                                                                    cSubconvTupleWithOuputAndShapesTrValTest[i],
+                                                                                    zSubconvTupleWithOuputAndShapesTrValTest[i]) \
+                                        for i in [1, 2, 3] ]
+        
+        return tuple([concatSubconvOutputs] + concatOutputShapesTrValTest)
         
         
     # Implement parent's abstract classes.
@@ -736,35 +634,24 @@ class SoftmaxLayer(Block):
         self._numberOfOutputClasses = layerConnected.getNumberOfFeatureMaps()
         self._softmaxTemperature = softmaxTemperature
         
-        self._setBlocksInputAttributes(layerConnected.outputTrain, layerConnected.outputVal, layerConnected.outputTest,
-                                        layerConnected.outputShapeTrain, layerConnected.outputShapeVal, \
-                                        layerConnected.outputShapeTest)
+        self._setBlocksInputAttributes(layerConnected.output, layerConnected.outputShapeTrain, \
+                                       layerConnected.outputShapeVal, layerConnected.outputShapeTest)
         
         # At this last classification layer, the conv output needs to have bias added before the softmax.
         # NOTE: So, two biases are associated with this layer. \
         #self.b which is added in the ouput of the previous layer's output of conv,
         # and this self._bClassLayer that is added only to this final output before the softmax.
         (self._b,
-        biasedInputToSoftmaxTrain,
-        biasedInputToSoftmaxVal,
-        biasedInputToSoftmaxTest) = makeBiasParamsAndApplyToFms( self.inputTrain, self.inputVal, self.inputTest, \
-                                                                 self._numberOfOutputClasses )
+        biasedInputToSoftmax) = makeBiasParamsAndApplyToFms( self.input, self._numberOfOutputClasses )
         self.params = self.params + [self._b]
         
         # ============ Softmax ==============
         #self.p_y_given_x_2d_train = ? Can I implement negativeLogLikelihood without this ?
-        ( self.p_y_given_x_train,
-        self.y_pred_train ) = applySoftmaxToFmAndReturnProbYandPredY( biasedInputToSoftmaxTrain, \
-                                                self.inputShapeTrain, self._numberOfOutputClasses, softmaxTemperature)
-        ( self.p_y_given_x_val,
-        self.y_pred_val ) = applySoftmaxToFmAndReturnProbYandPredY( biasedInputToSoftmaxVal, \
-                                                self.inputShapeVal, self._numberOfOutputClasses, softmaxTemperature)
-        ( self.p_y_given_x_test,
-        self.y_pred_test ) = applySoftmaxToFmAndReturnProbYandPredY( biasedInputToSoftmaxTest, \
-                                                self.inputShapeTest, self._numberOfOutputClasses, softmaxTemperature)
-        
-        self._setBlocksOutputAttributes(self.p_y_given_x_train, self.p_y_given_x_val, self.p_y_given_x_test, \
-                                        self.inputShapeTrain, self.inputShapeVal, self.inputShapeTest)
+        ( self.p_y_given_x,
+        self.y_pred ) = applySoftmaxToFmAndReturnProbYandPredY( biasedInputToSoftmax, self._numberOfOutputClasses, \
+                                                                softmaxTemperature)
+        
+        self._setBlocksOutputAttributes(self.p_y_given_x, self.inputShapeTrain, self.inputShapeVal, self.inputShapeTest)
         
         layerConnected.setTargetBlock(self)
         
@@ -775,12 +662,13 @@ class SoftmaxLayer(Block):
         # weightPerClass is a vector with 1 element per class.
         
         #Weighting the cost of the different classes in the cost-function, in order to counter class imbalance.
+        p_y_given_x_train = self._getProbYAndPredYOfTrain0OrVal1OrTest2(0)[0]
         e1 = np.finfo(np.float32).tiny
-        addTinyProbMatrix = T.lt(self.p_y_given_x_train, 4*e1) * e1
+        addTinyProbMatrix = T.lt(p_y_given_x_train, 4*e1) * e1
         
         weightPerClassBroadcasted = weightPerClass.dimshuffle('x', 0, 'x', 'x', 'x')
         #added a tiny so that it does not go to zero and I have problems with nan again...
-        log_p_y_given_x_train = T.log(self.p_y_given_x_train + addTinyProbMatrix) 
+        log_p_y_given_x_train = T.log(p_y_given_x_train + addTinyProbMatrix) 
         weighted_log_p_y_given_x_train = log_p_y_given_x_train * weightPerClassBroadcasted
         # return -T.mean( weighted_log_p_y_given_x_train[T.arange(y.shape[0]), y] )
         
@@ -796,25 +684,27 @@ class SoftmaxLayer(Block):
         # Returns float = number of errors / number of examples of the minibatch ; [0., 1.]
         # param y: y = T.itensor4('y'). Dimensions [batchSize, r, c, z]
         
+        y_pred_train = self._getProbYAndPredYOfTrain0OrVal1OrTest2(0)[1]
         # check if y has same dimension of y_pred
-        checkDimsOfYpredAndYEqual(y, self.y_pred_train, "training")
+        checkDimsOfYpredAndYEqual(y, y_pred_train, "training")
         
         #Mean error of the training batch.
-        tneq = T.neq(self.y_pred_train, y)
+        tneq = T.neq(y_pred_train, y)
         meanError = T.mean(tneq)
         return meanError
     
     def meanErrorValidation(self, y):
         # y = T.itensor4('y'). Dimensions [batchSize, r, c, z]
         
+        y_pred_val = self._getProbYAndPredYOfTrain0OrVal1OrTest2(1)[1]
         # check if y has same dimension of y_pred
-        checkDimsOfYpredAndYEqual(y, self.y_pred_val, "validation")
+        checkDimsOfYpredAndYEqual(y, y_pred_val, "validation")
         
         # check if y is of the correct datatype
         if y.dtype.startswith('int'):
             # the T.neq operator returns a vector of 0s and 1s, where 1
             # represents a mistake in prediction
-            tneq = T.neq(self.y_pred_val, y)
+            tneq = T.neq(y_pred_val, y)
             meanError = T.mean(tneq)
             return meanError #The percentage of the predictions that is not the correct class.
         else:
@@ -827,7 +717,7 @@ class SoftmaxLayer(Block):
         #(ie class-0 RP,RN,TPP,TPN, class-1 RP,RN,TPP,TPN, class-2 RP,RN,TPP,TPN ...)
         # param y: y = T.itensor4('y'). Dimensions [batchSize, r, c, z]
         
-        yPredToUse = self.y_pred_train if  training0OrValidation1 == 0 else self.y_pred_val
+        yPredToUse = self._getProbYAndPredYOfTrain0OrVal1OrTest2(training0OrValidation1)[1]
         checkDimsOfYpredAndYEqual(y, yPredToUse, "training" if training0OrValidation1 == 0 else "validation")
         
         returnedListWithNumberOfRpRnTpTnForEachClass = []
@@ -851,6 +741,14 @@ class SoftmaxLayer(Block):
         return returnedListWithNumberOfRpRnTpTnForEachClass
     
     def predictionProbabilities(self) :
-        return self.p_y_given_x_test
+        return self._getProbYAndPredYOfTrain0OrVal1OrTest2(2)[0]
+    
+    def _getProbYAndPredYOfTrain0OrVal1OrTest2(self, train0OrVal1OrTest2) :
+        if hasattr(self, "p_y_given_x") :
+            return (self.p_y_given_x, self.y_pred)
+        # Models pickled before the graph was shared by training, validation and testing have one per function.
+        return [ (self.p_y_given_x_train, self.y_pred_train),
+                 (self.p_y_given_x_val, self.y_pred_val),
+                 (self.p_y_given_x_test, self.y_pred_test) ][train0OrVal1OrTest2]
     
     
\ No newline at end of file
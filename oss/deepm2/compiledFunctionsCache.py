@@ -0,0 +1,206 @@
+# Copyright (c) 2016, Konstantinos Kamnitsas
+# All rights reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the BSD license. See the accompanying LICENSE file
+# or read the terms at https://opensource.org/licenses/BSD-3-Clause.
+
+import os
+import sys
+import time
+import hashlib
+import cPickle
+
+import theano
+
+# On-disk cache of the compiled theano functions of a Cnn3d, to skip the optimization of their graphs at startup.
+# The functions of a session are pickled together with the shared variables they use, so that on loading they \
+# keep sharing them. The shared variables of the model are then pointed to the containers of the loaded functions.
+# An entry is keyed by the architecture, the batch sizes and segment sizes (arguments of make_cnn_model), the \
+# options of training that are constants in the graph, the sources that build the graph, the device and the \
+# theano config. Entries are written to a temporary file and renamed when complete.
+
+FORMAT_VERSION_OF_ENTRIES = 1
+
+# Kind of function: [method of Cnn3d that compiles it, attribute of Cnn3d that holds it]
+METHOD_AND_ATTRIBUTE_PER_KIND_OF_FUNCTION = { "train" : ["compileTrainFunction", "cnnTrainModel"],
+                                              "validation" : ["compileValidationFunction", "cnnValidateModel"],
+                                              "test" : ["compileTestFunction", "cnnTestModel"],
+                                              "visualisation" : ["compileTestAndVisualisationFunction",
+                                                                 "cnnTestAndVisualiseAllFmsFunction"] }
+# Kind of function: the kind whose inputs it uses. The testing and visualisation functions share theirs.
+KIND_OF_INPUTS_PER_KIND_OF_FUNCTION = { "train" : "train", "validation" : "validation",
+                                        "test" : "test", "visualisation" : "test" }
+# Attributes of the training state that change between sessions, but are not constants in the training function.
+NAMES_OF_TRAINING_STATE_ATTRIBUTES_NOT_IN_GRAPH = [ "_trainingStateAttributesInitialized", "numberOfEpochsTrained",
+                                                    "initialLearningRate", "initialMomentum",
+                                                    "topMeanValidationAccuracyAchievedInEpoch",
+                                                    "lastEpochAtTheEndOfWhichLrWasLowered" ]
+# The modules that build the graph. A change in them makes all entries stale.
+FILENAMES_OF_SOURCES_OF_GRAPH = [ "cnn3d.py", "cnnLayerTypes.py", "pathways.py", "maxPoolingModule.py",
+                                  "convolutionBackends.py" ]
+# Pickling theano graphs recurses deeply.
+MIN_RECURSION_LIMIT_FOR_PICKLING = 50000
+
+def _getHashOfSourcesOfGraph() :
+    folderOfSources = os.path.dirname(os.path.abspath(__file__))
+    hashOfSources = hashlib.sha1()
+    for filename in FILENAMES_OF_SOURCES_OF_GRAPH :
+        f = open(os.path.join(folderOfSources, filename), "rb")
+        try :
+            hashOfSources.update(f.read())
+        finally :
+            f.close()
+    return hashOfSources.hexdigest()
+
+def _getSharedVariablesOfInputs(cnnInstance, kindOfInputs) :
+    if kindOfInputs == "train" :
+        return [cnnInstance.sharedInpXTrain] + cnnInstance.sharedInpXPerSubsListTrain + [cnnInstance.sharedLabelsYTrain]
+    elif kindOfInputs == "validation" :
+        return [cnnInstance.sharedInpXVal] + cnnInstance.sharedInpXPerSubsListVal + [cnnInstance.sharedLabelsYVal]
+    sharedVariablesOfTest = [cnnInstance.sharedInpXTest] + cnnInstance.sharedInpXPerSubsListTest
+    if cnnInstance._graphIsSharedByTheFunctions() : # Its batch size for testing is shared, to change it later.
+        sharedVariablesOfTest.append(cnnInstance._getSharedBatchSizeTesting())
+    return sharedVariablesOfTest
+
+def _getKindsOfInputs(kindsOfFunctions) :
+    kindsOfInputs = []
+    for kindOfFunction in kindsOfFunctions :
+        if KIND_OF_INPUTS_PER_KIND_OF_FUNCTION[kindOfFunction] not in kindsOfInputs :
+            kindsOfInputs.append(KIND_OF_INPUTS_PER_KIND_OF_FUNCTION[kindOfFunction])
+    return kindsOfInputs
+
+def _initializeSharedVariablesOfInputs(cnnInstance, kindOfInputs) :
+    # What compiling the function would have made. Their containers are replaced by those of the loaded functions.
+    if kindOfInputs == "train" :
+        cnnInstance._initializeSharedVarsForInputsTrain()
+    elif kindOfInputs == "validation" :
+        cnnInstance._initializeSharedVarsForInputsVal()
+    else :
+        cnnInstance._initializeSharedVarsForInputsTest()
+
+def _getSharedVariablesOfFunctions(cnnInstance, kindsOfFunctions) :
+    # All the shared variables of the model that the functions may use, in an order that depends only on the key.
+    sharedVariables = [ sharedVariable for [name, sharedVariable] in cnnInstance.getNamedSharedVariables() ]
+    for kindOfInputs in _getKindsOfInputs(kindsOfFunctions) :
+        sharedVariables += _getSharedVariablesOfInputs(cnnInstance, kindOfInputs)
+    return sharedVariables
+
+class CompiledFunctionsCache(object):
+    def __init__(self, folderForCache, myLogger=None) :
+        self._folderForCache = os.path.abspath(folderForCache)
+        self._myLogger = myLogger
+        if not os.path.isdir(self._folderForCache) :
+            try :
+                os.makedirs(self._folderForCache)
+            except OSError :
+                if not os.path.isdir(self._folderForCache) : # Else, another process just created it.
+                    raise
+
+    def getFolder(self) :
+        return self._folderForCache
+
+    def _print(self, string) :
+        if self._myLogger <> None :
+            self._myLogger.print3(string)
+        else :
+            print string
+
+    def canCache(self, cnnInstance) :
+        # Models pickled before checkpoints were introduced do not know their architecture, to key the entries.
+        return getattr(cnnInstance, "argumentsOfMakeCnnModel", None) <> None
+
+    def _getFilepathOfEntry(self, cnnInstance, kindsAndArgumentsOfCompilation) :
+        trainingStateAttributes = cnnInstance.getTrainingStateAttributes()
+        for name in NAMES_OF_TRAINING_STATE_ATTRIBUTES_NOT_IN_GRAPH :
+            del trainingStateAttributes[name]
+        kindsOfFunctions = [ kindOfFunction for [kindOfFunction, argumentsOfCompilation] in kindsAndArgumentsOfCompilation ]
+        key = repr([ FORMAT_VERSION_OF_ENTRIES,
+                     kindsAndArgumentsOfCompilation,
+                     sorted(cnnInstance.argumentsOfMakeCnnModel.items()),
+                     sorted(trainingStateAttributes.items()) if "train" in kindsOfFunctions else None,
+                     [ name for [name, sharedVariable] in cnnInstance.getNamedSharedVariables() ],
+                     _getHashOfSourcesOfGraph(),
+                     theano.__version__, theano.config.device, theano.config.floatX, theano.config.mode,
+                     theano.config.optimizer, theano.config.linker, theano.config.optimizer_excluding,
+                     theano.config.optimizer_including ])
+        return os.path.join(self._folderForCache, "functions_" + hashlib.sha1(key).hexdigest() + ".pkl")
+
+    def loadFunctionsIntoCnn(self, cnnInstance, kindsAndArgumentsOfCompilation) :
+        # kindsAndArgumentsOfCompilation: [[kindOfFunction, argumentsOfCompilationWithoutTheLogger], ...]
+        # Returns True if the functions were found and set in the instance. Otherwise the instance is not changed.
+        if not self.canCache(cnnInstance) :
+            return False
+        filepathOfEntry = self._getFilepathOfEntry(cnnInstance, kindsAndArgumentsOfCompilation)
+        if not os.path.isfile(filepathOfEntry) :
+            self._print("The compiled functions were not found in the cache. They will be compiled and cached.")
+            return False
+        sys.setrecursionlimit(max(sys.getrecursionlimit(), MIN_RECURSION_LIMIT_FOR_PICKLING))
+        try :
+            f = open(filepathOfEntry, "rb")
+            try :
+                [functionsPerKind, sharedVariablesOfEntry] = cPickle.load(f)
+            finally :
+                f.close()
+        except Exception, e : # Corrupted, or pickled by an incompatible version of a library.
+            self._print("WARN: Loading the compiled functions from [" + filepathOfEntry + "] failed with: " + str(e) + \
+                        ". They will be compiled.")
+            return False
+
+        kindsOfFunctions = [ kindOfFunction for [kindOfFunction, argumentsOfCompilation] in kindsAndArgumentsOfCompilation ]
+        for kindOfInputs in _getKindsOfInputs(kindsOfFunctions) :
+            _initializeSharedVariablesOfInputs(cnnInstance, kindOfInputs)
+        sharedVariablesOfCnn = _getSharedVariablesOfFunctions(cnnInstance, kindsOfFunctions)
+        if len(sharedVariablesOfCnn) <> len(sharedVariablesOfEntry) or \
+                not all([ sharedVariablesOfCnn[i].type == sharedVariablesOfEntry[i].type for i in xrange(len(sharedVariablesOfCnn)) ]) :
+            self._print("ERROR: The shared variables of the compiled functions in [" + filepathOfEntry + "] do not " + \
+                        "match those of the model. The cache is inconsistent. Delete it. Exiting!"); exit(1)
+        # The model keeps its values, but in the containers that the loaded functions use.
+        for var_i in xrange(len(sharedVariablesOfCnn)) :
+            containerOfEntry = sharedVariablesOfEntry[var_i].container
+            containerOfEntry.storage[0] = sharedVariablesOfCnn[var_i].container.storage[0]
+            sharedVariablesOfCnn[var_i].container = containerOfEntry
+        for kindOfFunction in kindsOfFunctions :
+            setattr(cnnInstance, METHOD_AND_ATTRIBUTE_PER_KIND_OF_FUNCTION[kindOfFunction][1], functionsPerKind[kindOfFunction])
+        os.utime(filepathOfEntry, None)
+        self._print("The compiled functions " + str(kindsOfFunctions) + " were loaded from the cache: " + filepathOfEntry)
+        return True
+
+    def saveFunctionsOfCnn(self, cnnInstance, kindsAndArgumentsOfCompilation) :
+        # After the functions were compiled.
+        if not self.canCache(cnnInstance) :
+            self._print("WARN: The model was made before checkpoints were introduced. Its functions cannot be cached.")
+            return
+        filepathOfEntry = self._getFilepathOfEntry(cnnInstance, kindsAndArgumentsOfCompilation)
+        kindsOfFunctions = [ kindOfFunction for [kindOfFunction, argumentsOfCompilation] in kindsAndArgumentsOfCompilation ]
+        functionsPerKind = dict([ [kindOfFunction, getattr(cnnInstance, METHOD_AND_ATTRIBUTE_PER_KIND_OF_FUNCTION[kindOfFunction][1])] \
+                                                                                for kindOfFunction in kindsOfFunctions ])
+        sys.setrecursionlimit(max(sys.getrecursionlimit(), MIN_RECURSION_LIMIT_FOR_PICKLING))
+        filepathOfTempFile = filepathOfEntry + ".tmp" + str(os.getpid())
+        f = open(filepathOfTempFile, "wb")
+        try :
+            # Pickled in one go, so that the functions keep sharing the variables after loading.
+            cPickle.dump([functionsPerKind, _getSharedVariablesOfFunctions(cnnInstance, kindsOfFunctions)], f,
+                         protocol=cPickle.HIGHEST_PROTOCOL)
+        finally :
+            f.close()
+        os.rename(filepathOfTempFile, filepathOfEntry)
+        self._print("The compiled functions " + str(kindsOfFunctions) + " were cached in: " + filepathOfEntry)
+
+def loadOrCompileFunctionsOfCnn(myLogger, cnnInstance, compiledFunctionsCache, kindsAndTuplesForCompilation) :
+    # kindsAndTuplesForCompilation: [[kindOfFunction, tupleForCompilation], ...], with the tuples given by the \
+    # session's parameters (logger first). compiledFunctionsCache can be None, to only compile.
+    # Returns the seconds it took.
+    startTime = time.time()
+    kindsAndArgumentsOfCompilation = [ [kindOfFunction, list(tupleForCompilation[1:])] \
+                                                for [kindOfFunction, tupleForCompilation] in kindsAndTuplesForCompilation ]
+    if compiledFunctionsCache <> None and \
+            compiledFunctionsCache.loadFunctionsIntoCnn(cnnInstance, kindsAndArgumentsOfCompilation) :
+        return time.time() - startTime
+    for [kindOfFunction, tupleForCompilation] in kindsAndTuplesForCompilation :
+        myLogger.print3("\n=========== Compiling the function for: " + kindOfFunction + " ===========")
+        getattr(cnnInstance, METHOD_AND_ATTRIBUTE_PER_KIND_OF_FUNCTION[kindOfFunction][0])(*tupleForCompilation)
+    if compiledFunctionsCache <> None :
+        compiledFunctionsCache.saveFunctionsOfCnn(cnnInstance, kindsAndArgumentsOfCompilation)
+    return time.time() - startTime
+
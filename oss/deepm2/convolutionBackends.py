@@ -0,0 +1,179 @@
+# Copyright (c) 2016, Konstantinos Kamnitsas
+# All rights reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the BSD license. See the accompanying LICENSE file
+# or read the terms at https://opensource.org/licenses/BSD-3-Clause.
+
+import time
+
+import numpy as np
+
+import theano
+import theano.tensor as T
+import theano.tensor.nnet.conv3d2d #conv3d2d fixed in bleeding edge version of theano.
+
+# Implementations of the valid 3D convolution of the layers. All take and give tensors of shape \
+# [batchSize, #FMs, r, c, z] and compute the same (true, flipped-filter) convolution, so a model's weights work with any.
+# conv3d2d: theano's conv3d2d, as 2D convolutions over (r,c) summed over z. Needs dimshuffles of input, filters, output.
+# corr3dMM: theano's abstract conv3d. im2col and GEMM (Corr3dMM) on CPU, cuDNN or GpuCorr3dMM on GPU. No dimshuffles.
+# fft: theano's conv3d_fft. Only with the old cuda backend of theano (device=gpu), with scikit-cuda.
+CONVOLUTION_BACKENDS = ["conv3d2d", "corr3dMM", "fft"]
+# Benchmark the available backends for each convolution when the model is made, on the shapes of its input in training, \
+# validation and testing, and use the fastest over them.
+AUTO_BACKEND = "auto"
+NUMBER_OF_RUNS_PER_BENCHMARK = 3
+
+# Seconds of the benchmarked backends, per [device, inputToConvShape, filterShape, withGradients], kept for the process \
+# so that models made again (eg from a saved one, or with other segment sizes) do not benchmark the same shapes again.
+_secondsPerBackendPerShapeOfProcess = {}
+
+def _getConv3dFft() :
+    try :
+        from theano.sandbox.cuda.fftconv import conv3d_fft
+    except Exception : # Not in this version of theano, or no cuda/scikit-cuda.
+        return None
+    return conv3d_fft if theano.config.device.startswith("gpu") else None
+
+def isBackendAvailable(backend) :
+    if backend == "fft" :
+        return _getConv3dFft() <> None
+    return backend in CONVOLUTION_BACKENDS
+
+def getShapeOfOutputOfConvolution(inputToConvShape, filterShape) :
+    return [ inputToConvShape[0],
+             filterShape[0],
+             inputToConvShape[2]-filterShape[2]+1,
+             inputToConvShape[3]-filterShape[3]+1,
+             inputToConvShape[4]-filterShape[4]+1 ]
+
+def _convolveWithConv3d2d(inputToConv, W, filterShape) :
+    # Conv3d2d requires in in shape:
+    #[Number_of_output_filters, zKernelDim, Numb_of_input_Channels, rKernelDim, cKernelDim]
+    wReshapedForConv = W.dimshuffle(0,4,1,2,3)
+    wReshapedForConvShape = (filterShape[0], filterShape[4], filterShape[1], filterShape[2], filterShape[3])
+    #Reshape image for what conv3d2d needs:
+    inputToConvReshaped = inputToConv.dimshuffle(0, 4, 1, 2, 3)
+    outputOfConv = \
+        T.nnet.conv3d2d.conv3d(signals = inputToConvReshaped, # batch_size, time, num_of_input_channels, rows, columns
+                                  filters = wReshapedForConv, # Number_of_output_filters, Z, Numb_of_input_Channels, r, c
+                                  signals_shape = None, # Symbolic. The graph is used with any batch size and dims.
+                                  filters_shape = wReshapedForConvShape,
+                                  border_mode = 'valid')
+    #reshape the result, to have the dimensions as the input image: [BatchSize, #FMsInThisLayer, r, c, z]
+    return outputOfConv.dimshuffle(0, 2, 3, 4, 1)
+
+def _convolveWithCorr3dMM(inputToConv, W, filterShape) :
+    return T.nnet.conv3d(input = inputToConv,
+                         filters = W,
+                         input_shape = (None, filterShape[1], None, None, None),
+                         filter_shape = tuple(filterShape),
+                         border_mode = 'valid',
+                         filter_flip = True)
+
+def _convolveWithFft(inputToConv, W, filterShape) :
+    conv3d_fft = _getConv3dFft()
+    return conv3d_fft(inputToConv, W, image_shape = None, filter_shape = tuple(filterShape), border_mode = 'valid')
+
+CONVOLVE_FUNCTION_PER_BACKEND = { "conv3d2d" : _convolveWithConv3d2d,
+                                  "corr3dMM" : _convolveWithCorr3dMM,
+                                  "fft" : _convolveWithFft }
+
+def convolve3d(backend, inputToConv, W, filterShape) :
+    # inputToConv: [batchSize, #FMs of Input, r, c, z]. W, of filterShape: [#FMs of layer, #FMs of Input, rK, cK, zK]
+    # Returns the output: [batchSize, #FMs of layer, r-rK+1, c-cK+1, z-zK+1]. Its shape is symbolic, so the same \
+    # graph serves inputs of any batch size and dims. See getShapeOfOutputOfConvolution() for the numbers.
+    return CONVOLVE_FUNCTION_PER_BACKEND[backend](inputToConv, W, filterShape)
+
+def benchmarkBackend(backend, inputToConvShape, filterShape, withGradients, numberOfRuns=NUMBER_OF_RUNS_PER_BENCHMARK) :
+    # Returns the seconds of the fastest of numberOfRuns calls (after a first one) of a function that convolves \
+    # random values of the given shapes, and if withGradients (as in training) computes the gradients too.
+    rng = np.random.RandomState(0)
+    inputToConv = theano.shared(rng.normal(size=inputToConvShape).astype("float32"))
+    W = theano.shared(rng.normal(scale=0.01, size=filterShape).astype("float32"))
+    output = convolve3d(backend, inputToConv, W, filterShape)
+    outputs = [output.sum()] # Reduced in the function, to not time the copy of the output to the host.
+    if withGradients :
+        outputs = T.grad(outputs[0], [inputToConv, W])
+        outputs = [ gradient.sum() for gradient in outputs ]
+    benchmarkFunction = theano.function([], outputs)
+    benchmarkFunction()
+    secondsOfFastestRun = None
+    for run_i in xrange(numberOfRuns) :
+        start = time.time()
+        benchmarkFunction()
+        seconds = time.time() - start
+        secondsOfFastestRun = seconds if secondsOfFastestRun == None else min(seconds, secondsOfFastestRun)
+    return secondsOfFastestRun
+
+class ConvolutionBackendSelector(object):
+    # Gives the backend to use for each convolution of a model while it is made. A convolution is in the one graph \
+    # of the model, used by training (with gradients), validation and testing with inputs of different shapes. \
+    # With AUTO_BACKEND, the available backends are benchmarked on each of these shapes (once per shape in the \
+    # process), and the one with the least total time is chosen.
+    # The choices are kept with the model (getChosenBackendPerShape()), so the model is rebuilt with the same ones.
+    def __init__(self, backend=AUTO_BACKEND, chosenBackendPerShape=None, myLogger=None) :
+        self._backend = backend
+        self._myLogger = myLogger
+        # List of [inputToConvShapesAndWithGradients, filterShape, backend]. Lists, to save as json with the model.
+        self._chosenBackendPerShape = [ list(choice) for choice in chosenBackendPerShape ] if \
+                                        chosenBackendPerShape <> None else []
+
+    def _print(self, string) :
+        if self._myLogger <> None :
+            self._myLogger.print3(string)
+        else :
+            print string
+
+    def getChosenBackendPerShape(self) :
+        return [ list(choice) for choice in self._chosenBackendPerShape ]
+
+    def getBackend(self, inputToConvShapesAndWithGradients, filterShape) :
+        # inputToConvShapesAndWithGradients: [[inputToConvShape, withGradients], ...], one per use of the convolution.
+        if self._backend <> AUTO_BACKEND :
+            return self._backend
+        inputToConvShapesAndWithGradients = [ [[ int(dim) for dim in inputToConvShape ], bool(withGradients)] \
+                                                for [inputToConvShape, withGradients] in inputToConvShapesAndWithGradients ]
+        filterShape = [ int(dim) for dim in filterShape ]
+        for choice in self._chosenBackendPerShape :
+            # Choices of models made before the graph was shared by training, validation and testing are of one shape.
+            if len(choice) == 3 and choice[:2] == [inputToConvShapesAndWithGradients, filterShape] \
+                    and isBackendAvailable(choice[2]) :
+                return choice[2]
+        backendsAndTotalSeconds = None
+        for [inputToConvShape, withGradients] in inputToConvShapesAndWithGradients :
+            secondsPerBackend = dict(self._getSecondsPerBackend(inputToConvShape, filterShape, withGradients))
+            backendsAndTotalSeconds = [ [backend, secondsPerBackend[backend]] for backend in CONVOLUTION_BACKENDS \
+                                        if backend in secondsPerBackend ] if backendsAndTotalSeconds == None else \
+                                      [ [backend, totalSeconds + secondsPerBackend[backend]] for [backend, totalSeconds] in \
+                                        backendsAndTotalSeconds if backend in secondsPerBackend ]
+        if len(backendsAndTotalSeconds) == 0 :
+            self._print("ERROR: No convolution backend could be benchmarked for all the shapes of input " + \
+                        str(inputToConvShapesAndWithGradients) + " with filters of shape " + str(filterShape) + \
+                        ". Exiting!"); exit(1)
+        [chosenBackend, secondsOfChosen] = min(backendsAndTotalSeconds, key=lambda backendAndSeconds : backendAndSeconds[1])
+        self._print("Convolution backends for filters " + str(filterShape) + ", total over the shapes of input: " + \
+                    ", ".join([ backend + " " + str(round(seconds, 4)) + "s" for [backend, seconds] in backendsAndTotalSeconds ]) + \
+                    ". Chosen: " + chosenBackend)
+        self._chosenBackendPerShape.append([inputToConvShapesAndWithGradients, filterShape, chosenBackend])
+        return chosenBackend
+
+    def _getSecondsPerBackend(self, inputToConvShape, filterShape, withGradients) :
+        # Returns [[backend, seconds], ...] of the backends that could be benchmarked on the shapes.
+        keyOfShapes = (theano.config.device, tuple(inputToConvShape), tuple(filterShape), withGradients)
+        if keyOfShapes in _secondsPerBackendPerShapeOfProcess :
+            return _secondsPerBackendPerShapeOfProcess[keyOfShapes]
+        backendsAndSeconds = []
+        for backend in CONVOLUTION_BACKENDS :
+            if not isBackendAvailable(backend) :
+                continue
+            try :
+                backendsAndSeconds.append([backend, benchmarkBackend(backend, inputToConvShape, filterShape, withGradients)])
+            except Exception, e : # Eg not implemented for these shapes on this device.
+                self._print("WARN: Benchmarking the convolution backend [" + backend + "] failed with: " + str(e))
+        self._print("Convolution backends for input " + str(inputToConvShape) + " and filters " + str(filterShape) + \
+                    (" (with gradients)" if withGradients else "") + ": " + \
+                    ", ".join([ backend + " " + str(round(seconds, 4)) + "s" for [backend, seconds] in backendsAndSeconds ]))
+        _secondsPerBackendPerShapeOfProcess[keyOfShapes] = backendsAndSeconds
+        return backendsAndSeconds
+
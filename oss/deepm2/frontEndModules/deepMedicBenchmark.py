@@ -0,0 +1,312 @@
+# Copyright (c) 2016, Konstantinos Kamnitsas
+# All rights reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the BSD license. See the accompanying LICENSE file
+# or read the terms at https://opensource.org/licenses/BSD-3-Clause.
+
+import os
+import sys
+import time
+import json
+import random
+import shutil
+import tempfile
+import resource
+import platform
+import subprocess
+import argparse
+import numpy as np
+import nibabel as nib
+
+from deepmedic import myLoggerModule
+from deepmedic.cnn3d import Cnn3d
+from deepmedic.cnnHelpers import CnnWrapperForSampling
+from deepmedic.trainValidateTestVisualiseParallel import actual_load_patient_imgs
+from deepmedic.trainValidateTestVisualiseParallel import buildIndexForSamplingCentralVoxels
+from deepmedic.trainValidateTestVisualiseParallel import sampleImageParts
+from deepmedic.trainValidateTestVisualiseParallel import extractDataOfASegmentFromImagesUsingSampledSliceCoords
+from deepmedic.trainValidateTestVisualiseParallel import getCoordsOfAllSegmentsOfAnImage
+from deepmedic.trainValidateTestVisualiseParallel import extractDataOfSegmentsUsingSampledSliceCoords
+from deepmedic.trainValidateTestVisualiseParallel import placeBatchOfOutputCubesInImage
+
+from deepmedic.frontEndModules.deepMedicNewModel import ModelConfig
+from deepmedic.frontEndModules.deepMedicNewModel import getCreateModelSessionParametersFromConfig
+
+# Times the cpu-side stages of the pipeline in isolation, on synthetic subjects, with the geometry of the model of \
+# a model-config (eg the tinyCnn and model configs of the examples). No theano function is compiled or run.
+# Writes the results as json, to be compared between commits with -compare.
+
+def getPeakMemoryOfProcessInMB() :
+    # ru_maxrss is in KB on linux, in bytes on mac.
+    peakMemory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peakMemory / (1024.**2) if sys.platform == "darwin" else peakMemory / 1024.
+
+def getGitRevisionOfCode() :
+    try :
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                        stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError) :
+        return None
+
+def makeCnnFromModelConfig(modelConfigFilepath, sessionLogger, folderForOutput) :
+    # The model is only built, to get the shapes of its pathways. Returns a CnnWrapperForSampling, like the sampling.
+    modelConfig = ModelConfig()
+    modelConfig.configStruct = {} # Per instance, as the class-level dict would keep the values of a previous config.
+    execfile(modelConfigFilepath, modelConfig.configStruct)
+    # The backend does not change the shapes. Not "auto", which would benchmark the convolutions of each layer.
+    modelConfig.configStruct[ModelConfig.CONV_BACKEND] = "conv3d2d"
+    createModelSessionParameters = getCreateModelSessionParametersFromConfig(modelConfig,
+                                                                            "benchmark",
+                                                                            sessionLogger,
+                                                                            folderForOutput,
+                                                                            folderForOutput)
+    cnn3dInstance = Cnn3d()
+    cnn3dInstance.make_cnn_model(*createModelSessionParameters.getTupleForCnnCreation())
+    return [CnnWrapperForSampling(cnn3dInstance), cnn3dInstance.numberOfOutputClasses]
+
+def makeSyntheticSubjects(folderForSubjects, numberOfSubjects, numberOfChannels, numberOfClasses, dimsOfVolumes) :
+    # Per subject: gaussian-noise channels, an ellipsoid as ROI, and label blobs of all classes inside it.
+    # Returns [fpathsToEachChannelOfEachPat, fpathsToGtLabelsOfEachPat, fpathsToRoiMaskOfEachPat]
+    affine = np.eye(4)
+    [rCoords, cCoords, zCoords] = np.ogrid[ :dimsOfVolumes[0], :dimsOfVolumes[1], :dimsOfVolumes[2] ]
+    normalisedSquaredDistanceFromCenter = ((rCoords - dimsOfVolumes[0]/2.) / (0.4*dimsOfVolumes[0]))**2 + \
+                                          ((cCoords - dimsOfVolumes[1]/2.) / (0.4*dimsOfVolumes[1]))**2 + \
+                                          ((zCoords - dimsOfVolumes[2]/2.) / (0.4*dimsOfVolumes[2]))**2
+    roiMask = (normalisedSquaredDistanceFromCenter <= 1).astype("int16")
+    fpathsToEachChannelOfEachPat = []; fpathsToGtLabelsOfEachPat = []; fpathsToRoiMaskOfEachPat = []
+    for subject_i in xrange(numberOfSubjects) :
+        fpathsToChannels = []
+        for channel_i in xrange(numberOfChannels) :
+            channel = np.random.normal(0, 1, dimsOfVolumes).astype("float32") * roiMask
+            fpathsToChannels.append(os.path.join(folderForSubjects, "subj" + str(subject_i) + "_chan" + str(channel_i) + ".nii.gz"))
+            nib.save(nib.Nifti1Image(channel, affine), fpathsToChannels[-1])
+        fpathsToEachChannelOfEachPat.append(fpathsToChannels)
+
+        gtLabels = np.zeros(dimsOfVolumes, dtype="int16")
+        for class_i in xrange(1, numberOfClasses) :
+            centerOfBlob = [ random.randint(dimsOfVolumes[i]/4, 3*dimsOfVolumes[i]/4) for i in xrange(3) ]
+            radiusOfBlob = max(2, min(dimsOfVolumes)/10)
+            gtLabels[ centerOfBlob[0]-radiusOfBlob : centerOfBlob[0]+radiusOfBlob,
+                      centerOfBlob[1]-radiusOfBlob : centerOfBlob[1]+radiusOfBlob,
+                      centerOfBlob[2]-radiusOfBlob : centerOfBlob[2]+radiusOfBlob ] = class_i
+        fpathsToGtLabelsOfEachPat.append(os.path.join(folderForSubjects, "subj" + str(subject_i) + "_gt.nii.gz"))
+        nib.save(nib.Nifti1Image(gtLabels * roiMask, affine), fpathsToGtLabelsOfEachPat[-1])
+        fpathsToRoiMaskOfEachPat.append(os.path.join(folderForSubjects, "subj" + str(subject_i) + "_roi.nii.gz"))
+        nib.save(nib.Nifti1Image(roiMask, affine), fpathsToRoiMaskOfEachPat[-1])
+    return [fpathsToEachChannelOfEachPat, fpathsToGtLabelsOfEachPat, fpathsToRoiMaskOfEachPat]
+
+def timeStage(functionToRun, numberOfRepeats) :
+    # Returns [resultOfLastRun, secondsOfEachRun]
+    secondsOfEachRun = []
+    for repeat_i in xrange(numberOfRepeats) :
+        startTime = time.time()
+        result = functionToRun()
+        secondsOfEachRun.append(time.time() - startTime)
+    return [result, secondsOfEachRun]
+
+def getResultsOfStage(secondsOfEachRun, numberOfSegments, numberOfVoxels, peakMemoryMB) :
+    # Throughputs from the fastest run, the least disturbed by other load of the machine.
+    bestSeconds = max(min(secondsOfEachRun), 1e-9)
+    return { "secondsOfEachRun" : secondsOfEachRun,
+             "bestSeconds" : bestSeconds,
+             "segments" : numberOfSegments,
+             "voxels" : numberOfVoxels,
+             "segmentsPerSecond" : numberOfSegments / bestSeconds,
+             "voxelsPerSecond" : numberOfVoxels / bestSeconds,
+             "peakMemoryOfProcessMB" : peakMemoryMB }
+
+def benchmarkModelConfig(myLogger, modelConfigFilepath, folderForSubjects, numberOfSubjects, dimsOfVolumes,
+                        numberOfSegmentsToSample, numberOfRepeats) :
+    [cnn3d, numberOfClasses] = makeCnnFromModelConfig(modelConfigFilepath, myLogger, folderForSubjects)
+    numberOfChannels = cnn3d.pathways[0].getShapeOfInput()[0][1]
+    [fpathsToEachChannelOfEachPat,
+    fpathsToGtLabelsOfEachPat,
+    fpathsToRoiMaskOfEachPat] = makeSyntheticSubjects(folderForSubjects, numberOfSubjects, numberOfChannels,
+                                                        numberOfClasses, dimsOfVolumes)
+    dimsOfTrainSegment = cnn3d.pathways[0].getShapeOfInput()[0][2:]
+    dimsOfInferSegment = cnn3d.pathways[0].getShapeOfInput()[2][2:]
+    inputVoxelsPerSegmentTrain = sum([ int(np.prod(pathway.getShapeOfInput()[0][1:])) for pathway in cnn3d.pathways[:cnn3d.getNumPathwaysThatRequireInput()] ])
+    inputVoxelsPerSegmentInfer = sum([ int(np.prod(pathway.getShapeOfInput()[2][1:])) for pathway in cnn3d.pathways[:cnn3d.getNumPathwaysThatRequireInput()] ])
+    outputDimsInfer = cnn3d.finalTargetLayer_outputShapeTrainValTest[2][2:]
+    batchSizeInfer = cnn3d.batchSizeTrainValTest[2]
+    rczHalfRecFieldCnn = [ (cnn3d.recFieldCnn[i]-1)/2 for i in xrange(3) ]
+
+    # Times and counts of a stage are summed over the subjects.
+    resultsPerStage = {}
+    secondsOfEachRunPerStage = {}; peakMemoryPerStage = {}
+    def addTimesOfSubject(nameOfStage, secondsOfEachRun) :
+        if nameOfStage not in secondsOfEachRunPerStage :
+            secondsOfEachRunPerStage[nameOfStage] = [0.]*numberOfRepeats
+        secondsOfEachRunPerStage[nameOfStage] = [ secondsOfEachRunPerStage[nameOfStage][i] + secondsOfEachRun[i] for i in xrange(numberOfRepeats) ]
+        peakMemoryPerStage[nameOfStage] = getPeakMemoryOfProcessInMB() # Peak of the process so far. It never decreases.
+    numberOfSegmentsPerStage = {}; numberOfVoxelsPerStage = {}
+    def addCountsOfSubject(nameOfStage, numberOfSegments, numberOfVoxels) :
+        numberOfSegmentsPerStage[nameOfStage] = numberOfSegmentsPerStage.get(nameOfStage, 0) + numberOfSegments
+        numberOfVoxelsPerStage[nameOfStage] = numberOfVoxelsPerStage.get(nameOfStage, 0) + numberOfVoxels
+
+    for subject_i in xrange(numberOfSubjects) :
+        # Loading, as for training: Channels, gt, roi, padded. No augmentation, so that all runs do the same work.
+        loadSubject = lambda : actual_load_patient_imgs(myLogger, 0, subject_i, fpathsToEachChannelOfEachPat,
+                                                        True, fpathsToGtLabelsOfEachPat,
+                                                        False, "placeholder",
+                                                        True, fpathsToRoiMaskOfEachPat,
+                                                        True, cnn3d.numSubsPaths > 0, "placeholder",
+                                                        True, cnn3d.recFieldCnn, dimsOfTrainSegment,
+                                                        [None, None], [0,-1,-1,-1], [0,0,0])
+        [loadedSubject, secondsOfEachRun] = timeStage(loadSubject, numberOfRepeats)
+        [allChannelsOfPatientInNpArray, gtLabelsImage, roiMask, _, allSubsamChannelsOfPatient, _, _] = loadedSubject
+        dimsOfPaddedVolume = list(allChannelsOfPatientInNpArray.shape[1:])
+        addTimesOfSubject("loadSubject", secondsOfEachRun)
+        addCountsOfSubject("loadSubject", 0, allChannelsOfPatientInNpArray.size + gtLabelsImage.size + roiMask.size)
+
+        # Sampling of central voxels, with the roi as weight-map.
+        weightMap = roiMask.astype("float32")
+        [indexForSampling, secondsOfEachRun] = timeStage(lambda : buildIndexForSamplingCentralVoxels(weightMap, dimsOfTrainSegment), numberOfRepeats)
+        addTimesOfSubject("buildIndexForSampling", secondsOfEachRun)
+        addCountsOfSubject("buildIndexForSampling", 0, weightMap.size)
+        sampleSegments = lambda : sampleImageParts(myLogger, numberOfSegmentsToSample, dimsOfTrainSegment,
+                                                    dimsOfPaddedVolume, None, indexForSampling)
+        [imagePartsSampled, secondsOfEachRun] = timeStage(sampleSegments, numberOfRepeats)
+        addTimesOfSubject("sampleImageParts", secondsOfEachRun)
+        addCountsOfSubject("sampleImageParts", numberOfSegmentsToSample, 0)
+
+        # Extraction of the sampled training segments, one by one as in training.
+        coordsOfCentralVoxelsOfPartsSampled = imagePartsSampled[0]
+        def extractTrainSegments() :
+            for segment_i in xrange(numberOfSegmentsToSample) :
+                extractDataOfASegmentFromImagesUsingSampledSliceCoords(0, cnn3d,
+                                                                    coordsOfCentralVoxelsOfPartsSampled[:,segment_i],
+                                                                    numberOfChannels,
+                                                                    allChannelsOfPatientInNpArray,
+                                                                    allSubsamChannelsOfPatient,
+                                                                    gtLabelsImage,
+                                                                    [0,-1,-1,-1],
+                                                                    None)
+        [_, secondsOfEachRun] = timeStage(extractTrainSegments, numberOfRepeats)
+        addTimesOfSubject("extractTrainSegments", secondsOfEachRun)
+        addCountsOfSubject("extractTrainSegments", numberOfSegmentsToSample, numberOfSegmentsToSample*inputVoxelsPerSegmentTrain)
+
+        # Tiling of the whole volume for inference, in segments that do not overlap in their output.
+        tileSubject = lambda : getCoordsOfAllSegmentsOfAnImage(myLogger, dimsOfInferSegment, outputDimsInfer,
+                                                                allChannelsOfPatientInNpArray, roiMask)
+        [[sliceCoordsOfSegs], secondsOfEachRun] = timeStage(tileSubject, numberOfRepeats)
+        numberOfSegmentsInfer = len(sliceCoordsOfSegs)
+        addTimesOfSubject("getCoordsOfAllSegmentsOfAnImage", secondsOfEachRun)
+        addCountsOfSubject("getCoordsOfAllSegmentsOfAnImage", numberOfSegmentsInfer, roiMask.size)
+
+        # Extraction of the inference segments, batch by batch.
+        def extractInferSegments() :
+            for firstSegmentOfBatch in xrange(0, numberOfSegmentsInfer, batchSizeInfer) : # The last batch may be smaller.
+                extractDataOfSegmentsUsingSampledSliceCoords(cnn3d,
+                                                            sliceCoordsOfSegs[ firstSegmentOfBatch : firstSegmentOfBatch+batchSizeInfer ],
+                                                            allChannelsOfPatientInNpArray,
+                                                            allSubsamChannelsOfPatient,
+                                                            cnn3d.recFieldCnn)
+        [_, secondsOfEachRun] = timeStage(extractInferSegments, numberOfRepeats)
+        addTimesOfSubject("extractInferSegments", secondsOfEachRun)
+        addCountsOfSubject("extractInferSegments", numberOfSegmentsInfer, numberOfSegmentsInfer*inputVoxelsPerSegmentInfer)
+
+        # Stitching of the probability maps, from random predictions of the shape of the output of the cnn.
+        predictionsOfBatch = np.random.random_sample([batchSizeInfer, numberOfClasses] + list(outputDimsInfer)).astype("float32")
+        for [nameOfStage, averageOverlappingPredictions] in [ ["stitchProbMaps", False], ["stitchProbMapsAveraging", True] ] :
+            def stitchProbMaps() :
+                predLabelImg = np.zeros([numberOfClasses] + dimsOfPaddedVolume, dtype="float32")
+                sumOfWeightsImg = np.zeros(dimsOfPaddedVolume, dtype="float32") if averageOverlappingPredictions else None
+                for firstSegmentOfBatch in xrange(0, numberOfSegmentsInfer, batchSizeInfer) :
+                    coordsOfSegsOfBatch = sliceCoordsOfSegs[ firstSegmentOfBatch : firstSegmentOfBatch+batchSizeInfer ]
+                    placeBatchOfOutputCubesInImage(predLabelImg,
+                                                    predictionsOfBatch[:len(coordsOfSegsOfBatch)],
+                                                    coordsOfSegsOfBatch,
+                                                    rczHalfRecFieldCnn,
+                                                    sumOfWeightsImg)
+            [_, secondsOfEachRun] = timeStage(stitchProbMaps, numberOfRepeats)
+            addTimesOfSubject(nameOfStage, secondsOfEachRun)
+            addCountsOfSubject(nameOfStage, numberOfSegmentsInfer, numberOfSegmentsInfer*numberOfClasses*int(np.prod(outputDimsInfer)))
+
+    for nameOfStage in secondsOfEachRunPerStage :
+        resultsPerStage[nameOfStage] = getResultsOfStage(secondsOfEachRunPerStage[nameOfStage],
+                                                        numberOfSegmentsPerStage[nameOfStage],
+                                                        numberOfVoxelsPerStage[nameOfStage],
+                                                        peakMemoryPerStage[nameOfStage])
+    geometry = { "receptiveField" : cnn3d.recFieldCnn,
+                "shapesOfInputsOfPathwaysTrainValTest" : [ pathway.getShapeOfInput() for pathway in cnn3d.pathways ],
+                "shapeOfOutputTrainValTest" : cnn3d.finalTargetLayer_outputShapeTrainValTest }
+    return [geometry, resultsPerStage]
+
+def printComparisonOfResults(filepathOfOldResults, filepathOfNewResults) :
+    oldResults = json.load(open(filepathOfOldResults)); newResults = json.load(open(filepathOfNewResults))
+    print "Old: ", filepathOfOldResults, " (revision: ", oldResults["gitRevision"], ")"
+    print "New: ", filepathOfNewResults, " (revision: ", newResults["gitRevision"], ")"
+    for modelConfigFilepath in sorted(newResults["resultsPerModelConfig"]) :
+        if modelConfigFilepath not in oldResults["resultsPerModelConfig"] :
+            continue
+        print "Model config: ", modelConfigFilepath
+        oldResultsPerStage = oldResults["resultsPerModelConfig"][modelConfigFilepath]["resultsPerStage"]
+        newResultsPerStage = newResults["resultsPerModelConfig"][modelConfigFilepath]["resultsPerStage"]
+        for nameOfStage in sorted(newResultsPerStage) :
+            if nameOfStage not in oldResultsPerStage :
+                continue
+            oldSeconds = oldResultsPerStage[nameOfStage]["bestSeconds"]; newSeconds = newResultsPerStage[nameOfStage]["bestSeconds"]
+            print "    %-35s old: %10.4f(s)  new: %10.4f(s)  speedup: x%.2f" % (nameOfStage, oldSeconds, newSeconds, oldSeconds / newSeconds)
+
+def deepMedicBenchmarkMain(listOfModelConfigFilepaths, filepathForResults, dimsOfVolumes, numberOfSubjects=2,
+                        numberOfSegmentsToSample=1000, numberOfRepeats=3, seed=1) :
+    folderForSubjects = tempfile.mkdtemp(prefix="deepMedicBenchmark")
+    myLogger = myLoggerModule.MyLogger(os.path.join(folderForSubjects, "benchmark.txt"))
+    results = { "gitRevision" : getGitRevisionOfCode(),
+                "date" : time.strftime("%Y-%m-%d %H:%M:%S"),
+                "machine" : platform.platform(),
+                "versionOfPython" : platform.python_version(),
+                "versionOfNumpy" : np.__version__,
+                "dimsOfVolumes" : dimsOfVolumes,
+                "numberOfSubjects" : numberOfSubjects,
+                "numberOfSegmentsToSamplePerSubject" : numberOfSegmentsToSample,
+                "numberOfRepeats" : numberOfRepeats,
+                "seed" : seed,
+                "resultsPerModelConfig" : {} }
+    try :
+        for modelConfigFilepath in listOfModelConfigFilepaths :
+            myLogger.print3("Benchmarking the geometry of the model of: " + modelConfigFilepath)
+            np.random.seed(seed); random.seed(seed)
+            [geometry, resultsPerStage] = benchmarkModelConfig(myLogger, modelConfigFilepath, folderForSubjects,
+                                                                numberOfSubjects, dimsOfVolumes,
+                                                                numberOfSegmentsToSample, numberOfRepeats)
+            results["resultsPerModelConfig"][modelConfigFilepath] = { "geometry" : geometry, "resultsPerStage" : resultsPerStage }
+            for nameOfStage in sorted(resultsPerStage) :
+                resultsOfStage = resultsPerStage[nameOfStage]
+                myLogger.print3("%-35s %10.4f(s) %12.1f segments/s %14.1f voxels/s  peak memory: %.1f MB" % \
+                                (nameOfStage, resultsOfStage["bestSeconds"], resultsOfStage["segmentsPerSecond"],
+                                resultsOfStage["voxelsPerSecond"], resultsOfStage["peakMemoryOfProcessMB"]))
+    finally :
+        shutil.rmtree(folderForSubjects, ignore_errors=True)
+    f = open(filepathForResults, "w")
+    try :
+        json.dump(results, f, indent=2, sort_keys=True)
+    finally :
+        f.close()
+    print "Results were written at: ", filepathForResults
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks the cpu-side stages of the pipeline (loading, sampling, "+\
+                                     "extraction of segments, tiling, stitching of probability maps) on synthetic subjects.")
+    parser.add_argument("-model", dest="modelConfigs", type=str, nargs="+", help="Path(s) to model-config files, "+\
+                        "that give the geometry of the cnn. Eg the tinyCnn and model configs of the examples.")
+    parser.add_argument("-out", dest="results", type=str, default="benchmarkResults.json", help="Where to write the json results.")
+    parser.add_argument("-dims", dest="dims", type=int, nargs=3, default=[150,180,150], help="Dimensions of the synthetic volumes.")
+    parser.add_argument("-subjects", dest="subjects", type=int, default=2, help="Number of synthetic subjects.")
+    parser.add_argument("-segments", dest="segments", type=int, default=1000, help="Training segments to sample per subject.")
+    parser.add_argument("-repeats", dest="repeats", type=int, default=3, help="Runs of each stage. The fastest is reported.")
+    parser.add_argument("-seed", dest="seed", type=int, default=1, help="Seed of the random number generators.")
+    parser.add_argument("-compare", dest="compare", type=str, nargs=2, help="Compare two json results: old new.")
+    args = parser.parse_args()
+    if args.compare :
+        printComparisonOfResults(args.compare[0], args.compare[1])
+    elif args.modelConfigs :
+        deepMedicBenchmarkMain([ os.path.abspath(modelConfig) for modelConfig in args.modelConfigs ],
+                            os.path.abspath(args.results), args.dims, args.subjects, args.segments, args.repeats, args.seed)
+    else :
+        parser.print_help()
+
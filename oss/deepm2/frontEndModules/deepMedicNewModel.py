@@ -19,10 +19,9 @@ from deepmedic.frontEndModules.frontEndHelpers.parsingFilesHelpers import checkT
 from deepmedic.frontEndModules.frontEndHelpers.createModelParametersClass import CreateModelSessionParameters
 from deepmedic.frontEndModules.frontEndHelpers.preparationForSessionHelpers import makeFoldersNeededForCreateModelSession
 
-from deepmedic.cnnHelpers import dump_cnn_to_gzip_file_dotSave
+from deepmedic.cnnCheckpoint import save_cnn_to_checkpoint, load_cnn_from_file
 from deepmedic.genericHelpers import datetimeNowAsStr
 
-from deepmedic.genericHelpers import load_object_from_gzip_file
 
 class ModelConfig(object):
     configStruct = {} #In here will be placed all read arguments.
@@ -82,29 +81,15 @@ class ModelConfig(object):
     
     #Batch Normalization
     BN_ROLL_AV_BATCHES = "rollAverageForBNOverThatManyBatches"
+    
+    #Implementation of the convolutions: "conv3d2d", "corr3dMM", "fft", or "auto" to benchmark them for each layer \
+    #when the model is created and use the fastest.
+    CONV_BACKEND = "convolutionBackend"
 
 
-#The argument should be absolute path to the config file for the model to create.
-def deepMedicNewModelMain(modelConfigFilepath, absPathToPreTrainedModelGivenInCmdLine, listOfLayersToTransfer) :
-    print "Given Model-Configuration File: ", modelConfigFilepath
-    #Parse the config file in this naive fashion...
-    modelConfig = ModelConfig()
-    execfile(modelConfigFilepath, modelConfig.configStruct)
-    configGet = modelConfig.get #Main interface
-    
-    #Create Folders and Logger
-    mainOutputAbsFolder = getAbsPathEvenIfRelativeIsGiven(configGet(modelConfig.FOLDER_FOR_OUTPUT), modelConfigFilepath)
-    modelName = configGet(modelConfig.MODEL_NAME) if configGet(modelConfig.MODEL_NAME) else \
-                                    CreateModelSessionParameters.getDefaultModelName()
-    [folderForCnnModels,
-    folderForLogs] = makeFoldersNeededForCreateModelSession(mainOutputAbsFolder, modelName)
-    loggerFileName = folderForLogs + "/" + modelName + ".txt"
-    sessionLogger = myLoggerModule.MyLogger(loggerFileName)
-    
-    sessionLogger.print3("CONFIG: The configuration file for the model-creation session was loaded from: " + \
-                         str(modelConfigFilepath))
-    
-    #Fill in the session's parameters.
+# Also used by the benchmark, to build a model with the geometry of a config.
+def getCreateModelSessionParametersFromConfig(modelConfig, modelName, sessionLogger, mainOutputAbsFolder, folderForCnnModels) :
+    configGet = modelConfig.get
     createModelSessionParameters = CreateModelSessionParameters(
                     cnnModelName=modelName,
                     sessionLogger=sessionLogger,
@@ -147,7 +132,38 @@ def deepMedicNewModelMain(modelConfigFilepath, absPathToPreTrainedModelGivenInCm
                     initialMethod=configGet(modelConfig.INITIAL_METHOD),
                     #== Batch Normalization ==
                     bnRollingAverOverThatManyBatches=configGet(modelConfig.BN_ROLL_AV_BATCHES),
+                    #== Convolution ==
+                    convolutionBackend=configGet(modelConfig.CONV_BACKEND)
                     )
+    return createModelSessionParameters
+
+
+#The argument should be absolute path to the config file for the model to create.
+def deepMedicNewModelMain(modelConfigFilepath, absPathToPreTrainedModelGivenInCmdLine, listOfLayersToTransfer) :
+    print "Given Model-Configuration File: ", modelConfigFilepath
+    #Parse the config file in this naive fashion...
+    modelConfig = ModelConfig()
+    execfile(modelConfigFilepath, modelConfig.configStruct)
+    configGet = modelConfig.get #Main interface
+    
+    #Create Folders and Logger
+    mainOutputAbsFolder = getAbsPathEvenIfRelativeIsGiven(configGet(modelConfig.FOLDER_FOR_OUTPUT), modelConfigFilepath)
+    modelName = configGet(modelConfig.MODEL_NAME) if configGet(modelConfig.MODEL_NAME) else \
+                                    CreateModelSessionParameters.getDefaultModelName()
+    [folderForCnnModels,
+    folderForLogs] = makeFoldersNeededForCreateModelSession(mainOutputAbsFolder, modelName)
+    loggerFileName = folderForLogs + "/" + modelName + ".txt"
+    sessionLogger = myLoggerModule.MyLogger(loggerFileName)
+    
+    sessionLogger.print3("CONFIG: The configuration file for the model-creation session was loaded from: " + \
+                         str(modelConfigFilepath))
+    
+    #Fill in the session's parameters.
+    createModelSessionParameters = getCreateModelSessionParametersFromConfig(modelConfig,
+                                                                            modelName,
+                                                                            sessionLogger,
+                                                                            mainOutputAbsFolder,
+                                                                            folderForCnnModels)
     
     
     createModelSessionParameters.sessionLogger.print3("\n===========    NEW CREATE-MODEL SESSION    ============")
@@ -160,7 +176,7 @@ def deepMedicNewModelMain(modelConfigFilepath, absPathToPreTrainedModelGivenInCm
     if absPathToPreTrainedModelGivenInCmdLine <> None: # Transfer parameters from a previously trained model to the new one.
         createModelSessionParameters.sessionLogger.print3("\n=========== Pre-training the new model ===============")
         sessionLogger.print3("...Loading the pre-trained network. This can take a few minutes if the model is big...")
-        cnnPretrainedInstance = load_object_from_gzip_file(absPathToPreTrainedModelGivenInCmdLine)
+        cnnPretrainedInstance = load_cnn_from_file(absPathToPreTrainedModelGivenInCmdLine, sessionLogger)
         sessionLogger.print3("The pre-trained model was loaded successfully from: " + \
                              str(absPathToPreTrainedModelGivenInCmdLine))
         from deepmedic import cnnTransferParameters
@@ -175,7 +191,7 @@ def deepMedicNewModelMain(modelConfigFilepath, absPathToPreTrainedModelGivenInCm
         filenameAndPathToSaveModel = createModelSessionParameters.getPathAndFilenameToSaveModel() + \
                 ".initial." + datetimeNowAsStr()
     filenameAndPathWhereModelWasSaved =  \
-        dump_cnn_to_gzip_file_dotSave(cnn3dInstance, filenameAndPathToSaveModel, sessionLogger)
+        save_cnn_to_checkpoint(cnn3dInstance, filenameAndPathToSaveModel, sessionLogger)
     createModelSessionParameters.sessionLogger.print3("=========== Creation of the model: \"" + \
                                 str(createModelSessionParameters.cnnModelName) +"\" finished =================")
     
@@ -6,10 +6,12 @@
 # or read the terms at https://opensource.org/licenses/BSD-3-Clause.
 
 import os
+import time
 
 from deepmedic import myLoggerModule
 
 from deepmedic.trainValidateTestVisualiseParallel import performInferForTestOnWholeVols
+from deepmedic.stageTimers import stageTimers
 
 from deepmedic.frontEndModules.frontEndHelpers.parsingFilesHelpers import getAbsPathEvenIfRelativeIsGiven
 from deepmedic.frontEndModules.frontEndHelpers.parsingFilesHelpers import checkIfAllElementsOfAListAreFilesAndExitIfNot
@@ -21,7 +23,11 @@ from deepmedic.frontEndModules.frontEndHelpers.parsingFilesHelpers import checkT
 from deepmedic.frontEndModules.frontEndHelpers.testParametersClass import TestSessionParameters
 from deepmedic.frontEndModules.frontEndHelpers.preparationForSessionHelpers import makeFoldersNeededForTestingSession
 
-from deepmedic.genericHelpers import load_object_from_gzip_file
+from deepmedic.cnnCheckpoint import load_cnn_from_file
+from deepmedic.compiledFunctionsCache import loadOrCompileFunctionsOfCnn
+from deepmedic.largeTileInference import getCnnForInferenceOnLargeTiles
+from deepmedic.inferenceBatchSize import setBatchSizeForInference
+from deepmedic.parallelInference import segmentSubjectsWithInferenceWorkers, LoggerOfInferenceWorker
 
 class TestConfig(object):
     configStruct = {} #In here will be placed all read arguments.
@@ -56,6 +62,40 @@ class TestConfig(object):
     INDICES_OF_FMS_TO_SAVE_SUBSAMPLED = "minMaxIndicesOfFmsToSaveFromEachLayerOfSubsampledPathway"
     INDICES_OF_FMS_TO_SAVE_FC = "minMaxIndicesOfFmsToSaveFromEachLayerOfFullyConnectedPathway"
     
+    #Stride of the segments when tiling the image. Default is the number of voxels predicted per segment. \
+    # Smaller strides make the segments overlap, and their predictions are averaged.
+    STRIDE_OF_SEGMENTS = "strideOfSegmentsForInference"
+    #How many subjects to load in a background thread, while the previous is segmented. 0 to disable. Default 1.
+    NUM_SUBJECTS_TO_PREFETCH = "numberOfSubjectsToPrefetch"
+    #Folder where the preprocessed volumes are cached as .npy files, reused across sessions. None to disable.
+    FOLDER_FOR_PREPROC_CACHE = "folderForPreprocessedVolumeCache"
+    #Budget of the cache. Least recently used volumes are deleted when exceeded. Default 20.
+    MAX_GB_OF_PREPROC_CACHE = "maxGigabytesOfPreprocessedVolumeCache"
+    #Folder where the compiled functions are cached, to skip their compilation at the startup of later sessions \
+    # with the same architecture, batch sizes, device and theano config. None to disable.
+    FOLDER_FOR_COMPILED_FUNCTIONS_CACHE = "folderForCompiledFunctionsCache"
+    #What the testing function returns: "probabilities" (default), "float16" (probabilities in half the bytes) \
+    # or "labels" (argmax on the GPU. No probability maps, and no overlapping segments). Ignored if FMs are saved.
+    OUTPUT_OF_INFERENCE_FUNCTION = "outputOfInferenceFunction"
+    #Rebuild the test graph of the model for segments as large as the (padded) volumes, within a budget of memory. \
+    # Each convolution is then computed once over the context that neighbouring segments share. Default False.
+    USE_LARGE_TILES_FOR_INFERENCE = "useLargeTilesForInference"
+    #Budget of memory for the large tiles. Default: Half of the memory available at the start of the session.
+    MAX_GB_FOR_LARGE_TILES = "maxGigabytesForLargeTiles"
+    #Segments per call of the testing function: A number, or "auto" for the largest batch that fits the budget below. \
+    # The last batch of each subject may be smaller. Default: The batch size the model was made with.
+    BATCH_SIZE_FOR_INFERENCE = "batchSizeForInference"
+    #Budget of memory for "auto". Default: Half of the memory free on the device (GPU, or host) at the start of the session.
+    MAX_GB_FOR_INFERENCE_BATCH = "maxGigabytesForInferenceBatch"
+    #Precision of the volumes held in memory: "float32" (default) or "float16", which also keeps labels and masks \
+    # in uint8/int16. Probability maps and FMs are then saved as int16 with a scaling, segmentations as uint8.
+    STORAGE_PRECISION_OF_VOLUMES = "storagePrecisionOfVolumes"
+    #Segment the subjects with several worker processes, each loading the model on its device: A list with the \
+    # device of each worker, eg ["gpu0", "gpu1"], or a number of workers on the cpu. The subjects are given to the \
+    # workers one at a time. Their log, records and a table of the metrics of all subjects are gathered in the \
+    # session's logs. Default: None, the subjects are segmented by this process, on the device it was given.
+    DEVICES_OF_INFERENCE_WORKERS = "devicesOfInferenceWorkers"
+    
     def checkIfConfigIsCorrectForParticularCnnModel(self, cnnInstance) :
         # DEPRECATED
         print "Checking if configuration is correct in relation to the loaded model \
@@ -293,8 +333,10 @@ def checkIfOptionalParametersAreGivenCorrectly(testConfig, testConfigFilepath) :
         after the cnn-model is loaded..."
     
 #Both the arguments are absolute paths. The "absPathToSavedModelFromCmdLine" can be None 
-# if it was not provided in cmd line.
-def deepMedicTestMain(testConfigFilepath, absPathToSavedModelFromCmdLine) :
+# if it was not provided in cmd line. connectionToCoordinator is given when run by an inference worker, \
+# which segments the subjects that the coordinator gives it (see parallelInference).
+def deepMedicTestMain(testConfigFilepath, absPathToSavedModelFromCmdLine, connectionToCoordinator=None) :
+    startTimeOfSession = time.time()
     print "Given Test-Configuration File: ", testConfigFilepath
     #Parse the config file in this naive fashion...
     testConfig = TestConfig()
@@ -319,11 +361,45 @@ def deepMedicTestMain(testConfigFilepath, absPathToSavedModelFromCmdLine) :
     folderForPredictions,
     folderForFeatures] = makeFoldersNeededForTestingSession(mainOutputAbsFolder, sessionName)
     loggerFileName = folderForLogs + "/" + sessionName + ".txt"
-    sessionLogger = myLoggerModule.MyLogger(loggerFileName)
+    sessionLogger = myLoggerModule.MyLogger(loggerFileName) if connectionToCoordinator == None else \
+                        LoggerOfInferenceWorker(connectionToCoordinator, loggerFileName)
     
     sessionLogger.print3("CONFIG: The configuration file for the testing session was loaded from: " + \
                          str(testConfigFilepath))
     
+    #Fill in the session's parameters.
+    #[[case1-ch1, ..., caseN-ch1], [case1-ch2,...,caseN-ch2]]
+    listOfAListPerChannelWithFilepathsOfAllCases = [parseAbsFileLinesInList(getAbsPathEvenIfRelativeIsGiven(channelConfPath, \
+                                                testConfigFilepath)) for channelConfPath in configGet(testConfig.CHANNELS)]
+    #[[case1-ch1, case1-ch2], ..., [caseN-ch1, caseN-ch2]]
+    listWithAListPerCaseWithFilepathPerChannel = [ list(item) for item in \
+                                                   zip(*tuple(listOfAListPerChannelWithFilepathsOfAllCases)) ]
+    gtLabelsFilepaths = parseAbsFileLinesInList( getAbsPathEvenIfRelativeIsGiven(\
+                    configGet(testConfig.GT_LABELS), testConfigFilepath) ) if configGet(testConfig.GT_LABELS) else None
+    roiMasksFilepaths = parseAbsFileLinesInList( getAbsPathEvenIfRelativeIsGiven(\
+                    configGet(testConfig.ROI_MASKS), testConfigFilepath) ) if configGet(testConfig.ROI_MASKS) else None
+    namesToSavePredsAndFeats = parseFileLinesInList( getAbsPathEvenIfRelativeIsGiven(\
+                    configGet(testConfig.NAMES_FOR_PRED_PER_CASE), testConfigFilepath) ) if \
+                        configGet(testConfig.NAMES_FOR_PRED_PER_CASE) else None #CAREFUL: Here we use a \
+                        #different parsing function!
+    
+    #With inference workers, this process only coordinates them. Each loads the model and runs this session.
+    if configGet(testConfig.DEVICES_OF_INFERENCE_WORKERS) and connectionToCoordinator == None :
+        sessionLogger.print3("\n======================================================")
+        sessionLogger.print3("=========== Testing with inference workers ===========")
+        sessionLogger.print3("======================================================")
+        argsOfWorker = ["-test", testConfigFilepath] + \
+                        (["-model", absPathToSavedModelFromCmdLine] if absPathToSavedModelFromCmdLine else [])
+        namesOfSubjects = namesToSavePredsAndFeats if namesToSavePredsAndFeats else \
+                            [ channels[0] for channels in listWithAListPerCaseWithFilepathPerChannel ]
+        segmentSubjectsWithInferenceWorkers(sessionLogger, configGet(testConfig.DEVICES_OF_INFERENCE_WORKERS), argsOfWorker,
+                                            namesOfSubjects, gtLabelsFilepaths <> None)
+        sessionLogger.print3("TIMING: The session took " + str(time.time() - startTimeOfSession) + "(s).")
+        sessionLogger.print3("\n======================================================")
+        sessionLogger.print3("=========== Testing session finished =================")
+        sessionLogger.print3("======================================================")
+        return
+    
     #Load the CNN Model!
     sessionLogger.print3("=========== Loading the CNN model for testing... ===============")
     #If CNN-Model was specified in command line, completely override the one in the config file.
@@ -339,27 +415,16 @@ def deepMedicTestMain(testConfigFilepath, absPathToSavedModelFromCmdLine) :
         filepathToCnnModelToLoad = getAbsPathEvenIfRelativeIsGiven(configGet(testConfig.CNN_MODEL_FILEPATH), \
                                                                    testConfigFilepath)
     sessionLogger.print3("...Loading the network can take a few minutes if the model is big...")
-    cnn3dInstance = load_object_from_gzip_file(filepathToCnnModelToLoad)
+    cnn3dInstance = load_cnn_from_file(filepathToCnnModelToLoad, sessionLogger)
     sessionLogger.print3("The CNN model was loaded successfully from: " + str(filepathToCnnModelToLoad))
     #Do final checks of the parameters. Check the ones that need check in comparison to the model's parameters! \
     # Such as: SAVE_PROBMAPS_PER_CLASS, INDICES_OF_FMS_TO_SAVE, Number of Channels!
     #testConfig.checkIfConfigIsCorrectForParticularCnnModel(cnn3dInstance)
     
-    #Fill in the session's parameters.
-    #[[case1-ch1, ..., caseN-ch1], [case1-ch2,...,caseN-ch2]]
-    listOfAListPerChannelWithFilepathsOfAllCases = [parseAbsFileLinesInList(getAbsPathEvenIfRelativeIsGiven(channelConfPath, \
-                                                testConfigFilepath)) for channelConfPath in configGet(testConfig.CHANNELS)]
-    #[[case1-ch1, case1-ch2], ..., [caseN-ch1, caseN-ch2]]
-    listWithAListPerCaseWithFilepathPerChannel = [ list(item) for item in \
-                                                   zip(*tuple(listOfAListPerChannelWithFilepathsOfAllCases)) ]
-    gtLabelsFilepaths = parseAbsFileLinesInList( getAbsPathEvenIfRelativeIsGiven(\
-                    configGet(testConfig.GT_LABELS), testConfigFilepath) ) if configGet(testConfig.GT_LABELS) else None
-    roiMasksFilepaths = parseAbsFileLinesInList( getAbsPathEvenIfRelativeIsGiven(\
-                    configGet(testConfig.ROI_MASKS), testConfigFilepath) ) if configGet(testConfig.ROI_MASKS) else None
-    namesToSavePredsAndFeats = parseFileLinesInList( getAbsPathEvenIfRelativeIsGiven(\
-                    configGet(testConfig.NAMES_FOR_PRED_PER_CASE), testConfigFilepath) ) if \
-                        configGet(testConfig.NAMES_FOR_PRED_PER_CASE) else None #CAREFUL: Here we use a \
-                        #different parsing function!
+    folderForPreprocessedVolumeCache = getAbsPathEvenIfRelativeIsGiven(configGet(testConfig.FOLDER_FOR_PREPROC_CACHE), \
+                                        testConfigFilepath) if configGet(testConfig.FOLDER_FOR_PREPROC_CACHE) else None
+    folderForCompiledFunctionsCache = getAbsPathEvenIfRelativeIsGiven(configGet(testConfig.FOLDER_FOR_COMPILED_FUNCTIONS_CACHE), \
+                        testConfigFilepath) if configGet(testConfig.FOLDER_FOR_COMPILED_FUNCTIONS_CACHE) else None
     
     testSessionParameters = TestSessionParameters(
                     sessionName = sessionName,
@@ -390,20 +455,62 @@ def deepMedicTestMain(testConfigFilepath, absPathToSavedModelFromCmdLine) :
                     folderForFeatures = folderForFeatures,
                     
                     padInputImagesBool = configGet(testConfig.PAD_INPUT),
+                    
+                    strideOfSegmentsForInference = configGet(testConfig.STRIDE_OF_SEGMENTS),
+                    numSubjectsToPrefetch = configGet(testConfig.NUM_SUBJECTS_TO_PREFETCH),
+                    
+                    folderForPreprocessedVolumeCache = folderForPreprocessedVolumeCache,
+                    maxGigabytesOfPreprocessedVolumeCache = configGet(testConfig.MAX_GB_OF_PREPROC_CACHE),
+                    
+                    folderForCompiledFunctionsCache = folderForCompiledFunctionsCache,
+                    
+                    outputOfInferenceFunction = configGet(testConfig.OUTPUT_OF_INFERENCE_FUNCTION),
+                    
+                    useLargeTilesForInference = configGet(testConfig.USE_LARGE_TILES_FOR_INFERENCE),
+                    maxGigabytesForLargeTiles = configGet(testConfig.MAX_GB_FOR_LARGE_TILES),
+                    
+                    batchSizeForInference = configGet(testConfig.BATCH_SIZE_FOR_INFERENCE),
+                    maxGigabytesForInferenceBatch = configGet(testConfig.MAX_GB_FOR_INFERENCE_BATCH),
+                    
+                    storagePrecisionOfVolumes = configGet(testConfig.STORAGE_PRECISION_OF_VOLUMES)
                     )
     
     testSessionParameters.sessionLogger.print3("\n===========       NEW TESTING SESSION         ===============")
     testSessionParameters.printParametersOfThisSession()
     
+    if testSessionParameters.useLargeTilesForInference :
+        cnn3dInstance = getCnnForInferenceOnLargeTiles(testSessionParameters.sessionLogger, cnn3dInstance,
+                                                       [ channels[0] for channels in testSessionParameters.channelsFilepaths ],
+                                                       testSessionParameters.padInputImagesBool,
+                                                       testSessionParameters.maxGigabytesForLargeTiles)
+        testSessionParameters.cnn3dInstance = cnn3dInstance
+        
+    setBatchSizeForInference(testSessionParameters.sessionLogger, cnn3dInstance,
+                             testSessionParameters.batchSizeForInference,
+                             testSessionParameters.maxGigabytesForInferenceBatch)
+    
     testSessionParameters.sessionLogger.print3("\n=======================================================")
     testSessionParameters.sessionLogger.print3("=========== Compiling the Testing Function ============")
     testSessionParameters.sessionLogger.print3("=======================================================")
-    cnn3dInstance.compileTestAndVisualisationFunction(*testSessionParameters.getTupleForCompilationOfTestFunc())
+    #The function that returns the FMs of all layers is compiled only if they are saved. Otherwise the lean one.
+    if testSessionParameters.requiresVisualisationFunc() :
+        kindsAndTuplesForCompilation = [["visualisation", testSessionParameters.getTupleForCompilationOfVisualisationFunc()]]
+    else :
+        kindsAndTuplesForCompilation = [["test", testSessionParameters.getTupleForCompilationOfTestFunc()]]
+    secondsForFunctions = loadOrCompileFunctionsOfCnn(testSessionParameters.sessionLogger, cnn3dInstance,
+                                                      testSessionParameters.compiledFunctionsCache,
+                                                      kindsAndTuplesForCompilation)
+    testSessionParameters.sessionLogger.print3("TIMING: Startup of the session took " + \
+                            str(time.time() - startTimeOfSession) + "(s), of which compiling or loading the " + \
+                            "compiled functions took " + str(secondsForFunctions) + "(s).")
     
     testSessionParameters.sessionLogger.print3("\n======================================================")
     testSessionParameters.sessionLogger.print3("=========== Testing with the CNN model ===============")
     testSessionParameters.sessionLogger.print3("======================================================")
-    performInferForTestOnWholeVols(*testSessionParameters.getTupleForCnnTesting())
+    indicesOfSubjectsToSegment = None if connectionToCoordinator == None else \
+                                    connectionToCoordinator.iterateIndicesOfSubjects()
+    performInferForTestOnWholeVols(*testSessionParameters.getTupleForCnnTesting(indicesOfSubjectsToSegment))
+    stageTimers.reportAndReset(testSessionParameters.sessionLogger, "testing session")
     testSessionParameters.sessionLogger.print3("\n======================================================")
     testSessionParameters.sessionLogger.print3("=========== Testing session finished =================")
     testSessionParameters.sessionLogger.print3("======================================================")
@@ -0,0 +1,41 @@
+# Copyright (c) 2016, Konstantinos Kamnitsas
+# All rights reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the BSD license. See the accompanying LICENSE file
+# or read the terms at https://opensource.org/licenses/BSD-3-Clause.
+
+import os
+import argparse
+import traceback
+
+from deepmedic.parallelInference import ConnectionToCoordinator, NAME_OF_ENV_VAR_OF_AUTHKEY
+from deepmedic.frontEndModules.deepMedicTest import deepMedicTestMain
+
+# A worker of a testing session with several inference workers (see parallelInference). Started by the coordinator, \
+# with theano set to the worker's device in THEANO_FLAGS. It runs the session of the config, segmenting the subjects \
+# that the coordinator gives it.
+
+def deepMedicTestWorkerMain(testConfigFilepath, absPathToSavedModelFromCmdLine, addressOfCoordinator, worker_i) :
+    connectionToCoordinator = ConnectionToCoordinator(addressOfCoordinator, os.environ[NAME_OF_ENV_VAR_OF_AUTHKEY],
+                                                      worker_i)
+    try :
+        deepMedicTestMain(testConfigFilepath, absPathToSavedModelFromCmdLine, connectionToCoordinator)
+        connectionToCoordinator.send(["finished"])
+    except BaseException : # Even the SystemExit of exit(1), after an ERROR was logged.
+        connectionToCoordinator.send(["error", traceback.format_exc()])
+        connectionToCoordinator.close()
+        exit(1)
+    connectionToCoordinator.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="A worker of a testing session with several inference workers. "+\
+                                     "Started by the session, not by the user.")
+    parser.add_argument("-test", dest="testConfig", type=str, required=True, help="Path to the testing config file.")
+    parser.add_argument("-model", dest="savedModel", type=str, help="Path to the cnn model, if given in the command line.")
+    parser.add_argument("-coordinator", dest="coordinator", type=str, required=True, help="host:port of the coordinator.")
+    parser.add_argument("-worker", dest="worker", type=int, required=True, help="Index of this worker.")
+    args = parser.parse_args()
+    [host, port] = args.coordinator.rsplit(":", 1)
+    deepMedicTestWorkerMain(args.testConfig, args.savedModel, (host, int(port)), args.worker)
+
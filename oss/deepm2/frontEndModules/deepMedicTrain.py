@@ -6,6 +6,7 @@
 # or read the terms at https://opensource.org/licenses/BSD-3-Clause.
 
 import os
+import time
 
 from deepmedic import myLoggerModule
 
@@ -21,7 +22,8 @@ from deepmedic.frontEndModules.frontEndHelpers.parsingFilesHelpers import checkT
 from deepmedic.frontEndModules.frontEndHelpers.trainParametersClass import TrainSessionParameters
 from deepmedic.frontEndModules.frontEndHelpers.preparationForSessionHelpers import makeFoldersNeededForTrainingSession
 
-from deepmedic.genericHelpers import load_object_from_gzip_file
+from deepmedic.cnnCheckpoint import load_cnn_from_file
+from deepmedic.compiledFunctionsCache import loadOrCompileFunctionsOfCnn
 
 class TrainConfig(object):
     configStruct = {} #In here will be placed all read arguments.
@@ -112,6 +114,9 @@ class TrainConfig(object):
     #Regularization L1 and L2.
     L1_REG = "L1_reg"
     L2_REG = "L2_reg"
+    #BatchNorm statistics for inference. If given (eg 0.99), they are an exponential moving average with this momentum, \
+    # instead of the average over the last batches (rollAverageForBNOverThatManyBatches of the model). Default None.
+    BN_EMA_MOMENTUM = "momentumOfExponentialMovingAverageForBn"
     
     #~~~  Freeze Layers ~~~
     LAYERS_TO_FREEZE_NORM = "layersToFreezeNormal"
@@ -120,6 +125,31 @@ class TrainConfig(object):
     
     #========= GENERICS =========
     PAD_INPUT = "padInputImagesBool"
+    #Processes extracting the segments for the next subepochs in parallel with training. 0 for sequential. Default 1.
+    NUM_SAMPLING_PROCESSES = "numberOfSamplingProcesses"
+    #How many subepochs' segments can be extracted ahead. Each takes shared memory. Default 1.
+    NUM_SUBEPOCHS_TO_PREFETCH = "numberOfSubepochsToPrefetch"
+    #Crop all volumes of a subject to the bounding box of its ROI, plus the margin the cnn needs, before smoothing \
+    # and padding. Saves memory and time when the ROI is much smaller than the image. Requires ROI masks. Default False.
+    CROP_TO_ROI = "cropVolumesToRoiBool"
+    #Folder where the preprocessed volumes are cached as .npy files, reused across epochs and sessions. None to disable.
+    FOLDER_FOR_PREPROC_CACHE = "folderForPreprocessedVolumeCache"
+    #Budget of the cache. Least recently used volumes are deleted when exceeded. Default 20.
+    MAX_GB_OF_PREPROC_CACHE = "maxGigabytesOfPreprocessedVolumeCache"
+    #Folder where the compiled functions are cached, to skip their compilation at the startup of later sessions \
+    # with the same architecture, batch sizes, device and theano config. None to disable.
+    FOLDER_FOR_COMPILED_FUNCTIONS_CACHE = "folderForCompiledFunctionsCache"
+    #If > 0, the segments are loaded on the GPU batch by batch, in a ring of that many batches, instead of a whole \
+    # subepoch at once. Subepochs are then not limited by GPU memory. Default 0 (whole subepochs).
+    NUM_BATCH_SLOTS_STREAMING = "numberOfBatchSlotsForStreaming"
+    #Precision of the volumes held in memory during the full inference on the validation subjects: "float32" \
+    # (default) or "float16", which also keeps labels and masks in uint8/int16.
+    STORAGE_PRECISION_OF_VOLUMES_VAL = "storagePrecisionOfVolumesForInferenceValidation"
+    #[epoch, subepoch] to profile, eg [0, 2]. The profile is saved next to the log of the session. Default None (none).
+    EPOCH_AND_SUBEPOCH_TO_PROFILE = "epochAndSubepochToProfile"
+    #"chromeTrace" (default) saves the timed stages as a trace for chrome://tracing. "cProfile" saves the profile \
+    # of the python functions of the main thread, to be read with pstats.
+    PROFILER_OF_SUBEPOCH = "profilerOfSubepoch"
     
     
     def checkIfConfigIsCorrectForParticularCnnModel(self, cnnInstance) :
@@ -364,6 +394,7 @@ def checkIfOptionalParametersAreGivenCorrectly(testConfig, testConfigFilepath) :
 #Only one of cnnInstancePreLoaded or absPathToSavedModelFromCmdLine will be <> None.
 def deepMedicTrainMain(trainConfigFilepath, absPathToSavedModelFromCmdLine, cnnInstancePreLoaded, \
                        filenameAndPathWherePreLoadedModelWas, resetOptimizer) :
+    startTimeOfSession = time.time()
     print "Given Training-Configuration File: ", trainConfigFilepath
     #Parse the config file in this naive fashion...
     trainConfig = TrainConfig()
@@ -416,7 +447,7 @@ def deepMedicTrainMain(trainConfigFilepath, absPathToSavedModelFromCmdLine, cnnI
             filepathToCnnModel = getAbsPathEvenIfRelativeIsGiven(configGet(trainConfig.CNN_MODEL_FILEPATH), \
                                                                  trainConfigFilepath)
         sessionLogger.print3("...Loading the network can take a few minutes if the model is big...")
-        cnn3dInstance = load_object_from_gzip_file(filepathToCnnModel)
+        cnn3dInstance = load_cnn_from_file(filepathToCnnModel, sessionLogger)
         sessionLogger.print3("The CNN model was loaded successfully from: " + str(filepathToCnnModel))
         
     """
@@ -480,6 +511,11 @@ def deepMedicTrainMain(trainConfigFilepath, absPathToSavedModelFromCmdLine, cnnI
                         weightMapConfPath in configGet(trainConfig.WEIGHT_MAPS_PER_CAT_FILEPATHS_VAL)]
     else :
         listOfAListPerWeightMapCategoryWithFilepathsOfAllCasesVal = None
+    #~~~~~Cache of preprocessed volumes~~~~~~
+    folderForPreprocessedVolumeCache = getAbsPathEvenIfRelativeIsGiven(configGet(trainConfig.FOLDER_FOR_PREPROC_CACHE), \
+                                        trainConfigFilepath) if configGet(trainConfig.FOLDER_FOR_PREPROC_CACHE) else None
+    folderForCompiledFunctionsCache = getAbsPathEvenIfRelativeIsGiven(configGet(trainConfig.FOLDER_FOR_COMPILED_FUNCTIONS_CACHE), \
+                        trainConfigFilepath) if configGet(trainConfig.FOLDER_FOR_COMPILED_FUNCTIONS_CACHE) else None
         
     trainSessionParameters = TrainSessionParameters(
                     sessionName = sessionName,
@@ -591,7 +627,34 @@ def deepMedicTrainMain(trainConfigFilepath, absPathToSavedModelFromCmdLine, cnnI
                                                     configGet(trainConfig.LAYERS_TO_FREEZE_FC) ],
                                                     
                     #==============Generic and Preprocessing===============
-                    padInputImagesBool = configGet(trainConfig.PAD_INPUT)
+                    padInputImagesBool = configGet(trainConfig.PAD_INPUT),
+                    
+                    #==============Sampling in parallel===============
+                    numberOfSamplingProcesses = configGet(trainConfig.NUM_SAMPLING_PROCESSES),
+                    numberOfSubepochsToPrefetch = configGet(trainConfig.NUM_SUBEPOCHS_TO_PREFETCH),
+                    
+                    #==============Cache of preprocessed volumes===============
+                    folderForPreprocessedVolumeCache = folderForPreprocessedVolumeCache,
+                    maxGigabytesOfPreprocessedVolumeCache = configGet(trainConfig.MAX_GB_OF_PREPROC_CACHE),
+                    
+                    #==============Loading===============
+                    cropVolumesToRoi = configGet(trainConfig.CROP_TO_ROI),
+                    
+                    #==============Streaming===============
+                    numberOfBatchSlotsForStreaming = configGet(trainConfig.NUM_BATCH_SLOTS_STREAMING),
+                    
+                    #==============Memory===============
+                    storagePrecisionOfVolumesForInferenceVal = configGet(trainConfig.STORAGE_PRECISION_OF_VOLUMES_VAL),
+                    
+                    #==============Profiling===============
+                    epochAndSubepochToProfile = configGet(trainConfig.EPOCH_AND_SUBEPOCH_TO_PROFILE),
+                    profilerOfSubepoch = configGet(trainConfig.PROFILER_OF_SUBEPOCH),
+                    
+                    #==============BatchNorm===============
+                    momentumOfExponentialMovingAverageForBn = configGet(trainConfig.BN_EMA_MOMENTUM),
+                    
+                    #==============Cache of compiled functions===============
+                    folderForCompiledFunctionsCache = folderForCompiledFunctionsCache
                     )
     
     trainSessionParameters.sessionLogger.print3("\n===========       NEW TRAINING SESSION         ===============")
@@ -605,12 +668,18 @@ def deepMedicTrainMain(trainConfigFilepath, absPathToSavedModelFromCmdLine, cnnI
                         "Reason: Uninitialized: ["+str(not cnn3dInstance.checkTrainingStateAttributesInitialized())+\
                             "], Reset requested: ["+str(resetOptimizer)+"]" )
         cnn3dInstance.initializeTrainingState(*trainSessionParameters.getTupleForInitializingTrainingState())
-    cnn3dInstance.compileTrainFunction(*trainSessionParameters.getTupleForCompilationOfTrainFunc())
-    trainSessionParameters.sessionLogger.print3("\n=========== Compiling the Validation Function =========")
-    cnn3dInstance.compileValidationFunction(*trainSessionParameters.getTupleForCompilationOfValFunc())
-    trainSessionParameters.sessionLogger.print3("\n=========== Compiling the Testing Function ============")
-    # For validation with full segmentation
-    cnn3dInstance.compileTestAndVisualisationFunction(*trainSessionParameters.getTupleForCompilationOfTestFunc()) 
+    # The testing function is for validation with full segmentation. The visualisation one, only to save the FMs.
+    kindsAndTuplesForCompilation = [["train", trainSessionParameters.getTupleForCompilationOfTrainFunc()],
+                                    ["validation", trainSessionParameters.getTupleForCompilationOfValFunc()],
+                                    ["test", trainSessionParameters.getTupleForCompilationOfTestFunc()]]
+    if trainSessionParameters.requiresVisualisationFunc() :
+        kindsAndTuplesForCompilation.append(["visualisation", trainSessionParameters.getTupleForCompilationOfVisualisationFunc()])
+    secondsForFunctions = loadOrCompileFunctionsOfCnn(trainSessionParameters.sessionLogger, cnn3dInstance,
+                                    trainSessionParameters.compiledFunctionsCache,
+                                    kindsAndTuplesForCompilation)
+    trainSessionParameters.sessionLogger.print3("TIMING: Startup of the session took " + \
+                            str(time.time() - startTimeOfSession) + "(s), of which compiling or loading the " + \
+                            "compiled functions took " + str(secondsForFunctions) + "(s).")
     
     trainSessionParameters.sessionLogger.print3("\n=======================================================")
     trainSessionParameters.sessionLogger.print3("============== Training the CNN model =================")
@@ -0,0 +1,87 @@
+# Copyright (c) 2016, Konstantinos Kamnitsas
+# All rights reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the BSD license. See the accompanying LICENSE file
+# or read the terms at https://opensource.org/licenses/BSD-3-Clause.
+
+import os
+import argparse
+
+from deepmedic import myLoggerModule
+from deepmedic.volumeCache import PreprocessedVolumeCache
+from deepmedic.trainValidateTestVisualiseParallel import loadVolumeForCnn
+
+from deepmedic.frontEndModules.frontEndHelpers.parsingFilesHelpers import getAbsPathEvenIfRelativeIsGiven
+from deepmedic.frontEndModules.frontEndHelpers.parsingFilesHelpers import parseAbsFileLinesInList
+
+from deepmedic.frontEndModules.deepMedicTrain import TrainConfig
+from deepmedic.frontEndModules.deepMedicTest import TestConfig
+
+# Fills the cache of preprocessed volumes ahead of a session, with all the volumes listed in a train or test config.
+# Padding depends on the cnn, so the volumes are cached unpadded. Sessions pad them in memory, or cache the padded too.
+
+def getListOfKindAndFilepathOfVolumesInConfig(config, configFilepath, keysOfListingFilesPerKindOfVolume) :
+    # keysOfListingFilesPerKindOfVolume: [[kindOfVolume, key], ...]. The key gives a listing file, or a list of them.
+    configGet = config.get
+    kindAndFilepathOfVolumes = []
+    for [kindOfVolume, key] in keysOfListingFilesPerKindOfVolume :
+        listingFiles = configGet(key)
+        if not listingFiles :
+            continue
+        listingFiles = listingFiles if isinstance(listingFiles, list) else [listingFiles]
+        for listingFile in listingFiles :
+            for filepath in parseAbsFileLinesInList(getAbsPathEvenIfRelativeIsGiven(listingFile, configFilepath)) :
+                kindAndFilepathOfVolumes.append([kindOfVolume, filepath])
+    return kindAndFilepathOfVolumes
+
+def deepMedicWarmCacheMain(configFilepath, trainOrTest="train") :
+    print "Given Configuration File: ", configFilepath
+    if trainOrTest == "train" :
+        config = TrainConfig()
+        keysOfListingFilesPerKindOfVolume = [["channel", config.CHANNELS_TR],
+                                             ["gtLabels", config.GT_LABELS_TR],
+                                             ["roiMask", config.ROI_MASKS_TR],
+                                             ["weightMap", config.WEIGHT_MAPS_PER_CAT_FILEPATHS_TR],
+                                             ["channel", config.CHANNELS_VAL],
+                                             ["gtLabels", config.GT_LABELS_VAL],
+                                             ["roiMask", config.ROI_MASKS_VAL],
+                                             ["weightMap", config.WEIGHT_MAPS_PER_CAT_FILEPATHS_VAL] ]
+    else :
+        config = TestConfig()
+        keysOfListingFilesPerKindOfVolume = [["channel", config.CHANNELS],
+                                             ["gtLabels", config.GT_LABELS],
+                                             ["roiMask", config.ROI_MASKS] ]
+    execfile(configFilepath, config.configStruct)
+    configGet = config.get
+
+    if not configGet(config.FOLDER_FOR_PREPROC_CACHE) :
+        print "ERROR: The config file does not specify a folder for the cache of preprocessed volumes [", \
+            config.FOLDER_FOR_PREPROC_CACHE, "]. Exiting!"; exit(1)
+    folderForCache = getAbsPathEvenIfRelativeIsGiven(configGet(config.FOLDER_FOR_PREPROC_CACHE), configFilepath)
+    maxGigabytes = configGet(config.MAX_GB_OF_PREPROC_CACHE) if configGet(config.MAX_GB_OF_PREPROC_CACHE) <> None else 20
+    preprocessedVolumeCache = PreprocessedVolumeCache(folderForCache, maxGigabytes)
+    myLogger = myLoggerModule.MyLogger(os.path.join(folderForCache, "warmCache.txt"))
+
+    kindAndFilepathOfVolumes = getListOfKindAndFilepathOfVolumesInConfig(config, configFilepath,
+                                                                         keysOfListingFilesPerKindOfVolume)
+    myLogger.print3("Caching [" + str(len(kindAndFilepathOfVolumes)) + "] volumes at [" + folderForCache + "]...")
+    for [kindOfVolume, filepath] in kindAndFilepathOfVolumes :
+        # Without smoothing, reflection or padding, as the sessions load them (smoothing is never used currently).
+        loadVolumeForCnn(preprocessedVolumeCache, filepath, kindOfVolume, None, [0,0,0], False, None, None)
+    myLogger.print3("Done. The cache takes [" + str(preprocessedVolumeCache.getTotalBytes() / (1024**2)) + "] MB.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Loads and caches the preprocessed volumes listed in a config file, "+\
+                                     "so that the following sessions load them from the cache.")
+    parser.add_argument("-train", dest="trainConfig", type=str, help="Path to a training config file.")
+    parser.add_argument("-test", dest="testConfig", type=str, help="Path to a testing config file.")
+    args = parser.parse_args()
+    if args.trainConfig :
+        deepMedicWarmCacheMain(os.path.abspath(args.trainConfig), "train")
+    if args.testConfig :
+        deepMedicWarmCacheMain(os.path.abspath(args.testConfig), "test")
+    if not args.trainConfig and not args.testConfig :
+        parser.print_help()
+
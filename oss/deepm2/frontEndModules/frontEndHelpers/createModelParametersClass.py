@@ -11,6 +11,7 @@ from deepmedic.cnnHelpers import calcReceptiveFieldDims
 from deepmedic.cnnHelpers import checkReceptiveFieldFineInComparisonToSegmentSize
 from deepmedic.cnnHelpers import checkKernDimPerLayerCorrect3dAndNumLayers
 from deepmedic.cnnHelpers import checkSubsampleFactorEven
+from deepmedic.convolutionBackends import CONVOLUTION_BACKENDS, AUTO_BACKEND
 
 class CreateModelSessionParameters(object) :
     #THE LOGIC WHETHER I GOT A PARAMETER THAT I NEED SHOULD BE IN HERE!
@@ -135,6 +136,10 @@ class CreateModelSessionParameters(object) :
     @staticmethod
     def errorReqActivFunction01() :
         print "ERROR: Parameter \"relu0orPrelu1\" must be given equal to 0 or 1. Omit for default (=1). Exiting!"; exit(1)
+    @staticmethod
+    def errorRequireConvolutionBackend() :
+        print "ERROR: Parameter \"convolutionBackend\" must be one of " + str(CONVOLUTION_BACKENDS + [AUTO_BACKEND]) + \
+            ". Omit for default (=\"" + AUTO_BACKEND + "\"). Exiting!"; exit(1)
         
     @staticmethod
     def errReqSameNumOfLayersPerSubPathway():
@@ -273,7 +278,10 @@ class CreateModelSessionParameters(object) :
                     initialMethod,
                     
                     #== Batch Normalization ==
-                    bnRollingAverOverThatManyBatches
+                    bnRollingAverOverThatManyBatches,
+                    
+                    #== Convolution ==
+                    convolutionBackend=None
                     ):
         
         #Importants for running session.
@@ -411,6 +419,11 @@ class CreateModelSessionParameters(object) :
         self.bnRollingAverOverThatManyBatches = bnRollingAverOverThatManyBatches if \
             bnRollingAverOverThatManyBatches <> None else 60
         
+        #==Convolution==
+        self.convolutionBackend = convolutionBackend if convolutionBackend <> None else AUTO_BACKEND
+        if self.convolutionBackend not in CONVOLUTION_BACKENDS + [AUTO_BACKEND] :
+            self.errorRequireConvolutionBackend()
+        
         #==============CALCULATED=====================
         # Residual Connections backwards, per pathway type :
         self.checkLayersForResidualsGivenDoNotInclude1st(residConnAtLayersNormal, residConnAtLayersSubsampled, \
@@ -542,6 +555,10 @@ class CreateModelSessionParameters(object) :
         logPrint("Batch Normalization uses a rolling average for inference, over this many batches = " + \
                                                                 str(self.bnRollingAverOverThatManyBatches))
         
+        logPrint("~~Convolution~~")
+        logPrint("Backend of the convolutions (\"" + AUTO_BACKEND + "\" for the fastest per layer, benchmarked) = " + \
+                                                                str(self.convolutionBackend))
+        
         logPrint("========== Done with printing session's parameters ==========")
         logPrint("=============================================================")
         
@@ -602,7 +619,10 @@ class CreateModelSessionParameters(object) :
                         
                         #=== various ===
                         borrowFlag,
-                        dataTypeX
+                        dataTypeX,
+                        
+                        #=== Convolution ===
+                        self.convolutionBackend
                         )
         
         return cnnCreationTuple
@@ -5,12 +5,30 @@
 # it under the terms of the BSD license. See the accompanying LICENSE file
 # or read the terms at https://opensource.org/licenses/BSD-3-Clause.
 
+from deepmedic.volumeCache import PreprocessedVolumeCache
+from deepmedic.compiledFunctionsCache import CompiledFunctionsCache
+from deepmedic.trainValidateTestVisualiseParallel import STORAGE_PRECISIONS_OF_VOLUMES
+from deepmedic.inferenceBatchSize import AUTO_BATCH_SIZE
+
 class TestSessionParameters(object) :
     #To be called from outside too.
     @staticmethod
     def getDefaultSessionName() :
         return "testSession"
     
+    @staticmethod
+    def errorRequireStoragePrecisionOfVolumes() :
+        print "ERROR: The parameter \"storagePrecisionOfVolumes\" must be given one of " + \
+                str(STORAGE_PRECISIONS_OF_VOLUMES) + ". Omit for default. Exiting!"; exit(1)
+    @staticmethod
+    def errorRequireOutputOfInferenceFunction() :
+        print "ERROR: The parameter \"outputOfInferenceFunction\" must be given one of \"probabilities\", \"float16\" " + \
+                "or \"labels\". Omit for default. Exiting!"; exit(1)
+    @staticmethod
+    def errorRequireBatchSizeForInference() :
+        print "ERROR: The parameter \"batchSizeForInference\" must be given a positive integer or \"" + \
+                AUTO_BATCH_SIZE + "\". Omit to use the batch size of the model. Exiting!"; exit(1)
+    
     def __init__(self,
                  
                 sessionName,
@@ -39,6 +57,23 @@ class TestSessionParameters(object) :
                 
                 padInputImagesBool,
                 
+                strideOfSegmentsForInference = None,
+                numSubjectsToPrefetch = None,
+                
+                folderForPreprocessedVolumeCache = None,
+                maxGigabytesOfPreprocessedVolumeCache = None,
+                
+                folderForCompiledFunctionsCache = None,
+                
+                outputOfInferenceFunction = None,
+                
+                useLargeTilesForInference = None,
+                maxGigabytesForLargeTiles = None,
+                
+                batchSizeForInference = None,
+                maxGigabytesForInferenceBatch = None,
+                
+                storagePrecisionOfVolumes = None
                 ):
         #Importants for running session.
         self.sessionName = sessionName if sessionName else self.getDefaultSessionName()
@@ -75,6 +110,44 @@ class TestSessionParameters(object) :
         #Preprocessing
         self.padInputImagesBool = padInputImagesBool if padInputImagesBool <> None else True
         
+        #Tiling. None means the default, non-overlapping segments.
+        self.strideOfSegmentsForInference = strideOfSegmentsForInference
+        #Pipeline. Subjects loaded in the background while the previous one is segmented.
+        self.numSubjectsToPrefetch = numSubjectsToPrefetch if numSubjectsToPrefetch <> None else 1
+        #Cache of the preprocessed volumes on disk. Reused by later sessions.
+        self.folderForPreprocessedVolumeCache = folderForPreprocessedVolumeCache
+        self.maxGigabytesOfPreprocessedVolumeCache = maxGigabytesOfPreprocessedVolumeCache if \
+                                                        maxGigabytesOfPreprocessedVolumeCache <> None else 20
+        self.preprocessedVolumeCache = PreprocessedVolumeCache(self.folderForPreprocessedVolumeCache,
+                                                               self.maxGigabytesOfPreprocessedVolumeCache,
+                                                               self.sessionLogger) if \
+                                                                    self.folderForPreprocessedVolumeCache else None
+        #Cache of the compiled functions on disk. Reused by later sessions.
+        self.folderForCompiledFunctionsCache = folderForCompiledFunctionsCache
+        self.compiledFunctionsCache = CompiledFunctionsCache(self.folderForCompiledFunctionsCache, self.sessionLogger) if \
+                                                                    self.folderForCompiledFunctionsCache else None
+        
+        #What the testing function returns per segment. Smaller outputs transfer faster from the GPU.
+        self.outputOfInferenceFunction = outputOfInferenceFunction if outputOfInferenceFunction <> None else "probabilities"
+        if self.outputOfInferenceFunction not in ["probabilities", "float16", "labels"] :
+            self.errorRequireOutputOfInferenceFunction()
+        
+        #Inference on segments as large as the volumes, within the budget. None for the default budget.
+        self.useLargeTilesForInference = useLargeTilesForInference if useLargeTilesForInference <> None else False
+        self.maxGigabytesForLargeTiles = maxGigabytesForLargeTiles
+        
+        #Segments per call of the testing function. None for that of the model. "auto" for the largest within the budget.
+        self.batchSizeForInference = batchSizeForInference
+        if self.batchSizeForInference not in [None, AUTO_BATCH_SIZE] and \
+                not (isinstance(self.batchSizeForInference, (int, long)) and self.batchSizeForInference > 0) :
+            self.errorRequireBatchSizeForInference()
+        self.maxGigabytesForInferenceBatch = maxGigabytesForInferenceBatch
+        
+        #Memory. Volumes in float16 (and labels in uint8/int16), converted to float32 only for the cnn.
+        self.storagePrecisionOfVolumes = storagePrecisionOfVolumes if storagePrecisionOfVolumes <> None else "float32"
+        if self.storagePrecisionOfVolumes not in STORAGE_PRECISIONS_OF_VOLUMES :
+            self.errorRequireStoragePrecisionOfVolumes()
+        
         #Others useful internally or for reporting:
         self.numberOfCases = len(self.channelsFilepaths)
         self.numberOfClasses = cnn3dInstance.numberOfOutputClasses
@@ -152,10 +225,32 @@ class TestSessionParameters(object) :
         if not self.padInputImagesBool :
             logPrint(">>> WARN: Inference near the borders of the image might be incomplete if not padded! Although \
             some speed is gained if not padded. Task-specific, your choice.")
+        logPrint("~~~~~~~ Parameters for Tiling ~~~~~~")
+        logPrint("Stride of the segments (None for non-overlapping) = " + str(self.strideOfSegmentsForInference))
+        logPrint("Number of subjects to prefetch in the background (0 for none) = " + str(self.numSubjectsToPrefetch))
+        logPrint("~~~~~~~ Cache of preprocessed volumes ~~~~~~")
+        logPrint("Folder of the cache (None for no caching) = " + str(self.folderForPreprocessedVolumeCache))
+        logPrint("Maximum size of the cache in GB = " + str(self.maxGigabytesOfPreprocessedVolumeCache))
+        logPrint("~~~~~~~ Cache of compiled functions ~~~~~~")
+        logPrint("Folder of the cache (None for no caching) = " + str(self.folderForCompiledFunctionsCache))
+        logPrint("~~~~~~~ Large tiles ~~~~~~")
+        logPrint("Use large tiles for inference = " + str(self.useLargeTilesForInference))
+        logPrint("Maximum memory for the large tiles in GB (None for half the available) = " + str(self.maxGigabytesForLargeTiles))
+        logPrint("~~~~~~~ Batch size of inference ~~~~~~")
+        logPrint("Batch size for inference (None for that of the model, \"auto\" within the budget) = " + \
+                 str(self.batchSizeForInference))
+        logPrint("Maximum memory for the batch in GB (None for half the free memory of the device) = " + \
+                 str(self.maxGigabytesForInferenceBatch))
+        logPrint("~~~~~~~ Memory ~~~~~~")
+        logPrint("Precision of the volumes in memory = " + str(self.storagePrecisionOfVolumes))
+        logPrint("~~~~~~~ Output of the cnn ~~~~~~")
+        logPrint("Output of the testing function (probabilities, float16 or labels) = " + str(self.outputOfInferenceFunction))
+        if self.outputOfInferenceFunction <> "probabilities" and (self.saveIndividualFmImages or self.saveMDImgWithAllFms) :
+            logPrint(">>> WARN: Feature maps are saved, so the function that returns them is used, which returns the probabilities.")
         logPrint("========== Done with printing session's parameters ==========")
         logPrint("=============================================================")
         
-    def getTupleForCnnTesting(self) :
+    def getTupleForCnnTesting(self, indicesOfSubjectsToSegment=None) :
         borrowFlag = True
         
         validation0orTesting1 = 1
@@ -188,14 +283,41 @@ class TestSessionParameters(object) :
             self.saveIndividualFmImages,
             self.saveMDImgWithAllFms,
             self.indicesOfFmsToVisualisePerPathwayAndLayer,
-            self.filepathsToSaveFeaturesForEachPat
+            self.filepathsToSaveFeaturesForEachPat,
+            
+            #--------Tiling--------
+            self.strideOfSegmentsForInference,
+            
+            #--------Pipeline--------
+            self.numSubjectsToPrefetch,
+            
+            #--------Cache--------
+            self.preprocessedVolumeCache,
+            
+            #--------Output of the cnn--------
+            self.outputOfInferenceFunction,
+            
+            #--------Memory--------
+            self.storagePrecisionOfVolumes,
+            
+            #--------Subjects--------
+            indicesOfSubjectsToSegment
             )
         
         return testTuple
     
     def getTupleForCompilationOfTestFunc(self) :
-        testFunctionCompilationTuple = ( self.sessionLogger, )
+        testFunctionCompilationTuple = ( self.sessionLogger,
+                                         self.outputOfInferenceFunction )
         return testFunctionCompilationTuple
+    
+    def getTupleForCompilationOfVisualisationFunc(self) :
+        visualisationFunctionCompilationTuple = ( self.sessionLogger, )
+        return visualisationFunctionCompilationTuple
+    
+    def requiresVisualisationFunc(self) :
+        # The function that returns the FMs of all layers is only needed for saving them.
+        return self.saveIndividualFmImages or self.saveMDImgWithAllFms
 
 
 
@@ -6,6 +6,10 @@
 # or read the terms at https://opensource.org/licenses/BSD-3-Clause.
 
 from deepmedic import samplingType
+from deepmedic.volumeCache import PreprocessedVolumeCache
+from deepmedic.compiledFunctionsCache import CompiledFunctionsCache
+from deepmedic.trainValidateTestVisualiseParallel import STORAGE_PRECISIONS_OF_VOLUMES
+from deepmedic.stageTimers import PROFILERS
 
 class TrainSessionParameters(object) :
     #THE LOGIC WHETHER I GOT A PARAMETER THAT I NEED SHOULD BE IN HERE!
@@ -180,6 +184,22 @@ class TrainSessionParameters(object) :
     @staticmethod
     def errorRequireMomNonNorm0Norm1() :
         print "ERROR: The parameter \"momNonNorm0orNormalized1\" must be given 0 or 1. Omit for default. Exiting!"; exit(1)
+    @staticmethod
+    def errorRequireStoragePrecisionOfVolumesVal() :
+        print "ERROR: The parameter \"storagePrecisionOfVolumesForInferenceValidation\" must be given one of " + \
+                str(STORAGE_PRECISIONS_OF_VOLUMES) + ". Omit for default. Exiting!"; exit(1)
+    @staticmethod
+    def errorRequireEpochAndSubepochToProfile() :
+        print "ERROR: The parameter \"epochAndSubepochToProfile\" must be given a list of two integers >= 0, " + \
+                "[epoch, subepoch]. Omit to not profile. Exiting!"; exit(1)
+    @staticmethod
+    def errorRequireProfilerOfSubepoch() :
+        print "ERROR: The parameter \"profilerOfSubepoch\" must be given one of " + str(PROFILERS) + \
+                ". Omit for default. Exiting!"; exit(1)
+    @staticmethod
+    def errorRequireBnEmaMomentumBetween01() :
+        print "ERROR: The parameter \"momentumOfExponentialMovingAverageForBn\" must be given in [0.0, 1.0). " + \
+                "Omit for a rolling average over the last batches. Exiting!"; exit(1)
         
     # Deprecated :
     @staticmethod
@@ -298,7 +318,34 @@ class TrainSessionParameters(object) :
                 layersToFreezePerPathwayType,
                 
                 #==============Generic and Preprocessing===============
-                padInputImagesBool
+                padInputImagesBool,
+                
+                #==============Sampling in parallel===============
+                numberOfSamplingProcesses = None,
+                numberOfSubepochsToPrefetch = None,
+                
+                #==============Cache of preprocessed volumes===============
+                folderForPreprocessedVolumeCache = None,
+                maxGigabytesOfPreprocessedVolumeCache = None,
+                
+                #==============Loading===============
+                cropVolumesToRoi = None,
+                
+                #==============Streaming===============
+                numberOfBatchSlotsForStreaming = None,
+                
+                #==============Memory===============
+                storagePrecisionOfVolumesForInferenceVal = None,
+                
+                #==============Profiling===============
+                epochAndSubepochToProfile = None,
+                profilerOfSubepoch = None,
+                
+                #==============BatchNorm===============
+                momentumOfExponentialMovingAverageForBn = None,
+                
+                #==============Cache of compiled functions===============
+                folderForCompiledFunctionsCache = None
                 ):
         
         #Importants for running session.
@@ -493,6 +540,39 @@ class TrainSessionParameters(object) :
         #===================== OTHERS======================
         #Preprocessing
         self.padInputImagesBool = padInputImagesBool if padInputImagesBool <> None else True
+        #Sampling. Processes that extract the segments of the next subepochs while the cnn trains.
+        self.numberOfSamplingProcesses = numberOfSamplingProcesses if numberOfSamplingProcesses <> None else 1
+        self.numberOfSubepochsToPrefetch = numberOfSubepochsToPrefetch if numberOfSubepochsToPrefetch <> None else 1
+        #Cache of the preprocessed volumes on disk. Reused by later epochs and sessions.
+        self.folderForPreprocessedVolumeCache = folderForPreprocessedVolumeCache
+        self.maxGigabytesOfPreprocessedVolumeCache = maxGigabytesOfPreprocessedVolumeCache if \
+                                                        maxGigabytesOfPreprocessedVolumeCache <> None else 20
+        #Loading. Volumes cropped to the box of the ROI. Only subjects with a ROI mask are cropped.
+        self.cropVolumesToRoi = cropVolumesToRoi if cropVolumesToRoi <> None else False
+        self.preprocessedVolumeCache = PreprocessedVolumeCache(self.folderForPreprocessedVolumeCache,
+                                                               self.maxGigabytesOfPreprocessedVolumeCache,
+                                                               self.sessionLogger) if \
+                                                                    self.folderForPreprocessedVolumeCache else None
+        #Cache of the compiled functions on disk. Reused by later sessions.
+        self.folderForCompiledFunctionsCache = folderForCompiledFunctionsCache
+        self.compiledFunctionsCache = CompiledFunctionsCache(self.folderForCompiledFunctionsCache, self.sessionLogger) if \
+                                                                    self.folderForCompiledFunctionsCache else None
+        #Streaming. Segments loaded on the GPU batch by batch, in a ring of that many batches. 0 for whole subepochs.
+        self.numberOfBatchSlotsForStreaming = numberOfBatchSlotsForStreaming if numberOfBatchSlotsForStreaming <> None else 0
+        #Memory. Volumes of the full inference on validation subjects in float16 (labels in uint8/int16).
+        self.storagePrecisionOfVolumesForInferenceVal = storagePrecisionOfVolumesForInferenceVal if \
+                                                    storagePrecisionOfVolumesForInferenceVal <> None else "float32"
+        if self.storagePrecisionOfVolumesForInferenceVal not in STORAGE_PRECISIONS_OF_VOLUMES :
+            self.errorRequireStoragePrecisionOfVolumesVal()
+        #Profiling of a subepoch.
+        self.epochAndSubepochToProfile = epochAndSubepochToProfile
+        if self.epochAndSubepochToProfile <> None and not (isinstance(self.epochAndSubepochToProfile, list) and \
+                len(self.epochAndSubepochToProfile) == 2 and \
+                False not in [ isinstance(value, int) and value >= 0 for value in self.epochAndSubepochToProfile ]) :
+            self.errorRequireEpochAndSubepochToProfile()
+        self.profilerOfSubepoch = profilerOfSubepoch if profilerOfSubepoch <> None else "chromeTrace"
+        if self.profilerOfSubepoch not in PROFILERS :
+            self.errorRequireProfilerOfSubepoch()
         
         #Others useful internally or for reporting:
         self.numberOfCasesTrain = len(self.channelsFilepathsTrain)
@@ -547,6 +627,13 @@ class TrainSessionParameters(object) :
         self.l1Reg = l1Reg if l1Reg <> None else 0.000001
         self.l2Reg = l2Reg if l2Reg <> None else 0.0001
         
+        #==BatchNorm==
+        # None: Rolling average over the last batches, as long as specified by the model. Else the momentum of an EMA.
+        self.momentumOfExponentialMovingAverageForBn = momentumOfExponentialMovingAverageForBn
+        if self.momentumOfExponentialMovingAverageForBn <> None and \
+                (self.momentumOfExponentialMovingAverageForBn < 0. or self.momentumOfExponentialMovingAverageForBn >= 1) :
+            self.errorRequireBnEmaMomentumBetween01()
+        
         #============= HIDDENS ==============
         # Indices of layers that should not be trained (kept fixed).
         indicesOfLayersToFreezeNorm = [ l-1 for l in layersToFreezePerPathwayType[0] ] if \
@@ -718,6 +805,9 @@ class TrainSessionParameters(object) :
         logPrint("~~L1/L2 Regularization~~")
         logPrint("L1 Regularization term = " + str(self.l1Reg))
         logPrint("L2 Regularization term = " + str(self.l2Reg))
+        logPrint("~~BatchNorm~~")
+        logPrint("Momentum of exponential moving average for the statistics of BN (None: rolling average) = " + \
+                 str(self.momentumOfExponentialMovingAverageForBn))
         
         logPrint("~~Freeze Weights of Certain Layers~~")
         logPrint("Indices of layers from each type of pathway that will be kept fixed (first layer is 0):")
@@ -728,6 +818,29 @@ class TrainSessionParameters(object) :
         logPrint("~~~~~~~~~~~~~~~~~~Other Generic Parameters~~~~~~~~~~~~~~~~")
         logPrint("~~Pre Processing~~")
         logPrint("Pad Input Images = " + str(self.padInputImagesBool))
+        logPrint("~~Sampling~~")
+        logPrint("Number of processes extracting segments in parallel (0 for sequential) = " + \
+                 str(self.numberOfSamplingProcesses))
+        logPrint("Number of subepochs to prefetch = " + str(self.numberOfSubepochsToPrefetch))
+        logPrint("Crop volumes to the bounding box of the ROI = " + str(self.cropVolumesToRoi))
+        if self.cropVolumesToRoi and not (self.providedRoiMasksTrain and \
+                (self.providedRoiMasksVal or not self.performValidationOnSamplesThroughoutTraining)) :
+            logPrint(">>> WARN: Volumes are cropped only if ROI masks are given. They were not given for training or \
+            validation, whose volumes will not be cropped.")
+        logPrint("~~Cache of preprocessed volumes~~")
+        logPrint("Folder of the cache (None for no caching) = " + str(self.folderForPreprocessedVolumeCache))
+        logPrint("Maximum size of the cache in GB = " + str(self.maxGigabytesOfPreprocessedVolumeCache))
+        logPrint("~~Cache of compiled functions~~")
+        logPrint("Folder of the cache (None for no caching) = " + str(self.folderForCompiledFunctionsCache))
+        logPrint("~~Streaming~~")
+        logPrint("Number of batch slots on the GPU for streaming the segments (0 to load whole subepochs) = " + \
+                 str(self.numberOfBatchSlotsForStreaming))
+        logPrint("~~Memory~~")
+        logPrint("Precision of the volumes in memory for the full inference on validation subjects = " + \
+                 str(self.storagePrecisionOfVolumesForInferenceVal))
+        logPrint("~~Profiling~~")
+        logPrint("[Epoch, subepoch] to profile (None for none) = " + str(self.epochAndSubepochToProfile))
+        logPrint("Profiler of the subepoch = " + str(self.profilerOfSubepoch))
         
         logPrint("========== Done with printing session's parameters ==========")
         logPrint("=============================================================")
@@ -805,7 +918,27 @@ class TrainSessionParameters(object) :
                 self.saveIndividualFmImagesVal,
                 self.saveMultidimImgWithAllFmsVal,
                 self.indicesOfFmsToVisualisePerPathwayAndLayerVal,
-                self.filepathsToSaveFeaturesForEachPatVal
+                self.filepathsToSaveFeaturesForEachPatVal,
+                
+                #--------Sampling in parallel---------
+                self.numberOfSamplingProcesses,
+                self.numberOfSubepochsToPrefetch,
+                
+                #--------Cache of preprocessed volumes---------
+                self.preprocessedVolumeCache,
+                
+                #--------Loading---------
+                self.cropVolumesToRoi,
+                
+                #--------Streaming---------
+                self.numberOfBatchSlotsForStreaming,
+                
+                #--------Memory---------
+                self.storagePrecisionOfVolumesForInferenceVal,
+                
+                #--------Profiling---------
+                self.epochAndSubepochToProfile,
+                self.profilerOfSubepoch
                 )
         return trainTuple
     
@@ -837,7 +970,8 @@ class TrainSessionParameters(object) :
         return initializingTrainingStateTuple
 
     def getTupleForCompilationOfTrainFunc(self) :
-        trainFunctionCompilationTuple = ( self.sessionLogger, )
+        trainFunctionCompilationTuple = ( self.sessionLogger,
+                                          self.momentumOfExponentialMovingAverageForBn )
         return trainFunctionCompilationTuple
        
     def getTupleForCompilationOfValFunc(self) :
@@ -847,6 +981,14 @@ class TrainSessionParameters(object) :
     def getTupleForCompilationOfTestFunc(self) :
         testFunctionCompilationTuple = ( self.sessionLogger, )
         return testFunctionCompilationTuple
+       
+    def getTupleForCompilationOfVisualisationFunc(self) :
+        visualisationFunctionCompilationTuple = ( self.sessionLogger, )
+        return visualisationFunctionCompilationTuple
+    
+    def requiresVisualisationFunc(self) :
+        # The function that returns the FMs of all layers is only needed for saving them.
+        return self.saveIndividualFmImagesVal or self.saveMultidimImgWithAllFmsVal
 
 
 
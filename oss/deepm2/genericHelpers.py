@@ -64,6 +64,12 @@ def strListFl5fNA(listWithFloatsOrNotAppl, notApplicPattern) : # If you just pri
     #the internal string-floats are printed with quotes ' '. To avoit it we use this.
     return strListFlXfNA(listWithFloatsOrNotAppl, 5, notApplicPattern)
 
+def replaceNaWithNone(valueOrList, notApplicPattern) :
+    # For structured (json) records, where the not-applicable entries should be null. Handles nested lists.
+    if isinstance(valueOrList, (list, tuple)) :
+        return [ replaceNaWithNone(element, notApplicPattern) for element in valueOrList ]
+    return None if valueOrList == notApplicPattern else valueOrList
+
 def getMeanOfListExclNA(list1, notApplicPattern) :
     # Calculates mean over the list's entries that are applicable. i.e. the ones that are not notApplicPattern == "N/A".
     # Returns NotApplicablePattern if all entries are not-applicable.
@@ -193,8 +199,14 @@ def saveImageToANewNiiWithHeaderFromOtherGivenExactFilePaths(predLabelImg,
     affine_trans_to_ras = img_proxy_for_orig_image.affine
     
     #Nifti Constructor. data is the image itself, dimensions x,y,z,time. The second argument is the affine RAS transf.
-    newLabelImg = nib.Nifti1Image(predLabelImg, affine_trans_to_ras) 
-    newLabelImg.set_data_dtype(npDtype)
+    if predLabelImg.dtype == np.float16 :
+        #Nifti has no float16. Saved as int16, with the slope and intercept that nibabel computes for the range.
+        hdr_for_new_image = nib.Nifti1Header()
+        hdr_for_new_image.set_data_dtype(np.int16)
+        newLabelImg = nib.Nifti1Image(predLabelImg, affine_trans_to_ras, header=hdr_for_new_image)
+    else :
+        newLabelImg = nib.Nifti1Image(predLabelImg, affine_trans_to_ras) 
+        newLabelImg.set_data_dtype(npDtype)
     
     dimensionsOfTheGivenArrayImageToSave = len(predLabelImg.shape)
     newZooms = list(hdr_for_orig_image.get_zooms()[:dimensionsOfTheGivenArrayImageToSave])
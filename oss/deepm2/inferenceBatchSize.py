@@ -0,0 +1,65 @@
+# Copyright (c) 2016, Konstantinos Kamnitsas
+# All rights reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the BSD license. See the accompanying LICENSE file
+# or read the terms at https://opensource.org/licenses/BSD-3-Clause.
+
+import theano
+
+from deepmedic.largeTileInference import estimateBytesForInferenceOnSegment, getBytesOfAvailableMemory
+
+# The batch size of inference. The testing functions accept any batch size, so it is set on the model without \
+# making it or compiling its functions again. "auto" picks the largest batch whose estimated memory fits a budget \
+# of the device that theano runs on (of the host, on the cpu).
+
+AUTO_BATCH_SIZE = "auto"
+# If no budget is given, this fraction of the memory of the device that is free when the session starts.
+FRACTION_OF_FREE_MEMORY_OF_DEVICE_BY_DEFAULT = 0.5
+
+def getBytesOfFreeMemoryOfDevice() :
+    # Of the GPU of theano, or the available memory of the host if it runs on the cpu or the GPU cannot be asked.
+    device = theano.config.device
+    try :
+        if device.startswith("gpu") : # The old cuda backend.
+            from theano.sandbox.cuda import cuda_ndarray
+            return int(cuda_ndarray.cuda_ndarray.mem_info()[0])
+        if device.startswith("cuda") : # The gpuarray backend.
+            from theano.gpuarray.type import get_context
+            return int(get_context(None).free_gmem)
+    except Exception :
+        pass
+    return getBytesOfAvailableMemory()
+
+def chooseBatchSizeForInference(myLogger, cnn3dInst, gigabytesOfBudget=None) :
+    # The largest number of segments of the test graph of cnn3dInst per batch that fits in the budget. At least 1.
+    bytesOfBudget = gigabytesOfBudget * 1024**3 if gigabytesOfBudget <> None else \
+                        FRACTION_OF_FREE_MEMORY_OF_DEVICE_BY_DEFAULT * getBytesOfFreeMemoryOfDevice()
+    dimsOfSegment = cnn3dInst.pathways[0].getShapeOfInput()[2][2:]
+    bytesPerSegment = estimateBytesForInferenceOnSegment(cnn3dInst, dimsOfSegment, batchSize=1)
+    batchSize = max(1, int(bytesOfBudget // bytesPerSegment))
+    if bytesPerSegment > bytesOfBudget :
+        myLogger.print3("WARN: One segment of dims " + str(dimsOfSegment) + " is estimated to need " + \
+                        str(round(bytesPerSegment / 1024.**3, 3)) + "GB, more than the budget of " + \
+                        str(round(bytesOfBudget / 1024.**3, 3)) + "GB. Batches will be of one segment.")
+    myLogger.print3("Batch size for inference: [" + str(batchSize) + "] segments of dims " + str(dimsOfSegment) + \
+                    ", estimated to need " + str(round(batchSize * bytesPerSegment / 1024.**3, 3)) + "GB of the " + \
+                    "budget of " + str(round(bytesOfBudget / 1024.**3, 3)) + "GB (" + \
+                    str(round(bytesPerSegment / 1024.**2, 2)) + "MB per segment). Of the model: [" + \
+                    str(cnn3dInst.batchSizeTesting) + "].")
+    myLogger.logRecord("batchSizeForInference", batchSize=batchSize, bytesPerSegment=bytesPerSegment,
+                       bytesOfBudget=int(bytesOfBudget), batchSizeOfModel=cnn3dInst.batchSizeTesting)
+    return batchSize
+
+def setBatchSizeForInference(myLogger, cnn3dInst, batchSizeForInference, gigabytesOfBudget=None) :
+    # batchSizeForInference: A number of segments, AUTO_BATCH_SIZE, or None to keep that of the model.
+    if batchSizeForInference == None :
+        return
+    if not cnn3dInst.canChangeBatchSizeTesting() :
+        myLogger.print3("WARN: The model was made before the batch size of its testing functions could change. " + \
+                        "Inference will use batches of [" + str(cnn3dInst.batchSizeTesting) + "] segments, " + \
+                        "as the model was made with.")
+        return
+    batchSize = chooseBatchSizeForInference(myLogger, cnn3dInst, gigabytesOfBudget) if \
+                    batchSizeForInference == AUTO_BATCH_SIZE else batchSizeForInference
+    cnn3dInst.setBatchSizeTesting(myLogger, batchSize)
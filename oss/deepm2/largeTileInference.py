@@ -0,0 +1,117 @@
+# Copyright (c) 2016, Konstantinos Kamnitsas
+# All rights reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the BSD license. See the accompanying LICENSE file
+# or read the terms at https://opensource.org/licenses/BSD-3-Clause.
+
+import os
+import math
+import nibabel as nib
+
+from deepmedic.cnn3d import Cnn3d
+
+# Inference on large tiles. The network is fully convolutional, so its test graph can be rebuilt for segments much \
+# larger than those it was trained with, up to whole (padded) volumes. Each convolution is then computed once over \
+# the context that neighbouring segments share, instead of once per segment. The dims of the tiles are chosen to \
+# fit a budget of memory. The rebuilt model gets the values of all the shared variables of the original.
+
+BYTES_PER_VALUE = 4 # float32
+# The estimate counts the FMs of all layers of the test graph as alive at once. The intermediates within a layer \
+# (BN, activation, dropout scaling, concatenation, mirror-padding) are covered by this factor.
+SAFETY_FACTOR_OF_ESTIMATE = 2.0
+# If no budget is given, this fraction of the memory that is available when the session starts.
+FRACTION_OF_AVAILABLE_MEMORY_BY_DEFAULT = 0.5
+# Each step of the search shrinks the largest dimension of the output of the tile by this fraction.
+FRACTION_TO_SHRINK_PER_STEP = 0.1
+
+def getBytesOfAvailableMemory() :
+    # MemAvailable of /proc/meminfo on Linux. Otherwise, the physical memory.
+    try :
+        f = open("/proc/meminfo", "r")
+        try :
+            for line in f :
+                if line.startswith("MemAvailable:") :
+                    return int(line.split()[1]) * 1024 # Given in kB.
+        finally :
+            f.close()
+    except (IOError, OSError) :
+        pass
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+
+def getDimsOfVolumes(filepathsOfVolumes) :
+    # Only the headers are read.
+    return [ list(nib.load(filepath).shape[:3]) for filepath in filepathsOfVolumes ]
+
+def estimateBytesForInferenceOnSegment(cnn3dInst, dimsOfSegment, batchSize=1) :
+    # The shapes of the test graph of cnn3dInst, shifted by the change of the dims of the segment. Convolutions are \
+    # valid, so every layer changes by as much as its input, divided by the subsampling factor of its pathway.
+    dimsOfSegmentOfCnn = cnn3dInst.pathways[0].getShapeOfInput()[2][2:]
+    changeOfDims = [ dimsOfSegment[i] - dimsOfSegmentOfCnn[i] for i in xrange(3) ]
+    numberOfValues = 0
+    for pathway in cnn3dInst.pathways :
+        shapesOfTestFms = [ pathway.getShapeOfInput()[2] ] + [ layer.outputShapeTest for layer in pathway.getLayers() ]
+        for shape in shapesOfTestFms :
+            numberOfValuesPerFm = 1
+            for i in xrange(3) :
+                numberOfValuesPerFm *= max(1, shape[2+i] + int(math.ceil(changeOfDims[i] * 1.0 / pathway.subsFactor()[i])))
+            numberOfValues += shape[1] * numberOfValuesPerFm
+    return int(numberOfValues * batchSize * BYTES_PER_VALUE * SAFETY_FACTOR_OF_ESTIMATE)
+
+def chooseDimsOfLargeSegments(myLogger, cnn3dInst, dimsOfVolumes, padInputImagesBool, bytesOfBudget) :
+    # dimsOfVolumes: [[r, c, z], ...] of all the subjects. Returns the rcz dims of the segments, as large as fit in \
+    # the budget and in the smallest (padded) volume, or None if they are not larger than those of cnn3dInst.
+    recFieldCnn = cnn3dInst.recFieldCnn
+    dimsOfSegmentOfCnn = cnn3dInst.pathways[0].getShapeOfInput()[2][2:]
+    paddingPerAxis = [ recFieldCnn[i] - 1 if padInputImagesBool else 0 for i in xrange(3) ]
+    maxDimsOfSegment = [ min([ dims[i] + paddingPerAxis[i] for dims in dimsOfVolumes ]) for i in xrange(3) ]
+    # Work with the dims of the output, which may be any, down to those of the segments of cnn3dInst.
+    minDimsOfOutput = [ dimsOfSegmentOfCnn[i] - recFieldCnn[i] + 1 for i in xrange(3) ]
+    dimsOfOutput = [ max(minDimsOfOutput[i], maxDimsOfSegment[i] - recFieldCnn[i] + 1) for i in xrange(3) ]
+    getDimsOfSegment = lambda dimsOfOutput : [ dimsOfOutput[i] + recFieldCnn[i] - 1 for i in xrange(3) ]
+
+    while estimateBytesForInferenceOnSegment(cnn3dInst, getDimsOfSegment(dimsOfOutput)) > bytesOfBudget and \
+            dimsOfOutput <> minDimsOfOutput :
+        axisToShrink = max([ i for i in xrange(3) if dimsOfOutput[i] > minDimsOfOutput[i] ],
+                           key=lambda i : dimsOfOutput[i] - minDimsOfOutput[i])
+        dimsOfOutput[axisToShrink] = max(minDimsOfOutput[axisToShrink],
+                                         int(dimsOfOutput[axisToShrink] * (1 - FRACTION_TO_SHRINK_PER_STEP)))
+    dimsOfSegment = getDimsOfSegment(dimsOfOutput)
+    myLogger.print3("Large tiles for inference: The segments will be of dims " + str(dimsOfSegment) + " (output " + \
+                    str(dimsOfOutput) + "), estimated to need " + \
+                    str(round(estimateBytesForInferenceOnSegment(cnn3dInst, dimsOfSegment) / 1024.**3, 3)) + "GB of " + \
+                    "the budget of " + str(round(bytesOfBudget / 1024.**3, 3)) + "GB. Largest possible: " + \
+                    str(maxDimsOfSegment) + ". Of the model: " + str(dimsOfSegmentOfCnn) + ".")
+    if dimsOfSegment == list(dimsOfSegmentOfCnn) :
+        return None
+    return dimsOfSegment
+
+def makeCnnForInferenceOnLargeSegments(myLogger, cnn3dInst, dimsOfSegment) :
+    # A new Cnn3d with the same architecture and values as cnn3dInst, but a test graph for one segment of the \
+    # given dims per batch. The graphs for training and validation are as in cnn3dInst.
+    argumentsOfMakeCnnModel = dict(cnn3dInst.argumentsOfMakeCnnModel)
+    argumentsOfMakeCnnModel["imagePartDimensionsTesting"] = list(dimsOfSegment)
+    argumentsOfMakeCnnModel["batch_size_testing"] = 1
+    myLogger.print3("...Building the model anew, for inference on large segments...")
+    cnnForLargeSegments = Cnn3d()
+    cnnForLargeSegments.make_cnn_model(myLogger, **argumentsOfMakeCnnModel)
+    cnnForLargeSegments.setTrainingStateAttributes(myLogger, cnn3dInst.getTrainingStateAttributes())
+    namedSharedVariablesOfSource = dict(cnn3dInst.getNamedSharedVariables())
+    for [name, sharedVariable] in cnnForLargeSegments.getNamedSharedVariables() :
+        sharedVariable.set_value(namedSharedVariablesOfSource[name].get_value())
+    return cnnForLargeSegments
+
+def getCnnForInferenceOnLargeTiles(myLogger, cnn3dInst, filepathsOfVolumes, padInputImagesBool, gigabytesOfBudget=None) :
+    # Returns the model to use for inference: One rebuilt for large tiles, or cnn3dInst if they would not be larger.
+    if getattr(cnn3dInst, "argumentsOfMakeCnnModel", None) == None :
+        myLogger.print3("WARN: The model was made before checkpoints were introduced, so it cannot be rebuilt for " + \
+                        "large tiles. Inference will use the segments of the model.")
+        return cnn3dInst
+    bytesOfBudget = gigabytesOfBudget * 1024**3 if gigabytesOfBudget <> None else \
+                        FRACTION_OF_AVAILABLE_MEMORY_BY_DEFAULT * getBytesOfAvailableMemory()
+    dimsOfSegment = chooseDimsOfLargeSegments(myLogger, cnn3dInst, getDimsOfVolumes(filepathsOfVolumes),
+                                              padInputImagesBool, bytesOfBudget)
+    if dimsOfSegment == None :
+        myLogger.print3("Large tiles for inference: Not larger than the segments of the model. These will be used.")
+        return cnn3dInst
+    return makeCnnForInferenceOnLargeSegments(myLogger, cnn3dInst, dimsOfSegment)
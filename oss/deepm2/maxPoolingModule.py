@@ -11,29 +11,57 @@ from theano.tensor.signal import pool
 from math import ceil
 
 def mirrorFinalBordersOfImage(image3dBC012, mirrorFinalBordersForThatMuch) :
+    # Replicates the last slice of each spatial axis mirrorFinalBordersForThatMuch[axis] times. \
+    # One concatenation per axis, so the feature maps are copied at most 3 times, not once per padded slice.
     image3dBC012WithMirroredFinalElemets = image3dBC012
-    for time_i in xrange(0, mirrorFinalBordersForThatMuch[0]) :
-        image3dBC012WithMirroredFinalElemets = T.concatenate([ image3dBC012WithMirroredFinalElemets, \
-                                                              image3dBC012WithMirroredFinalElemets[:,:,-1:,:,:] ], axis=2)
-    for time_i in xrange(0, mirrorFinalBordersForThatMuch[1]) :
-        image3dBC012WithMirroredFinalElemets = T.concatenate([ image3dBC012WithMirroredFinalElemets, \
-                                                              image3dBC012WithMirroredFinalElemets[:,:,:,-1:,:] ], axis=3)
-    for time_i in xrange(0, mirrorFinalBordersForThatMuch[2]) :
-        image3dBC012WithMirroredFinalElemets = T.concatenate([ image3dBC012WithMirroredFinalElemets, \
-                                                              image3dBC012WithMirroredFinalElemets[:,:,:,:,-1:] ], axis=4)
+    for spatialAxis_i in xrange(0, 3) :
+        numberOfTimesToMirror = mirrorFinalBordersForThatMuch[spatialAxis_i]
+        if numberOfTimesToMirror > 0 :
+            axis = 2 + spatialAxis_i
+            lastSlice = image3dBC012WithMirroredFinalElemets[ (slice(None),) * axis + (slice(-1, None),) ]
+            image3dBC012WithMirroredFinalElemets = T.concatenate([ image3dBC012WithMirroredFinalElemets, \
+                                                                   T.repeat(lastSlice, numberOfTimesToMirror, axis=axis) ],
+                                                                 axis=axis)
     return image3dBC012WithMirroredFinalElemets
 
-
-def myMaxPooling3d(image3dBC012, image3dBC012Shape, maxPoolingParameters) :
-    # image3dBC012 dimensions: (batch, fms, r, c, z)
-    # maxPoolingParameters: [[dsr,dsc,dsz], [strr,strc,strz], [mirrorPad-r,-c,-z], mode]
-    
+def getShapeOfImageAfterMaxPoolingAfterMirroring(image3dBC012Shape, maxPoolingParameters) :
+    #This calculation is for ignore_border=True! Pooling should only be done in full areas in the mirror-padded image.
     ds = maxPoolingParameters[0]
     stride = maxPoolingParameters[1]
-    mode1 = maxPoolingParameters[3]
-    
-    image3dBC012WithMirroredFinalElemets = mirrorFinalBordersOfImage(image3dBC012, maxPoolingParameters[2])
-    
+    return [ image3dBC012Shape[0],
+             image3dBC012Shape[1],
+             int(ceil( (image3dBC012Shape[2] + maxPoolingParameters[2][0] - ds[0] + 1) / (1.0*stride[0])) ),
+             int(ceil( (image3dBC012Shape[3] + maxPoolingParameters[2][1] - ds[1] + 1) / (1.0*stride[1])) ),
+             int(ceil( (image3dBC012Shape[4] + maxPoolingParameters[2][2] - ds[2] + 1) / (1.0*stride[2])) )
+            ]
+
+def _numberOfWindowsWithoutIgnoringBorder(dimensionOfImage, ds, stride) :
+    # As computed by theano's Pool with ignore_border=False, where the last windows may be partially outside the image.
+    if stride >= ds :
+        return (dimensionOfImage - 1) // stride + 1
+    return max(0, (dimensionOfImage - ds + stride - 1) // stride) + 1
+
+def _partialWindowsGiveTheMirroredPooling(image3dBC012Shape, maxPoolingParameters, shapeAfterPooling) :
+    # With max pooling, a window that extends past the end of the image over replicated final elements has the max of \
+    # its part inside the image, because the replicated element is in that part. So pooling the unpadded image with \
+    # partial windows (ignore_border=False) gives the same values, without materializing the padding. \
+    # Holds if each of the windows we need starts inside the image and theano gives at least as many windows. \
+    # The gradients are NOT the same: Theano's max-pool gradient goes to every element equal to the max, so with \
+    # mirroring the final element also gets the gradient of its replicas. Hence only for inference, see myMaxPooling3d().
+    if maxPoolingParameters[3] <> 'max' :
+        return False
+    for spatialAxis_i in xrange(0, 3) :
+        dimensionOfImage = image3dBC012Shape[2 + spatialAxis_i]
+        ds = maxPoolingParameters[0][spatialAxis_i]
+        stride = maxPoolingParameters[1][spatialAxis_i]
+        numberOfWindowsNeeded = shapeAfterPooling[2 + spatialAxis_i]
+        if (numberOfWindowsNeeded - 1) * stride >= dimensionOfImage or \
+                _numberOfWindowsWithoutIgnoringBorder(dimensionOfImage, ds, stride) < numberOfWindowsNeeded :
+            return False
+    return True
+
+def _myMaxPooling3dWithTwoPasses2d(image3dBC012WithMirroredFinalElemets, ds, stride, mode1) :
+    # For theano versions without pool_3d (< 0.9).
     pooled_out1 = pool.max_pool_2d(
                             input = image3dBC012WithMirroredFinalElemets,
                             ds=(ds[1], ds[2]),
@@ -50,18 +78,62 @@ def myMaxPooling3d(image3dBC012, image3dBC012Shape, maxPoolingParameters) :
                             st=(1,stride[0]),
                             padding=(0, 0),
                             mode=mode1)
-    pooled_out = pooled_out2.dimshuffle(0,1,4,2,3)
+    return pooled_out2.dimshuffle(0,1,4,2,3)
+
+def _cropToTheNumberOfWindowsOfTheMirroredPooling(pooledOut, image3dBC012, maxPoolingParameters) :
+    # Symbolic, as the graph serves images of any dims. The number of windows is as in \
+    # getShapeOfImageAfterMaxPoolingAfterMirroring(): ceil((dim + mirror - ds + 1) / stride).
+    cropSlices = [ slice(None), slice(None) ]
+    for spatialAxis_i in xrange(0, 3) :
+        ds = maxPoolingParameters[0][spatialAxis_i]
+        stride = maxPoolingParameters[1][spatialAxis_i]
+        dimensionOfImage = image3dBC012.shape[2 + spatialAxis_i]
+        cropSlices.append(slice(0, (dimensionOfImage + maxPoolingParameters[2][spatialAxis_i] - ds + stride) // stride))
+    return pooledOut[tuple(cropSlices)]
+
+def myMaxPooling3d(image3dBC012, image3dBC012Shapes, maxPoolingParameters, isTrainingFlag=None) :
+    # image3dBC012 dimensions: (batch, fms, r, c, z)
+    # image3dBC012Shapes: The shapes of the image the graph is used with, eg in training, validation and testing.
+    # maxPoolingParameters: [[dsr,dsc,dsz], [strr,strc,strz], [mirrorPad-r,-c,-z], mode]
+    # isTrainingFlag: Symbolic int8 scalar of the model (see cnnLayerTypes.applyDropout()), or None if the graph may \
+    #    be trained in any of its uses.
+    # Returns the pooled image and its shape per given shape.
+    # Pools in one pass over the 3 spatial axes with theano's pool_3d. The final borders are mirrored by making the \
+    # padded image first. For 'max' pooling, the functions that do not train (isTrainingFlag == 0) use instead the \
+    # partial windows of the op where possible, which give the same values but not the same gradients.
+    
+    ds = maxPoolingParameters[0]
+    stride = maxPoolingParameters[1]
+    mode1 = maxPoolingParameters[3]
     
     #calculate the shape of the image after the max pooling.
-    #This calculation is for ignore_border=True! Pooling should only be done in full areas in the mirror-padded image.
-    shapeOfImageAfterMaxPoolingAfterMirroring = [   image3dBC012Shape[0],
-                                                    image3dBC012Shape[1],
-                                                    int(ceil( (image3dBC012Shape[2] + maxPoolingParameters[2][0] - \
-                                                               ds[0] + 1) / (1.0*stride[0])) ),
-                                                    int(ceil( (image3dBC012Shape[3] + maxPoolingParameters[2][1] - \
-                                                               ds[1] + 1) / (1.0*stride[1])) ),
-                                                    int(ceil( (image3dBC012Shape[4] + maxPoolingParameters[2][2] - \
-                                                               ds[2] + 1) / (1.0*stride[2])) )
-                                                ]
-    return (pooled_out, shapeOfImageAfterMaxPoolingAfterMirroring)
-
+    shapesOfImageAfterMaxPoolingAfterMirroring = [ getShapeOfImageAfterMaxPoolingAfterMirroring(image3dBC012Shape,
+                                                                                                maxPoolingParameters) \
+                                                  for image3dBC012Shape in image3dBC012Shapes ]
+    if not hasattr(pool, "pool_3d") :
+        image3dBC012WithMirroredFinalElemets = mirrorFinalBordersOfImage(image3dBC012, maxPoolingParameters[2])
+        pooled_out = _myMaxPooling3dWithTwoPasses2d(image3dBC012WithMirroredFinalElemets, ds, stride, mode1)
+    else :
+        image3dBC012WithMirroredFinalElemets = mirrorFinalBordersOfImage(image3dBC012, maxPoolingParameters[2])
+        pooled_out = pool.pool_3d(input = image3dBC012WithMirroredFinalElemets,
+                                  ws=tuple(ds),
+                                  ignore_border=True,
+                                  stride=tuple(stride),
+                                  pad=(0, 0, 0),
+                                  mode=mode1)
+        if isTrainingFlag <> None and \
+                all([ _partialWindowsGiveTheMirroredPooling(image3dBC012Shapes[shape_i], maxPoolingParameters,
+                                                            shapesOfImageAfterMaxPoolingAfterMirroring[shape_i]) \
+                      for shape_i in xrange(len(image3dBC012Shapes)) ]) :
+            pooledOutWithPartialWindows = pool.pool_3d(input = image3dBC012,
+                                                       ws=tuple(ds),
+                                                       ignore_border=False,
+                                                       stride=tuple(stride),
+                                                       pad=(0, 0, 0),
+                                                       mode=mode1)
+            pooledOutWithPartialWindows = _cropToTheNumberOfWindowsOfTheMirroredPooling(pooledOutWithPartialWindows,
+                                                                                        image3dBC012, maxPoolingParameters)
+            # The flag is a constant in each compiled function, so the branch not taken is optimized away.
+            pooled_out = T.switch(isTrainingFlag, pooled_out, pooledOutWithPartialWindows)
+            
+    return (pooled_out, shapesOfImageAfterMaxPoolingAfterMirroring)
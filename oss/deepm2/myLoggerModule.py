@@ -5,18 +5,123 @@
 # it under the terms of the BSD license. See the accompanying LICENSE file
 # or read the terms at https://opensource.org/licenses/BSD-3-Clause.
 
+import os
 import datetime
+import json
+import threading
+import atexit
+
+LEVEL_DEBUG = 10
+LEVEL_INFO = 20
+LEVEL_WARN = 30
+LEVEL_ERROR = 40
+# Level of messages given without one, by the prefix of the message. Otherwise LEVEL_INFO. \
+# Messages prefixed "DEBUG" were always printed, so they stay at LEVEL_INFO. Only those given LEVEL_DEBUG are hidden \
+# by default, and shown by a logger with levelOfOutput=LEVEL_DEBUG.
+LEVELS_BY_PREFIX_OF_MESSAGE = [ ["ERROR", LEVEL_ERROR], ["WARN", LEVEL_WARN] ]
+
+# The files are kept open and buffered. They are flushed at most this many seconds after a write, \
+# immediately for warnings and errors, and when the process exits.
+SECONDS_BETWEEN_FLUSHES = 2.0
+EXTENSION_OF_RECORDS = ".jsonl"
+
+def getLevelOfMessage(string) :
+    for [prefix, level] in LEVELS_BY_PREFIX_OF_MESSAGE :
+        if string.startswith(prefix) :
+            return level
+    return LEVEL_INFO
+
+def getFilenameOfRecordsForLog(filenameOfLog) :
+    # logs/session.txt -> logs/session.jsonl
+    return os.path.splitext(filenameOfLog)[0] + EXTENSION_OF_RECORDS
+
+def _convertToJsonSerializable(obj) :
+    if hasattr(obj, "tolist") : # numpy arrays and scalars.
+        return obj.tolist()
+    return str(obj)
 
 class MyLogger :
+    # Free-text log, printed and appended to loggerFileName. Also structured records (one json object per line) \
+    # appended to recordsFileName by logRecord(), for dashboards and scripts.
+    # Forked processes (eg the SamplerPool's) do not use the buffered files of their parent, whose content would \
+    # then be written twice. They open their own and flush every write, as they may exit without cleanup.
     loggerFileName = None
-    
-    def print3(self, string) :
-        print (string)    
-        f = open(self.loggerFileName,'a')
-        f.write(str(datetime.datetime.now())+" >> "+string+"\n")
-        f.close()
-        
-    def __init__(self, filenameAndPathOfLoggerTxt="logs/defaultLogFile.txt") :
+
+    def print3(self, string, level=None) :
+        level = level if level <> None else getLevelOfMessage(string)
+        if level < self.levelOfOutput :
+            return
+        print (string)
+        self._write(self.loggerFileName, str(datetime.datetime.now())+" >> "+string+"\n", level >= LEVEL_WARN)
+
+    def logRecord(self, typeOfRecord, **fields) :
+        # Eg logRecord("timing", session="Training", stage="subepoch", seconds=1.2). Values are numbers, strings, \
+        # lists and dicts of them, or numpy arrays and scalars.
+        record = { "time" : str(datetime.datetime.now()), "type" : typeOfRecord }
+        record.update(fields)
+        self._write(self.recordsFileName, json.dumps(record, default=_convertToJsonSerializable) + "\n", False)
+
+    def flush(self) :
+        with self._getLock() :
+            for f in self._filesByName.values() :
+                f.flush()
+
+    def close(self) :
+        self._stopFlushing()
+        with self._getLock() :
+            for f in self._filesByName.values() :
+                f.close()
+            self._filesByName = {}
+
+    def _stopFlushing(self) :
+        # Before the interpreter shuts down, as a daemon thread still running then may fail.
+        self._stopFlusher.set()
+        if self._flusher <> None and self._pidOfFiles == self._pidOfCreator :
+            self._flusher.join()
+        self.flush()
+
+    def _getLock(self) :
+        if self._pidOfFiles <> os.getpid() : # Forked. Do not touch the parent's files (or their buffers), nor its lock, \
+            # which another of its threads may have held at the fork.
+            # The parent's files are kept referenced, as closing them (eg by garbage collection) would flush their buffers.
+            self._filesOfParents += self._filesByName.values()
+            self._pidOfFiles = os.getpid()
+            self._filesByName = {}
+            self._lock = threading.RLock()
+        return self._lock
+
+    def _getFile(self, filename) :
+        # Called with the lock held.
+        if filename not in self._filesByName :
+            self._filesByName[filename] = open(filename, 'a')
+        return self._filesByName[filename]
+
+    def _write(self, filename, string, flushNow) :
+        with self._getLock() :
+            f = self._getFile(filename)
+            f.write(string)
+            if flushNow or self._pidOfFiles <> self._pidOfCreator :
+                f.flush()
+            elif self._flusher == None :
+                self._flusher = threading.Thread(target=self._flushPeriodically)
+                self._flusher.daemon = True
+                self._flusher.start()
+
+    def _flushPeriodically(self) :
+        while not self._stopFlusher.wait(SECONDS_BETWEEN_FLUSHES) :
+            self.flush()
+
+    def __init__(self, filenameAndPathOfLoggerTxt="logs/defaultLogFile.txt", filenameAndPathOfRecords=None, levelOfOutput=LEVEL_INFO) :
         self.loggerFileName = filenameAndPathOfLoggerTxt
-        
-        
\ No newline at end of file
+        self.recordsFileName = filenameAndPathOfRecords if filenameAndPathOfRecords <> None else \
+                                getFilenameOfRecordsForLog(filenameAndPathOfLoggerTxt)
+        self.levelOfOutput = levelOfOutput
+        self._lock = threading.RLock()
+        self._filesByName = {}
+        self._filesOfParents = []
+        self._pidOfCreator = os.getpid()
+        self._pidOfFiles = os.getpid()
+        self._flusher = None
+        self._stopFlusher = threading.Event()
+        atexit.register(self._stopFlushing)
+
@@ -0,0 +1,302 @@
+# Copyright (c) 2016, Konstantinos Kamnitsas
+# All rights reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the BSD license. See the accompanying LICENSE file
+# or read the terms at https://opensource.org/licenses/BSD-3-Clause.
+
+import os
+import sys
+import csv
+import time
+import threading
+import subprocess
+import multiprocessing
+from multiprocessing.connection import Listener, Client
+
+from deepmedic.myLoggerModule import MyLogger, getLevelOfMessage, LEVEL_INFO
+from deepmedic.accuracyMonitor import AccuracyOfEpochMonitorSegmentation
+from deepmedic.trainValidateTestVisualiseParallel import reportAverageMetricsOverSubjects
+
+# Segmentation of the subjects of a testing session by several worker processes on one machine, eg one per GPU, \
+# or a few that share the cores of the cpu. Each worker is a new python process, with theano set to its own device \
+# before it is imported, which loads the cnn and gets its functions once. The coordinator hands out the indices of \
+# the subjects one at a time, when a worker asks for its next, so faster workers segment more. The workers save \
+# their outputs as a single process would, and forward their log and records to the coordinator, which writes them \
+# in the log of the session, along with a table of the metrics of all subjects.
+# Messages of the workers: ["print3", string, level], ["record", typeOfRecord, fields], ["nextSubject"] (answered \
+# with an index, or None when all are given), ["finished"] and ["error", traceback].
+
+NAME_OF_MODULE_OF_WORKER = __name__.rsplit(".", 1)[0] + ".frontEndModules.deepMedicTestWorker"
+NAME_OF_ENV_VAR_OF_AUTHKEY = "DEEPMEDIC_INFERENCE_WORKER_AUTHKEY"
+# Set for the workers on the cpu, unless already set, so that together they use each core once.
+NAMES_OF_ENV_VARS_OF_NUMBER_OF_THREADS = ["OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"]
+SECONDS_BETWEEN_CHECKS_OF_WORKERS = 1.0
+EXTENSION_OF_TABLE_OF_METRICS = ".metricsOfSubjects.csv"
+
+def isValidDeviceOfWorker(device) :
+    # As the [-dev] option of deepMedicRun, or the cuda devices of the gpuarray backend.
+    if not isinstance(device, str) :
+        return False
+    for prefix in ["gpu", "cuda"] :
+        if device.startswith(prefix) and (device[len(prefix):] == "" or device[len(prefix):].isdigit()) :
+            return True
+    return device == "cpu"
+
+def getDevicesOfInferenceWorkers(myLogger, devicesOrNumberOfWorkers) :
+    # Given a list of devices, one worker per entry. Given a number N, N workers on the cpu.
+    if isinstance(devicesOrNumberOfWorkers, int) and not isinstance(devicesOrNumberOfWorkers, bool) and \
+            devicesOrNumberOfWorkers > 0 :
+        return ["cpu"] * devicesOrNumberOfWorkers
+    if isinstance(devicesOrNumberOfWorkers, list) and len(devicesOrNumberOfWorkers) > 0 and \
+            all([ isValidDeviceOfWorker(device) for device in devicesOrNumberOfWorkers ]) :
+        return devicesOrNumberOfWorkers
+    myLogger.print3("ERROR: The devices of the inference workers should be given as a list with the device of each " + \
+                    "worker, eg [\"cpu\", \"cpu\", \"gpu0\", \"gpu1\"], or as a number of workers on the cpu. " + \
+                    "Given: [" + str(devicesOrNumberOfWorkers) + "]. Exiting!"); exit(1)
+
+def getTheanoFlagsForDevice(theanoFlags, device) :
+    # The given flags (eg those that deepMedicRun set for this process), with the device replaced.
+    flags = [ flag.strip() for flag in theanoFlags.split(",") if flag.strip() <> "" ]
+    flags = [ flag for flag in flags if not flag.replace(" ", "").startswith("device=") ]
+    return ",".join(flags + ["device=" + device])
+
+def getFilenameOfTableOfMetricsForLog(filenameOfLog) :
+    # logs/session.txt -> logs/session.metricsOfSubjects.csv
+    return os.path.splitext(filenameOfLog)[0] + EXTENSION_OF_TABLE_OF_METRICS
+
+def saveTableOfMetricsOfSubjects(filepathOfTable, numberOfClasses, metricsOfSubjectsByIndex, namesOfSubjects) :
+    # metricsOfSubjectsByIndex: The fields of the "metricsOfSubject" records of the subjects, and their "worker". \
+    # One row per subject, with a column per metric and class. Empty where not applicable.
+    namesOfMetrics = ["dice1", "dice2", "dice3", "sensitivity", "specificity"]
+    with open(filepathOfTable, "wb") as fileOfTable :
+        writer = csv.writer(fileOfTable)
+        writer.writerow(["subject", "name", "worker"] + [ nameOfMetric + "Class" + str(class_i) \
+                            for nameOfMetric in namesOfMetrics for class_i in xrange(numberOfClasses) ])
+        for subject_i in sorted(metricsOfSubjectsByIndex.keys()) :
+            metrics = metricsOfSubjectsByIndex[subject_i]
+            writer.writerow([subject_i, namesOfSubjects[subject_i], metrics["worker"]] + \
+                            [ "" if value == None else value for nameOfMetric in namesOfMetrics \
+                                                                for value in metrics[nameOfMetric] ])
+
+class CoordinatorOfInferenceWorkers(object):
+    def __init__(self, myLogger, devicesOfWorkers, numberOfSubjects) :
+        self._myLogger = myLogger
+        self._devicesOfWorkers = devicesOfWorkers
+        self._numberOfSubjects = numberOfSubjects
+        self._lock = threading.Lock()
+        self._indicesOfSubjectsToGive = range(numberOfSubjects)
+        self._indicesOfSubjectsGivenPerWorker = [ [] for device in devicesOfWorkers ]
+        self._metricsOfSubjectsByIndex = {}
+        self._workersFinished = [ False ] * len(devicesOfWorkers)
+        self._errorsOfWorkers = [ None ] * len(devicesOfWorkers)
+        self._threadsServingWorkers = []
+
+    def _getNameOfWorker(self, worker_i) :
+        return "Worker #" + str(worker_i) + " (" + self._devicesOfWorkers[worker_i] + ")"
+
+    def getMetricsOfSubjectsByIndex(self) :
+        return self._metricsOfSubjectsByIndex
+
+    def _takeIndexOfNextSubject(self, worker_i) :
+        with self._lock :
+            if len(self._indicesOfSubjectsToGive) == 0 :
+                return None
+            subject_i = self._indicesOfSubjectsToGive.pop(0)
+            self._indicesOfSubjectsGivenPerWorker[worker_i].append(subject_i)
+            numberOfSubjectsGiven = self._numberOfSubjects - len(self._indicesOfSubjectsToGive)
+        self._myLogger.print3("Subject #" + str(subject_i) + " is given to " + self._getNameOfWorker(worker_i) + \
+                              ". Given: " + str(numberOfSubjectsGiven) + "/" + str(self._numberOfSubjects) + " subjects.")
+        return subject_i
+
+    def _allSubjectsAreSegmented(self) :
+        # All were given, and the workers given any have finished. No other subject can be given to the rest.
+        with self._lock :
+            return len(self._indicesOfSubjectsToGive) == 0 and \
+                all([ self._workersFinished[worker_i] or len(self._indicesOfSubjectsGivenPerWorker[worker_i]) == 0 \
+                        for worker_i in xrange(len(self._devicesOfWorkers)) ])
+
+    def _serveWorker(self, connection) :
+        # Target of a thread per worker. Until the worker closes the connection.
+        try :
+            [typeOfMessage, worker_i] = connection.recv()
+            prefix = "[" + self._getNameOfWorker(worker_i) + "] "
+            while True :
+                message = connection.recv()
+                typeOfMessage = message[0]
+                if typeOfMessage == "print3" :
+                    self._myLogger.print3(prefix + message[1], message[2])
+                elif typeOfMessage == "record" :
+                    [typeOfRecord, fields] = message[1:]
+                    fields["worker"] = worker_i
+                    if typeOfRecord == "metricsOfSubject" :
+                        self._metricsOfSubjectsByIndex[fields["subject"]] = fields
+                    self._myLogger.logRecord(typeOfRecord, **fields)
+                elif typeOfMessage == "nextSubject" :
+                    connection.send(self._takeIndexOfNextSubject(worker_i))
+                elif typeOfMessage == "finished" :
+                    self._workersFinished[worker_i] = True
+                elif typeOfMessage == "error" :
+                    self._errorsOfWorkers[worker_i] = message[1]
+        except (EOFError, IOError) : # Closed, when the worker exits.
+            pass
+        finally :
+            connection.close()
+
+    def _acceptWorkers(self, listener) :
+        # Target of a thread. Each worker connects once, when it starts.
+        for worker_i in xrange(len(self._devicesOfWorkers)) :
+            connection = listener.accept()
+            thread = threading.Thread(target=self._serveWorker, args=(connection,))
+            thread.daemon = True
+            thread.start()
+            self._threadsServingWorkers.append(thread)
+
+    def _startWorker(self, worker_i, addressOfListener, authkey, argsOfWorker, numberOfThreadsPerCpuWorker) :
+        device = self._devicesOfWorkers[worker_i]
+        env = dict(os.environ)
+        env["THEANO_FLAGS"] = getTheanoFlagsForDevice(os.environ.get("THEANO_FLAGS", ""), device)
+        env[NAME_OF_ENV_VAR_OF_AUTHKEY] = authkey
+        # So that the workers import this package, wherever they are started from.
+        folderOfPackage = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env["PYTHONPATH"] = os.pathsep.join([folderOfPackage] + ([env["PYTHONPATH"]] if env.get("PYTHONPATH") else []))
+        if device == "cpu" :
+            for nameOfEnvVar in NAMES_OF_ENV_VARS_OF_NUMBER_OF_THREADS :
+                env[nameOfEnvVar] = env.get(nameOfEnvVar, str(numberOfThreadsPerCpuWorker))
+        return subprocess.Popen([sys.executable, "-m", NAME_OF_MODULE_OF_WORKER,
+                                 "-coordinator", addressOfListener[0] + ":" + str(addressOfListener[1]),
+                                 "-worker", str(worker_i)] + argsOfWorker, env=env)
+
+    def _stopWorkersAndExit(self, workers) :
+        for worker in workers :
+            if worker.poll() == None :
+                worker.terminate()
+        for worker in workers :
+            worker.wait()
+        self._myLogger.print3("ERROR: Segmentation by the inference workers failed. Exiting!"); exit(1)
+
+    def segmentSubjects(self, argsOfWorker) :
+        # argsOfWorker: Command line args of deepMedicTestWorker that give the session. Returns when all are finished.
+        startTime = time.time()
+        numberOfCpuWorkers = self._devicesOfWorkers.count("cpu")
+        numberOfThreadsPerCpuWorker = max(1, multiprocessing.cpu_count() // max(1, numberOfCpuWorkers))
+        authkey = os.urandom(16).encode("hex")
+        listener = Listener(("localhost", 0), authkey=authkey)
+        acceptingThread = threading.Thread(target=self._acceptWorkers, args=(listener,))
+        acceptingThread.daemon = True
+        acceptingThread.start()
+
+        self._myLogger.print3("Starting " + str(len(self._devicesOfWorkers)) + " inference workers, on the devices: " + \
+                              str(self._devicesOfWorkers) + ". Each loads the cnn and gets its functions, before it " + \
+                              "asks for subjects. Their lines in the log are prefixed by their name.")
+        workers = [ self._startWorker(worker_i, listener.address, authkey, argsOfWorker, numberOfThreadsPerCpuWorker) \
+                        for worker_i in xrange(len(self._devicesOfWorkers)) ]
+
+        # A worker that exits without reporting it finished failed, eg with an error, or killed when out of memory.
+        while not self._allSubjectsAreSegmented() :
+            time.sleep(SECONDS_BETWEEN_CHECKS_OF_WORKERS)
+            for worker_i in xrange(len(workers)) :
+                exitCode = workers[worker_i].poll()
+                if exitCode <> None and not self._workersFinished[worker_i] :
+                    for thread in self._threadsServingWorkers : # Until they log all that the workers sent.
+                        thread.join(SECONDS_BETWEEN_CHECKS_OF_WORKERS)
+                    if self._workersFinished[worker_i] :
+                        continue
+                    self._myLogger.print3("ERROR: " + self._getNameOfWorker(worker_i) + " exited with code [" + \
+                                          str(exitCode) + "] before finishing. It was given the subjects: " + \
+                                          str(self._indicesOfSubjectsGivenPerWorker[worker_i]) + ". " + \
+                                          ("Its error:\n" + self._errorsOfWorkers[worker_i] if \
+                                                self._errorsOfWorkers[worker_i] <> None else ""))
+                    self._stopWorkersAndExit(workers)
+        # Workers that were not given any subject, eg still starting when the others segmented all, are not needed.
+        for worker_i in xrange(len(workers)) :
+            if not self._workersFinished[worker_i] and workers[worker_i].poll() == None :
+                self._myLogger.print3(self._getNameOfWorker(worker_i) + " was not given any subject. It is stopped.")
+                workers[worker_i].terminate()
+        for worker in workers :
+            worker.wait()
+        for thread in self._threadsServingWorkers :
+            thread.join()
+        listener.close()
+
+        secondsOfSegmentation = time.time() - startTime
+        for worker_i in xrange(len(workers)) :
+            self._myLogger.print3(self._getNameOfWorker(worker_i) + " segmented " + \
+                                  str(len(self._indicesOfSubjectsGivenPerWorker[worker_i])) + " subjects: " + \
+                                  str(self._indicesOfSubjectsGivenPerWorker[worker_i]))
+        self._myLogger.print3("TIMING: The " + str(len(workers)) + " inference workers segmented the " + \
+                              str(self._numberOfSubjects) + " subjects in " + str(secondsOfSegmentation) + "(s).")
+        self._myLogger.logRecord("timing", session="Testing", stage="inferenceWorkers", seconds=secondsOfSegmentation,
+                                 devicesOfWorkers=self._devicesOfWorkers,
+                                 subjectsPerWorker=self._indicesOfSubjectsGivenPerWorker)
+
+def segmentSubjectsWithInferenceWorkers(myLogger, devicesOrNumberOfWorkers, argsOfWorker, namesOfSubjects,
+                                        providedGtLabelsBool) :
+    # Segments the subjects by workers that run deepMedicTestWorker with argsOfWorker. Then reports the average \
+    # metrics over all subjects and saves the table of the metrics per subject, if the labels were given.
+    devicesOfWorkers = getDevicesOfInferenceWorkers(myLogger, devicesOrNumberOfWorkers)
+    coordinator = CoordinatorOfInferenceWorkers(myLogger, devicesOfWorkers, len(namesOfSubjects))
+    coordinator.segmentSubjects(argsOfWorker)
+
+    metricsOfSubjectsByIndex = coordinator.getMetricsOfSubjectsByIndex()
+    if providedGtLabelsBool and len(metricsOfSubjectsByIndex) > 0 :
+        NA_PATTERN = AccuracyOfEpochMonitorSegmentation.NA_PATTERN
+        indicesOfSubjects = sorted(metricsOfSubjectsByIndex.keys())
+        getMetricOfSubjects = lambda nameOfMetric : [ [ NA_PATTERN if value == None else value for value in \
+                                    metricsOfSubjectsByIndex[i][nameOfMetric] ] for i in indicesOfSubjects ]
+        myLogger.print3("+++++++++++++++++++++++++++++++ Segmentation of all subjects by the workers finished")
+        reportAverageMetricsOverSubjects(myLogger, "Testing", getMetricOfSubjects("dice1"), getMetricOfSubjects("dice2"),
+                                         getMetricOfSubjects("dice3"), getMetricOfSubjects("sensitivity"),
+                                         getMetricOfSubjects("specificity"))
+        filepathOfTable = getFilenameOfTableOfMetricsForLog(myLogger.loggerFileName)
+        numberOfClasses = len(metricsOfSubjectsByIndex[indicesOfSubjects[0]]["dice1"])
+        saveTableOfMetricsOfSubjects(filepathOfTable, numberOfClasses, metricsOfSubjectsByIndex, namesOfSubjects)
+        myLogger.print3("The metrics of each subject were saved in the table: " + filepathOfTable)
+
+
+class ConnectionToCoordinator(object):
+    # Of a worker. Its log is forwarded from the main thread and from those of the pipeline of inference, so sending \
+    # a message, or a request and its answer, holds the lock.
+    def __init__(self, addressOfCoordinator, authkey, worker_i) :
+        self._lock = threading.Lock()
+        self._connection = Client(addressOfCoordinator, authkey=authkey)
+        self.send(["hello", worker_i])
+
+    def send(self, message) :
+        with self._lock :
+            self._connection.send(message)
+
+    def request(self, message) :
+        with self._lock :
+            self._connection.send(message)
+            return self._connection.recv()
+
+    def iterateIndicesOfSubjects(self) :
+        # Asks for the next subject only when it is needed, eg by the thread that prefetches them.
+        while True :
+            subject_i = self.request(["nextSubject"])
+            if subject_i == None :
+                return
+            yield subject_i
+
+    def close(self) :
+        with self._lock :
+            self._connection.close()
+
+
+class LoggerOfInferenceWorker(MyLogger) :
+    # Forwards the log and the records to the coordinator, which writes them in the files of the session. \
+    # loggerFileName is that of the session's log, for whoever derives filenames from it.
+    def __init__(self, connectionToCoordinator, filenameAndPathOfLoggerTxt, levelOfOutput=LEVEL_INFO) :
+        MyLogger.__init__(self, filenameAndPathOfLoggerTxt, levelOfOutput=levelOfOutput)
+        self._connectionToCoordinator = connectionToCoordinator
+
+    def print3(self, string, level=None) :
+        level = level if level <> None else getLevelOfMessage(string)
+        if level < self.levelOfOutput :
+            return
+        self._connectionToCoordinator.send(["print3", string, level])
+
+    def logRecord(self, typeOfRecord, **fields) :
+        self._connectionToCoordinator.send(["record", typeOfRecord, fields])
+
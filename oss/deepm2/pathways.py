@@ -22,7 +22,7 @@ from deepmedic.cnnHelpers import calcReceptiveFieldDims
 #################################################################
 
 def cropRczOf5DimArrayToMatchOther(array5DimToCrop, dimensionsOf5DimArrayToMatchInRcz):
-    # dimensionsOf5DimArrayToMatchInRcz : [ batch size, num of fms, r, c, z] 
+    # dimensionsOf5DimArrayToMatchInRcz : [ batch size, num of fms, r, c, z]. May be symbolic, eg T.shape(other).
     output = array5DimToCrop[:,
                             :,
                             :dimensionsOf5DimArrayToMatchInRcz[2],
@@ -48,7 +48,7 @@ def upsampleRcz5DimArrayAndOptionalCrop(array5dimToUpsample,
     else :
         print "NOT IMPLEMENTED! EXITING!"; exit(1)
         
-    if dimensionsOf5DimArrayToMatchInRcz <> None :
+    if dimensionsOf5DimArrayToMatchInRcz is not None : # May be symbolic.
         # If the central-voxels are eg 10, the susampled-part will have 4 central voxels. \
         #Which above will be repeated to 3*4 = 12.
         # I need to clip the last ones, to have the same dimension as the input from 1st pathway, \
@@ -59,8 +59,14 @@ def upsampleRcz5DimArrayAndOptionalCrop(array5dimToUpsample,
         
     return output
     
+def getRczDimsOfFms(fms) :
+    # Symbolic, for the graph to serve fms of any dims. A list, to give to getMiddlePartOfFms().
+    fmsShape = T.shape(fms)
+    return [ fmsShape[2], fmsShape[3], fmsShape[4] ]
+    
 def getMiddlePartOfFms(fms, listOfNumberOfCentralVoxelsToGetPerDimension) :
     # fms: a 5D tensor, [batch, fms, r, c, z]
+    # listOfNumberOfCentralVoxelsToGetPerDimension: ints, or symbolic (see getRczDimsOfFms()).
     fmsShape = T.shape(fms) #fms.shape works too, but this is clearer theano grammar.
     # if part is of even width, one voxel to the left is the centre.
     rCentreOfPartIndex = (fmsShape[2] - 1) / 2
@@ -90,60 +96,40 @@ def getMiddlePartOfFms(fms, listOfNumberOfCentralVoxelsToGetPerDimension) :
         return -1
         
 def makeResidualConnectionBetweenLayersAndReturnOutput( myLogger,
-                                                        deeperLayerOutputImagesTrValTest,
+                                                        deeperLayerOutputImage,
                                                         deeperLayerOutputImageShapesTrValTest,
-                                                        earlierLayerOutputImagesTrValTest,
+                                                        earlierLayerOutputImage,
                                                         earlierLayerOutputImageShapesTrValTest) :
     # Add the outputs of the two layers and return the output, as well as its dimensions.
     # Result: The result should have exactly the same shape as the output of the Deeper layer. 
     # Both #FMs and Dimensions of FMs.
     
-    (deeperLayerOutputImageTrain, deeperLayerOutputImageVal, deeperLayerOutputImageTest) = \
-        deeperLayerOutputImagesTrValTest
-    (deeperLayerOutputImageShapeTrain, deeperLayerOutputImageShapeVal, deeperLayerOutputImageShapeTest) = \
-        deeperLayerOutputImageShapesTrValTest
-    (earlierLayerOutputImageTrain, earlierLayerOutputImageVal, earlierLayerOutputImageTest) = \
-        earlierLayerOutputImagesTrValTest
-    (earlierLayerOutputImageShapeTrain, earlierLayerOutputImageShapeVal, earlierLayerOutputImageShapeTest) = \
-        earlierLayerOutputImageShapesTrValTest
     # Note: deeperLayerOutputImageShapeTrain has dimensions: [batchSize, FMs, r, c, z]    
     # The deeper FMs can be greater only when there is upsampling. But then, to do residuals, I would need to upsample 
     # the earlier FMs. Not implemented.
-    if np.any(np.asarray(deeperLayerOutputImageShapeTrain[2:]) > np.asarray(earlierLayerOutputImageShapeTrain[2:])) or \
-            np.any(np.asarray(deeperLayerOutputImageShapeVal[2:]) > np.asarray(earlierLayerOutputImageShapeVal[2:])) or \
-                np.any(np.asarray(deeperLayerOutputImageShapeTest[2:]) > np.asarray(earlierLayerOutputImageShapeTest[2:])) :
-        myLogger.print3("ERROR: In function [makeResidualConnectionBetweenLayersAndReturnOutput] the RCZ-dimensions of \
-            a deeper layer FMs were found greater than the earlier layers. Not implemented functionality. Exiting!")
-        myLogger.print3("\t (train) Dimensions of Deeper Layer=" + str(deeperLayerOutputImageShapeTrain) + \
-                        ". Dimensions of Earlier Layer=" + str(earlierLayerOutputImageShapeTrain) )
-        myLogger.print3("\t (val) Dimensions of Deeper Layer=" + str(deeperLayerOutputImageShapeVal) + \
-                        ". Dimensions of Earlier Layer=" + str(earlierLayerOutputImageShapeVal) )
-        myLogger.print3("\t (test) Dimensions of Deeper Layer=" + str(deeperLayerOutputImageShapeTest) + \
-                        ". Dimensions of Earlier Layer=" + str(earlierLayerOutputImageShapeTest) )
-        exit(1)
-        
+    for [stringTrainValTest, deeperLayerOutputImageShape, earlierLayerOutputImageShape] in \
+            zip(["train", "val", "test"], deeperLayerOutputImageShapesTrValTest, earlierLayerOutputImageShapesTrValTest) :
+        if np.any(np.asarray(deeperLayerOutputImageShape[2:]) > np.asarray(earlierLayerOutputImageShape[2:])) :
+            myLogger.print3("ERROR: In function [makeResidualConnectionBetweenLayersAndReturnOutput] the RCZ-dimensions of \
+                a deeper layer FMs were found greater than the earlier layers. Not implemented functionality. Exiting!")
+            myLogger.print3("\t (" + stringTrainValTest + ") Dimensions of Deeper Layer=" + str(deeperLayerOutputImageShape) + \
+                            ". Dimensions of Earlier Layer=" + str(earlierLayerOutputImageShape) )
+            exit(1)
+            
     # get the part of the earlier layer that is of the same dimensions as the FMs of the deeper:
-    partOfEarlierFmsToAddTrain = getMiddlePartOfFms(earlierLayerOutputImageTrain, deeperLayerOutputImageShapeTrain[2:])
-    partOfEarlierFmsToAddVal = getMiddlePartOfFms(earlierLayerOutputImageVal, deeperLayerOutputImageShapeVal[2:])
-    partOfEarlierFmsToAddTest = getMiddlePartOfFms(earlierLayerOutputImageTest, deeperLayerOutputImageShapeTest[2:])
+    partOfEarlierFmsToAdd = getMiddlePartOfFms(earlierLayerOutputImage, getRczDimsOfFms(deeperLayerOutputImage))
     
     # Add the FMs, after taking care of zero padding if the deeper layer has more FMs.
-    numFMsDeeper = deeperLayerOutputImageShapeTrain[1]
-    numFMsEarlier = earlierLayerOutputImageShapeTrain[1]
+    numFMsDeeper = deeperLayerOutputImageShapesTrValTest[0][1]
+    numFMsEarlier = earlierLayerOutputImageShapesTrValTest[0][1]
     if numFMsDeeper >= numFMsEarlier :
-        outputOfResConnTrain = T.inc_subtensor(deeperLayerOutputImageTrain[:, :numFMsEarlier, :,:,:], \
-                                               partOfEarlierFmsToAddTrain, inplace=False)
-        outputOfResConnVal = T.inc_subtensor(deeperLayerOutputImageVal[:, :numFMsEarlier, :,:,:], \
-                                             partOfEarlierFmsToAddVal, inplace=False)
-        outputOfResConnTest = T.inc_subtensor(deeperLayerOutputImageTest[:, :numFMsEarlier, :,:,:], \
-                                              partOfEarlierFmsToAddTest, inplace=False)
+        outputOfResConn = T.inc_subtensor(deeperLayerOutputImage[:, :numFMsEarlier, :,:,:], \
+                                          partOfEarlierFmsToAdd, inplace=False)
     else : # Deeper FMs are fewer than earlier. This should not happen in most architectures. But oh well...
-        outputOfResConnTrain = deeperLayerOutputImageTrain + partOfEarlierFmsToAddTrain[:, :numFMsDeeper, :,:,:]
-        outputOfResConnVal = deeperLayerOutputImageVal + partOfEarlierFmsToAddVal[:, :numFMsDeeper, :,:,:]
-        outputOfResConnTest = deeperLayerOutputImageTest + partOfEarlierFmsToAddTest[:, :numFMsDeeper, :,:,:]
+        outputOfResConn = deeperLayerOutputImage + partOfEarlierFmsToAdd[:, :numFMsDeeper, :,:,:]
         
     # Dimensions of output are the same as those of the deeperLayer
-    return (outputOfResConnTrain, outputOfResConnVal, outputOfResConnTest)
+    return outputOfResConn
     
     
 #################################################################
@@ -158,9 +144,8 @@ class Pathway(object):
         self._pType = None # Pathway Type.
         
         # === Input to the pathway ===
-        self._inputTrain = None
-        self._inputVal = None
-        self._inputTest = None
+        # One symbolic input and output, of the graph shared by training, validation and testing. Shapes per function.
+        self._input = None
         self._inputShapeTrain = None
         self._inputShapeVal = None
         self._inputShapeTest = None
@@ -171,9 +156,7 @@ class Pathway(object):
         self._recField = None # At the end of pathway
         
         # === Output of the block ===
-        self._outputTrain = None
-        self._outputVal = None
-        self._outputTest = None
+        self._output = None
         self._outputShapeTrain = None
         self._outputShapeVal = None
         self._outputShapeTest = None
@@ -182,12 +165,11 @@ class Pathway(object):
     def makeLayersAndReturnDimsOfOutputFM(self,
                                                     myLogger,
                                                     
-                                                    inputTrain,
-                                                    inputVal,
-                                                    inputTest,
+                                                    inputToPathway,
                                                     inputDimsTrain,
                                                     inputDimsVal,
                                                     inputDimsTest,
+                                                    isTrainingFlag, # Symbolic int8 scalar of the model.
                                                     
                                                     numKernsPerLayer,
                                                     kernelDimsPerLayer,
@@ -204,19 +186,20 @@ class Pathway(object):
                                                     indicesOfLowerRankLayersForPathway=[],
                                                     ranksOfLowerRankLayersForPathway = [],
                                                     
-                                                    indicesOfLayersToConnectResidualsInOutputForPathway=[]
+                                                    indicesOfLayersToConnectResidualsInOutputForPathway=[],
+                                                    
+                                                    convolutionBackendSelector=None
                                                     ) :
         rng = numpy.random.RandomState(55789)
         myLogger.print3("[Pathway_" + str(self.getStringType()) + "] is being built...")
         
         self._recField = self.calcRecFieldOfPathway(kernelDimsPerLayer)
         
-        self._setInputAttributes(inputTrain, inputVal, inputTest, inputDimsTrain, inputDimsVal, inputDimsTest)                
+        self._setInputAttributes(inputToPathway, inputDimsTrain, inputDimsVal, inputDimsTest)
         myLogger.print3("\t[Pathway_"+str(self.getStringType())+"]: Input's Shape: (Train) " + str(self._inputShapeTrain) + \
                 ", (Val) " + str(self._inputShapeVal) + ", (Test) " + str(self._inputShapeTest))
         
-        inputToNextLayerTrain = self._inputTrain; inputToNextLayerVal = self._inputVal; 
-        inputToNextLayerTest = self._inputTest
+        inputToNextLayer = self._input
         inputToNextLayerShapeTrain = self._inputShapeTrain; inputToNextLayerShapeVal = self._inputShapeVal; 
         inputToNextLayerShapeTest = self._inputShapeTest
         numOfLayers = len(numKernsPerLayer)
@@ -240,12 +223,11 @@ class Pathway(object):
             else : # normal conv layer
                 layer = ConvLayer()
             layer.makeLayer(rng,
-                            inputToLayerTrain=inputToNextLayerTrain,
-                            inputToLayerVal=inputToNextLayerVal,
-                            inputToLayerTest=inputToNextLayerTest,
+                            inputToLayer=inputToNextLayer,
                             inputToLayerShapeTrain=inputToNextLayerShapeTrain,
                             inputToLayerShapeVal=inputToNextLayerShapeVal,
                             inputToLayerShapeTest=inputToNextLayerShapeTest,
+                            isTrainingFlag=isTrainingFlag,
                             
                             filterShape=thisLayerFilterShape,
                             poolingParameters=thisLayerPoolingParameters,
@@ -254,45 +236,37 @@ class Pathway(object):
                             rollingAverageForBNOverThatManyBatches=\
                                 rollingAverageForBNOverThatManyBatches,
                             activationFunctionToUseRelu0orPrelu1orMinus1ForLinear=thisLayerActivFunc,
-                            dropoutRate=thisLayerDropoutRate
+                            dropoutRate=thisLayerDropoutRate,
+                            convolutionBackendSelector=convolutionBackendSelector
                             ) 
             self._layersInPathway.append(layer)
             
             if layer_i not in indicesOfLayersToConnectResidualsInOutputForPathway : #not a residual connecting here
-                inputToNextLayerTrain = layer.outputTrain
-                inputToNextLayerVal = layer.outputVal
-                inputToNextLayerTest = layer.outputTest
+                inputToNextLayer = layer.output
             else : #make residual connection
                 myLogger.print3("\t[Pathway_"+str(self.getStringType())+ \
                                 "]: making Residual Connection between output of [Layer_"+str(layer_i)+\
                                 "] to input of previous layer.")
-                deeperLayerOutputImagesTrValTest = (layer.outputTrain, layer.outputVal, layer.outputTest)
                 deeperLayerOutputImageShapesTrValTest = (layer.outputShapeTrain, layer.outputShapeVal, layer.outputShapeTest)
                 assert layer_i > 0 # The very first layer (index 0), should never be provided for now. 
                 # Cause I am connecting 2 layers back.
                 earlierLayer = self._layersInPathway[layer_i-1]
-                earlierLayerOutputImagesTrValTest = (earlierLayer.inputTrain, earlierLayer.inputVal, \
-                                                     earlierLayer.inputTest)
                 earlierLayerOutputImageShapesTrValTest = (earlierLayer.inputShapeTrain, earlierLayer.inputShapeVal, \
                                                           earlierLayer.inputShapeTest)
                 
-                (inputToNextLayerTrain,
-                inputToNextLayerVal,
-                inputToNextLayerTest) = makeResidualConnectionBetweenLayersAndReturnOutput( myLogger,
-															                 deeperLayerOutputImagesTrValTest,
+                inputToNextLayer = makeResidualConnectionBetweenLayersAndReturnOutput( myLogger,
+															                 layer.output,
 															                 deeperLayerOutputImageShapesTrValTest,
-															                 earlierLayerOutputImagesTrValTest,
+															                 earlierLayer.input,
 															                 earlierLayerOutputImageShapesTrValTest )
-                layer.outputAfterResidualConnIfAnyAtOutpTrain = inputToNextLayerTrain
-                layer.outputAfterResidualConnIfAnyAtOutpVal = inputToNextLayerVal
-                layer.outputAfterResidualConnIfAnyAtOutpTest = inputToNextLayerTest
+                layer.outputAfterResidualConnIfAnyAtOutp = inputToNextLayer
             # Residual connections preserve the both the number of FMs and the dimensions of the FMs, 
             # the same as in the later, deeper layer.
             inputToNextLayerShapeTrain = layer.outputShapeTrain
             inputToNextLayerShapeVal = layer.outputShapeVal
             inputToNextLayerShapeTest = layer.outputShapeTest
         
-        self._setOutputAttributes(inputToNextLayerTrain, inputToNextLayerVal, inputToNextLayerTest,
+        self._setOutputAttributes(inputToNextLayer,
                                 inputToNextLayerShapeTrain, inputToNextLayerShapeVal, inputToNextLayerShapeTest)
         
         myLogger.print3("\t[Pathway_"+str(self.getStringType())+"]: Output's Shape: (Train) " + str(self._outputShapeTrain) + \
@@ -305,27 +279,21 @@ class Pathway(object):
     	
         layersInThisPathway = self.getLayers()
         
-        [outputOfPathwayTrain, outputOfPathwayVal, outputOfPathwayTest ] = self.getOutput()
+        outputOfPathway = self.getOutput()
         [outputShapeTrain, outputShapeVal, outputShapeTest] = self.getShapeOfOutput()
-        numOfCentralVoxelsToGetTrain = outputShapeTrain[2:]; numOfCentralVoxelsToGetVal = outputShapeVal[2:]; 
-        numOfCentralVoxelsToGetTest = outputShapeTest[2:]
+        numOfCentralVoxelsToGet = getRczDimsOfFms(outputOfPathway)
         
         for convLayer_i in convLayersToConnectToFirstFcForMultiscaleFromThisLayerType :
             thisLayer = layersInThisPathway[convLayer_i]
                     
-            middlePartOfFmsTrain = getMiddlePartOfFms(thisLayer.outputTrain, numOfCentralVoxelsToGetTrain)
-            middlePartOfFmsVal = getMiddlePartOfFms(thisLayer.outputVal, numOfCentralVoxelsToGetVal)
-            middlePartOfFmsTest = getMiddlePartOfFms(thisLayer.outputTest, numOfCentralVoxelsToGetTest)
+            middlePartOfFms = getMiddlePartOfFms(thisLayer.output, numOfCentralVoxelsToGet)
             
-            outputOfPathwayTrain = T.concatenate([outputOfPathwayTrain, middlePartOfFmsTrain], axis=1)
-            outputOfPathwayVal = T.concatenate([outputOfPathwayVal, middlePartOfFmsVal], axis=1)
-            outputOfPathwayTest = T.concatenate([outputOfPathwayTest, middlePartOfFmsTest], axis=1)
+            outputOfPathway = T.concatenate([outputOfPathway, middlePartOfFms], axis=1)
             outputShapeTrain[1] += thisLayer.getNumberOfFeatureMaps(); 
             outputShapeVal[1] += thisLayer.getNumberOfFeatureMaps(); 
             outputShapeTest[1] += thisLayer.getNumberOfFeatureMaps(); 
             
-        self._setOutputAttributes(outputOfPathwayTrain, outputOfPathwayVal, outputOfPathwayTest,
-                                outputShapeTrain, outputShapeVal, outputShapeTest)
+        self._setOutputAttributes(outputOfPathway, outputShapeTrain, outputShapeVal, outputShapeTest)
         
     # The below should be updated, and calculated in here properly with private function and per layer.
     def calcRecFieldOfPathway(self, kernelDimsPerLayer) :
@@ -351,15 +319,13 @@ class Pathway(object):
         return rczDimsOfInput
         
     # Setters
-    def _setInputAttributes(self, inputToLayerTrain, inputToLayerVal, inputToLayerTest, inputToLayerShapeTrain, \
-                            inputToLayerShapeVal, inputToLayerShapeTest) :
-        self._inputTrain = inputToLayerTrain; self._inputVal = inputToLayerVal; self._inputTest = inputToLayerTest
+    def _setInputAttributes(self, inputToLayer, inputToLayerShapeTrain, inputToLayerShapeVal, inputToLayerShapeTest) :
+        self._input = inputToLayer
         self._inputShapeTrain = inputToLayerShapeTrain; self._inputShapeVal = inputToLayerShapeVal; 
         self._inputShapeTest = inputToLayerShapeTest
         
-    def _setOutputAttributes(self, outputTrain, outputVal, outputTest, outputShapeTrain, \
-                             outputShapeVal, outputShapeTest) :
-        self._outputTrain = outputTrain; self._outputVal = outputVal; self._outputTest = outputTest
+    def _setOutputAttributes(self, output, outputShapeTrain, outputShapeVal, outputShapeTest) :
+        self._output = output
         self._outputShapeTrain = outputShapeTrain; self._outputShapeVal = outputShapeVal; 
         self._outputShapeTest = outputShapeTest
         
@@ -375,7 +341,7 @@ class Pathway(object):
     def subsFactor(self):
         return self._subsFactor
     def getOutput(self):
-        return [ self._outputTrain, self._outputVal, self._outputTest ]
+        return self._output
     def getShapeOfOutput(self):
         return [ self._outputShapeTrain, self._outputShapeVal, self._outputShapeTest ]
     def getShapeOfInput(self):
@@ -401,44 +367,34 @@ class SubsampledPathway(Pathway):
         self._pType = PathwayTypes.SUBS
         self._subsFactor = subsamplingFactor
         
-        self._outputNormResTrain = None
-        self._outputNormResVal = None
-        self._outputNormResTest = None
+        self._outputNormRes = None
         self._outputNormResShapeTrain = None
         self._outputNormResShapeVal = None
         self._outputNormResShapeTest = None
         
     def upsampleOutputToNormalRes(self, upsamplingScheme="repeat",
-                            shapeToMatchInRczTrain=None, shapeToMatchInRczVal=None, shapeToMatchInRczTest=None):
+                            shapeToMatchInRczTrain=None, shapeToMatchInRczVal=None, shapeToMatchInRczTest=None,
+                            fmsToMatchInRcz=None):
+        # fmsToMatchInRcz: The output of the normal pathway, to whose (symbolic) dims the upsampled output is cropped.
         #should be called only once to build. Then just call getters if needed to get upsampled layer again.
-        [outputTrain, outputVal, outputTest] = self.getOutput()
+        output = self.getOutput()
         [outputShapeTrain, outputShapeVal, outputShapeTest] = self.getShapeOfOutput()
         
-        outputNormResTrain = upsampleRcz5DimArrayAndOptionalCrop(outputTrain,
-                                                                self.subsFactor(),
-                                                                upsamplingScheme,
-                                                                shapeToMatchInRczTrain)
-        outputNormResVal = upsampleRcz5DimArrayAndOptionalCrop(	outputVal,
-                                                                self.subsFactor(),
-                                                                upsamplingScheme,
-                                                                shapeToMatchInRczVal)
-        outputNormResTest = upsampleRcz5DimArrayAndOptionalCrop(outputTest,
-                                                                self.subsFactor(),
-                                                                upsamplingScheme,
-                                                                shapeToMatchInRczTest)
+        outputNormRes = upsampleRcz5DimArrayAndOptionalCrop(output,
+                                                            self.subsFactor(),
+                                                            upsamplingScheme,
+                                                            T.shape(fmsToMatchInRcz))
         
         outputNormResShapeTrain = outputShapeTrain[:2] + shapeToMatchInRczTrain[2:]
         outputNormResShapeVal = outputShapeVal[:2] + shapeToMatchInRczVal[2:]
         outputNormResShapeTest = outputShapeTest[:2] + shapeToMatchInRczTest[2:]
         
-        self._setOutputAttributesNormRes(outputNormResTrain, outputNormResVal, outputNormResTest,
-                                outputNormResShapeTrain, outputNormResShapeVal, outputNormResShapeTest)
+        self._setOutputAttributesNormRes(outputNormRes, outputNormResShapeTrain, outputNormResShapeVal, outputNormResShapeTest)
         
-    def _setOutputAttributesNormRes(self, outputNormResTrain, outputNormResVal, outputNormResTest,
+    def _setOutputAttributesNormRes(self, outputNormRes,
                                     outputNormResShapeTrain, outputNormResShapeVal, outputNormResShapeTest) :
         #Essentially this is after the upsampling "layer"
-        self._outputNormResTrain = outputNormResTrain; self._outputNormResVal = outputNormResVal; 
-        self._outputNormResTest = outputNormResTest
+        self._outputNormRes = outputNormRes
         self._outputNormResShapeTrain = outputNormResShapeTrain; self._outputNormResShapeVal = outputNormResShapeVal; 
         self._outputNormResShapeTest = outputNormResShapeTest
         
@@ -449,7 +405,7 @@ class SubsampledPathway(Pathway):
         
     def getOutputAtNormalRes(self):
         # upsampleOutputToNormalRes() must be called first once.
-        return [ self._outputNormResTrain, self._outputNormResVal, self._outputNormResTest ]
+        return self._outputNormRes
         
     def getShapeOfOutputAtNormalRes(self):
         # upsampleOutputToNormalRes() must be called first once.
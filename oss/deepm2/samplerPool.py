@@ -0,0 +1,182 @@
+# Copyright (c) 2016, Konstantinos Kamnitsas
+# All rights reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the BSD license. See the accompanying LICENSE file
+# or read the terms at https://opensource.org/licenses/BSD-3-Clause.
+
+import random
+import traceback
+import ctypes
+import multiprocessing
+import numpy as np
+
+BYTES_PER_FLOAT32 = 4
+
+def getNumberOfBytesOfFloat32Arrays(listOfShapes) :
+    return BYTES_PER_FLOAT32 * sum([ int(np.prod(shape)) for shape in listOfShapes ])
+
+def getViewsOfFloat32ArraysInSharedBuffer(sharedBuffer, listOfShapes) :
+    # Returns numpy arrays that share memory with the buffer, one after the other, with the given shapes.
+    fullBuffer = np.frombuffer(sharedBuffer, dtype="uint8")
+    listOfViews = []
+    offsetInBytes = 0
+    for shape in listOfShapes :
+        numberOfBytes = getNumberOfBytesOfFloat32Arrays([shape])
+        listOfViews.append( fullBuffer[offsetInBytes : offsetInBytes + numberOfBytes].view("float32").reshape(shape) )
+        offsetInBytes += numberOfBytes
+    return listOfViews
+
+def allocateFloat32Arrays(listOfShapes, inSharedMemory=False) :
+    # Contiguous float32 arrays, to be filled in place. If inSharedMemory, they are views of a single RawArray, \
+    # so processes forked afterwards write in the same memory.
+    if not inSharedMemory :
+        return [ np.empty(shape, dtype="float32") for shape in listOfShapes ]
+    sharedBuffer = multiprocessing.RawArray(ctypes.c_char, max(getNumberOfBytesOfFloat32Arrays(listOfShapes), 1))
+    return getViewsOfFloat32ArraysInSharedBuffer(sharedBuffer, listOfShapes)
+
+def shuffleRowsOfArraysInPlace(listOfArrays) :
+    # Same permutation of the first axis for all arrays. np.random.shuffle swaps rows through a one-row buffer.
+    rngStateBeforeShuffle = np.random.get_state()
+    for array in listOfArrays :
+        np.random.set_state(rngStateBeforeShuffle)
+        np.random.shuffle(array)
+
+def moveRowsToTheStartOfArraysInPlace(listOfArrays, rowRangesToKeep) :
+    # rowRangesToKeep: list of [firstRow, numberOfRows], non-overlapping. Returns the number of rows kept.
+    numberOfRowsKept = 0
+    for [firstRow, numberOfRows] in sorted(rowRangesToKeep) :
+        if firstRow <> numberOfRowsKept :
+            for array in listOfArrays :
+                array[numberOfRowsKept : numberOfRowsKept + numberOfRows] = array[firstRow : firstRow + numberOfRows]
+        numberOfRowsKept += numberOfRows
+    return numberOfRowsKept
+
+def samplerWorkerLoop(queueOfTasks, queueOfResults, sharedSlots, functionToFillArrays, argsPerTypeOfJob) :
+    # Target of each worker process. The slots and the args are inherited on fork, only small tasks are pickled.
+    # Task: [jobId, slot_i, typeOfJob, subjectIndices, numberOfSegmentsPerCategoryAndSubject, rowOffset, shapes, seed]
+    # functionToFillArrays(argsOfJob, subjectIndices, numberOfSegmentsPerCategoryAndSubject, arraysToFill, rowOffset) \
+    # writes the segments in the rows of arraysToFill starting at rowOffset and returns how many it wrote.
+    while True :
+        task = queueOfTasks.get()
+        if task == None :
+            return
+        [jobId, slot_i, typeOfJob, subjectIndices, numberOfSegmentsPerCategoryAndSubject, rowOffset, listOfShapes, seed] = task
+        try :
+            np.random.seed(seed)
+            random.seed(seed)
+            arraysToFill = getViewsOfFloat32ArraysInSharedBuffer(sharedSlots[slot_i], listOfShapes)
+            numberOfSegmentsWritten = functionToFillArrays( argsPerTypeOfJob[typeOfJob],
+                                                            subjectIndices,
+                                                            numberOfSegmentsPerCategoryAndSubject,
+                                                            arraysToFill,
+                                                            rowOffset )
+            queueOfResults.put([jobId, "result", [rowOffset, numberOfSegmentsWritten]])
+        except BaseException :
+            queueOfResults.put([jobId, "error", traceback.format_exc()])
+
+
+class SamplerPool(object):
+    # Worker processes that extract the segments of a subepoch, each from a shard of its subjects.
+    # The segments are written in a slot of shared memory. A slot is taken by a job from its submission until its \
+    # result is released, after the caller has finished using it. To prefetch K subepochs while the result of \
+    # another is used, K+1 slots are needed.
+    def __init__(self,
+                myLogger,
+                numberOfWorkers,
+                numberOfSlots,
+                bytesPerSlot,
+                functionToFillArrays,
+                argsPerTypeOfJob) :
+        self._myLogger = myLogger
+        self._numberOfWorkers = numberOfWorkers
+        self._sharedSlots = [ multiprocessing.RawArray(ctypes.c_char, max(bytesPerSlot, 1)) for slot_i in xrange(numberOfSlots) ]
+        self._freeSlots = range(numberOfSlots)
+        self._pendingJobs = [] # FIFO of [jobId, typeOfJob, slot_i, numberOfShards, listOfShapes]
+        self._slotsOfReturnedResults = []
+        self._resultsOfShardsPerJob = {}
+        self._nextJobId = 0
+
+        self._queueOfTasks = multiprocessing.Queue()
+        self._queueOfResults = multiprocessing.Queue()
+        # Workers are forked after the slots are allocated, so they share them.
+        self._myLogger.flush() # Otherwise the workers inherit the buffered lines of the log.
+        self._workers = []
+        for worker_i in xrange(numberOfWorkers) :
+            worker = multiprocessing.Process(target=samplerWorkerLoop,
+                                            args=(self._queueOfTasks, self._queueOfResults, self._sharedSlots,
+                                                functionToFillArrays, argsPerTypeOfJob) )
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def getNumberOfWorkers(self) :
+        return self._numberOfWorkers
+    def getNumberOfPendingJobs(self) :
+        return len(self._pendingJobs)
+    def hasFreeSlot(self) :
+        return len(self._freeSlots) > 0
+
+    def submitJob(self,
+                typeOfJob,
+                listOfShapes, # Of the arrays to fill, with the maximum number of segments of the job.
+                subjectIndicesPerShard,
+                numberOfSegmentsPerCategoryAndSubjectPerShard,
+                rowOffsetPerShard) :
+        if not self.hasFreeSlot() :
+            self._myLogger.print3("ERROR: Tried to submit a sampling job to the SamplerPool, but all of its slots "+\
+                                  "are taken by pending jobs or unreleased results. This should not happen. Exiting!"); exit(1)
+        if getNumberOfBytesOfFloat32Arrays(listOfShapes) > len(self._sharedSlots[0]) :
+            self._myLogger.print3("ERROR: The arrays of the sampling job need more memory than a slot of the "+\
+                                  "SamplerPool. This should not happen. Exiting!"); exit(1)
+        slot_i = self._freeSlots.pop(0)
+        jobId = self._nextJobId
+        self._nextJobId += 1
+        for shard_i in xrange(len(subjectIndicesPerShard)) :
+            seed = random.randint(0, 2**31 - 1) # Workers are forked with the same rng state. Reseed per task.
+            self._queueOfTasks.put([jobId, slot_i, typeOfJob,
+                                    subjectIndicesPerShard[shard_i],
+                                    numberOfSegmentsPerCategoryAndSubjectPerShard[shard_i],
+                                    rowOffsetPerShard[shard_i],
+                                    listOfShapes,
+                                    seed])
+        self._pendingJobs.append([jobId, typeOfJob, slot_i, len(subjectIndicesPerShard), listOfShapes])
+        self._resultsOfShardsPerJob[jobId] = []
+        return jobId
+
+    def getResultOfOldestJob(self) :
+        # Blocks until all shards of the oldest pending job are done. Returns [typeOfJob, listOfArrays]. The arrays \
+        # are views of the slot, with the written rows moved to the start and shuffled together, in place. \
+        # They are valid until releaseSlotsOfReturnedResults() is called.
+        [jobId, typeOfJob, slot_i, numberOfShards, listOfShapes] = self._pendingJobs.pop(0)
+        while len(self._resultsOfShardsPerJob[jobId]) < numberOfShards :
+            [jobIdOfResult, typeOfResult, result] = self._queueOfResults.get()
+            if typeOfResult == "error" :
+                self._myLogger.print3("ERROR: A process of the SamplerPool failed while extracting segments. "+\
+                                      "Its traceback follows:\n" + result)
+                self.terminate()
+                self._myLogger.print3("ERROR: Sampling failed. Exiting!"); exit(1)
+            self._resultsOfShardsPerJob[jobIdOfResult].append(result)
+        rowRangesWrittenPerShard = self._resultsOfShardsPerJob.pop(jobId)
+        
+        arraysInSlot = getViewsOfFloat32ArraysInSharedBuffer(self._sharedSlots[slot_i], listOfShapes)
+        numberOfRowsWritten = moveRowsToTheStartOfArraysInPlace(arraysInSlot, rowRangesWrittenPerShard)
+        listOfArrays = [ arrayInSlot[:numberOfRowsWritten] for arrayInSlot in arraysInSlot ]
+        shuffleRowsOfArraysInPlace(listOfArrays)
+        self._slotsOfReturnedResults.append(slot_i)
+        return [typeOfJob, listOfArrays]
+    
+    def releaseSlotsOfReturnedResults(self) :
+        # The arrays returned by getResultOfOldestJob() must not be used after this.
+        self._freeSlots += self._slotsOfReturnedResults
+        self._slotsOfReturnedResults = []
+        
+    def terminate(self) :
+        for worker in self._workers :
+            if worker.is_alive() :
+                worker.terminate()
+        for worker in self._workers :
+            worker.join()
+        self._workers = []
+        self._pendingJobs = []
+
@@ -0,0 +1,79 @@
+# Copyright (c) 2016, Konstantinos Kamnitsas
+# All rights reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the BSD license. See the accompanying LICENSE file
+# or read the terms at https://opensource.org/licenses/BSD-3-Clause.
+
+import threading
+import numpy as np
+
+class StreamOfSegments(object):
+    # The segments of a subepoch, given to the cnn batch by batch while they are still being extracted.
+    # A producer writes segments in the next rows of the arrays and announces them with addWrittenRows(). \
+    # getNextBatch() draws a batch at random from the rows written and not yet used. It waits for the producer \
+    # only if fewer than a batch are ready. Without a producer (all rows written), it just gives shuffled batches.
+    def __init__(self,
+                listOfArrays, # Per pathway [segments, channels, r, c, z], and the labels [segments, r, c, z] last.
+                batchSize,
+                numberOfRowsWritten) :
+        self._listOfArrays = listOfArrays
+        self._batchSize = batchSize
+        self._condition = threading.Condition()
+        self._numberOfRowsWritten = numberOfRowsWritten
+        self._unusedRows = np.arange(len(listOfArrays[0]), dtype="int64") # The first _numberOfUnusedRows are valid.
+        self._numberOfUnusedRows = numberOfRowsWritten
+        self._producerFinished = numberOfRowsWritten == len(listOfArrays[0])
+        self._excInfoOfProducer = None
+
+    def getBatchSize(self) :
+        return self._batchSize
+    def getNumberOfRowsWritten(self) :
+        return self._numberOfRowsWritten
+    def getLabelsOfRowsWritten(self) :
+        return self._listOfArrays[-1][:self._numberOfRowsWritten]
+
+    # For the producer.
+    def addWrittenRows(self, numberOfRows) :
+        with self._condition :
+            self._unusedRows[self._numberOfUnusedRows : self._numberOfUnusedRows + numberOfRows] = \
+                                    np.arange(self._numberOfRowsWritten, self._numberOfRowsWritten + numberOfRows)
+            self._numberOfUnusedRows += numberOfRows
+            self._numberOfRowsWritten += numberOfRows
+            self._condition.notify_all()
+
+    def finish(self, excInfoOfProducer=None) :
+        # Called by the producer when done. If it failed, its sys.exc_info() is raised by getNextBatch().
+        with self._condition :
+            self._producerFinished = True
+            self._excInfoOfProducer = excInfoOfProducer
+            self._condition.notify_all()
+
+    def waitUntilProducerFinished(self) :
+        # Then all the rows are written (unless it failed, which getNextBatch() raises).
+        with self._condition :
+            while not self._producerFinished :
+                self._condition.wait()
+
+    # For the consumer.
+    def getNextBatch(self) :
+        # Returns a list of contiguous arrays with the batch of each pathway and its labels last. None when the \
+        # producer finished and less than a batch is left (dropped, as when the whole subepoch is loaded).
+        with self._condition :
+            while self._numberOfUnusedRows < self._batchSize and not self._producerFinished :
+                self._condition.wait()
+            if self._excInfoOfProducer <> None :
+                excInfo = self._excInfoOfProducer
+                raise excInfo[0], excInfo[1], excInfo[2]
+            if self._numberOfUnusedRows < self._batchSize :
+                return None
+            # Partial Fisher-Yates shuffle: Take each row at random from the unused ones and move the last unused in its place.
+            rowsOfBatch = np.empty(self._batchSize, dtype="int64")
+            for segment_i in xrange(self._batchSize) :
+                position = np.random.randint(self._numberOfUnusedRows)
+                rowsOfBatch[segment_i] = self._unusedRows[position]
+                self._unusedRows[position] = self._unusedRows[self._numberOfUnusedRows - 1]
+                self._numberOfUnusedRows -= 1
+        # The rows of the batch are written, and the producer does not touch them again.
+        return [ array[rowsOfBatch] for array in self._listOfArrays ]
+
@@ -0,0 +1,107 @@
+# Copyright (c) 2016, Konstantinos Kamnitsas
+# All rights reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the BSD license. See the accompanying LICENSE file
+# or read the terms at https://opensource.org/licenses/BSD-3-Clause.
+
+import numpy as np
+
+# Metrics of a segmentation from its confusion matrices. One pass of np.bincount over (roi, gt, prediction) gives \
+# two matrices, of the voxels outside and inside the ROI, with rows the class of the GT and columns the predicted one. \
+# All the DICE variants, sensitivities and specificities are then computed from these small matrices. \
+# Labels of the GT that are not classes of the model (>= numberOfClasses) are kept in an extra row, as foreground \
+# that matches no class. Negative labels are counted as background.
+# Class-0 stands for the whole foreground (all classes > 0), as in the rest of the code.
+
+INDEX_OUTSIDE_ROI = 0
+INDEX_INSIDE_ROI = 1
+# Volumes are accumulated in slabs of this many slices (first axis), to bound the memory of the temporary indices.
+NUMBER_OF_SLICES_PER_CHUNK_BY_DEFAULT = 32
+
+class ConfusionMatricesAccumulator(object):
+    # Accumulates the confusion matrices over any number of calls to accumulate(), eg per tile or per slab of a \
+    # volume, or over many subjects.
+    def __init__(self, numberOfClasses) :
+        self._numberOfClasses = numberOfClasses
+        self._numberOfBins = numberOfClasses + 1 # +1 for the GT labels that are not classes of the model.
+        self._matrices = np.zeros([2, self._numberOfBins, self._numberOfBins], dtype="int64")
+
+    def _clipLabels(self, labels) :
+        return np.clip(labels.astype("int64", copy=False), 0, self._numberOfClasses)
+
+    def accumulate(self, predictedLabels, gtLabels, roiMask=None) :
+        # Arrays of the same shape. predictedLabels have values in [0, numberOfClasses). roiMask: None for no ROI \
+        # (all voxels inside), otherwise non-zero inside.
+        numberOfBinsPerMatrix = self._numberOfBins * self._numberOfBins
+        indices = self._clipLabels(gtLabels) * self._numberOfBins
+        indices += predictedLabels
+        if roiMask is not None :
+            indices += (roiMask > 0) * numberOfBinsPerMatrix
+        else :
+            indices += INDEX_INSIDE_ROI * numberOfBinsPerMatrix
+        counts = np.bincount(indices.ravel(), minlength=2 * numberOfBinsPerMatrix)
+        self._matrices += counts.reshape(self._matrices.shape)
+
+    def accumulateVolume(self, predictedLabels, gtLabels, roiMask=None,
+                         numberOfSlicesPerChunk=NUMBER_OF_SLICES_PER_CHUNK_BY_DEFAULT) :
+        for start in xrange(0, predictedLabels.shape[0], numberOfSlicesPerChunk) :
+            end = start + numberOfSlicesPerChunk
+            self.accumulate(predictedLabels[start:end], gtLabels[start:end],
+                            roiMask[start:end] if roiMask is not None else None)
+
+    def add(self, otherAccumulator) :
+        self._matrices += otherAccumulator._matrices
+
+    def getConfusionMatrix(self, insideRoiOnly=False) :
+        # [classOfGt, predictedClass]. Last row: GT labels that are not classes of the model.
+        return self._matrices[INDEX_INSIDE_ROI].copy() if insideRoiOnly else self._matrices.sum(axis=0)
+
+    def _getCountsOfClass(self, class_i, matrixOfGtAndPred, matrixOfGt=None, matrixOfPred=None) :
+        # Returns [truePositives, predictedPositives, gtPositives, numberOfVoxels] of the binary problem of class_i. \
+        # The positives of the GT and the prediction may be counted in other matrices (eg over the whole volume).
+        matrixOfGt = matrixOfGtAndPred if matrixOfGt is None else matrixOfGt
+        matrixOfPred = matrixOfGtAndPred if matrixOfPred is None else matrixOfPred
+        if class_i == 0 :
+            return [matrixOfGtAndPred[1:, 1:].sum(), matrixOfPred[:, 1:].sum(), matrixOfGt[1:, :].sum(),
+                    matrixOfGtAndPred.sum()]
+        return [matrixOfGtAndPred[class_i, class_i], matrixOfPred[:, class_i].sum(), matrixOfGt[class_i, :].sum(),
+                matrixOfGtAndPred.sum()]
+
+    def getDiceCoefficients(self) :
+        # Returns [dice1, dice2, dice3], lists with the DICE per class, -1 where the GT has no voxel of the class. \
+        # DICE1: whole segmentation vs whole GT. DICE2: segmentation within the ROI vs whole GT. \
+        # DICE3: segmentation within the ROI vs GT within the ROI.
+        matrixWhole = self.getConfusionMatrix()
+        matrixInRoi = self._matrices[INDEX_INSIDE_ROI]
+        dicesPerVariant = [[], [], []]
+        for class_i in xrange(self._numberOfClasses) :
+            countsPerVariant = [ self._getCountsOfClass(class_i, matrixWhole),
+                                 self._getCountsOfClass(class_i, matrixInRoi, matrixOfGt=matrixWhole),
+                                 self._getCountsOfClass(class_i, matrixInRoi) ]
+            for variant_i in xrange(3) :
+                [truePositives, predictedPositives, gtPositives, numberOfVoxels] = countsPerVariant[variant_i]
+                dicesPerVariant[variant_i].append( (2.0 * truePositives) / (predictedPositives + gtPositives) if \
+                                                                                            gtPositives <> 0 else -1 )
+        return dicesPerVariant
+
+    def getSensitivitiesAndSpecificities(self, insideRoiOnly=False) :
+        # Returns [sensitivities, specificities], lists per class, -1 where not defined \
+        # (no positive, respectively negative, voxel of the class in the GT).
+        matrix = self.getConfusionMatrix(insideRoiOnly)
+        sensitivities = []
+        specificities = []
+        for class_i in xrange(self._numberOfClasses) :
+            [truePositives, predictedPositives, gtPositives, numberOfVoxels] = self._getCountsOfClass(class_i, matrix)
+            gtNegatives = numberOfVoxels - gtPositives
+            trueNegatives = gtNegatives - (predictedPositives - truePositives)
+            sensitivities.append( truePositives * 1.0 / gtPositives if gtPositives <> 0 else -1 )
+            specificities.append( trueNegatives * 1.0 / gtNegatives if gtNegatives <> 0 else -1 )
+        return [sensitivities, specificities]
+
+def computeConfusionMatricesOfVolume(numberOfClasses, predictedLabels, gtLabels, roiMask=None,
+                                     numberOfSlicesPerChunk=NUMBER_OF_SLICES_PER_CHUNK_BY_DEFAULT) :
+    accumulator = ConfusionMatricesAccumulator(numberOfClasses)
+    accumulator.accumulateVolume(predictedLabels, gtLabels, roiMask, numberOfSlicesPerChunk)
+    return accumulator
+
@@ -0,0 +1,119 @@
+# Copyright (c) 2016, Konstantinos Kamnitsas
+# All rights reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the BSD license. See the accompanying LICENSE file
+# or read the terms at https://opensource.org/licenses/BSD-3-Clause.
+
+import os
+import time
+import json
+import threading
+import cProfile
+from contextlib import contextmanager
+
+# Named timers and counters of the stages of training and inference. Each timer accumulates the number of calls, \
+# the wall-clock time and the CPU time of the process (of all its threads) spent in the stage. Stages may nest, and \
+# may run in the background threads (loading, saving). The timers of a forked process (eg the SamplerPool's workers) \
+# are its own and not reported, the main process times its waits for them instead.
+# Optionally, each timed stage is also recorded as an event of a Chrome trace (chrome://tracing), or a cProfile \
+# profile is collected, eg for a chosen subepoch.
+
+PROFILERS = ["chromeTrace", "cProfile"]
+
+class StageTimers(object):
+    def __init__(self) :
+        self._lock = threading.Lock()
+        self._namesOfStagesInOrder = []
+        self._callsWallCpuPerStage = {}
+        self._namesOfCountersInOrder = []
+        self._valuePerCounter = {}
+        self._traceEvents = None # A list while tracing.
+        self._profiler = None
+
+    @contextmanager
+    def timeStage(self, nameOfStage) :
+        startWall = time.time()
+        startCpu = time.clock()
+        try :
+            yield
+        finally :
+            endWall = time.time()
+            endCpu = time.clock()
+            with self._lock :
+                if nameOfStage not in self._callsWallCpuPerStage :
+                    self._namesOfStagesInOrder.append(nameOfStage)
+                    self._callsWallCpuPerStage[nameOfStage] = [0, 0.0, 0.0]
+                callsWallCpu = self._callsWallCpuPerStage[nameOfStage]
+                callsWallCpu[0] += 1
+                callsWallCpu[1] += endWall - startWall
+                callsWallCpu[2] += endCpu - startCpu
+                if self._traceEvents <> None :
+                    self._traceEvents.append({ "name" : nameOfStage, "ph" : "X", "pid" : os.getpid(),
+                                               "tid" : threading.current_thread().ident,
+                                               "ts" : startWall * 1e6, "dur" : (endWall - startWall) * 1e6 })
+
+    def addToCounter(self, nameOfCounter, value=1) :
+        with self._lock :
+            if nameOfCounter not in self._valuePerCounter :
+                self._namesOfCountersInOrder.append(nameOfCounter)
+                self._valuePerCounter[nameOfCounter] = 0
+            self._valuePerCounter[nameOfCounter] += value
+
+    def getWallTimeOfStage(self, nameOfStage) :
+        with self._lock :
+            return self._callsWallCpuPerStage[nameOfStage][1] if nameOfStage in self._callsWallCpuPerStage else 0.0
+
+    def reportAndReset(self, myLogger, titleOfReport) :
+        # Prints the table of the stages and counters since the last report, and logs them as a structured record.
+        with self._lock :
+            namesOfStages = self._namesOfStagesInOrder; callsWallCpuPerStage = self._callsWallCpuPerStage
+            namesOfCounters = self._namesOfCountersInOrder; valuePerCounter = self._valuePerCounter
+            self._namesOfStagesInOrder = []; self._callsWallCpuPerStage = {}
+            self._namesOfCountersInOrder = []; self._valuePerCounter = {}
+        lengthOfNames = max([len("Stage")] + [ len(name) for name in namesOfStages + namesOfCounters ])
+        myLogger.print3("TIMING: ========== Time per stage, " + titleOfReport + " ==========")
+        myLogger.print3("TIMING: " + "Stage".ljust(lengthOfNames) + "\t Calls \t Wall(s) \t Wall/Call(s) \t CPU(s)")
+        for name in namesOfStages :
+            [calls, wall, cpu] = callsWallCpuPerStage[name]
+            myLogger.print3("TIMING: " + name.ljust(lengthOfNames) + "\t " + str(calls) + " \t " + "%.3f" % wall + \
+                            " \t " + "%.4f" % (wall / calls) + " \t " + "%.3f" % cpu)
+        for name in namesOfCounters :
+            myLogger.print3("TIMING: " + name.ljust(lengthOfNames) + "\t Count: " + str(valuePerCounter[name]))
+        myLogger.logRecord("timingOfStages", title=titleOfReport,
+                           stages=dict([ [name, { "calls" : callsWallCpuPerStage[name][0],
+                                                  "wallSeconds" : callsWallCpuPerStage[name][1],
+                                                  "cpuSeconds" : callsWallCpuPerStage[name][2] }] for name in namesOfStages ]),
+                           counters=valuePerCounter)
+
+    # ============ Profiling, eg of a subepoch =============
+    def startProfiling(self, profiler) :
+        # profiler: One of PROFILERS.
+        if profiler == "chromeTrace" :
+            with self._lock :
+                self._traceEvents = []
+        else :
+            self._profiler = cProfile.Profile()
+            self._profiler.enable() # Profiles the calling thread only.
+
+    def stopProfilingAndDump(self, filepathWithoutExtension) :
+        # Returns the filepath written: .trace.json for a Chrome trace, .prof for cProfile (see pstats).
+        if self._profiler <> None :
+            self._profiler.disable()
+            filepath = filepathWithoutExtension + ".prof"
+            self._profiler.dump_stats(filepath)
+            self._profiler = None
+            return filepath
+        with self._lock :
+            traceEvents = self._traceEvents
+            self._traceEvents = None
+        filepath = filepathWithoutExtension + ".trace.json"
+        f = open(filepath, "w")
+        try :
+            json.dump({ "traceEvents" : traceEvents, "displayTimeUnit" : "ms" }, f)
+        finally :
+            f.close()
+        return filepath
+
+# The timers of this process. Used by all stages, so that they need not be passed through every function.
+stageTimers = StageTimers()
@@ -6,34 +6,69 @@
 # or read the terms at https://opensource.org/licenses/BSD-3-Clause.
 
 import sys
+import os
 import time
 import numpy as np
 import nibabel as nib
 import random
 import math
+import threading
+import Queue
 
 from scipy.ndimage.filters import gaussian_filter
 
-import pp
-
-from deepmedic.cnnHelpers import dump_cnn_to_gzip_file_dotSave
+from deepmedic.cnnCheckpoint import CheckpointSaverInBackground
 from deepmedic.cnnHelpers import CnnWrapperForSampling
 from deepmedic.pathwayTypes import PathwayTypes as pt
 from deepmedic.accuracyMonitor import AccuracyOfEpochMonitorSegmentation
+from deepmedic.samplerPool import SamplerPool, getNumberOfBytesOfFloat32Arrays, allocateFloat32Arrays, shuffleRowsOfArraysInPlace
+from deepmedic.volumeCache import getIdentityOfFile
+from deepmedic.segmentStream import StreamOfSegments
+from deepmedic.segmentationMetrics import computeConfusionMatricesOfVolume
+from deepmedic.stageTimers import stageTimers
 from deepmedic.genericHelpers import *
 
 TINY_FLOAT = np.finfo(np.float32).tiny 
 
+#Precision of the volumes held in memory during inference. They are converted to float32 only when given to the cnn. \
+# "float32": As before. "float16": Channels, probability maps and FMs in float16. Labels and integer masks \
+# in uint8 or int16. Saved as such. Nifti has no float16, so these are saved as int16, with a scaling in the header.
+STORAGE_PRECISIONS_OF_VOLUMES = ["float32", "float16"]
+
+def getDtypeOfFloatVolumes(storagePrecisionOfVolumes) :
+    return "float16" if storagePrecisionOfVolumes == "float16" else "float32"
+
+def getDtypeOfSegmentation(storagePrecisionOfVolumes, numberOfClasses) :
+    return "uint8" if storagePrecisionOfVolumes == "float16" and numberOfClasses <= 256 else "int16"
+
+def reduceDtypeOfLabelsOrMask(volume, storagePrecisionOfVolumes) :
+    # Only integer-valued volumes, so that probabilistic masks are kept as they are.
+    if storagePrecisionOfVolumes <> "float16" or not isinstance(volume, np.ndarray) or volume.size == 0 :
+        return volume
+    if not np.issubdtype(volume.dtype, np.integer) and not np.array_equal(volume, np.rint(volume)) :
+        return volume
+    [minValue, maxValue] = [volume.min(), volume.max()]
+    for dtype in ["uint8", "int16"] :
+        if np.iinfo(dtype).min <= minValue and maxValue <= np.iinfo(dtype).max :
+            return volume.astype(dtype)
+    return volume
+
 #These two pad/unpad should have their own class, and an instance should be created per subject. 
 # So that unpad gets how much to unpad from the pad.
 def padCnnInputs(array1, cnnReceptiveField, imagePartDimensions) : #Works for 2D as well I think.
-    cnnReceptiveFieldArray = np.asarray(cnnReceptiveField, dtype="int16")
-    array1D = np.asarray(array1.shape,dtype="int16")
     if len(array1.shape) <> 3 :
         print("ERROR! Given array in padCnnInputs() was expected of 3-dimensions, \
         but was passed an array of dimensions: ", \
               array1.shape,", Exiting!")
         exit(1)
+    tupleOfPaddingPerAxes = getPaddingPerAxesForCnnInputs(array1.shape, cnnReceptiveField, imagePartDimensions)
+    #Very poor design because channels/gt/bmask etc are all getting back a different padding? 
+    # tupleOfPaddingPerAxes is returned in order for unpad to know.
+    return [np.lib.pad(array1, tupleOfPaddingPerAxes, 'reflect' ), tupleOfPaddingPerAxes]
+
+def getPaddingPerAxesForCnnInputs(shapeOfArray, cnnReceptiveField, imagePartDimensions) :
+    cnnReceptiveFieldArray = np.asarray(cnnReceptiveField, dtype="int16")
+    array1D = np.asarray(shapeOfArray,dtype="int16")
     #paddingValue = (array1[0,0,0] + array1[-1,0,0] + array1[0,-1,0] + array1[-1,-1,0] + array1[0,0,-1] + 
     # array1[-1,0,-1] + array1[0,-1,-1] + array1[-1,-1,-1]) / 8.0
     #Calculate how much padding needed to fully infer the original array1, taking 
@@ -49,9 +84,7 @@ def padCnnInputs(array1, cnnReceptiveField, imagePartDimensions) : #Works for 2D
     tupleOfPaddingPerAxes = ( (paddingAtLeftPerAxis[0],paddingAtRightPerAxis[0]), \
                               (paddingAtLeftPerAxis[1],paddingAtRightPerAxis[1]), \
                               (paddingAtLeftPerAxis[2],paddingAtRightPerAxis[2]))
-    #Very poor design because channels/gt/bmask etc are all getting back a different padding? 
-    # tupleOfPaddingPerAxes is returned in order for unpad to know.
-    return [np.lib.pad(array1, tupleOfPaddingPerAxes, 'reflect' ), tupleOfPaddingPerAxes]
+    return tupleOfPaddingPerAxes
 
 #In the 3 first axes. Which means it can take a 4-dim image.
 def unpadCnnOutputs(array1, paddingPerAxes) :
@@ -82,6 +115,105 @@ def smoothImageWithGaussianFilterIfNeeded(smoothImageWithGaussianFilterStds, ima
     else :
         return gaussian_filter(imageArray, smoothImageWithGaussianFilterStds)
     
+def readAndPreprocessVolume(filepathToVolume, kindOfVolume, smoothImageWithGaussianFilterStds=None, slicesToCrop=None) :
+    # kindOfVolume: "channel", "gtLabels", "roiMask" or "weightMap". Only channels are smoothed.
+    # slicesToCrop: None, or a slice per axis. A smoothed volume is cropped after it is smoothed, so that the voxels \
+    # near the borders of the box are as when the volume is not cropped. Others are cropped as soon as read.
+    smoothingIsNeeded = kindOfVolume == "channel" and smoothImageWithGaussianFilterStds <> None
+    with stageTimers.timeStage("loadingVolumes") :
+        img_proxy = nib.load(filepathToVolume)
+        volume = img_proxy.get_data()
+        if len(volume.shape) > 3 and kindOfVolume == "channel" :
+            volume = volume[:,:,:,0]
+        if slicesToCrop <> None and not smoothingIsNeeded :
+            volume = np.array(volume[slicesToCrop]) # Copy, so that the full volume is not kept alive by a view.
+    if kindOfVolume == "channel" :
+        with stageTimers.timeStage("preprocessing") :
+            volume = smoothImageWithGaussianFilterIfNeeded(smoothImageWithGaussianFilterStds, volume)
+            volume = np.array(volume[slicesToCrop]) if slicesToCrop <> None and smoothingIsNeeded else volume
+    elif kindOfVolume == "gtLabels" :
+        #If the gt file was not type "int" (eg it was float), convert it to int. \
+        # Because later I m doing some == int comparisons. Labels are few, int16 is enough.
+        volume = volume if np.issubdtype( volume.dtype, np.integer ) and volume.dtype.itemsize <= 2 else \
+                    np.rint(volume).astype("int16")
+    else : # roiMask or weightMap
+        volume = volume if volume.dtype.itemsize <= 4 else volume.astype("float32")
+    img_proxy.uncache()
+    return volume
+
+def reflectAndPadVolumeForCnn(volume, reflectFlags, padInputImgs, cnnReceptiveField, dimsOfPrimeSegmentRcz) :
+    with stageTimers.timeStage("preprocessing") :
+        volume = reflectImageArrayIfNeeded(reflectFlags, volume)
+        return padCnnInputs(volume, cnnReceptiveField, dimsOfPrimeSegmentRcz) if padInputImgs else \
+                                                                        [volume, ((0,0), (0,0), (0,0))]
+
+def getMarginOfInputsAroundCentralVoxelOfSegments(cnn3d, training0orValidation1) :
+    # Per axis, how far from the central voxel of a segment the inputs of any pathway reach. \
+    # A subsampled pathway takes its input from an area subsFactor times larger than its input shape.
+    marginPerAxis = [0, 0, 0]
+    for pathway in cnn3d.pathways :
+        if pathway.pType() == pt.FC :
+            continue
+        shapeOfInputRcz = pathway.getShapeOfInput()[training0orValidation1][2:]
+        subsFactor = pathway.subsFactor()
+        for rcz_i in xrange(3) :
+            marginPerAxis[rcz_i] = max( marginPerAxis[rcz_i],
+                                        int(shapeOfInputRcz[rcz_i] * subsFactor[rcz_i] / 2 + subsFactor[rcz_i]) )
+    return marginPerAxis
+
+def getSlicesToCropToBoundingBoxOfRoi(roiMask, marginPerAxis) :
+    # Returns a slice per axis, for the bounding box of roiMask>0 enlarged by the margin, within the volume.
+    # None if the ROI is empty, in which case nothing should be cropped.
+    roiMaskBool = roiMask > 0
+    slicesToCrop = []
+    for rcz_i in xrange(3) :
+        otherAxes = tuple([ axis for axis in xrange(3) if axis <> rcz_i ])
+        indicesWithRoi = np.flatnonzero( np.any(roiMaskBool, axis=otherAxes) )
+        if len(indicesWithRoi) == 0 :
+            return None
+        slicesToCrop.append( slice( max(0, indicesWithRoi[0] - marginPerAxis[rcz_i]),
+                                    min(roiMask.shape[rcz_i], indicesWithRoi[-1] + 1 + marginPerAxis[rcz_i]) ) )
+    return tuple(slicesToCrop)
+
+def loadVolumeForCnn(volumeCache, # None, or a PreprocessedVolumeCache.
+                    filepathToVolume,
+                    kindOfVolume,
+                    smoothImageWithGaussianFilterStds,
+                    reflectFlags,
+                    padInputImgs,
+                    cnnReceptiveField,
+                    dimsOfPrimeSegmentRcz,
+                    slicesToCrop=None) : # None, or a slice per axis, to crop the volume before the rest.
+    # Reads, smooths, crops, reflects and pads a volume. Returns [volume, paddingPerAxes].
+    # With a cache, the read and smoothed volume is cached as float32 for channels, native type otherwise. \
+    # If it is not reflected or cropped, the padded volume is cached too, since reflection is applied before padding.
+    # Cropped volumes are cut from the cached full one. Either way, a volume is smoothed in full and then cropped.
+    if volumeCache == None :
+        volume = readAndPreprocessVolume(filepathToVolume, kindOfVolume, smoothImageWithGaussianFilterStds, slicesToCrop)
+        return reflectAndPadVolumeForCnn(volume, reflectFlags, padInputImgs, cnnReceptiveField, dimsOfPrimeSegmentRcz)
+    
+    preprocessingParameters = [smoothImageWithGaussianFilterStds] if kindOfVolume == "channel" else []
+    def readAndPreprocessVolumeToCache() :
+        volume = readAndPreprocessVolume(filepathToVolume, kindOfVolume, smoothImageWithGaussianFilterStds)
+        return volume.astype("float32") if kindOfVolume == "channel" else volume
+    
+    if padInputImgs and not (True in [ bool(flag) for flag in reflectFlags ]) and slicesToCrop == None :
+        def padVolumeToCache() :
+            volume = volumeCache.getOrCompute(filepathToVolume, kindOfVolume, preprocessingParameters,
+                                              readAndPreprocessVolumeToCache)
+            return padCnnInputs(volume, cnnReceptiveField, dimsOfPrimeSegmentRcz)[0]
+        volume = volumeCache.getOrCompute(filepathToVolume, kindOfVolume,
+                                          preprocessingParameters + [list(cnnReceptiveField), list(dimsOfPrimeSegmentRcz)],
+                                          padVolumeToCache)
+        shapeBeforePadding = nib.load(filepathToVolume).shape[:3] # Only the header is read.
+        paddingPerAxes = getPaddingPerAxesForCnnInputs(shapeBeforePadding, cnnReceptiveField, dimsOfPrimeSegmentRcz)
+        return [volume, paddingPerAxes]
+    
+    volume = volumeCache.getOrCompute(filepathToVolume, kindOfVolume, preprocessingParameters,
+                                      readAndPreprocessVolumeToCache)
+    volume = volume[slicesToCrop] if slicesToCrop <> None else volume # Only the box is read from the memory-map.
+    return reflectAndPadVolumeForCnn(volume, reflectFlags, padInputImgs, cnnReceptiveField, dimsOfPrimeSegmentRcz)
+    
 # roi_mask_filename and roiMinusLesion_mask_filename can be passed "no". In this case, 
 #the corresponding return result is nothing.
 # This is so because: the do_training() function only needs the roiMinusLesion_mask, whereas the do_testing() 
@@ -113,7 +245,12 @@ def actual_load_patient_imgs(myLogger,
                                                                 
                                                        smoothChannelsWithGaussFilteringStdsForNormalAndSubsampledImage,
                             normAugmFlag,
-                                                                reflectImageWithHalfProb
+                                                                reflectImageWithHalfProb,
+                                                                
+                                                                volumeCache=None, # PreprocessedVolumeCache, or None.
+                            # None, or per axis how many voxels to keep around the ROI's bounding box, cropping the rest.
+                                                                marginToCropAroundRoi=None,
+                                                                storagePrecisionOfVolumes="float32" # See STORAGE_PRECISIONS_OF_VOLUMES
                                                                 ):
     #listOfNiiFilepathNames: should be a list of lists. Each sublist corresponds to one certain patient-case.
     #...Each sublist should have as many elements(strings-filenamePaths) as numberOfChannels, \
@@ -136,21 +273,27 @@ def actual_load_patient_imgs(myLogger,
         reflectFlags.append(reflectImageWithHalfProb[reflectImageWithHalfProb_dimi] * random.randint(0,1))
     
     paddingPerAxes = ((0,0), (0,0), (0,0)) #This will be given a proper value if padding is performed.
+    slicesToCrop = None #All volumes are cropped with these before smoothing and padding, if given.
     
     if providedRoiMaskBool :
         fullFilenamePathOfRoiMask = fpathsToRoiMaskOfEachPat[idx_wanted_img]
-        img_proxy = nib.load(fullFilenamePathOfRoiMask)
-        roiMaskData = img_proxy.get_data()
-        roiMaskData = reflectImageArrayIfNeeded(reflectFlags, roiMaskData)
-        roiMask = roiMaskData #np.asarray(roiMaskData, dtype="float32") #the .get_data returns a nparray but \
-        #it is not a float64
-        img_proxy.uncache()
-        [roiMask, paddingPerAxes] = padCnnInputs(roiMask, cnnReceptiveField, dimsOfPrimeSegmentRcz) if \
-            padInputImgs else [roiMask, paddingPerAxes]
+        if marginToCropAroundRoi <> None :
+            #The ROI is loaded first, as it is, to find the box to crop all volumes to.
+            roiMask = loadVolumeForCnn(volumeCache, fullFilenamePathOfRoiMask, "roiMask", None,
+                                        [0,0,0], False, cnnReceptiveField, dimsOfPrimeSegmentRcz)[0]
+            slicesToCrop = getSlicesToCropToBoundingBoxOfRoi(roiMask, marginToCropAroundRoi)
+            roiMask = np.array(roiMask[slicesToCrop]) if slicesToCrop <> None else roiMask
+            [roiMask, paddingPerAxes] = reflectAndPadVolumeForCnn(roiMask, reflectFlags, padInputImgs,
+                                                                cnnReceptiveField, dimsOfPrimeSegmentRcz)
+        else :
+            [roiMask, paddingPerAxes] = loadVolumeForCnn(volumeCache, fullFilenamePathOfRoiMask, "roiMask", None,
+                                                    reflectFlags, padInputImgs, cnnReceptiveField, dimsOfPrimeSegmentRcz)
+        roiMask = reduceDtypeOfLabelsOrMask(roiMask, storagePrecisionOfVolumes)
     else :
         roiMask = "placeholderNothing"
         
     #Load the channels of the patient.
+    dtypeOfChannels = getDtypeOfFloatVolumes(storagePrecisionOfVolumes)
     niiDims = None
     allChannelsOfPatientInNpArray = None
     #The below has dimensions (channels, 2). Holds per channel: [value to add per voxel for mean norm, 
@@ -160,23 +303,17 @@ def actual_load_patient_imgs(myLogger,
     for channel_i in xrange(numberOfNormalScaleChannels):
         fullFilenamePathOfChannel = fpathsToEachChannelOfEachPat[idx_wanted_img][channel_i]
         if fullFilenamePathOfChannel <> "-" : #normal case, filepath was given.
-            img_proxy = nib.load(fullFilenamePathOfChannel)
-            channelData = img_proxy.get_data()
-            if len(channelData.shape) > 3 :
-                channelData = channelData[:,:,:,0]
-                
-            channelData = smoothImageWithGaussianFilterIfNeeded(\
-                                        smoothChannelsWithGaussFilteringStdsForNormalAndSubsampledImage[0], channelData)
-            channelData = reflectImageArrayIfNeeded(reflectFlags, channelData) #reflect if flag ==1 .
-            [channelData, paddingPerAxes] = padCnnInputs(channelData, \
-                        cnnReceptiveField, dimsOfPrimeSegmentRcz) if padInputImgs else\
-                                                 [channelData, paddingPerAxes]
+            #Smoothed, reflected if flag ==1, and padded.
+            [channelData, paddingPerAxes] = loadVolumeForCnn(volumeCache, fullFilenamePathOfChannel, "channel",
+                                            smoothChannelsWithGaussFilteringStdsForNormalAndSubsampledImage[0],
+                                            reflectFlags, padInputImgs, cnnReceptiveField, dimsOfPrimeSegmentRcz,
+                                            slicesToCrop)
             
             if not isinstance(allChannelsOfPatientInNpArray, (np.ndarray)) :
                 #Initialize the array in which all the channels for the patient will be placed.
                 niiDims = list(channelData.shape)
                 allChannelsOfPatientInNpArray = np.zeros( (numberOfNormalScaleChannels, niiDims[0], \
-                                                           niiDims[1], niiDims[2]))
+                                                           niiDims[1], niiDims[2]), dtype=dtypeOfChannels)
                 
             allChannelsOfPatientInNpArray[channel_i] = channelData
         else : # "-" was given in the config-listing file. Do Min-fill!
@@ -189,7 +326,6 @@ def actual_load_patient_imgs(myLogger,
             allChannelsOfPatientInNpArray[channel_i] = channelData[:,:,:,0] #np.asarray(channelData[:,:,:,0], \
             # dtype="float32") #[:,:,:,0] because the nii image actually is of 4 dims, with 4th being time.
         """
-        img_proxy.uncache()
         
         #-------For Data Augmentation when it comes to normalisation values--------------
         #The normalization-augmentation variable should be [0]==0 for no normAug, eg in the case of validation. 
@@ -220,18 +356,11 @@ def actual_load_patient_imgs(myLogger,
     #LOAD the class-labels.
     if providedGtLabelsBool : #For training (exact target labels) or validation on samples labels.
         fullFilenamePathOfGtLabels = fpathsToGtLabelsOfEachPat[idx_wanted_img]
-        imgGtLabels_proxy = nib.load(fullFilenamePathOfGtLabels)
-        #If the gt file was not type "int" (eg it was float), convert it to int. \
-        # Because later I m doing some == int comparisons.
-        gtLabelsData = imgGtLabels_proxy.get_data()
-        gtLabelsData = gtLabelsData if np.issubdtype( gtLabelsData.dtype, np.int ) else \
-                                                    np.rint(gtLabelsData).astype("int32")
-        gtLabelsData = reflectImageArrayIfNeeded(reflectFlags, gtLabelsData) #reflect if flag ==1 .
-        imageGtLabels = gtLabelsData
-        imgGtLabels_proxy.uncache()
-        [imageGtLabels, paddingPerAxes] = padCnnInputs(imageGtLabels, cnnReceptiveField, \
-                                            dimsOfPrimeSegmentRcz) if padInputImgs else \
-                                                [imageGtLabels, paddingPerAxes]
+        #Converted to int if needed, reflected if flag ==1, and padded.
+        [imageGtLabels, paddingPerAxes] = loadVolumeForCnn(volumeCache, fullFilenamePathOfGtLabels, "gtLabels", None,
+                                                reflectFlags, padInputImgs, cnnReceptiveField, dimsOfPrimeSegmentRcz,
+                                                slicesToCrop)
+        imageGtLabels = reduceDtypeOfLabelsOrMask(imageGtLabels, storagePrecisionOfVolumes)
     else : 
         imageGtLabels = "placeholderNothing" #For validation and testing
         
@@ -246,13 +375,10 @@ def actual_load_patient_imgs(myLogger,
             filepathToTheWeightMapOfThisPatientForThisCategory = \
                     filepathsToTheWeightMapsOfAllPatientsForThisCategory[idx_wanted_img]
             
-            img_proxy = nib.load(filepathToTheWeightMapOfThisPatientForThisCategory)
-            weightedMapForThisCatData = img_proxy.get_data()
-            weightedMapForThisCatData = reflectImageArrayIfNeeded(reflectFlags, weightedMapForThisCatData)
-            img_proxy.uncache()
-            [weightedMapForThisCatData, paddingPerAxes] = padCnnInputs(weightedMapForThisCatData, \
-                                cnnReceptiveField, dimsOfPrimeSegmentRcz) if padInputImgs else \
-                                    [weightedMapForThisCatData, paddingPerAxes]
+            [weightedMapForThisCatData, paddingPerAxes] = loadVolumeForCnn(volumeCache,
+                                                    filepathToTheWeightMapOfThisPatientForThisCategory, "weightMap", None,
+                                                    reflectFlags, padInputImgs, cnnReceptiveField, dimsOfPrimeSegmentRcz,
+                                                    slicesToCrop)
             
             sampleWeightMaps[cat_i] = weightedMapForThisCatData
     else :
@@ -269,20 +395,14 @@ def actual_load_patient_imgs(myLogger,
     else :
         numberOfSubsampledScaleChannels = len(fpathsToEachSubsampledChannelOfEachPat[0])
         allSubsamChannelsOfPatient = np.zeros( (numberOfSubsampledScaleChannels, niiDims[0], \
-                                                             niiDims[1], niiDims[2]))
+                                                             niiDims[1], niiDims[2]), dtype=dtypeOfChannels)
         for channel_i in xrange(numberOfSubsampledScaleChannels):
             fullFilenamePathOfChannel = \
                 fpathsToEachSubsampledChannelOfEachPat[idx_wanted_img][channel_i]
-            img_proxy = nib.load(fullFilenamePathOfChannel)
-            channelData = img_proxy.get_data()
-            if len(channelData.shape) > 3 :
-                channelData = channelData[:,:,:,0]
-            channelData = smoothImageWithGaussianFilterIfNeeded(\
-                                        smoothChannelsWithGaussFilteringStdsForNormalAndSubsampledImage[1], channelData)
-            channelData = reflectImageArrayIfNeeded(reflectFlags, channelData)
-            [channelData, paddingPerAxes] = padCnnInputs(channelData, \
-                                cnnReceptiveField, dimsOfPrimeSegmentRcz) if padInputImgs else\
-                                     [channelData, paddingPerAxes]
+            [channelData, paddingPerAxes] = loadVolumeForCnn(volumeCache, fullFilenamePathOfChannel, "channel",
+                                            smoothChannelsWithGaussFilteringStdsForNormalAndSubsampledImage[1],
+                                            reflectFlags, padInputImgs, cnnReceptiveField, dimsOfPrimeSegmentRcz,
+                                            slicesToCrop)
             
             allSubsamChannelsOfPatient[channel_i] = channelData
             """
@@ -293,7 +413,6 @@ def actual_load_patient_imgs(myLogger,
                 #np.asarray(channelData[:,:,:,0], dtype="float32") #[:,:,:,0] \
                 #because the nii image actually is of 4 dims, with 4th being time.
             """
-            img_proxy.uncache()
             
             #-------For Data Augmentation when it comes to normalisation values--------------
             if training0orValidation1orTest2 == 0 and \
@@ -306,16 +425,93 @@ def actual_load_patient_imgs(myLogger,
                                                                       + valueToAddToEachVoxel)*valueToMultiplyEachVoxel
                 
     return [allChannelsOfPatientInNpArray, imageGtLabels, roiMask, sampleWeightMaps, \
-                                        allSubsamChannelsOfPatient, paddingPerAxes]
+                                        allSubsamChannelsOfPatient, paddingPerAxes, reflectFlags]
 
 
 #made for 3d
+def getHalfImagePartBoundaries(dimsOfSegmentRcz) :
+    #KernelDim is always odd. BUT ImagePart dimensions can be odd or even.
+    #If odd, ok, floor(dim/2) from central.
+    #If even, dim/2-1 voxels towards the begining of the axis and dim/2 towards the end. Ie, \
+    # "central" imagePart voxel is 1 closer to begining.
+    #BTW imagePartDim takes kernel into account (ie if I want 9^3 voxels classified per imagePart with kernel 5x5, \
+    # I want 13 dim ImagePart)
+    
+    #dim1: 1 row per r,c,z. Dim2: left/right width not to sample from (=half segment).
+    halfImagePartBoundaries = np.zeros( (len(dimsOfSegmentRcz), 2) , dtype='int32') 
+    for rcz_i in xrange( len(dimsOfSegmentRcz) ) :
+        if dimsOfSegmentRcz[rcz_i]%2 == 0: #even
+            dimensionDividedByTwo = dimsOfSegmentRcz[rcz_i]/2
+            #central of ImagePart is 1 vox closer to begining of axes.
+            halfImagePartBoundaries[rcz_i] = [dimensionDividedByTwo - 1, dimensionDividedByTwo] 
+        else: #odd
+            #eg 5/2 = 2, with the 3rd voxel being the "central"
+            dimensionDividedByTwoFloor = math.floor(dimsOfSegmentRcz[rcz_i]/2) 
+            halfImagePartBoundaries[rcz_i] = [dimensionDividedByTwoFloor, dimensionDividedByTwoFloor] 
+    return halfImagePartBoundaries
+
+# An index for sampling central voxels of segments in proportion to a weight map. One entry per voxel with \
+# positive weight that can be the central voxel of a segment within the image boundaries, in the order of the \
+# flattened image. Drawing a voxel is then a binary search in the cumulative weights, instead of passes over the image.
+DTYPE_OF_INDEX_FOR_SAMPLING = np.dtype([("flatIndex", "int64"), ("cumulativeWeight", "float64")])
+
+def buildIndexForSamplingCentralVoxels(weightMapToSampleFrom, dimsOfSegmentRcz) :
+    halfImagePartBoundaries = getHalfImagePartBoundaries(dimsOfSegmentRcz)
+    dimensionsOfImage = weightMapToSampleFrom.shape
+    #The voxels that allow you to get an image part CENTERED on them, and be safely within image boundaries.
+    #Note: in 2D case halfImagePartBoundaries might be ==0, so slice with the end index, not a negative one.
+    slicesOfValidCentralVoxels = [ slice( halfImagePartBoundaries[rcz_i][0],
+                                          max(halfImagePartBoundaries[rcz_i][0],
+                                              dimensionsOfImage[rcz_i] - halfImagePartBoundaries[rcz_i][1]) )
+                                   for rcz_i in xrange(len(dimsOfSegmentRcz)) ]
+    weightsOfValidCentralVoxels = weightMapToSampleFrom[tuple(slicesOfValidCentralVoxels)]
+    coordsInSlices = np.nonzero(weightsOfValidCentralVoxels > 0)
+    indexForSampling = np.empty(len(coordsInSlices[0]), dtype=DTYPE_OF_INDEX_FOR_SAMPLING)
+    indexForSampling["flatIndex"] = np.ravel_multi_index( [ coordsInSlices[rcz_i] + halfImagePartBoundaries[rcz_i][0]
+                                                            for rcz_i in xrange(len(dimsOfSegmentRcz)) ],
+                                                          dimensionsOfImage )
+    indexForSampling["cumulativeWeight"] = np.cumsum(weightsOfValidCentralVoxels[coordsInSlices], dtype="float64")
+    return indexForSampling
+
+def getIndicesForSamplingCentralVoxelsOfSubject(volumeCache, # PreprocessedVolumeCache, or None.
+                                                samplingTypeInstance,
+                                                functionGivingWeightMapsPerCategory,
+                                                dimsOfSegmentRcz,
+                                                filepathToGtLabels,
+                                                filepathsToOtherMapsOfSubject, # Roi mask and weight maps, if used.
+                                                parametersOfLoading) : # Anything else that changes the loaded maps.
+    # Returns one index per sampling category. With a cache, the indices are stored alongside the loaded volumes, \
+    # and the weight maps are only computed if an index is not cached.
+    weightMapsPerCategory = []
+    def buildIndexForCategory(cat_i) :
+        if len(weightMapsPerCategory) == 0 :
+            weightMapsPerCategory.extend( functionGivingWeightMapsPerCategory() )
+        return buildIndexForSamplingCentralVoxels(weightMapsPerCategory[cat_i], dimsOfSegmentRcz)
+    
+    numberOfCategoriesToSample = samplingTypeInstance.getNumberOfCategoriesToSample()
+    if volumeCache == None :
+        return [ buildIndexForCategory(cat_i) for cat_i in xrange(numberOfCategoriesToSample) ]
+    
+    parametersOfIndices = [ samplingTypeInstance.getIntSamplingType(),
+                            numberOfCategoriesToSample,
+                            [ getIdentityOfFile(filepath) for filepath in filepathsToOtherMapsOfSubject ],
+                            [ int(dim) for dim in dimsOfSegmentRcz ],
+                            parametersOfLoading ]
+    indicesForSamplingPerCategory = []
+    for cat_i in xrange(numberOfCategoriesToSample) :
+        indicesForSamplingPerCategory.append( volumeCache.getOrCompute(filepathToGtLabels,
+                                                                       "samplingIndex",
+                                                                       parametersOfIndices + [cat_i],
+                                                                       lambda : buildIndexForCategory(cat_i)) )
+    return indicesForSamplingPerCategory
+
 def sampleImageParts(   myLogger,
                         numOfSegmentsToExtractForThisSubject,
                         dimsOfSegmentRcz,
                         dimensionsOfImageChannel,# the dimensions of the images of this subject. 
                         #All channels etc should have the same dimensions
-                        weightMapToSampleFrom
+                        weightMapToSampleFrom, # Can be None if the index is given.
+                        indexForSampling = None # From buildIndexForSamplingCentralVoxels(). Built if not given.
                         ) :
     """
     This function returns the coordinates (index) of the "central" voxel of sampled image parts \
@@ -331,67 +527,23 @@ def sampleImageParts(   myLogger,
     boundary of the slice, and [1] for the higher boundary. INCLUSIVE BOTH SIDES.
         Example: [ r-sliceCoordsOfImagePart, c-sliceCoordsOfImagePart, z-sliceCoordsOfImagePart ]
     """
-    # Check if the weight map is fully-zeros. In this case, return no element.
+    if indexForSampling is None :
+        indexForSampling = buildIndexForSamplingCentralVoxels(weightMapToSampleFrom, dimsOfSegmentRcz)
+    # Check if no voxel can be sampled. In this case, return no element.
     # Note: Currently, the caller function is checking this case already and does not let this being \
     # called. Which is still fine.
-    if np.sum(weightMapToSampleFrom>0) == 0 :
+    if len(indexForSampling) == 0 :
         myLogger.print3("WARN: The sampling mask/map was found just zeros! No image parts were sampled for this subject!")
         return [ [[],[],[]], [[],[],[]] ]
     
-    imagePartsSampled = []
-    
-    #Now out of these, I need to randomly select one, which will be an ImagePart's central voxel.
-    #But I need to be CAREFUL and get one that IS NOT closer to the image boundaries than the \
-    # dimensions of the ImagePart permit.
-    
-    #I look for lesions that are not closer to the image boundaries than the ImagePart dimensions allow.
-    #KernelDim is always odd. BUT ImagePart dimensions can be odd or even.
-    #If odd, ok, floor(dim/2) from central.
-    #If even, dim/2-1 voxels towards the begining of the axis and dim/2 towards the end. Ie, \
-    # "central" imagePart voxel is 1 closer to begining.
-    #BTW imagePartDim takes kernel into account (ie if I want 9^3 voxels classified per imagePart with kernel 5x5, \
-    # I want 13 dim ImagePart)
-    
-    #dim1: 1 row per r,c,z. Dim2: left/right width not to sample from (=half segment).
-    halfImagePartBoundaries = np.zeros( (len(dimsOfSegmentRcz), 2) , dtype='int32') 
-    
-    #The below starts all zero. Will be Multiplied by other true-false arrays expressing if the relevant voxels \
-    # are within boundaries.
-    #In the end, the final vector will be true only for the indices of lesions that are within all boundaries.
-    booleanNpArray_voxelsToCentraliseImPartsWithinBoundaries = np.zeros(weightMapToSampleFrom.shape, dtype="int32")
+    halfImagePartBoundaries = getHalfImagePartBoundaries(dimsOfSegmentRcz)
     
-    #The following loop leads to booleanNpArray_voxelsToCentraliseImPartsWithinBoundaries to be true for the \
-    # indices that allow you to get an image part CENTERED on them, and be safely within image boundaries. Note that if the imagePart is of even dimension, the "central" voxel is one voxel to the left.
-    for rcz_i in xrange( len(dimsOfSegmentRcz) ) :
-        if dimsOfSegmentRcz[rcz_i]%2 == 0: #even
-            dimensionDividedByTwo = dimsOfSegmentRcz[rcz_i]/2
-            #central of ImagePart is 1 vox closer to begining of axes.
-            halfImagePartBoundaries[rcz_i] = [dimensionDividedByTwo - 1, dimensionDividedByTwo] 
-        else: #odd
-            #eg 5/2 = 2, with the 3rd voxel being the "central"
-            dimensionDividedByTwoFloor = math.floor(dimsOfSegmentRcz[rcz_i]/2) 
-            halfImagePartBoundaries[rcz_i] = [dimensionDividedByTwoFloor, dimensionDividedByTwoFloor] 
-    #used to be [halfImagePartBoundaries[0][0]: -halfImagePartBoundaries[0][1]], but in 2D case 
-    # halfImagePartBoundaries might be ==0, causes problem and you get a null slice.
-    booleanNpArray_voxelsToCentraliseImPartsWithinBoundaries[\
-                                halfImagePartBoundaries[0][0]: dimensionsOfImageChannel[0] - halfImagePartBoundaries[0][1],
-                                halfImagePartBoundaries[1][0]: dimensionsOfImageChannel[1] - halfImagePartBoundaries[1][1],
-                            halfImagePartBoundaries[2][0]: dimensionsOfImageChannel[2] - halfImagePartBoundaries[2][1]] = 1
-                                                            
-    constrainedWithImageBoundariesMaskToSample = \
-        weightMapToSampleFrom * booleanNpArray_voxelsToCentraliseImPartsWithinBoundaries
-    #normalize the probabilities to sum to 1, cause the function needs it as so.
-    constrainedWithImageBoundariesMaskToSample = \
-        constrainedWithImageBoundariesMaskToSample / (1.0* np.sum(constrainedWithImageBoundariesMaskToSample))
-    
-    flattenedConstrainedWithImageBoundariesMaskToSample = constrainedWithImageBoundariesMaskToSample.flatten()
-    
-    #This is going to be a 3xNumberOfImagePartSamples array.
-    indicesInTheFlattenArrayThatWereSampledAsCentralVoxelsOfImageParts = np.random.choice(  \
-                                                                   constrainedWithImageBoundariesMaskToSample.size,
-                                                                   size = numOfSegmentsToExtractForThisSubject,
-                                                                   replace=True,
-                                                                    p=flattenedConstrainedWithImageBoundariesMaskToSample)
+    #Draw with probability proportional to the weights, like np.random.choice(p=...), using the same random numbers.
+    cumulativeWeights = indexForSampling["cumulativeWeight"]
+    randomPointsInCumulativeWeights = np.random.random_sample(numOfSegmentsToExtractForThisSubject) * cumulativeWeights[-1]
+    positionsInIndexSampled = np.minimum( np.searchsorted(cumulativeWeights, randomPointsInCumulativeWeights, side="right"),
+                                          len(indexForSampling) - 1 )
+    indicesInTheFlattenArrayThatWereSampledAsCentralVoxelsOfImageParts = indexForSampling["flatIndex"][positionsInIndexSampled]
     #np.unravel_index([listOfIndicesInFlattened], dims) returns a tuple of arrays (eg 3 of them if 3 dimImage), \
     # where each of the array in the tuple has the same shape as the listOfIndices. They have the r/c/z coords that \
     # correspond to the index of the flattened version.
@@ -399,7 +551,7 @@ def sampleImageParts(   myLogger,
     # 3(rcz) x numOfSegmentsToExtractForThisSubject.
     coordsOfCentralVoxelsOfPartsSampled = np.asarray(\
                                         np.unravel_index(indicesInTheFlattenArrayThatWereSampledAsCentralVoxelsOfImageParts,
-                                        constrainedWithImageBoundariesMaskToSample.shape #the shape of the brainmask/scan.
+                                        dimensionsOfImageChannel #the shape of the brainmask/scan.
                                         )
                                         )
     #Array with shape: 3(rcz) x NumberOfImagePartSamples x 2. The last dimension has [0] for the lower boundary \
@@ -537,71 +689,110 @@ def getImagePartFromSubsampledImageForTraining( dimsOfPrimarySegment,
     return subsampledChannelsForThisImagePart
 
 
+def getLowBoundariesOfSegmentsAlongAxis(dimOfImageInAxis, dimOfSegmentInAxis, strideInAxis) :
+    # Same as stepping with the stride from 0 until the far end of a segment reaches the end of the image. \
+    # The far boundary of the segments is clipped to the image, so the last segment is shifted back to fit in it.
+    numberOfStepsAfterFirst = max(0, int(math.ceil((dimOfImageInAxis - dimOfSegmentInAxis)*1.0/strideInAxis)))
+    lowBoundariesNext = np.arange(numberOfStepsAfterFirst + 1, dtype="int32") * strideInAxis
+    farBoundaries = np.minimum(lowBoundariesNext + dimOfSegmentInAxis, dimOfImageInAxis) #Excluding.
+    return farBoundaries - dimOfSegmentInAxis
+
+def makeIntegralVolume(volume) :
+    # Summed-area table with a zero-border at the beginning of each axis, so that
+    # integralVol[r,c,z] = sum(volume[:r,:c,:z]).
+    integralVol = np.zeros([dim+1 for dim in volume.shape], dtype="int64")
+    integralVol[1:,1:,1:] = np.cumsum(np.cumsum(np.cumsum(volume, axis=0, dtype="int64"), axis=1), axis=2)
+    return integralVol
+
+def getSumsOfBoxesFromIntegralVolume(integralVol, lowCoords, farCoordsNonIncl) :
+    # lowCoords, farCoordsNonIncl: numBoxes x 3. Each box sum costs 8 lookups, whatever its size.
+    [r0, c0, z0] = [ lowCoords[:,i] for i in xrange(3) ]
+    [r1, c1, z1] = [ farCoordsNonIncl[:,i] for i in xrange(3) ]
+    return integralVol[r1,c1,z1] - integralVol[r0,c1,z1] - integralVol[r1,c0,z1] - integralVol[r1,c1,z0] + \
+            integralVol[r0,c0,z1] + integralVol[r0,c1,z0] + integralVol[r1,c0,z0] - integralVol[r0,c0,z0]
+
 # This is very similar to sampleImageParts() I believe, which is used for training. Consider way to merge them.
 def getCoordsOfAllSegmentsOfAnImage(myLogger,
                                     dimsOfPrimarySegment, # RCZ dims of input to primary pathway (NORMAL). \
                                     #Which should be the first one in .pathways.
                                     strideOfSegmentsPerDimInVoxels,
-                                    batch_size,
                                     channelsOfImageNpArray,#chans,niiDims
                                     brainMask
                                     ) :
     myLogger.print3("Starting to (tile) extract Segments from the images of the subject for Segmentation...")
     
-    sliceCoordsOfSegmentsToReturn = []
-    
     niiDims = list(channelsOfImageNpArray[0].shape) # Dims of the volumes
     
-    zLowBoundaryNext=0; zAxisCentralPartPredicted = False;
-    while not zAxisCentralPartPredicted :
-        zFarBoundary = min(zLowBoundaryNext+dimsOfPrimarySegment[2], niiDims[2]) #Excluding.
-        zLowBoundary = zFarBoundary - dimsOfPrimarySegment[2]
-        zLowBoundaryNext = zLowBoundaryNext + strideOfSegmentsPerDimInVoxels[2]
-        zAxisCentralPartPredicted = False if zFarBoundary < niiDims[2] else True #THIS IS THE IMPORTANT CRITERION.
-        
-        cLowBoundaryNext=0; cAxisCentralPartPredicted = False;
-        while not cAxisCentralPartPredicted :
-            cFarBoundary = min(cLowBoundaryNext+dimsOfPrimarySegment[1], niiDims[1]) #Excluding.
-            cLowBoundary = cFarBoundary - dimsOfPrimarySegment[1]
-            cLowBoundaryNext = cLowBoundaryNext + strideOfSegmentsPerDimInVoxels[1]
-            cAxisCentralPartPredicted = False if cFarBoundary < niiDims[1] else True
-            
-            rLowBoundaryNext=0; rAxisCentralPartPredicted = False;
-            while not rAxisCentralPartPredicted :
-                rFarBoundary = min(rLowBoundaryNext+dimsOfPrimarySegment[0], niiDims[0]) #Excluding.
-                rLowBoundary = rFarBoundary - dimsOfPrimarySegment[0]
-                rLowBoundaryNext = rLowBoundaryNext + strideOfSegmentsPerDimInVoxels[0]
-                rAxisCentralPartPredicted = False if rFarBoundary < niiDims[0] else True
-                #In case I pass a brain-mask, I ll use it to only predict inside it. Otherwise, whole image.
-                if isinstance(brainMask, (np.ndarray)) : 
-                    if not np.any(brainMask[rLowBoundary:rFarBoundary,
-                                            cLowBoundary:cFarBoundary,
-                                            zLowBoundary:zFarBoundary
-                                            ]) : #all of it is out of the brain so skip it.
-                        continue
-                    
-                sliceCoordsOfSegmentsToReturn.append([ [rLowBoundary, rFarBoundary-1], [cLowBoundary, cFarBoundary-1], \
-                                                      [zLowBoundary, zFarBoundary-1] ])
-                
-    #I need to have a total number of image-parts that can be exactly-divided by the 'batch_size'. 
-    # For this reason, I add in the far end of the list multiple copies of the last element. 
-    # I NEED THIS IN THEANO. I TRIED WITHOUT. NO.
-    total_number_of_image_parts = len(sliceCoordsOfSegmentsToReturn)
-    number_of_imageParts_missing_for_exact_division =  batch_size - total_number_of_image_parts%batch_size if \
-                                                            total_number_of_image_parts%batch_size <> 0 else 0
-    for extra_useless_image_part_i in xrange(number_of_imageParts_missing_for_exact_division) :
-        sliceCoordsOfSegmentsToReturn.append(sliceCoordsOfSegmentsToReturn[-1])
+    lowBoundariesPerAxis = [ getLowBoundariesOfSegmentsAlongAxis(niiDims[i],
+                                                                 dimsOfPrimarySegment[i],
+                                                                 strideOfSegmentsPerDimInVoxels[i]) for i in xrange(3) ]
+    #The grid of the segments, in the order of the previous loops: z outer, then c, r inner.
+    [zLowBoundaries, cLowBoundaries, rLowBoundaries] = np.meshgrid(lowBoundariesPerAxis[2],
+                                                                  lowBoundariesPerAxis[1],
+                                                                  lowBoundariesPerAxis[0], indexing="ij")
+    lowBoundaries = np.stack([rLowBoundaries.ravel(), cLowBoundaries.ravel(), zLowBoundaries.ravel()], axis=1)
+    farBoundaries = lowBoundaries + np.asarray(dimsOfPrimarySegment, dtype="int32") #Excluding.
+    
+    #In case I pass a brain-mask, I ll use it to only predict inside it. Otherwise, whole image.
+    if isinstance(brainMask, (np.ndarray)) :
+        integralVolOfMask = makeIntegralVolume(brainMask > 0)
+        sumsOfMaskInSegments = getSumsOfBoxesFromIntegralVolume(integralVolOfMask,
+                                                                np.maximum(lowBoundaries, 0),
+                                                                farBoundaries)
+        segmentsInsideMask = sumsOfMaskInSegments > 0 #The rest are out of the brain so skip them.
+        lowBoundaries = lowBoundaries[segmentsInsideMask]
+        farBoundaries = farBoundaries[segmentsInsideMask]
         
+    # numberOfSegments x 3(rcz) x 2 (lower and upper limit of the segment, INCLUSIVE both sides)
+    sliceCoordsOfSegmentsToReturn = np.stack([lowBoundaries, farBoundaries-1], axis=2).astype("int32")
+    
+    #The number of segments need not be a multiple of the batch size. The last batch of the subject is smaller.
+    
     #I think that since the parts are acquired in a certain order and are sorted this way in the list, it is easy
     #to know which part of the image they came from, as it depends only on the stride-size and the imagePart size.
     
     myLogger.print3("Finished (tiling) extracting Segments from the images of the subject for Segmentation.")
     
-    # sliceCoordsOfSegmentsToReturn: list with 3 dimensions. numberOfSegments x 3(rcz) x 2 
+    # sliceCoordsOfSegmentsToReturn: int32 array with 3 dimensions. numberOfSegments x 3(rcz) x 2 
     # (lower and upper limit of the segment, INCLUSIVE both sides)
     return [sliceCoordsOfSegmentsToReturn]
 
 
+def getIndicesPerAxisOfSubsampledPartsForBatch( lowCoordsOfPrimarySegmentsInAxis,
+                                                dimOfPrimarySegmentInAxis,
+                                                recFieldCnnInAxis,
+                                                subSamplingFactorInAxis,
+                                                subsampledImagePartDimInAxis,
+                                                subsampledImageDimInAxis
+                                                ) :
+    """
+    Vectorized counterpart of the per-axis index arithmetic in getImagePartFromSubsampledImageForTraining(). \
+    For every segment of a batch, it returns the index in the subsampled image that each voxel of the \
+    subsampled image-part is copied from, and whether this index falls inside the image (otherwise the voxel \
+    keeps the zero-intensity of the channel). The placement quirk of the original when rlow < 0 \
+    (floor division of abs(rlow)) is reproduced exactly, so that both give identical parts.
+    """
+    f = subSamplingFactorInAxis
+    numberOfCentralVoxelsClassified = dimOfPrimarySegmentInAxis - recFieldCnnInAxis + 1
+    slotsPreviously = ((f-1)/2)*recFieldCnnInAxis if f%2==1 else (f-2)/2*recFieldCnnInAxis + recFieldCnnInAxis/2
+    toCentralVoxelOfAnAveragedArea = f/2 if f%2==1 else (f/2 - 1)
+    
+    lowCoords = np.asarray(lowCoordsOfPrimarySegmentsInAxis, dtype="int64") # numSegs
+    low = lowCoords + toCentralVoxelOfAnAveragedArea - slotsPreviously
+    highNonIncl = low + f*recFieldCnnInAxis + (int(math.ceil((numberOfCentralVoxelsClassified*1.0)/f)) - 1) * f
+    highNonInclCorrected = np.minimum(highNonIncl, subsampledImageDimInAxis)
+    lowCorrected = np.maximum(low, 0)
+    lowToPutTheNotPaddedInSubsampledImPart = np.where(low >= 0, 0, np.abs(low)/f)
+    
+    positionsInPart = np.arange(subsampledImagePartDimInAxis, dtype="int64")[np.newaxis,:] # 1 x partDim
+    indicesInImage = lowCorrected[:,np.newaxis] + \
+                        (positionsInPart - lowToPutTheNotPaddedInSubsampledImPart[:,np.newaxis]) * f # numSegs x partDim
+    validIndices = (positionsInPart >= lowToPutTheNotPaddedInSubsampledImPart[:,np.newaxis]) * \
+                    (indicesInImage < highNonInclCorrected[:,np.newaxis])
+    indicesInImage = np.clip(indicesInImage, 0, subsampledImageDimInAxis-1)
+    return [indicesInImage, validIndices]
+
+
 # I must merge this with function: extractDataOfASegmentFromImagesUsingSampledSliceCoords() that is \
 # used for Training/Validation! Should be easy!
 # This is used in testing only.
@@ -611,45 +802,70 @@ def extractDataOfSegmentsUsingSampledSliceCoords(cnn3dInst,
                                                 channelsOfSubsampledImageNpArray, #chans,niiDims
                                                 recFieldCnn
                                                 ) :
-    numSegsToExtract = len(sliceCoordsOfSegsToExtract)
+    """
+    Extracts all the segments of a batch at once, instead of slicing them one by one.
+    For the primary pathway, a strided (no-copy) view of all the possible segment-windows of the image is made, \
+    and the wanted ones are gathered with a single fancy-index. For the subsampled pathways, per-axis index \
+    grids are computed for the whole batch and gathered in one go, filling the out-of-image voxels with \
+    the zero-intensity of each channel, exactly like getImagePartFromSubsampledImageForTraining().
+    sliceCoordsOfSegsToExtract: list or array of dimensions numberOfSegments x 3(rcz) x 2 (inclusive limits).
+    Returns a list with one float32 array per pathway that requires input, of dimensions \
+    [numberOfSegments, channels, r, c, z], ready to be loaded on the shared variables of the cnn.
+    """
     # [pathway, image parts, channels, r, c, z]
-    channsForSegsPerPath = [ [] for i in xrange(cnn3dInst.getNumPathwaysThatRequireInput()) ] 
+    channsForSegsPerPath = [ None for i in xrange(cnn3dInst.getNumPathwaysThatRequireInput()) ] 
     # RCZ dims of input to primary pathway (NORMAL). Which should be the first one in .pathways.
     dimsOfPrimarySegment = cnn3dInst.pathways[0].getShapeOfInput()[2][2:] 
     
-    for segment_i in xrange(numSegsToExtract) :
-        rLowBoundary = sliceCoordsOfSegsToExtract[segment_i][0][0]; 
-        rFarBoundary = sliceCoordsOfSegsToExtract[segment_i][0][1]
-        cLowBoundary = sliceCoordsOfSegsToExtract[segment_i][1][0]; 
-        cFarBoundary = sliceCoordsOfSegsToExtract[segment_i][1][1]
-        zLowBoundary = sliceCoordsOfSegsToExtract[segment_i][2][0]; 
-        zFarBoundary = sliceCoordsOfSegsToExtract[segment_i][2][1]
-        # segment for primary pathway
-        channsForPrimaryPath = channelsOfImageNpArray[:,
-                                                                rLowBoundary:rFarBoundary+1,
-                                                                cLowBoundary:cFarBoundary+1,
-                                                                zLowBoundary:zFarBoundary+1
-                                                                ]
-        channsForSegsPerPath[0].append(channsForPrimaryPath)
+    sliceCoordsArray = np.asarray(sliceCoordsOfSegsToExtract, dtype="int32") # numSegs x 3 x 2
+    rLowBoundaries = sliceCoordsArray[:,0,0]; cLowBoundaries = sliceCoordsArray[:,1,0]; zLowBoundaries = sliceCoordsArray[:,2,0]
+    
+    # segments for primary pathway. View of all windows: [chans, r, c, z, segR, segC, segZ]. No copy is made here.
+    niiDims = channelsOfImageNpArray.shape[1:]
+    shapeOfWindowsView = (channelsOfImageNpArray.shape[0], 
+                          niiDims[0] - dimsOfPrimarySegment[0] + 1,
+                          niiDims[1] - dimsOfPrimarySegment[1] + 1,
+                          niiDims[2] - dimsOfPrimarySegment[2] + 1) + tuple(dimsOfPrimarySegment)
+    windowsOfImage = np.lib.stride_tricks.as_strided(channelsOfImageNpArray,
+                                                     shape=shapeOfWindowsView,
+                                                     strides=channelsOfImageNpArray.strides + \
+                                                             channelsOfImageNpArray.strides[1:])
+    # Fancy indexing gives [chans, segments, r, c, z]. Bring the segments first.
+    channsForPrimaryPath = windowsOfImage[:, rLowBoundaries, cLowBoundaries, zLowBoundaries]
+    channsForSegsPerPath[0] = np.ascontiguousarray(np.swapaxes(channsForPrimaryPath, 0, 1), dtype="float32")
+    
+    #Subsampled pathways
+    for pathway_i in xrange(len(cnn3dInst.pathways)) : # Except Normal 1st, cause that was done already.
+        if cnn3dInst.pathways[pathway_i].pType() == pt.FC or \
+            cnn3dInst.pathways[pathway_i].pType() == pt.NORM:
+            continue
+        subSamplingFactor = cnn3dInst.pathways[pathway_i].subsFactor()
+        subsampledImagePartDimensions = cnn3dInst.pathways[pathway_i].getShapeOfInput()[2][2:]
+        subsampledImageDimensions = channelsOfSubsampledImageNpArray[0].shape
+        indicesAndValidityPerAxis = [ getIndicesPerAxisOfSubsampledPartsForBatch(sliceCoordsArray[:,axis_i,0],
+                                                                                dimsOfPrimarySegment[axis_i],
+                                                                                recFieldCnn[axis_i],
+                                                                                subSamplingFactor[axis_i],
+                                                                                subsampledImagePartDimensions[axis_i],
+                                                                                subsampledImageDimensions[axis_i])
+                                     for axis_i in xrange(3) ]
+        [rIndices, rValid] = indicesAndValidityPerAxis[0]
+        [cIndices, cValid] = indicesAndValidityPerAxis[1]
+        [zIndices, zValid] = indicesAndValidityPerAxis[2]
+        # [chans, segments, r, c, z]
+        gatheredParts = channelsOfSubsampledImageNpArray[:,
+                                                        rIndices[:,:,np.newaxis,np.newaxis],
+                                                        cIndices[:,np.newaxis,:,np.newaxis],
+                                                        zIndices[:,np.newaxis,np.newaxis,:]]
+        validVoxels = rValid[:,:,np.newaxis,np.newaxis] * cValid[:,np.newaxis,:,np.newaxis] * \
+                        zValid[:,np.newaxis,np.newaxis,:]
+        intensityZeroPerChannel = np.asarray([ calculateTheZeroIntensityOf3dImage(channel) \
+                                                for channel in channelsOfSubsampledImageNpArray ], dtype="float32")
+        channsForThisSubsPath = np.where(validVoxels[np.newaxis],
+                                         gatheredParts.astype("float32"),
+                                         intensityZeroPerChannel[:,np.newaxis,np.newaxis,np.newaxis,np.newaxis])
+        channsForSegsPerPath[pathway_i] = np.ascontiguousarray(np.swapaxes(channsForThisSubsPath, 0, 1), dtype="float32")
         
-        #Subsampled pathways
-        for pathway_i in xrange(len(cnn3dInst.pathways)) : # Except Normal 1st, cause that was done already.
-            if cnn3dInst.pathways[pathway_i].pType() == pt.FC or \
-                cnn3dInst.pathways[pathway_i].pType() == pt.NORM:
-                continue
-            #the right hand values are placeholders in this case.
-            slicesCoordsOfSegmForPrimaryPW = [ [rLowBoundary, rFarBoundary-1], [cLowBoundary, cFarBoundary-1], \
-                                                   [zLowBoundary, zFarBoundary-1] ] 
-            channsForThisSubsPath = getImagePartFromSubsampledImageForTraining(  \
-                                                                dimsOfPrimarySegment=dimsOfPrimarySegment,
-                                                                recFieldCnn=recFieldCnn,
-                                                                subsampledImageChannels=channelsOfSubsampledImageNpArray,
-                                                                image_part_slices_coords=slicesCoordsOfSegmForPrimaryPW,
-                                                            subSamplingFactor=cnn3dInst.pathways[pathway_i].subsFactor(),
-                                    subsampledImagePartDimensions=cnn3dInst.pathways[pathway_i].getShapeOfInput()[2][2:]
-                                                                                        )
-            channsForSegsPerPath[pathway_i].append(channsForThisSubsPath)
-            
     return [channsForSegsPerPath]
 
 
@@ -784,24 +1000,6 @@ def extractDataOfASegmentFromImagesUsingSampledSliceCoords(
     return [ channelsForThisImagePartPerPathway, gtLabelsForTheCentralClassifiedPartOfThisImagePart ]
 
 
-def shuffleTheSegmentsForThisSubepoch(  imagePartsChannelsToLoadOnGpuForSubepochPerPathway,
-                                        gtLabelsForTheCentralPredictedPartOfSegmentsInGpUForSubepoch ) :
-    numOfPathwayWithInput = len(imagePartsChannelsToLoadOnGpuForSubepochPerPathway)
-    inputToZip = [ sublistForPathway for sublistForPathway in imagePartsChannelsToLoadOnGpuForSubepochPerPathway ]
-    inputToZip += [ gtLabelsForTheCentralPredictedPartOfSegmentsInGpUForSubepoch ]
-    
-    combined = zip(*inputToZip)
-    random.shuffle(combined)
-    shuffledInputListsToZip = zip(*combined)
-    
-    shuffledImagePartsChannelsToLoadOnGpuForSubepochPerPathway = [ sublistForPathway for sublistForPathway in \
-                                                                  shuffledInputListsToZip[:numOfPathwayWithInput] ]
-    shuffledGtLabelsForTheCentralPredictedPartOfSegmentsInGpUForSubepoch = shuffledInputListsToZip[numOfPathwayWithInput]
-    
-    return [shuffledImagePartsChannelsToLoadOnGpuForSubepochPerPathway, \
-                    shuffledGtLabelsForTheCentralPredictedPartOfSegmentsInGpUForSubepoch]
-
-
 def getNumberOfSegmentsToExtractPerCategoryFromEachSubject( numberOfImagePartsToLoadInGpuPerSubepoch,
                                                             percentOfSamplesPerCategoryToSample, # list with a percentage \
                                                             #for each type of category to sample
@@ -840,39 +1038,14 @@ def getNumberOfSegmentsToExtractPerCategoryFromEachSubject( numberOfImagePartsTo
             
     return arrayNumberOfSegmentsToExtractPerSamplingCategoryAndSubject
 
-#-----------The function that is executed in parallel with gpu training:----------------
-def getTheArraysOfImageChannelsAndLesionsToLoadToGpuForSubepoch(myLogger,
-                                                                training0orValidation1,
-                                                                cnn3d,
-                                                                maxNumSubjectsLoadedPerSubepoch,
-                                                                numberOfImagePartsToLoadInGpuPerSubepoch,
-                                                                samplingTypeInstance,
-                                                                
-                                                                fpathsToEachChannelOfEachPat,
-                                                                listOfFilepathsToGtLabelsOfEachPatTrainOrVal,
-                                                                
-                                                                providedRoiMaskBool,
-                                                                fpathsToRoiMaskOfEachPat,
-                                                                
-                                                                providedWeightMapsToSampleForEachCategory,
-                                                    forEachSamplingCategory_aListOfFilepathsToWeightMapsOfEachPat,
-                                                                
-                                                                useSameSubChannelsAsSingleScale,
-                                                                fpathsToEachSubsampledChannelOfEachPat,
-                                                                
-                                                                padInputImgs,
-                                                    smoothChannelsWithGaussFilteringStdsForNormalAndSubsampledImage,
-                            normAugmFlag,
-                                                                reflectImageWithHalfProbDuringTraining
-                                                                ):
-    start_getAllImageParts_time = time.clock()
-    
+def chooseSubjectsAndNumberOfSegmentsToExtractForSubepoch(myLogger,
+                                                        training0orValidation1,
+                                                        total_number_of_subjects,
+                                                        maxNumSubjectsLoadedPerSubepoch,
+                                                        numberOfImagePartsToLoadInGpuPerSubepoch,
+                                                        samplingTypeInstance) :
     trainingOrValidationString = "Training" if training0orValidation1 == 0 else "Validation"
     
-    myLogger.print3(":=:=:=:=:=:=:=:=: Starting to extract Segments from the images for next " + \
-                                            trainingOrValidationString + "... :=:=:=:=:=:=:=:=:")
-    
-    total_number_of_subjects = len(fpathsToEachChannelOfEachPat)
     randomIndicesList_for_gpu = get_random_subject_indices_to_load_on_GPU(\
                                                     total_number_of_subjects = total_number_of_subjects,
                                                     max_subjects_on_gpu_for_subepoch = maxNumSubjectsLoadedPerSubepoch,
@@ -883,24 +1056,63 @@ def getTheArraysOfImageChannelsAndLesionsToLoadToGpuForSubepoch(myLogger,
                     str(maxNumSubjectsLoadedPerSubepoch) + "] per subepoch.")
     myLogger.print3("Shuffled indices of subjects that were randomly chosen: "+str(randomIndicesList_for_gpu))
     
-    #This is x. Will end up with dimensions: numberOfPathwaysThatTakeInput, 
-    # partImagesLoadedPerSubepoch, channels, r,c,z, but flattened.
-    imagePartsChannelsToLoadOnGpuForSubepochPerPathway = [ [] for i in xrange(cnn3d.getNumPathwaysThatRequireInput()) ]
-    # Labels only for the central/predicted part of segments.
-    gtLabelsForTheCentralPredictedPartOfSegmentsInGpUForSubepoch = [] 
     #Can be different than maxNumSubjectsLoadedPerSubepoch, cause of available images number.
     numOfSubjectsLoadingThisSubepochForSampling = len(randomIndicesList_for_gpu) 
+    percentOfSamplesPerCategoryToSample = samplingTypeInstance.getPercentOfSamplesPerCategoryToSample()
+    arrayNumberOfSegmentsToExtractPerSamplingCategoryAndSubject = \
+        getNumberOfSegmentsToExtractPerCategoryFromEachSubject(numberOfImagePartsToLoadInGpuPerSubepoch,
+                                                                percentOfSamplesPerCategoryToSample,
+                                                               numOfSubjectsLoadingThisSubepochForSampling)
+    return [randomIndicesList_for_gpu, arrayNumberOfSegmentsToExtractPerSamplingCategoryAndSubject]
+
+def extractSegmentsFromSubjectsForSubepoch(myLogger,
+                                            training0orValidation1,
+                                            cnn3d,
+                                            subjectIndicesToLoad, # Indices in the user-defined list of subjects.
+                                            # [cats x subjects]. Column i is for subjectIndicesToLoad[i].
+                                            arrayNumberOfSegmentsToExtractPerSamplingCategoryAndSubject,
+                                            samplingTypeInstance,
+                                            
+                                            fpathsToEachChannelOfEachPat,
+                                            listOfFilepathsToGtLabelsOfEachPatTrainOrVal,
+                                            
+                                            providedRoiMaskBool,
+                                            fpathsToRoiMaskOfEachPat,
+                                            
+                                            providedWeightMapsToSampleForEachCategory,
+                                            forEachSamplingCategory_aListOfFilepathsToWeightMapsOfEachPat,
+                                            
+                                            useSameSubChannelsAsSingleScale,
+                                            fpathsToEachSubsampledChannelOfEachPat,
+                                            
+                                            padInputImgs,
+                                            smoothChannelsWithGaussFilteringStdsForNormalAndSubsampledImage,
+                                            normAugmFlag,
+                                            reflectImageWithHalfProbDuringTraining,
+                                            volumeCache, # PreprocessedVolumeCache, or None.
+                                            cropVolumesToRoi, # Crop the volumes to the ROI's box plus a margin.
+                                            
+                                            arraysToFill, # From getShapesOfArraysOfSubepoch(). Labels last.
+                                            rowOffset
+                                            ):
+    # Loads the given subjects and extracts from each the given number of segments per sampling category.
+    # The segments are written in place in the rows of arraysToFill, starting at rowOffset, in the order they \
+    # are extracted. Returns the number of segments written.
+    trainingOrValidationString = "Training" if training0orValidation1 == 0 else "Validation"
+    
+    numberOfPathwaysThatRequireInput = cnn3d.getNumPathwaysThatRequireInput()
+    numberOfRowsInArrays = len(arraysToFill[-1])
+    rowToWrite = rowOffset
+    numOfSubjectsLoadingThisSubepochForSampling = len(subjectIndicesToLoad) 
     
     dimsOfPrimeSegmentRcz=cnn3d.pathways[0].getShapeOfInput()[training0orValidation1][2:]
+    #Segments are only centred within the ROI. The margin keeps all the voxels their pathways may take as input.
+    marginToCropAroundRoi = getMarginOfInputsAroundCentralVoxelOfSegments(cnn3d, training0orValidation1) if \
+                                (cropVolumesToRoi and providedRoiMaskBool) else None
     
     # This is to separate each sampling category (fore/background, uniform, full-image, weighted-classes)
     stringsPerCategoryToSample = samplingTypeInstance.getStringsPerCategoryToSample()
     numberOfCategoriesToSample = samplingTypeInstance.getNumberOfCategoriesToSample()
-    percentOfSamplesPerCategoryToSample = samplingTypeInstance.getPercentOfSamplesPerCategoryToSample()
-    arrayNumberOfSegmentsToExtractPerSamplingCategoryAndSubject = \
-        getNumberOfSegmentsToExtractPerCategoryFromEachSubject(numberOfImagePartsToLoadInGpuPerSubepoch,
-                                                                percentOfSamplesPerCategoryToSample,
-                                                               numOfSubjectsLoadingThisSubepochForSampling)
     numOfInpChannelsForPrimaryPath = len(fpathsToEachChannelOfEachPat[0])
     
     myLogger.print3("SAMPLING: Starting iterations to extract Segments from each subject for next " + \
@@ -917,13 +1129,14 @@ def getTheArraysOfImageChannelsAndLesionsToLoadToGpuForSubepoch(myLogger,
         sampleWeightMaps, #can be returned "placeholderNothing" if it's \
         # testing phase or not "provided weighted maps". In this case, I will sample from GT/ROI.
         allSubsamChannelsOfPatient,  #a nparray(channels,dim0,dim1,dim2)
-        paddingPerAxes #( (padLeftR, padRightR), (padLeftC,padRightC), (padLeftZ,padRightZ)). \
+        paddingPerAxes, #( (padLeftR, padRightR), (padLeftC,padRightC), (padLeftZ,padRightZ)). \
         #All 0s when no padding.
+        reflectFlags # Per axis, whether the images were reflected.
         ] = actual_load_patient_imgs(
                                                 myLogger,
                                                 training0orValidation1,
                                                 
-                                                randomIndicesList_for_gpu[index_for_vector_with_images_on_gpu],
+                                                subjectIndicesToLoad[index_for_vector_with_images_on_gpu],
                                                 
                                                 fpathsToEachChannelOfEachPat,
                                 # If this getTheArr function is called (training), gtLabels should already been provided.
@@ -951,10 +1164,12 @@ def getTheArraysOfImageChannelsAndLesionsToLoadToGpuForSubepoch(myLogger,
                                     smoothChannelsWithGaussFilteringStdsForNormalAndSubsampledImage,
                         normAugmFlag=\
                             normAugmFlag,
-                                                reflectImageWithHalfProb = reflectImageWithHalfProbDuringTraining
+                                                reflectImageWithHalfProb = reflectImageWithHalfProbDuringTraining,
+                                                volumeCache = volumeCache,
+                                                marginToCropAroundRoi = marginToCropAroundRoi
                                                 )
         myLogger.print3("DEBUG: Index of this case in the original user-defined list of subjects: " + \
-                        str(randomIndicesList_for_gpu[index_for_vector_with_images_on_gpu]))
+                        str(subjectIndicesToLoad[index_for_vector_with_images_on_gpu]))
         myLogger.print3("Images for subject loaded.")
         ########################
         #For normalization-augmentation: Get channels' stds if needed:
@@ -971,8 +1186,8 @@ def getTheArraysOfImageChannelsAndLesionsToLoadToGpuForSubepoch(myLogger,
         #######################
         
         dimensionsOfImageChannel = allChannelsOfPatientInNpArray[0].shape
-        finalWeightMapsToSampleFromPerCategoryForSubject = \
-            samplingTypeInstance.logicDecidingAndGivingFinalSamplingMapsForEachCategory(
+        def getFinalWeightMapsToSampleFromPerCategoryForSubject() :
+            return samplingTypeInstance.logicDecidingAndGivingFinalSamplingMapsForEachCategory(
                                                         providedWeightMapsToSampleForEachCategory,
                                                         sampleWeightMaps,
                                                                                                 
@@ -984,6 +1199,24 @@ def getTheArraysOfImageChannelsAndLesionsToLoadToGpuForSubepoch(myLogger,
                                                                                                 roiMask,
                                                                                                 
                                                                                             dimensionsOfImageChannel)
+        subjectIndex = subjectIndicesToLoad[index_for_vector_with_images_on_gpu]
+        filepathsToOtherMapsOfSubject = [ fpathsToRoiMaskOfEachPat[subjectIndex] ] if providedRoiMaskBool else []
+        if providedWeightMapsToSampleForEachCategory :
+            filepathsToOtherMapsOfSubject += [ filepathsToWeightMapsOfEachPat[subjectIndex] for \
+                                                filepathsToWeightMapsOfEachPat in \
+                                                    forEachSamplingCategory_aListOfFilepathsToWeightMapsOfEachPat ]
+        indicesForSamplingPerCategory = getIndicesForSamplingCentralVoxelsOfSubject(
+                                                        volumeCache,
+                                                        samplingTypeInstance,
+                                                        getFinalWeightMapsToSampleFromPerCategoryForSubject,
+                                                        dimsOfPrimeSegmentRcz,
+                                                        listOfFilepathsToGtLabelsOfEachPatTrainOrVal[subjectIndex],
+                                                        filepathsToOtherMapsOfSubject,
+                                                        [ padInputImgs,
+                                                          [ int(dim) for dim in cnn3d.recFieldCnn ] if padInputImgs else None,
+                                                          [ int(flag) for flag in reflectFlags ],
+                                                          marginToCropAroundRoi ]
+                                                        )
         #THE number of imageParts in memory per subepoch does not need to be constant. The batch_size does.
         #But I could have less batches per subepoch if some images dont have lesions I guess. Anyway.
         
@@ -991,12 +1224,12 @@ def getTheArraysOfImageChannelsAndLesionsToLoadToGpuForSubepoch(myLogger,
             catString = stringsPerCategoryToSample[cat_i]
             numOfSegmsToExtractForThisCatFromThisSubject = \
                 arrayNumberOfSegmentsToExtractPerSamplingCategoryAndSubject[cat_i][index_for_vector_with_images_on_gpu]
-            finalWeightMapToSampleFromForThisCat = finalWeightMapsToSampleFromPerCategoryForSubject[cat_i]
+            indexForSamplingThisCat = indicesForSamplingPerCategory[cat_i]
             
             # Check if the weight map is fully-zeros. In this case, don't call the sampling function, just continue.
             # Note that this way, the data loaded on GPU will not be as much as I initially wanted. Thus calculate \
             # number-of-batches from this actual number of extracted segments.
-            if np.sum(finalWeightMapToSampleFromForThisCat>0) == 0 :
+            if len(indexForSamplingThisCat) == 0 :
                 myLogger.print3("WARN: The sampling mask/map was found just zeros! No [" + catString + \
                                 "] image parts were sampled for this subject!")
                 continue
@@ -1009,10 +1242,14 @@ def getTheArraysOfImageChannelsAndLesionsToLoadToGpuForSubepoch(myLogger,
                                                 dimsOfSegmentRcz = dimsOfPrimeSegmentRcz,
                                 dimensionsOfImageChannel = dimensionsOfImageChannel, #image dimensions for \
                                 # this subject. All images should have the same.
-                                                weightMapToSampleFrom=finalWeightMapToSampleFromForThisCat)
+                                                weightMapToSampleFrom=None,
+                                                indexForSampling=indexForSamplingThisCat)
             myLogger.print3("Finished sampling segments of Category [" + catString + "]. Number sampled: " + \
                                                                     str( len(imagePartsSampled[0][0]) ) )
             
+            if rowToWrite + len(imagePartsSampled[0][0]) > numberOfRowsInArrays :
+                myLogger.print3("ERROR: More segments were sampled than the rows of the arrays for the subepoch [" + \
+                                str(numberOfRowsInArrays) + "]. This should not happen. Exiting!"); exit(1)
             # Use the just sampled coordinates of slices to actually extract the segments (data) 
             # from the subject's images. 
             for image_part_i in xrange(len(imagePartsSampled[0][0])) :
@@ -1038,31 +1275,271 @@ def getTheArraysOfImageChannelsAndLesionsToLoadToGpuForSubepoch(myLogger,
                                 normAugmFlag,
                                                                         stdsOfTheChannsOfThisImage
                                                                         )
-                for pathway_i in xrange(cnn3d.getNumPathwaysThatRequireInput()) :
-                    imagePartsChannelsToLoadOnGpuForSubepochPerPathway[pathway_i].append(\
-                                                                    channelsForThisImagePartPerPathway[pathway_i])
-                gtLabelsForTheCentralPredictedPartOfSegmentsInGpUForSubepoch.append(\
-                                                                    gtLabelsForTheCentralClassifiedPartOfThisImagePart)
+                for pathway_i in xrange(numberOfPathwaysThatRequireInput) :
+                    arraysToFill[pathway_i][rowToWrite] = channelsForThisImagePartPerPathway[pathway_i]
+                arraysToFill[-1][rowToWrite] = gtLabelsForTheCentralClassifiedPartOfThisImagePart
+                rowToWrite += 1
                 
+    return rowToWrite - rowOffset
+
+#-----------The function that extracts the segments of a subepoch sequentially:----------------
+def getTheArraysOfImageChannelsAndLesionsToLoadToGpuForSubepoch(myLogger,
+                                                                training0orValidation1,
+                                                                cnn3d,
+                                                                maxNumSubjectsLoadedPerSubepoch,
+                                                                numberOfImagePartsToLoadInGpuPerSubepoch,
+                                                                samplingTypeInstance,
+                                                                
+                                                                fpathsToEachChannelOfEachPat,
+                                                                listOfFilepathsToGtLabelsOfEachPatTrainOrVal,
+                                                                
+                                                                providedRoiMaskBool,
+                                                                fpathsToRoiMaskOfEachPat,
+                                                                
+                                                                providedWeightMapsToSampleForEachCategory,
+                                                    forEachSamplingCategory_aListOfFilepathsToWeightMapsOfEachPat,
+                                                                
+                                                                useSameSubChannelsAsSingleScale,
+                                                                fpathsToEachSubsampledChannelOfEachPat,
+                                                                
+                                                                padInputImgs,
+                                                    smoothChannelsWithGaussFilteringStdsForNormalAndSubsampledImage,
+                            normAugmFlag,
+                                                                reflectImageWithHalfProbDuringTraining,
+                                                                volumeCache=None,
+                                                                cropVolumesToRoi=False
+                                                                ):
+    start_getAllImageParts_time = time.time()
+    
+    trainingOrValidationString = "Training" if training0orValidation1 == 0 else "Validation"
+    
+    myLogger.print3(":=:=:=:=:=:=:=:=: Starting to extract Segments from the images for next " + \
+                                            trainingOrValidationString + "... :=:=:=:=:=:=:=:=:")
+    
+    [randomIndicesList_for_gpu,
+    arrayNumberOfSegmentsToExtractPerSamplingCategoryAndSubject] = \
+        chooseSubjectsAndNumberOfSegmentsToExtractForSubepoch(myLogger,
+                                                            training0orValidation1,
+                                                            len(fpathsToEachChannelOfEachPat),
+                                                            maxNumSubjectsLoadedPerSubepoch,
+                                                            numberOfImagePartsToLoadInGpuPerSubepoch,
+                                                            samplingTypeInstance)
+    
+    #Preallocated contiguous float32 arrays, where the segments are written in place: \
+    # One [segments, channels, r, c, z] per pathway that takes input, and the labels of the central/predicted part last.
+    arraysOfSegmentsAndLabels = allocateFloat32Arrays( getShapesOfArraysOfSubepoch(cnn3d,
+                                                                                training0orValidation1,
+                                                                                numberOfImagePartsToLoadInGpuPerSubepoch) )
+    with stageTimers.timeStage("sampling") :
+        numberOfSegmentsExtracted = \
+            extractSegmentsFromSubjectsForSubepoch(myLogger,
+                                                training0orValidation1,
+                                                cnn3d,
+                                                randomIndicesList_for_gpu,
+                                                arrayNumberOfSegmentsToExtractPerSamplingCategoryAndSubject,
+                                                samplingTypeInstance,
+                                                fpathsToEachChannelOfEachPat,
+                                                listOfFilepathsToGtLabelsOfEachPatTrainOrVal,
+                                                providedRoiMaskBool,
+                                                fpathsToRoiMaskOfEachPat,
+                                                providedWeightMapsToSampleForEachCategory,
+                                                forEachSamplingCategory_aListOfFilepathsToWeightMapsOfEachPat,
+                                                useSameSubChannelsAsSingleScale,
+                                                fpathsToEachSubsampledChannelOfEachPat,
+                                                padInputImgs,
+                                                smoothChannelsWithGaussFilteringStdsForNormalAndSubsampledImage,
+                                                normAugmFlag,
+                                                reflectImageWithHalfProbDuringTraining,
+                                                volumeCache,
+                                                cropVolumesToRoi,
+                                                arraysOfSegmentsAndLabels,
+                                                0)
+    #Fewer than requested, if some sampling maps were empty.
+    arraysOfSegmentsAndLabels = [ array[:numberOfSegmentsExtracted] for array in arraysOfSegmentsAndLabels ]
+    
     #I need to shuffle them, together imageParts and lesionParts!
-    [imagePartsChannelsToLoadOnGpuForSubepochPerPathway,
-    gtLabelsForTheCentralPredictedPartOfSegmentsInGpUForSubepoch ] = \
-        shuffleTheSegmentsForThisSubepoch( imagePartsChannelsToLoadOnGpuForSubepochPerPathway,
-                                gtLabelsForTheCentralPredictedPartOfSegmentsInGpUForSubepoch )
+    shuffleRowsOfArraysInPlace(arraysOfSegmentsAndLabels)
     
-    end_getAllImageParts_time = time.clock()
+    end_getAllImageParts_time = time.time()
     myLogger.print3("TIMING: Extracting all the Segments for next " + trainingOrValidationString + " took time: "+\
                     str(end_getAllImageParts_time-start_getAllImageParts_time)+"(s)")
     
     myLogger.print3(":=:=:=:=:=:=:=:=: Finished extracting Segments from the images for next " + \
                     trainingOrValidationString + ". :=:=:=:=:=:=:=:=:")
     
-    imagePartsChannelsToLoadOnGpuForSubepochPerPathwayArrays = [ np.asarray(imPartsForPathwayi, dtype="float32") for \
-                                            imPartsForPathwayi in imagePartsChannelsToLoadOnGpuForSubepochPerPathway ]
-    return [imagePartsChannelsToLoadOnGpuForSubepochPerPathwayArrays,
-            np.asarray(gtLabelsForTheCentralPredictedPartOfSegmentsInGpUForSubepoch, dtype="float32") ]
+    return [arraysOfSegmentsAndLabels[:-1], arraysOfSegmentsAndLabels[-1]]
+    
+    
+#-----------Sampling with the SamplerPool, in parallel with gpu training:----------------
+def getShapesOfArraysOfSubepoch(cnn3d, training0orValidation1, numberOfSegments) :
+    # Shapes of the arrays with the segments of each pathway, followed by the shape of the array with their labels.
+    listOfShapes = []
+    for pathway_i in xrange(cnn3d.getNumPathwaysThatRequireInput()) :
+        listOfShapes.append( [numberOfSegments] + list(cnn3d.pathways[pathway_i].getShapeOfInput()[training0orValidation1][1:]) )
+    listOfShapes.append( [numberOfSegments] + list(cnn3d.finalTargetLayer_outputShapeTrainValTest[training0orValidation1][2:]) )
+    return listOfShapes
+
+def fillArraysWithSegmentsFromShardOfSubjects(argsForSubepochSampling, # As given to getTheArrays...ForSubepoch()
+                                            subjectIndicesOfShard,
+                                            arrayNumberOfSegmentsToExtractPerSamplingCategoryAndSubjectOfShard,
+                                            arraysToFill, # Views of a slot of the SamplerPool.
+                                            rowOffset) :
+    # Runs in the processes of the SamplerPool. Writes the segments of the shard in the arrays, starting at rowOffset.
+    [myLogger, training0orValidation1, cnn3d, maxNumSubjectsLoadedPerSubepoch, numberOfImagePartsToLoadInGpuPerSubepoch,
+    samplingTypeInstance] = argsForSubepochSampling[:6]
+    
+    return extractSegmentsFromSubjectsForSubepoch(myLogger,
+                                                training0orValidation1,
+                                                cnn3d,
+                                                subjectIndicesOfShard,
+                                                arrayNumberOfSegmentsToExtractPerSamplingCategoryAndSubjectOfShard,
+                                                samplingTypeInstance,
+                                                *(list(argsForSubepochSampling[6:]) + [arraysToFill, rowOffset]))
+
+def submitSamplingOfSubepochToSamplerPool(samplerPool, argsForSubepochSampling) :
+    # Chooses the subjects of the subepoch here, so that the rng of the main process decides them, and shards \
+    # them to the processes of the pool. Each shard writes its segments at its own rows of the pool's slot.
+    [myLogger, training0orValidation1, cnn3d, maxNumSubjectsLoadedPerSubepoch, numberOfImagePartsToLoadInGpuPerSubepoch,
+    samplingTypeInstance, fpathsToEachChannelOfEachPat] = argsForSubepochSampling[:7]
+    trainingOrValidationString = "Training" if training0orValidation1 == 0 else "Validation"
+    
+    [randomIndicesList_for_gpu,
+    arrayNumberOfSegmentsToExtractPerSamplingCategoryAndSubject] = \
+        chooseSubjectsAndNumberOfSegmentsToExtractForSubepoch(myLogger,
+                                                            training0orValidation1,
+                                                            len(fpathsToEachChannelOfEachPat),
+                                                            maxNumSubjectsLoadedPerSubepoch,
+                                                            numberOfImagePartsToLoadInGpuPerSubepoch,
+                                                            samplingTypeInstance)
+    numberOfSegmentsPerSubject = np.sum(arrayNumberOfSegmentsToExtractPerSamplingCategoryAndSubject, axis=0)
+    rowOffsetPerSubject = np.cumsum(numberOfSegmentsPerSubject) - numberOfSegmentsPerSubject
+    
+    subjectIndicesPerShard = []
+    numberOfSegmentsPerCategoryAndSubjectPerShard = []
+    rowOffsetPerShard = []
+    for positionsOfSubjectsInShard in np.array_split(np.arange(len(randomIndicesList_for_gpu)), samplerPool.getNumberOfWorkers()) :
+        if len(positionsOfSubjectsInShard) == 0 :
+            continue
+        subjectIndicesPerShard.append( [ randomIndicesList_for_gpu[pos] for pos in positionsOfSubjectsInShard ] )
+        numberOfSegmentsPerCategoryAndSubjectPerShard.append( \
+                                arrayNumberOfSegmentsToExtractPerSamplingCategoryAndSubject[:, positionsOfSubjectsInShard] )
+        rowOffsetPerShard.append( int(rowOffsetPerSubject[positionsOfSubjectsInShard[0]]) )
+        
+    samplerPool.submitJob(training0orValidation1,
+                        getShapesOfArraysOfSubepoch(cnn3d, training0orValidation1, int(np.sum(numberOfSegmentsPerSubject))),
+                        subjectIndicesPerShard,
+                        numberOfSegmentsPerCategoryAndSubjectPerShard,
+                        rowOffsetPerShard)
+    myLogger.print3("PARALLEL: Submitted the sampling job for a next " + trainingOrValidationString + ", in [" + \
+                    str(len(subjectIndicesPerShard)) + "] shards of subjects. Sampling jobs pending: " + \
+                    str(samplerPool.getNumberOfPendingJobs()))
+    
+def getArraysOfSegmentsForNextSubepoch(myLogger,
+                                        training0orValidation1,
+                                        samplerPool, # None to extract the segments sequentially, right now.
+                                        scheduleOfSamplingJobs, # Types (0/1) of the jobs to submit next. Consumed.
+                                        argsForSubepochSamplingPerTypeOfJob) :
+    # Returns [segmentsPerPathway, labelsOfSegments], shuffled float32 arrays. If they come from the samplerPool, \
+    # they are in its shared memory, valid until samplerPool.releaseSlotsOfReturnedResults().
+    if samplerPool == None :
+        return getTheArraysOfImageChannelsAndLesionsToLoadToGpuForSubepoch(
+                                                    *argsForSubepochSamplingPerTypeOfJob[training0orValidation1] )
     
+    trainingOrValidationString = "Training" if training0orValidation1 == 0 else "Validation"
+    start_waitForSampling_time = time.time()
+    with stageTimers.timeStage("waitingForSampling") :
+        [typeOfJob, listOfArrays] = samplerPool.getResultOfOldestJob()
+    end_waitForSampling_time = time.time()
+    if typeOfJob <> training0orValidation1 :
+        myLogger.print3("ERROR: Expected the segments for " + trainingOrValidationString + " from the SamplerPool, "+\
+                        "but the oldest pending job was of the other type. This should not happen. Exiting!"); exit(1)
+    myLogger.print3("TIMING: Waited for the SamplerPool to finish extracting the Segments for " + \
+                    trainingOrValidationString + ": " + str(end_waitForSampling_time-start_waitForSampling_time) + "(s)")
+    # Its slot was freed. Keep the pool busy with the next job of the schedule.
+    if len(scheduleOfSamplingJobs) > 0 :
+        submitSamplingOfSubepochToSamplerPool(samplerPool, argsForSubepochSamplingPerTypeOfJob[scheduleOfSamplingJobs.pop(0)])
+    return [listOfArrays[:-1], listOfArrays[-1]]
+    
+#-----------Streaming the segments to the cnn batch by batch:----------------
+# The rows of the subjects are given to the stream in groups of this many subjects, so that the batches, drawn at \
+# random from the rows given so far, mix segments of several subjects, as the shuffled arrays of the whole subepoch do.
+NUMBER_OF_SUBJECTS_PER_ADDITION_TO_STREAM = 4
+
+def extractSegmentsOfSubjectsInBackgroundThread(argsForSubepochSampling, # As given to getTheArrays...ForSubepoch()
+                                                subjectIndicesToLoad,
+                                                arrayNumberOfSegmentsToExtractPerSamplingCategoryAndSubject,
+                                                arraysToFill,
+                                                streamOfSegments) :
+    # Target of a thread. Extracts the segments subject by subject, giving the rows to the stream after each \
+    # group of NUMBER_OF_SUBJECTS_PER_ADDITION_TO_STREAM subjects (and after the last).
+    [myLogger, training0orValidation1, cnn3d, maxNumSubjectsLoadedPerSubepoch, numberOfImagePartsToLoadInGpuPerSubepoch,
+    samplingTypeInstance] = argsForSubepochSampling[:6]
+    try :
+        rowOffset = 0
+        numberOfRowsNotGivenToStream = 0
+        for subject_i in xrange(len(subjectIndicesToLoad)) :
+            numberOfSegmentsWritten = extractSegmentsFromSubjectsForSubepoch(myLogger,
+                                            training0orValidation1,
+                                            cnn3d,
+                                            subjectIndicesToLoad[subject_i : subject_i+1],
+                                            arrayNumberOfSegmentsToExtractPerSamplingCategoryAndSubject[:, subject_i : subject_i+1],
+                                            samplingTypeInstance,
+                                            *(list(argsForSubepochSampling[6:]) + [arraysToFill, rowOffset]))
+            rowOffset += numberOfSegmentsWritten
+            numberOfRowsNotGivenToStream += numberOfSegmentsWritten
+            if (subject_i + 1) % NUMBER_OF_SUBJECTS_PER_ADDITION_TO_STREAM == 0 or subject_i == len(subjectIndicesToLoad) - 1 :
+                streamOfSegments.addWrittenRows(numberOfRowsNotGivenToStream)
+                numberOfRowsNotGivenToStream = 0
+        streamOfSegments.finish()
+    except BaseException : # Even the SystemExit of exit(1). Raised in the main thread by the stream.
+        streamOfSegments.finish(sys.exc_info())
+        
+def getStreamOfSegmentsForNextSubepoch(myLogger,
+                                        training0orValidation1,
+                                        samplerPool,
+                                        scheduleOfSamplingJobs,
+                                        argsForSubepochSamplingPerTypeOfJob,
+                                        batchSize) :
+    # With the samplerPool, the segments were extracted in advance, and they are all in the stream. \
+    # Otherwise they are extracted by a background thread, and the cnn starts as soon as a batch is ready.
+    if samplerPool <> None :
+        [channsOfSegmentsPerPathway,
+        labelsOfSegments] = getArraysOfSegmentsForNextSubepoch(myLogger,
+                                                            training0orValidation1,
+                                                            samplerPool,
+                                                            scheduleOfSamplingJobs,
+                                                            argsForSubepochSamplingPerTypeOfJob)
+        return StreamOfSegments(channsOfSegmentsPerPathway + [labelsOfSegments], batchSize, len(labelsOfSegments))
+    
+    argsForSubepochSampling = argsForSubepochSamplingPerTypeOfJob[training0orValidation1]
+    [myLogger, training0orValidation1, cnn3d, maxNumSubjectsLoadedPerSubepoch, numberOfImagePartsToLoadInGpuPerSubepoch,
+    samplingTypeInstance, fpathsToEachChannelOfEachPat] = argsForSubepochSampling[:7]
+    trainingOrValidationString = "Training" if training0orValidation1 == 0 else "Validation"
+    [randomIndicesList_for_gpu,
+    arrayNumberOfSegmentsToExtractPerSamplingCategoryAndSubject] = \
+        chooseSubjectsAndNumberOfSegmentsToExtractForSubepoch(myLogger,
+                                                            training0orValidation1,
+                                                            len(fpathsToEachChannelOfEachPat),
+                                                            maxNumSubjectsLoadedPerSubepoch,
+                                                            numberOfImagePartsToLoadInGpuPerSubepoch,
+                                                            samplingTypeInstance)
+    arraysOfSegmentsAndLabels = allocateFloat32Arrays( getShapesOfArraysOfSubepoch(cnn3d,
+                                                training0orValidation1,
+                                                int(np.sum(arrayNumberOfSegmentsToExtractPerSamplingCategoryAndSubject))) )
+    streamOfSegments = StreamOfSegments(arraysOfSegmentsAndLabels, batchSize, 0)
+    threadExtractingSegments = threading.Thread(target=extractSegmentsOfSubjectsInBackgroundThread,
+                                                args=(argsForSubepochSampling,
+                                                    randomIndicesList_for_gpu,
+                                                    arrayNumberOfSegmentsToExtractPerSamplingCategoryAndSubject,
+                                                    arraysOfSegmentsAndLabels,
+                                                    streamOfSegments))
+    threadExtractingSegments.daemon = True
+    threadExtractingSegments.start()
+    myLogger.print3("STREAMING: Extracting the Segments for " + trainingOrValidationString + " in a background thread. "+\
+                    "Batches are drawn from the Segments extracted so far.")
+    return streamOfSegments
     
+
 #A main routine in do_training, that runs for every batch of validation and training.
 def doTrainOrValidationOnBatchesAndReturnMeanAccuraciesOfSubepoch(myLogger,
                                                                 train0orValidation1,
@@ -1071,8 +1548,11 @@ def doTrainOrValidationOnBatchesAndReturnMeanAccuraciesOfSubepoch(myLogger,
                                                                 cnn3dInst,
                                                                 vectorWithWeightsOfTheClassesForCostFunctionOfTraining,
                                                                 subepoch,
-                                                                accuracyMonitorForEpoch) :
+                                                                accuracyMonitorForEpoch,
+                                                                streamOfSegments=None) :
     """
+    If streamOfSegments is given, each batch is taken from it and loaded in the next slot of the cnn. \
+    num_batches is then an upper bound, as the stream may end sooner.
     Returned array is of dimensions [NumberOfClasses x 6]
     For each class: [meanAccuracyOfSubepoch, meanAccuracyOnPositivesOfSubepoch, meanAccuracyOnNegativesOfSubepoch, \
     meanDiceOfSubepoch, meanCostOfSubepoch]
@@ -1090,17 +1570,28 @@ def doTrainOrValidationOnBatchesAndReturnMeanAccuraciesOfSubepoch(myLogger,
         if  batch_i%printProgressStep == 0 :
             myLogger.print3( trainedOrValidatedString + " on "+str(batch_i)+"/"+str(num_batches)+\
                              " of the batches for this subepoch...")
+        indexOfBatch = batch_i
+        if streamOfSegments <> None :
+            with stageTimers.timeStage("waitingForSampling") :
+                batchOfSegmentsAndLabels = streamOfSegments.getNextBatch()
+            if batchOfSegmentsAndLabels == None : # Fewer segments were extracted than requested.
+                break
+            with stageTimers.timeStage("hostToDevice") :
+                indexOfBatch = cnn3dInst.loadBatchInNextSlot(train0orValidation1, batchOfSegmentsAndLabels)
         if train0orValidation1==0 : #training
-            listWithCostMeanErrorAndRpRnTpTnForEachClassFromTraining = cnn3dInst.cnnTrainModel(batch_i, \
+            # The function also updates the rolling average of BatchNorm for inference, so this includes it.
+            with stageTimers.timeStage("trainStep") :
+                listWithCostMeanErrorAndRpRnTpTnForEachClassFromTraining = cnn3dInst.cnnTrainModel(indexOfBatch, \
                                                                 vectorWithWeightsOfTheClassesForCostFunctionOfTraining)
-            #I should put this inside the 3dCNN.
-            cnn3dInst.updateTheMatricesOfTheLayersWithTheLastMusAndVarsForTheMovingAverageOfTheBatchNormInference() 
+            stageTimers.addToCounter("batchesTrained")
             
             costOfThisBatch = listWithCostMeanErrorAndRpRnTpTnForEachClassFromTraining[0]
             listWithNumberOfRpRnPpPnForEachClass = listWithCostMeanErrorAndRpRnTpTnForEachClassFromTraining[1:]
             
         else : #validation
-            listWithMeanErrorAndRpRnTpTnForEachClassFromValidation = cnn3dInst.cnnValidateModel(batch_i)
+            with stageTimers.timeStage("validationStep") :
+                listWithMeanErrorAndRpRnTpTnForEachClassFromValidation = cnn3dInst.cnnValidateModel(indexOfBatch)
+            stageTimers.addToCounter("batchesValidated")
             costOfThisBatch = 999 #placeholder in case of validation.
             listWithNumberOfRpRnPpPnForEachClass = listWithMeanErrorAndRpRnTpTnForEachClassFromValidation[:]
             
@@ -1117,7 +1608,7 @@ def doTrainOrValidationOnBatchesAndReturnMeanAccuraciesOfSubepoch(myLogger,
     # In case of validation, meanCostOfSubepoch is just a placeholder. Cause this does not get calculated and \
     # reported in this case.
     meanCostOfSubepoch = accuracyMonitorForEpoch.NA_PATTERN if (train0orValidation1 == 1) else \
-                                                sum(costsOfBatches) / float(num_batches)
+                                                sum(costsOfBatches) / float(len(costsOfBatches))
     # This function does NOT flip the class-0 background to foreground!
     accuracyMonitorForEpoch.updateMonitorAccuraciesWithNewSubepochEntries(meanCostOfSubepoch, \
                                                                           arrayWithNumbersOfPerClassRpRnTpTnInSubepoch)
@@ -1199,20 +1690,35 @@ def do_training(myLogger,
                 saveIndividualFmImgsForV=False,
                 saveMDImgWithAllFms=False,
                 allFmsIdxForV="placeholder",
-                namesToGiveToFmVisualisationsIfSaving="placeholder"
+                namesToGiveToFmVisualisationsIfSaving="placeholder",
+                
+                #--------Sampling in parallel---------
+                numberOfSamplingProcesses=1, # 0 to extract the segments sequentially, without overlap with training.
+                numberOfSubepochsToPrefetch=1,
+                
+                #--------Cache---------
+                preprocessedVolumeCache=None, # PreprocessedVolumeCache for the loaded volumes, or None.
+                
+                #--------Loading---------
+                cropVolumesToRoi=False, # Crop the volumes to the bounding box of the ROI, plus the margin the cnn needs.
+                
+                #--------Streaming---------
+                numberOfBatchSlotsForStreaming=0, # If > 0, segments go to the device batch by batch, in a ring of that many.
+                
+                #--------Memory---------
+                storagePrecisionOfVolumesForInference="float32", # Of the full inference on the validation subjects.
+                
+                #--------Profiling---------
+                epochAndSubepochToProfile=None, # [epoch, subepoch] to profile, or None.
+                profilerOfSubepoch="chromeTrace" # One of stageTimers.PROFILERS.
                 ):
     
-    start_training_time = time.clock()
+    start_training_time = time.time()
     
     # Used because I cannot pass cnn3dInst to the sampling function.
     #This is because the parallel process then loads theano again. And creates problems in the GPU when cnmem is used.
     cnn3dWrapper = CnnWrapperForSampling(cnn3dInst) 
     
-    #---------To run PARALLEL the extraction of parts for the next subepoch---
-    ppservers = () # tuple of all parallel python servers to connect with
-    # Creates jobserver with automatically detected number of workers
-    job_server = pp.Server(ncpus=1, ppservers=ppservers) 
-    
     tupleWithParametersForTraining = (myLogger,
                                     0,
                                     cnn3dWrapper,
@@ -1238,7 +1744,9 @@ def do_training(myLogger,
                                     padInputImgs,
                                     smoothChannelsWithGaussFilteringStdsForNormalAndSubsampledImage,
                             normAugmFlag,
-                                    reflectImageWithHalfProbDuringTraining
+                                    reflectImageWithHalfProbDuringTraining,
+                                    preprocessedVolumeCache,
+                                    cropVolumesToRoi
                                     )
     tupleWithParametersForValidation = (myLogger,
                                     1,
@@ -1265,28 +1773,50 @@ def do_training(myLogger,
                                     padInputImgs,
                                     smoothChannelsWithGaussFilteringStdsForNormalAndSubsampledImage,
                                     [0, -1,-1,-1], #don't perform intensity-augmentation during validation.
-                                    [0,0,0] #don't perform reflection-augmentation during validation.
+                                    [0,0,0], #don't perform reflection-augmentation during validation.
+                                    preprocessedVolumeCache,
+                                    cropVolumesToRoi
                                     )
-    tupleWithLocalFunctionsThatWillBeCalledByTheMainJob = ( get_random_subject_indices_to_load_on_GPU,
-                                                            actual_load_patient_imgs,
-                                                            smoothImageWithGaussianFilterIfNeeded,
-                                                            reflectImageArrayIfNeeded,
-                                                            padCnnInputs,
-                                                            getNumberOfSegmentsToExtractPerCategoryFromEachSubject,
-                                                            sampleImageParts,
-                                                            extractDataOfASegmentFromImagesUsingSampledSliceCoords,
-                                                            getImagePartFromSubsampledImageForTraining,
-                                                            shuffleTheSegmentsForThisSubepoch
-                                                            )
-    tupleWithModulesToImportWhichAreUsedByTheJobFunctions = ("random", "time", "numpy as np", "nibabel as nib", "math", \
-                                                             "from scipy.ndimage.filters import gaussian_filter", \
-                                                             "from deepmedic.genericHelpers import *",
-                                                        "from deepmedic.pathwayTypes import PathwayTypes as pt", \
-                                                        "from deepmedic.cnnHelpers import CnnWrapperForSampling")
-    #to know so that in the very first I sequencially load the data for it.
-    boolItIsTheVeryFirstSubepochOfThisProcess = True 
+    argsForSubepochSamplingPerTypeOfJob = [tupleWithParametersForTraining, tupleWithParametersForValidation]
+    
+    #---------To run PARALLEL the extraction of segments for the next subepochs---
+    # The types of the sampling jobs (0 training, 1 validation) in the order their segments will be needed.
+    scheduleOfSamplingJobs = ([1, 0] if performValidationOnSamplesDuringTrainingProcessBool else [0]) * \
+                                ( (n_epochs - cnn3dInst.numberOfEpochsTrained) * number_of_subepochs )
+    samplerPool = None
+    if numberOfSamplingProcesses > 0 and len(scheduleOfSamplingJobs) > 0 :
+        bytesPerSlot = getNumberOfBytesOfFloat32Arrays(getShapesOfArraysOfSubepoch(cnn3dWrapper, 0,
+                                                                                    imagePartsLoadedInGpuPerSubepoch))
+        if performValidationOnSamplesDuringTrainingProcessBool :
+            bytesPerSlot = max(bytesPerSlot, getNumberOfBytesOfFloat32Arrays(getShapesOfArraysOfSubepoch(cnn3dWrapper, 1,
+                                                                        imagePartsLoadedInGpuPerSubepochValidation)))
+        numberOfSubepochsToPrefetch = max(1, numberOfSubepochsToPrefetch)
+        # One more slot than the prefetched subepochs, for the segments that the cnn is currently using.
+        myLogger.print3("PARALLEL: Starting the SamplerPool, with [" + str(numberOfSamplingProcesses) + \
+                        "] processes and shared memory for prefetching [" + str(numberOfSubepochsToPrefetch) + \
+                        "] subepochs (validation and training are counted separately): " + \
+                        str((numberOfSubepochsToPrefetch + 1) * bytesPerSlot / (1024*1024)) + " MB.")
+        samplerPool = SamplerPool(myLogger,
+                                numberOfSamplingProcesses,
+                                numberOfSubepochsToPrefetch + 1,
+                                bytesPerSlot,
+                                fillArraysWithSegmentsFromShardOfSubjects,
+                                argsForSubepochSamplingPerTypeOfJob)
+        while samplerPool.getNumberOfPendingJobs() < numberOfSubepochsToPrefetch and len(scheduleOfSamplingJobs) > 0 :
+            submitSamplingOfSubepochToSamplerPool(samplerPool,
+                                                argsForSubepochSamplingPerTypeOfJob[scheduleOfSamplingJobs.pop(0)])
     #------End for parallel------
     
+    #---------To stream the segments to the device batch by batch, instead of loading whole subepochs---
+    # The device holds only the ring of batches, so the subepoch is not limited by its memory. Sampling sequentially, \
+    # training starts as soon as a batch is extracted.
+    streamingBool = numberOfBatchSlotsForStreaming > 0
+    if streamingBool :
+        cnn3dInst.compileFunctionsToLoadBatchesInSlots(myLogger, numberOfBatchSlotsForStreaming)
+    
+    # The model is saved at the end of each epoch. Files are written in the background, while the next epoch starts.
+    checkpointSaver = CheckpointSaverInBackground(myLogger)
+    
     while cnn3dInst.numberOfEpochsTrained < n_epochs :
         epoch = cnn3dInst.numberOfEpochsTrained
         
@@ -1301,57 +1831,64 @@ def do_training(myLogger,
         myLogger.print3("~~~~~~~~~~~~~~~~~~~~Starting new Epoch! Epoch #"+str(epoch)+"/"+\
                                                 str(n_epochs)+" ~~~~~~~~~~~~~~~~~~~~~~~~~")
 #         myLogger.print3("~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~")
-        start_epoch_time = time.clock()
+        start_epoch_time = time.time()
         
         for subepoch in xrange(number_of_subepochs): #per subepoch I randomly load some images in the gpu. Random order.
 #             myLogger.print3("**************************************************************************************************")
             myLogger.print3("************* Starting new Subepoch: #"+str(subepoch)+"/"+\
                                             str(number_of_subepochs)+" *************")
+            profilingThisSubepoch = epochAndSubepochToProfile <> None and list(epochAndSubepochToProfile) == [epoch, subepoch]
+            if profilingThisSubepoch :
+                myLogger.print3("PROFILING: Profiling this subepoch with: " + str(profilerOfSubepoch))
+                stageTimers.startProfiling(profilerOfSubepoch)
 #             myLogger.print3("**************************************************************************************************")
             
             #-------------------------GET DATA FOR THIS SUBEPOCH's VALIDATION---------------------------------
             
-            if performValidationOnSamplesDuringTrainingProcessBool :
-                if boolItIsTheVeryFirstSubepochOfThisProcess :
-                    [channsOfSegmentsForSubepPerPathwayVal,
-                    labelsForCentralOfSegmentsForSubepVal] = \
-                        getTheArraysOfImageChannelsAndLesionsToLoadToGpuForSubepoch(myLogger,
+            if performValidationOnSamplesDuringTrainingProcessBool and streamingBool :
+                streamOfSegmentsVal = getStreamOfSegmentsForNextSubepoch(myLogger,
                                                                         1,
-                                                                        cnn3dWrapper,
-                                                                        maxNumSubjectsLoadedPerSubepoch,
-                                                                        imagePartsLoadedInGpuPerSubepochValidation,
-                                                                        samplingTypeInstanceValidation,
-                                                                        
-                                                        listOfFilepathsToEachChannelOfEachPatValidation,
-                                                                        
-                                                        listOfFilepathsToGtLabelsOfEachPatValidationOnSamplesAndDsc,
-                                                                        
-                                                                        providedRoiMaskForValidationBool,
-                                                                        listOfFilepathsToRoiMaskOfEachPatValidation,
-                                                                        
-                                                        providedWeightMapsToSampleForEachCategoryValidation,
-                                                forEachSamplingCategory_aListOfFilepathsToWeightMapsOfEachPatValidation,
-                                                                        
-                                                                        useSameSubChannelsAsSingleScale,
-                                                                        
-                                                            listOfFilepathsToEachSubsampledChannelOfEachPatValidation,
-                                                                        
-                                                                        padInputImgs,
-                                                            smoothChannelsWithGaussFilteringStdsForNormalAndSubsampledImage,
-                            #Joe: intensity normalization-augmentation used during training if set. 
-                            # this call is for "validation", the following flag is useless, as "testing"
-                    normAugmFlag=[0,-1,-1,-1],
-                                                                        reflectImageWithHalfProbDuringTraining = [0,0,0]
-                                                                        )
-                    boolItIsTheVeryFirstSubepochOfThisProcess = False
-                else : #It was done in parallel with the training of the previous epoch, just grab the results...
-                    [channsOfSegmentsForSubepPerPathwayVal,
-                    labelsForCentralOfSegmentsForSubepVal] = parallelJobToGetDataForNextValidation() #fromParallelProcessing \
-                    #that had started from last loop when it was submitted.
-                    
+                                                                        samplerPool,
+                                                                        scheduleOfSamplingJobs,
+                                                                        argsForSubepochSamplingPerTypeOfJob,
+                                                                        cnn3dInst.batchSizeValidation)
+                myLogger.print3("-V-V-V-V-V- Now Validating for this subepoch before commencing the \
+                                                                training iterations... -V-V-V-V-V-")
+                start_validationForSubepoch_time = time.time()
+                doTrainOrValidationOnBatchesAndReturnMeanAccuraciesOfSubepoch(myLogger,
+                                                                            1,
+                                                                            imagePartsLoadedInGpuPerSubepochValidation / \
+                                                                                cnn3dInst.batchSizeValidation,
+                                                                            cnn3dInst,
+                                                                            'placeholder',
+                                                                            subepoch,
+                                                                            validationAccuracyMonitorForEpoch,
+                                                                            streamOfSegmentsVal)
+                streamOfSegmentsVal = ""
+                if samplerPool <> None :
+                    samplerPool.releaseSlotsOfReturnedResults()
+                end_validationForSubepoch_time = time.time()
+                myLogger.print3("TIMING: Extracting (if streamed) and validating on the batches of this subepoch #" + \
+                                str(subepoch) + " took time: "+\
+                                str(end_validationForSubepoch_time-start_validationForSubepoch_time)+"(s)")
+                myLogger.logRecord("timing", session="Validation", stage="subepoch", epoch=epoch, subepoch=subepoch,
+                                   seconds=end_validationForSubepoch_time-start_validationForSubepoch_time)
+                cnn3dInst.checkMeanValidationAccOfLastEpochAndUpdateCnnsTopAccAchievedIfNeeded(myLogger,
+                                                    validationAccuracyMonitorForEpoch.getMeanEmpiricalAccuracyOfEpoch(),
+                                                    minIncreaseInValidationAccuracyConsideredForLrSchedule)
+                
+            elif performValidationOnSamplesDuringTrainingProcessBool :
+                #Extracted in parallel with the training of the previous subepochs, unless sampling sequentially.
+                [channsOfSegmentsForSubepPerPathwayVal,
+                labelsForCentralOfSegmentsForSubepVal] = getArraysOfSegmentsForNextSubepoch(myLogger,
+                                                                                        1,
+                                                                                        samplerPool,
+                                                                                        scheduleOfSamplingJobs,
+                                                                                argsForSubepochSamplingPerTypeOfJob)
+                
                 #------------------------------LOAD DATA FOR VALIDATION----------------------
                 myLogger.print3("Loading Validation data for subepoch #"+str(subepoch)+" on shared variable...")
-                start_loadingToGpu_time = time.clock()
+                start_loadingToGpu_time = time.time()
                 
                 numberOfBatchesValidation = len(channsOfSegmentsForSubepPerPathwayVal[0]) / \
                     cnn3dInst.batchSizeValidation #Computed with number of extracted samples, \
@@ -1360,35 +1897,25 @@ def do_training(myLogger,
                 myLogger.print3("DEBUG: For Validation, loading to shared variable that many Segments: " + \
                                 str(len(channsOfSegmentsForSubepPerPathwayVal[0])))
                 
-                cnn3dInst.sharedInpXVal.set_value(channsOfSegmentsForSubepPerPathwayVal[0], \
-                                                      borrow=borrowFlag) # Primary pathway
-                for index in xrange(len(channsOfSegmentsForSubepPerPathwayVal[1:])) :
-                    cnn3dInst.sharedInpXPerSubsListVal[index].set_value(channsOfSegmentsForSubepPerPathwayVal[1+index], \
-                                                                            borrow=borrowFlag)
-                cnn3dInst.sharedLabelsYVal.set_value(labelsForCentralOfSegmentsForSubepVal, borrow=borrowFlag)
+                with stageTimers.timeStage("hostToDevice") :
+                    cnn3dInst.sharedInpXVal.set_value(channsOfSegmentsForSubepPerPathwayVal[0], \
+                                                          borrow=borrowFlag) # Primary pathway
+                    for index in xrange(len(channsOfSegmentsForSubepPerPathwayVal[1:])) :
+                        cnn3dInst.sharedInpXPerSubsListVal[index].set_value(channsOfSegmentsForSubepPerPathwayVal[1+index], \
+                                                                                borrow=borrowFlag)
+                    cnn3dInst.sharedLabelsYVal.set_value(labelsForCentralOfSegmentsForSubepVal, borrow=borrowFlag)
                 channsOfSegmentsForSubepPerPathwayVal = ""
                 labelsForCentralOfSegmentsForSubepVal = ""
                 
-                end_loadingToGpu_time = time.clock()
+                end_loadingToGpu_time = time.time()
                 myLogger.print3("TIMING: Loading sharedVariables for Validation in epoch|subepoch="+str(epoch)+"|"+\
                                 str(subepoch)+" took time: "+str(end_loadingToGpu_time-start_loadingToGpu_time)+"(s)")
                 
                 
-                #------------------------SUBMIT PARALLEL JOB TO GET TRAINING DATA FOR NEXT TRAINING-----------------
-                #submit the parallel job
-                myLogger.print3("PARALLEL: Before Validation in subepoch #" +str(subepoch) + \
-                                ", the parallel job for extracting Segments for the next Training is submitted.")
-                parallelJobToGetDataForNextTraining = job_server.submit(\
-                getTheArraysOfImageChannelsAndLesionsToLoadToGpuForSubepoch, #local function to call and execute in parallel.
-                tupleWithParametersForTraining, #tuple with the arguments required
-                tupleWithLocalFunctionsThatWillBeCalledByTheMainJob, #tuple of local functions that I need to call
-                tupleWithModulesToImportWhichAreUsedByTheJobFunctions) #tuple of the external modules that I need, \
-                #of which I am calling functions (not the mods of the ext-functions).
-                
                 #------------------------------------DO VALIDATION--------------------------------
                 myLogger.print3("-V-V-V-V-V- Now Validating for this subepoch before commencing the \
                                                                 training iterations... -V-V-V-V-V-")
-                start_validationForSubepoch_time = time.clock()
+                start_validationForSubepoch_time = time.time()
                 
                 train0orValidation1 = 1 #validation
                 vectorWithWeightsOfTheClassesForCostFunctionOfTraining = 'placeholder' #only used in training
@@ -1401,10 +1928,14 @@ def do_training(myLogger,
                                                                             subepoch,
                                                                             validationAccuracyMonitorForEpoch)
                 cnn3dInst.freeGpuValidationData()
+                if samplerPool <> None : # The shared variables may have borrowed the memory of its slot till now.
+                    samplerPool.releaseSlotsOfReturnedResults()
                 
-                end_validationForSubepoch_time = time.clock()
+                end_validationForSubepoch_time = time.time()
                 myLogger.print3("TIMING: Validating on the batches of this subepoch #" + str(subepoch) + " took time: "+\
                                 str(end_validationForSubepoch_time-start_validationForSubepoch_time)+"(s)")
+                myLogger.logRecord("timing", session="Validation", stage="subepoch", epoch=epoch, subepoch=subepoch,
+                                   seconds=end_validationForSubepoch_time-start_validationForSubepoch_time)
                 
                 #Update cnn's top achieved validation accuracy if needed: (for the autoReduction of Learning Rate.)
                 cnn3dInst.checkMeanValidationAccOfLastEpochAndUpdateCnnsTopAccAchievedIfNeeded(myLogger,
@@ -1414,53 +1945,40 @@ def do_training(myLogger,
             
             
             #-------------------------GET DATA FOR THIS SUBEPOCH's TRAINING---------------------------------
-            if (not performValidationOnSamplesDuringTrainingProcessBool) and boolItIsTheVeryFirstSubepochOfThisProcess :                    
-                [channsOfSegmentsForSubepPerPathwayTrain,
-                labelsForCentralOfSegmentsForSubepTrain] = getTheArraysOfImageChannelsAndLesionsToLoadToGpuForSubepoch(\
-                                                                        myLogger,
+            #Extracted in parallel with the validation (or with previous training iteration, \
+            #in case I am not performing validation), unless sampling sequentially.
+            if streamingBool :
+                streamOfSegmentsTrain = getStreamOfSegmentsForNextSubepoch(myLogger,
                                                                         0,
-                                                                        cnn3dWrapper,
-                                                                        maxNumSubjectsLoadedPerSubepoch,
-                                                                        imagePartsLoadedInGpuPerSubepoch,
-                                                                        samplingTypeInstanceTraining,
-                                                                        
-                                                                        listOfFilepathsToEachChannelOfEachPatTraining,
-                                                                        
-                                                                        listOfFilepathsToGtLabelsOfEachPatTraining,
-                                                                        
-                                                                        providedRoiMaskForTrainingBool,
-                                                                        listOfFilepathsToRoiMaskOfEachPatTraining,
-                                                                        
-                                                                        providedWeightMapsToSampleForEachCategoryTraining,
-                                                forEachSamplingCategory_aListOfFilepathsToWeightMapsOfEachPatTraining,
-                                                                        
-                                                                        useSameSubChannelsAsSingleScale,
-                                                                        
-                                                            listOfFilepathsToEachSubsampledChannelOfEachPatTraining,
-                                                                        
-                                                                        padInputImgs,
-                                                        smoothChannelsWithGaussFilteringStdsForNormalAndSubsampledImage,
-                            normAugmFlag,
-                                                                        reflectImageWithHalfProbDuringTraining
-                                                                        )
-                boolItIsTheVeryFirstSubepochOfThisProcess = False
+                                                                        samplerPool,
+                                                                        scheduleOfSamplingJobs,
+                                                                        argsForSubepochSamplingPerTypeOfJob,
+                                                                        cnn3dInst.batchSize)
+                #The class-weights are computed from the labels of all the segments of the subepoch, so training \
+                # waits for all to be extracted while the classes are weighted.
+                if cnn3dInst.numberOfEpochsTrained < numberOfEpochsToWeightTheClassesInTheCostFunction :
+                    streamOfSegmentsTrain.waitUntilProducerFinished()
+                labelsForCentralOfSegmentsForSubepTrain = streamOfSegmentsTrain.getLabelsOfRowsWritten()
             else :
-                #It was done in parallel with the validation (or with previous training iteration, \
-                #in case I am not performing validation).
                 [channsOfSegmentsForSubepPerPathwayTrain,
-                labelsForCentralOfSegmentsForSubepTrain] = parallelJobToGetDataForNextTraining() #fromParallelProcessing\
-                # that had started from last loop when it was submitted.
+                labelsForCentralOfSegmentsForSubepTrain] = getArraysOfSegmentsForNextSubepoch(myLogger,
+                                                                                        0,
+                                                                                        samplerPool,
+                                                                                        scheduleOfSamplingJobs,
+                                                                                argsForSubepochSamplingPerTypeOfJob)
                 
             #-------------------------COMPUTE CLASS-WEIGHTS, TO WEIGHT COST FUNCTION AND COUNTER CLASS IMBALANCE----------------------
             #Do it for only few epochs, until I get to an ok local minima neighbourhood.
             if cnn3dInst.numberOfEpochsTrained < numberOfEpochsToWeightTheClassesInTheCostFunction :
                 numOfPatchesInTheSubepoch_notParts = np.prod(labelsForCentralOfSegmentsForSubepTrain.shape)
-                actualNumOfPatchesPerClassInTheSubepoch_notParts = \
-                    np.bincount(np.ravel(labelsForCentralOfSegmentsForSubepTrain).astype(int))
+                #A class without voxels in the subepoch is counted as one, so that its weight stays finite.
+                actualNumOfPatchesPerClassInTheSubepoch_notParts = np.maximum(1,
+                    np.bincount(np.ravel(labelsForCentralOfSegmentsForSubepTrain).astype(int),
+                                minlength=cnn3dInst.numberOfOutputClasses))
                 # yx - y1 = (x - x1) * (y2 - y1)/(x2 - x1)
                 # yx = the multiplier I currently want, y1 = the multiplier at the begining, y2 = the multiplier at the end
                 # x = current epoch, x1 = epoch where linear decrease starts, x2 = epoch where linear decrease ends
-                y1 = (1./(actualNumOfPatchesPerClassInTheSubepoch_notParts+TINY_FLOAT)) * \
+                y1 = (1./actualNumOfPatchesPerClassInTheSubepoch_notParts) * \
                     (numOfPatchesInTheSubepoch_notParts*1.0/cnn3dInst.numberOfOutputClasses)
                 y2 = 1.
                 x1 = 0. * number_of_subepochs # linear decrease starts from epoch=0
@@ -1488,51 +2006,34 @@ def do_training(myLogger,
                 cnn3dInst.change_learning_rate_of_a_cnn(newLearningRate, myLogger)
                 
             #----------------------------------LOAD TRAINING DATA ON GPU-------------------------------
-            myLogger.print3("Loading Training data for subepoch #"+str(subepoch)+" on shared variable...")
-            start_loadingToGpu_time = time.clock()
-            
-            #Computed with number of extracted samples, in case I dont manage to extract as many as I wanted initially.
-            numberOfBatchesTraining = len(channsOfSegmentsForSubepPerPathwayTrain[0]) / cnn3dInst.batchSize 
-            
-            # Primary pathway
-            cnn3dInst.sharedInpXTrain.set_value(channsOfSegmentsForSubepPerPathwayTrain[0], borrow=borrowFlag) 
-            for index in xrange(len(channsOfSegmentsForSubepPerPathwayTrain[1:])) :
-                cnn3dInst.sharedInpXPerSubsListTrain[index].set_value(channsOfSegmentsForSubepPerPathwayTrain[1+index], \
-                                                                          borrow=borrowFlag)
-            cnn3dInst.sharedLabelsYTrain.set_value(labelsForCentralOfSegmentsForSubepTrain, borrow=borrowFlag)
-            channsOfSegmentsForSubepPerPathwayTrain = ""
-            labelsForCentralOfSegmentsForSubepTrain = ""
-            
-            end_loadingToGpu_time = time.clock()
-            myLogger.print3("TIMING: Loading sharedVariables for Training in epoch|subepoch="+str(epoch)+"|"+\
-                            str(subepoch)+" took time: "+str(end_loadingToGpu_time-start_loadingToGpu_time)+"(s)")
-            
-            
-            #------------------------SUBMIT PARALLEL JOB TO GET VALIDATION/TRAINING DATA (if val is/not performed) \
-            # FOR NEXT SUBEPOCH-----------------
-            if performValidationOnSamplesDuringTrainingProcessBool :
-                #submit the parallel job
-                myLogger.print3("PARALLEL: Before Training in subepoch #" +str(subepoch) + \
-                                ", submitting the parallel job for extracting Segments for the next Validation.")
-                parallelJobToGetDataForNextValidation = job_server.submit(\
-                getTheArraysOfImageChannelsAndLesionsToLoadToGpuForSubepoch, #local function to call and execute in parallel.
-                    tupleWithParametersForValidation, #tuple with the arguments required
-                    tupleWithLocalFunctionsThatWillBeCalledByTheMainJob, #tuple of local functions that I need to call
-                    tupleWithModulesToImportWhichAreUsedByTheJobFunctions) #tuple of the external modules that I need, \
-                    # of which I am calling functions (not the mods of the ext-functions).
-            else : #extract in parallel the samples for the next subepoch's training.
-                myLogger.print3("PARALLEL: Before Training in subepoch #" +str(subepoch) + \
-                                ", submitting the parallel job for extracting Segments for the next Training.")
-                parallelJobToGetDataForNextTraining = job_server.submit(\
-                getTheArraysOfImageChannelsAndLesionsToLoadToGpuForSubepoch, #local function to call and execute in parallel.
-                    tupleWithParametersForTraining, #tuple with the arguments required
-                    tupleWithLocalFunctionsThatWillBeCalledByTheMainJob, #tuple of local functions that I need to call
-                tupleWithModulesToImportWhichAreUsedByTheJobFunctions) #tuple of the external modules that I need, \
-                # of which I am calling
+            if streamingBool : #Loaded batch by batch, while training.
+                numberOfBatchesTraining = imagePartsLoadedInGpuPerSubepoch / cnn3dInst.batchSize #The stream may end sooner.
+                labelsForCentralOfSegmentsForSubepTrain = ""
+            else :
+                myLogger.print3("Loading Training data for subepoch #"+str(subepoch)+" on shared variable...")
+                start_loadingToGpu_time = time.time()
+                
+                #Computed with number of extracted samples, in case I dont manage to extract as many as I wanted initially.
+                numberOfBatchesTraining = len(channsOfSegmentsForSubepPerPathwayTrain[0]) / cnn3dInst.batchSize 
                 
+                with stageTimers.timeStage("hostToDevice") :
+                    # Primary pathway
+                    cnn3dInst.sharedInpXTrain.set_value(channsOfSegmentsForSubepPerPathwayTrain[0], borrow=borrowFlag) 
+                    for index in xrange(len(channsOfSegmentsForSubepPerPathwayTrain[1:])) :
+                        cnn3dInst.sharedInpXPerSubsListTrain[index].set_value(channsOfSegmentsForSubepPerPathwayTrain[1+index], \
+                                                                                  borrow=borrowFlag)
+                    cnn3dInst.sharedLabelsYTrain.set_value(labelsForCentralOfSegmentsForSubepTrain, borrow=borrowFlag)
+                channsOfSegmentsForSubepPerPathwayTrain = ""
+                labelsForCentralOfSegmentsForSubepTrain = ""
+                
+                end_loadingToGpu_time = time.time()
+                myLogger.print3("TIMING: Loading sharedVariables for Training in epoch|subepoch="+str(epoch)+"|"+\
+                                str(subepoch)+" took time: "+str(end_loadingToGpu_time-start_loadingToGpu_time)+"(s)")
+                
+            
             #-------------------------------START TRAINING IN BATCHES------------------------------
             myLogger.print3("-T-T-T-T-T- Now Training for this subepoch... This may take a few minutes... -T-T-T-T-T-")
-            start_trainingForSubepoch_time = time.clock()
+            start_trainingForSubepoch_time = time.time()
             
             train0orValidation1 = 0 #training
             doTrainOrValidationOnBatchesAndReturnMeanAccuraciesOfSubepoch(myLogger,
@@ -1541,12 +2042,23 @@ def do_training(myLogger,
                                                                         cnn3dInst,
                                                                 vectorWithWeightsOfTheClassesForCostFunctionOfTraining,
                                                                         subepoch,
-                                                                        trainingAccuracyMonitorForEpoch)
-            cnn3dInst.freeGpuTrainingData()
+                                                                        trainingAccuracyMonitorForEpoch,
+                                                                        streamOfSegmentsTrain if streamingBool else None)
+            streamOfSegmentsTrain = ""
+            if not streamingBool : #Else the ring of batches is kept for the next subepoch.
+                cnn3dInst.freeGpuTrainingData()
+            if samplerPool <> None :
+                samplerPool.releaseSlotsOfReturnedResults()
             
-            end_trainingForSubepoch_time = time.clock()
+            end_trainingForSubepoch_time = time.time()
             myLogger.print3("TIMING: Training on the batches of this subepoch #" + str(subepoch) + " took time: "+\
                             str(end_trainingForSubepoch_time-start_trainingForSubepoch_time)+"(s)")
+            myLogger.logRecord("timing", session="Training", stage="subepoch", epoch=epoch, subepoch=subepoch,
+                               seconds=end_trainingForSubepoch_time-start_trainingForSubepoch_time)
+            if profilingThisSubepoch :
+                filepathOfProfile = stageTimers.stopProfilingAndDump(os.path.splitext(myLogger.loggerFileName)[0] + \
+                                                                     ".epoch" + str(epoch) + ".subepoch" + str(subepoch))
+                myLogger.print3("PROFILING: The profile of the subepoch was saved at: " + filepathOfProfile)
             
 #         myLogger.print3("~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~" )
         myLogger.print3("~~~~~~~~~~~~~~~~~~ Epoch #" + str(epoch) + \
@@ -1625,9 +2137,11 @@ def do_training(myLogger,
         cnn3dInst.increaseNumberOfEpochsTrained()
         
         myLogger.print3("SAVING: Epoch #"+str(epoch)+" finished. Saving CNN model.")
-        dump_cnn_to_gzip_file_dotSave(cnn3dInst, fileToSaveTrainedCnnModelTo+"."+datetimeNowAsStr(), myLogger)
-        end_epoch_time = time.clock()
+        with stageTimers.timeStage("savingModel") :
+            checkpointSaver.save(cnn3dInst, fileToSaveTrainedCnnModelTo+"."+datetimeNowAsStr())
+        end_epoch_time = time.time()
         myLogger.print3("TIMING: The whole Epoch #"+str(epoch)+" took time: "+str(end_epoch_time-start_epoch_time)+"(s)")
+        myLogger.logRecord("timing", session="Training", stage="epoch", epoch=epoch, seconds=end_epoch_time-start_epoch_time)
         myLogger.print3("~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~ End of Training Epoch. Model was \
                                     Saved. ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~")
         
@@ -1671,36 +2185,320 @@ def do_training(myLogger,
                                     saveMDImgWithAllFms=saveMDImgWithAllFms,
                     allFmsIdxForV=\
                             allFmsIdxForV,
-                    namesToGiveToFmVisualisationsIfSaving=namesToGiveToFmVisualisationsIfSaving
+                    namesToGiveToFmVisualisationsIfSaving=namesToGiveToFmVisualisationsIfSaving,
+                    
+                                    preprocessedVolumeCache=preprocessedVolumeCache,
+                                    storagePrecisionOfVolumes=storagePrecisionOfVolumesForInference
                                     )
+        stageTimers.reportAndReset(myLogger, "Epoch #" + str(epoch))
             
-    dump_cnn_to_gzip_file_dotSave(cnn3dInst, fileToSaveTrainedCnnModelTo+".final."+datetimeNowAsStr(), myLogger)
-    
-    end_training_time = time.clock()
+    if samplerPool <> None :
+        samplerPool.terminate()
+    with stageTimers.timeStage("savingModel") :
+        checkpointSaver.save(cnn3dInst, fileToSaveTrainedCnnModelTo+".final."+datetimeNowAsStr())
+        checkpointSaver.waitForPendingSave()
+    stageTimers.reportAndReset(myLogger, "end of training")
+    
+    end_training_time = time.time()
     myLogger.print3("TIMING: Training process took time: "+str(end_training_time-start_training_time)+"(s)")
+    myLogger.logRecord("timing", session="Training", stage="total", seconds=end_training_time-start_training_time)
     myLogger.print3("The whole do_training() function has finished.")
     
     
 #---------------------------------------------TESTING-------------------------------------
 
-def performInferForTestOnWholeVols(myLogger,
-                            validation0orTesting1,
-                            savePredImgsSegAndProbMapsList,
-                            cnn3dInst,
-                            
-                            fpathsToEachChannelOfEachPat,
-                            
-                            providedGtLabelsBool, #boolean. DSC calculation will be performed if this is provided.
-                            fpathsToGtLabelsOfEachPat,
-                            
-                            providedRoiMaskForFastInfBool,
-                            fpathsToRoiMaskFastInfOfEachPat,
-                            
-                            borrowFlag,
-                            namesToGiveToPredsIfSavingResults,
-                            
-                            #----Preprocessing------
-                            padInputImgs,
+def runJobsInBackgroundThread(functionToRun, listOfArgsPerJob, queueForResults) :
+    # Target of a thread. Runs the jobs in order and puts their results in queueForResults. If the queue is \
+    # bounded, it blocks when it is full, so that no more than that many results are kept in memory. \
+    # Errors (even the SystemExit of exit(1)) are put in the queue, to be raised by getResultOfBackgroundJob(). \
+    # listOfArgsPerJob can be any iterable, even one that gives its args lazily. After the last job, "finished".
+    try :
+        for argsOfJob in listOfArgsPerJob :
+            queueForResults.put(["result", functionToRun(*argsOfJob)])
+    except BaseException :
+        queueForResults.put(["error", sys.exc_info()])
+        return
+    queueForResults.put(["finished", None])
+        
+def getResultOfBackgroundJob(queueOfResults) :
+    # Returns None when all the jobs are finished.
+    [typeOfResult, result] = queueOfResults.get()
+    if typeOfResult == "error" :
+        raise result[0], result[1], result[2]
+    return result
+
+def consumeJobsInBackgroundThread(queueOfJobs, listForResults) :
+    # Target of a thread. Runs the [function, args] jobs given in queueOfJobs, until it gets None. \
+    # Results, or the sys.exc_info() of the failed jobs, are appended in listForResults.
+    while True :
+        job = queueOfJobs.get()
+        if job == None :
+            return
+        [functionToRun, argsOfJob] = job
+        try :
+            listForResults.append(functionToRun(*argsOfJob))
+        except BaseException :
+            listForResults.append(sys.exc_info())
+            
+def raiseErrorOfFailedBackgroundJobIfAny(listOfResults) :
+    for result in listOfResults :
+        if isinstance(result, tuple) and len(result) == 3 and isinstance(result[1], BaseException) :
+            raise result[0], result[1], result[2]
+            
+def loadAndTileSubjectForInference(myLogger,
+                                    image_i,
+                                    cnn3dInst,
+                                    fpathsToEachChannelOfEachPat,
+                                    providedGtLabelsBool,
+                                    fpathsToGtLabelsOfEachPat,
+                                    providedRoiMaskForFastInfBool,
+                                    fpathsToRoiMaskFastInfOfEachPat,
+                                    padInputImgs,
+                                    smoothChannelsWithGaussFilteringStdsForNormalAndSubsampledImage,
+                                    useSameSubChannelsAsSingleScale,
+                                    fpathsToEachSubsampledChannelOfEachPat,
+                                    strideImgParts,
+                                    volumeCache=None,
+                                    storagePrecisionOfVolumes="float32"
+                                    ) :
+    """
+    First stage of the inference pipeline. Loads the images of a subject in cpu and tiles them into segments.
+    Runs in a background thread when subjects are prefetched, so it must not touch the theano functions.
+    Returns the index of the subject first, as the subjects may be given in any order.
+    """
+    start_load_time = time.time()
+    with stageTimers.timeStage("loadingAndTilingForInference") :
+        recFieldCnn = cnn3dInst.recFieldCnn
+    
+        [imageChannels, #a nparray(channels,dim0,dim1,dim2)
+        gtLabelsImage, #only for accurate/correct DICE1-2 calculation
+        brainMask, 
+        sampleWeightMaps, #only used in training. Placeholder here.
+        allSubsamChannelsOfPatient,  #a nparray(channels,dim0,dim1,dim2)
+        paddingPerAxes, #( (padLeftR, padRightR), (padLeftC,padRightC), (padLeftZ,padRightZ)). \
+        # All 0s when no padding.
+        reflectFlags # Not used. No reflection in testing.
+        ] = actual_load_patient_imgs(
+                                                    myLogger,
+                                                    2,#flag for "testing"
+                                                
+                                                    image_i,
+                                                
+                                                    fpathsToEachChannelOfEachPat,
+                                                
+                                                    providedGtLabelsBool,
+                                                    fpathsToGtLabelsOfEachPat,
+                                        # Says if weightMaps are provided. If true, must provide all. Placeholder in testing.
+                                                    providedWeightMapsToSampleForEachCategory = False, 
+                                                    forEachSamplingCategory_aListOfFilepathsToWeightMapsOfEachPat = \
+                                                        "placeholder", # Placeholder in testing.
+                                                
+                                                    providedRoiMaskBool = providedRoiMaskForFastInfBool,
+                                        fpathsToRoiMaskOfEachPat = fpathsToRoiMaskFastInfOfEachPat,
+                                                
+                                                    useSameSubChannelsAsSingleScale = useSameSubChannelsAsSingleScale,
+                                                    usingSubsampledPathways = cnn3dInst.numSubsPaths > 0,
+                                        fpathsToEachSubsampledChannelOfEachPat = fpathsToEachSubsampledChannelOfEachPat,
+                                                
+                                                    padInputImgs = padInputImgs,
+                                                    cnnReceptiveField = recFieldCnn, # only used if padInputsBool
+                                        dimsOfPrimeSegmentRcz = \
+                                            cnn3dInst.pathways[0].getShapeOfInput()[2][2:], # only used if padInputsBool
+                                                
+                                        smoothChannelsWithGaussFilteringStdsForNormalAndSubsampledImage = \
+                                            smoothChannelsWithGaussFilteringStdsForNormalAndSubsampledImage,
+                    #Joe: intensity normalization-augmentation used during training if set. 
+                    #Joe: this call is for "testing", the following flag is useless
+                normAugmFlag= [0, -1,-1,-1],
+                                                    reflectImageWithHalfProb = [0,0,0],
+                                                    volumeCache = volumeCache,
+                                                    storagePrecisionOfVolumes = storagePrecisionOfVolumes
+                                                    )
+    
+        # Tile the image and get all slices of the segments that it fully breaks down to.
+        [sliceCoordsOfSegs] = getCoordsOfAllSegmentsOfAnImage(myLogger=myLogger,
+                                                dimsOfPrimarySegment=cnn3dInst.pathways[0].getShapeOfInput()[2][2:],
+                                                strideOfSegmentsPerDimInVoxels=strideImgParts,
+                                                channelsOfImageNpArray = imageChannels,#chans,niiDims
+                                                                        brainMask = brainMask
+                                                                        )
+    end_load_time = time.time()
+    myLogger.print3("Loaded and tiled subject #" + str(image_i) + " in " + str(end_load_time - start_load_time) + "(s)")
+    
+    return [image_i, imageChannels, gtLabelsImage, brainMask, allSubsamChannelsOfPatient, paddingPerAxes,
+            sliceCoordsOfSegs, end_load_time - start_load_time]
+
+
+def saveOutputImagesOfSubject(myLogger,
+                                image_i,
+                                cnn3dInst,
+                                savePredImgsSegAndProbMapsList,
+                                segImg,
+                                predLabelImg,
+                                multidimImg,
+                                padInputImgs,
+                                paddingPerAxes,
+                                fpathsToEachChannelOfEachPat,
+                                namesToGiveToPredsIfSavingResults,
+                                saveIndividualFmImgsForV,
+                                saveMDImgWithAllFms,
+                                allFmsIdxForV,
+                                namesToGiveToFmVisualisationsIfSaving
+                                ) :
+    """
+    Last stage of the inference pipeline. Saves the segmentation, probability maps and feature maps of a subject.
+    Runs in a background thread when subjects are prefetched. Returns the time it took.
+    """
+    start_save_time = time.time()
+    with stageTimers.timeStage("savingOutputs") :
+        NUMBER_OF_CLASSES = cnn3dInst.numberOfOutputClasses
+    
+
+        #Save Result:
+        if savePredImgsSegAndProbMapsList[0] == True : #save predicted segmentation
+            npDtypeForPredImg = np.dtype(np.uint8) if segImg.dtype == np.uint8 else np.dtype(np.int16)
+            suffixToAdd = "_Segm"
+            #Save the image. Pass the filename paths of the normal image so that I can \
+            # dublicate the header info, eg RAS transformation.
+            unpadSegImg = segImg if not padInputImgs else unpadCnnOutputs(segImg, paddingPerAxes)
+            savePredictedImageToANewNiiWithHeaderFromOther( unpadSegImg,
+                                                            namesToGiveToPredsIfSavingResults,
+                                                            fpathsToEachChannelOfEachPat,
+                                                            image_i,
+                                                            suffixToAdd,
+                                                            npDtypeForPredImg,
+                                                            myLogger
+                                                            )
+        for class_i in xrange(0, NUMBER_OF_CLASSES) :
+            if (len(savePredImgsSegAndProbMapsList[1]) >= class_i + 1) and \
+                (savePredImgsSegAndProbMapsList[1][class_i] == True) : #save predicted probMap for class
+                npDtypeForPredImg = np.dtype(np.float32)
+                suffixToAdd = "_ProbMapClass" + str(class_i)
+                #Save the image. Pass the filename paths of the normal image so that I can dublicate \
+                # the header info, eg RAS transformation.
+                predLabelImg_i = predLabelImg[class_i,:,:,:]
+                unpadPredLabelImg_i = predLabelImg_i if not \
+                    padInputImgs else unpadCnnOutputs(predLabelImg_i, paddingPerAxes)
+                savePredictedImageToANewNiiWithHeaderFromOther(unpadPredLabelImg_i,
+                                        namesToGiveToPredsIfSavingResults,
+                                        fpathsToEachChannelOfEachPat,
+                                        image_i,
+                                        suffixToAdd,
+                                        npDtypeForPredImg,
+                                        myLogger
+                                        )
+        #=================Save FEATURE MAPS ====================
+        if saveIndividualFmImgsForV :
+            curIdxInMDImg = 0
+            for pathway_i in xrange( len(cnn3dInst.pathways) ) :
+                pathway = cnn3dInst.pathways[pathway_i]
+                fmsIdxForV = allFmsIdxForV[ pathway.pType() ]
+                if fmsIdxForV<>[] :
+                    for layer_i in xrange( len(pathway.getLayers()) ) :
+                        fmsIdxForV_i = fmsIdxForV[layer_i]
+                        if fmsIdxForV_i<>[] :
+                            #If the user specifies to grab more feature maps than exist (eg 9999), correct it, \
+                            # replacing it with the number of FMs in the layer.
+                            for fmActualNumber in xrange(fmsIdxForV_i[0], fmsIdxForV_i[1]) :
+                                fmToSave = multidimImg[curIdxInMDImg]
+                                unpaddedFmToSave = fmToSave if not padInputImgs else \
+                                    unpadCnnOutputs(fmToSave, paddingPerAxes)
+                                saveFmActivationImageToANewNiiWithHeaderFromOther(  unpaddedFmToSave,
+                                                                        namesToGiveToFmVisualisationsIfSaving,
+                                                                        fpathsToEachChannelOfEachPat,
+                                                                                    image_i,
+                                                                                    pathway_i,
+                                                                                    layer_i,
+                                                                                    fmActualNumber,
+                                                                                    myLogger
+                                                                                    ) 
+                                curIdxInMDImg += 1
+        if saveMDImgWithAllFms :
+            """
+            mDImgWith4thDimAsFms =  \
+                np.zeros(niiDims + [totalNumFMs], dtype = "float32")
+            for fm_i in xrange(0, totalNumFMs) :
+                mDImgWith4thDimAsFms[:,:,:,fm_i] = \
+                multidimImg[fm_i]
+            """
+            mDImgWith4thDimAsFms =  np.transpose(multidimImg, (1,2,3, 0) )
+        
+            unpadMDImgWith4thDimAsFms = mDImgWith4thDimAsFms if not padInputImgs else \
+                unpadCnnOutputs(mDImgWith4thDimAsFms, paddingPerAxes)
+            
+            #Save a multidimensional Nii image. 3D Image, with the 4th dimension being all the Fms...
+            saveMDImgWithAllVisualisedFmsToANewNiiWithHeaderFromOther( \
+                                                unpadMDImgWith4thDimAsFms,
+                                                namesToGiveToFmVisualisationsIfSaving,
+                                                fpathsToEachChannelOfEachPat,
+                                                image_i,
+                                                myLogger)
+        #=================IMAGES SAVED. PROBABILITY MAPS AND FEATURE MAPS TOO (if wanted). ====================
+    return time.time() - start_save_time
+
+
+def placeBatchOfOutputCubesInImage( imgToConstruct, # [channels/classes/fms, r, c, z]
+                                    outputCubesOfBatch, # [batch, channels/classes/fms, outR, outC, outZ]
+                                    sliceCoordsOfSegsOfBatch, # numSegs x 3(rcz) x 2, inclusive limits.
+                                    rczHalfRecFieldCnn,
+                                    sumOfWeightsImg=None # [r,c,z]. If given, cubes are accumulated for averaging.
+                                    ) :
+    """
+    Places the output cubes of a whole batch in the image being constructed, with one scatter operation \
+    instead of a python loop over the segments. The very first predicted voxel of a segment goes \
+    half-receptive-field further from its top-left voxel, at the position of the central voxel of the top-left patch.
+    If sumOfWeightsImg is None, the cubes overwrite the voxels they cover (segments should not overlap).
+    Otherwise, the cubes are added to imgToConstruct and sumOfWeightsImg counts how many cubes covered each voxel, \
+    so that the caller can divide by it in the end to average overlapping predictions. The copies of the last \
+    segment that are used to fill the last batch are counted only once.
+    """
+    cubeDims = outputCubesOfBatch.shape[2:]
+    sliceCoordsArray = np.asarray(sliceCoordsOfSegsOfBatch, dtype="int32")
+    # numSegs x 3. Where the first central voxel of each segment goes.
+    startCoords = sliceCoordsArray[:,:,0] + np.asarray(rczHalfRecFieldCnn, dtype="int32")
+    if sumOfWeightsImg is not None :
+        [_, idxsOfUniqueSegs] = np.unique(np.ravel_multi_index(startCoords.T, imgToConstruct.shape[1:]), return_index=True)
+        startCoords = startCoords[idxsOfUniqueSegs]
+        outputCubesOfBatch = outputCubesOfBatch[idxsOfUniqueSegs]
+    rIdxs = (startCoords[:,0,np.newaxis] + np.arange(cubeDims[0]))[:,:,np.newaxis,np.newaxis]
+    cIdxs = (startCoords[:,1,np.newaxis] + np.arange(cubeDims[1]))[:,np.newaxis,:,np.newaxis]
+    zIdxs = (startCoords[:,2,np.newaxis] + np.arange(cubeDims[2]))[:,np.newaxis,np.newaxis,:]
+    # Indexing with the broadcasted grids gives [channels, segments, outR, outC, outZ].
+    cubesWithChannelsFirst = np.swapaxes(outputCubesOfBatch, 0, 1)
+    if sumOfWeightsImg is None :
+        imgToConstruct[:, rIdxs, cIdxs, zIdxs] = cubesWithChannelsFirst
+    else :
+        # Cubes of the same batch may overlap, so a plain += would drop repeated voxels. \
+        # Sum the repeated voxels first (unique + bincount) and then add them in one go.
+        linearIdxs = np.ravel_multi_index(np.broadcast_arrays(rIdxs, cIdxs, zIdxs), imgToConstruct.shape[1:]).ravel()
+        [uniqueLinearIdxs, inverseIdxs] = np.unique(linearIdxs, return_inverse=True)
+        uniqueIdxsPerAxis = np.unravel_index(uniqueLinearIdxs, imgToConstruct.shape[1:])
+        cubesFlattenedPerChannel = cubesWithChannelsFirst.reshape(cubesWithChannelsFirst.shape[0], -1)
+        for channel_i in xrange(imgToConstruct.shape[0]) :
+            imgToConstruct[(channel_i,) + uniqueIdxsPerAxis] += np.bincount(inverseIdxs,
+                                                                            weights=cubesFlattenedPerChannel[channel_i],
+                                                                            minlength=len(uniqueLinearIdxs))
+        sumOfWeightsImg[uniqueIdxsPerAxis] += np.bincount(inverseIdxs, minlength=len(uniqueLinearIdxs))
+        
+        
+def performInferForTestOnWholeVols(myLogger,
+                            validation0orTesting1,
+                            savePredImgsSegAndProbMapsList,
+                            cnn3dInst,
+                            
+                            fpathsToEachChannelOfEachPat,
+                            
+                            providedGtLabelsBool, #boolean. DSC calculation will be performed if this is provided.
+                            fpathsToGtLabelsOfEachPat,
+                            
+                            providedRoiMaskForFastInfBool,
+                            fpathsToRoiMaskFastInfOfEachPat,
+                            
+                            borrowFlag,
+                            namesToGiveToPredsIfSavingResults,
+                            
+                            #----Preprocessing------
+                            padInputImgs,
                             smoothChannelsWithGaussFilteringStdsForNormalAndSubsampledImage,
                             
                             useSameSubChannelsAsSingleScale,
@@ -1713,7 +2511,26 @@ def performInferForTestOnWholeVols(myLogger,
                             # should contain an entry per pathwayType, even if just []. If not [], the list should contain \
                             # one entry per layer of the pathway, even if just []. The layer entries, if not [], they \
                             # should have to integers, lower and upper FM to visualise. Excluding the highest index.
-                            namesToGiveToFmVisualisationsIfSaving
+                            namesToGiveToFmVisualisationsIfSaving,
+                            
+                            #--------Tiling--------
+                            strideOfSegmentsForInference = None, # None for the default, non-overlapping tiling.
+                            
+                            #--------Pipeline--------
+                            numSubjectsToPrefetch = 1, # Subjects loaded ahead in a background thread. 0 to disable.
+                            
+                            #--------Cache--------
+                            preprocessedVolumeCache = None, # PreprocessedVolumeCache for the loaded volumes, or None.
+                            
+                            #--------Output of the cnn--------
+                            outputOfInferenceFunction = "probabilities", # Or "float16" or "labels". See compileTestFunction().
+                            
+                            #--------Memory--------
+                            storagePrecisionOfVolumes = "float32", # See STORAGE_PRECISIONS_OF_VOLUMES.
+                            
+                            #--------Subjects--------
+                            indicesOfSubjectsToSegment = None # None for all, in order. Otherwise an iterable of \
+                            # indices, which may give them lazily, as they are needed (see parallelInference).
                             ) :
     valOrTestString = "Validation" if validation0orTesting1 == 0 else "Testing"
 #     myLogger.print3("###########################################################################################################")
@@ -1721,7 +2538,7 @@ def performInferForTestOnWholeVols(myLogger,
                     " subjects ##########################")
 #     myLogger.print3("###########################################################################################################")
     
-    start_t = time.clock()
+    start_t = time.time()
     
     NA_PATTERN = AccuracyOfEpochMonitorSegmentation.NA_PATTERN
     
@@ -1729,6 +2546,9 @@ def performInferForTestOnWholeVols(myLogger,
     
     num_images = len(fpathsToEachChannelOfEachPat)    
     batch_size = cnn3dInst.batchSizeTesting
+    #Models made before the testing functions accepted any batch size must be given full batches. For these, the \
+    # last batch of a subject is filled with copies of its last segment, whose outputs are discarded.
+    fillLastBatchOfSubject = not cnn3dInst.canChangeBatchSizeTesting()
     
     #one dice score for whole + for each class)
     # A list of dimensions: num_images X NUMBER_OF_CLASSES
@@ -1737,6 +2557,9 @@ def performInferForTestOnWholeVols(myLogger,
     diceCoeffs2 = [ [-1] * NUMBER_OF_CLASSES for i in xrange(num_images) ] 
     #predictedInsideBrainMask/ LesionsInsideBrainMAsk (for comparisons)
     diceCoeffs3 = [ [-1] * NUMBER_OF_CLASSES for i in xrange(num_images) ] 
+    # Within the ROI.
+    sensitivities = [ [-1] * NUMBER_OF_CLASSES for i in xrange(num_images) ]
+    specificities = [ [-1] * NUMBER_OF_CLASSES for i in xrange(num_images) ]
     
     recFieldCnn = cnn3dInst.recFieldCnn
     
@@ -1744,7 +2567,36 @@ def performInferForTestOnWholeVols(myLogger,
     #I move exactly the number I segment in the centre of each image part 
     # (originally this was 9^3 segmented per imagePart).
     numOfCenterVoxClassified = cnn3dInst.finalTargetLayer.outputShapeTest[2:]
-    strideImgParts = numOfCenterVoxClassified
+    strideImgParts = numOfCenterVoxClassified if strideOfSegmentsForInference == None else strideOfSegmentsForInference
+    if any([ strideImgParts[i] > numOfCenterVoxClassified[i] or strideImgParts[i] < 1 for i in xrange(3) ]) :
+        myLogger.print3("ERROR: The stride of the segments for inference [" + str(strideImgParts) + "] should be \
+            between 1 and the number of central voxels classified per segment [" + \
+            str(numOfCenterVoxClassified) + "], otherwise parts of the image are not predicted. Exiting!"); exit(1)
+    #If the stride is smaller than the output of the cnn, the segments overlap and their predictions are averaged.
+    averageOverlappingPredictions = any([ strideImgParts[i] < numOfCenterVoxClassified[i] for i in xrange(3) ])
+    
+    if storagePrecisionOfVolumes not in STORAGE_PRECISIONS_OF_VOLUMES :
+        myLogger.print3("ERROR: The precision of the volumes in memory should be one of " + \
+                        str(STORAGE_PRECISIONS_OF_VOLUMES) + ". Given: [" + str(storagePrecisionOfVolumes) + "]. Exiting!"); exit(1)
+    dtypeOfFloatVolumes = getDtypeOfFloatVolumes(storagePrecisionOfVolumes)
+    dtypeOfSegmentation = getDtypeOfSegmentation(storagePrecisionOfVolumes, NUMBER_OF_CLASSES)
+    
+    #Only the function that returns the FMs of all layers can give them. Otherwise the lean one is enough.
+    saveFms = saveIndividualFmImgsForV or saveMDImgWithAllFms
+    if saveFms :
+        if getattr(cnn3dInst, "cnnTestAndVisualiseAllFmsFunction", "") == "" :
+            cnn3dInst.compileTestAndVisualisationFunction(myLogger)
+        outputOfFunctionUsed = "probabilities"
+    else :
+        if cnn3dInst.cnnTestModel == "" :
+            cnn3dInst.compileTestFunction(myLogger, outputOfInferenceFunction)
+        outputOfFunctionUsed = outputOfInferenceFunction
+    #With labels there are no probabilities to average over overlapping segments or to save.
+    segmentationFromLabels = outputOfFunctionUsed == "labels"
+    if segmentationFromLabels and (averageOverlappingPredictions or True in savePredImgsSegAndProbMapsList[1]) :
+        myLogger.print3("ERROR: The testing function returns the labels, so the probability maps cannot be saved and \
+            the segments cannot overlap. Do not save probability maps and do not give a stride smaller than the number \
+            of central voxels classified per segment [" + str(numOfCenterVoxClassified) + "]. Exiting!"); exit(1)
     
     rczHalfRecFieldCnn = [ (recFieldCnn[i]-1)/2 for i in xrange(3) ]
     #for tiny cnn: ('recFieldCnn', [7, 7, 7], 'strideImgParts', [39, 39, 39])
@@ -1778,73 +2630,76 @@ def performInferForTestOnWholeVols(myLogger,
                         fmsIdxForV_i[1] = min(fmsIdxForV_i[1], numFms)
                         totalNumFMs += fmsIdxForV_i[1] - fmsIdxForV_i[0]
                         
-    for image_i in xrange(num_images) :
-        myLogger.print3("~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~")
-        myLogger.print3("~~~~~~~~~~~~~~~~~~~~ Segmenting subject with index #"+str(image_i)+" ~~~~~~~~~~~~~~~~~~~~")
-        
-        #load the image channels in cpu
-        
-        [imageChannels, #a nparray(channels,dim0,dim1,dim2)
+    #Subjects are processed in a pipeline: while subject N is segmented by the cnn, a background thread loads \
+    # and tiles the next subjects and another one saves the outputs of the previous ones. \
+    # The queues are bounded, so at most numSubjectsToPrefetch subjects wait loaded in memory.
+    # The args are made as the subjects are taken, as their indices may be given lazily.
+    indicesOfSubjectsToSegment = xrange(num_images) if indicesOfSubjectsToSegment == None else indicesOfSubjectsToSegment
+    argsForLoadingPerSubject = ( (myLogger, image_i, cnn3dInst, fpathsToEachChannelOfEachPat,
+                                  providedGtLabelsBool, fpathsToGtLabelsOfEachPat,
+                                  providedRoiMaskForFastInfBool, fpathsToRoiMaskFastInfOfEachPat,
+                                  padInputImgs, smoothChannelsWithGaussFilteringStdsForNormalAndSubsampledImage,
+                                  useSameSubChannelsAsSingleScale, fpathsToEachSubsampledChannelOfEachPat,
+                                  strideImgParts, preprocessedVolumeCache, storagePrecisionOfVolumes) \
+                                                                        for image_i in indicesOfSubjectsToSegment )
+    if numSubjectsToPrefetch > 0 :
+        queueOfLoadedSubjects = Queue.Queue(maxsize=numSubjectsToPrefetch)
+        loaderThread = threading.Thread(target=runJobsInBackgroundThread,
+                                        args=(loadAndTileSubjectForInference, argsForLoadingPerSubject, queueOfLoadedSubjects))
+        loaderThread.daemon = True
+        loaderThread.start()
+        queueOfSavingJobs = Queue.Queue(maxsize=1)
+        resultsOfSavingJobs = [] # Times of the saving jobs, or exc_info of the ones that failed.
+        saverThread = threading.Thread(target=consumeJobsInBackgroundThread, args=(queueOfSavingJobs, resultsOfSavingJobs))
+        saverThread.daemon = True
+        saverThread.start()
+    loadTimeTotal = 0; waitForLoadTimeTotal = 0; inferenceTimeTotal = 0; waitForSaveTimeTotal = 0
+    saveTimesPerSubject = []
+    indicesOfSubjectsSegmented = []
+    
+    while True :
+        #load the image channels in cpu, or get them from the background thread that prefetched them.
+        start_wait_time = time.time()
+        if numSubjectsToPrefetch > 0 :
+            loadedSubject = getResultOfBackgroundJob(queueOfLoadedSubjects)
+        else :
+            argsForLoading = next(argsForLoadingPerSubject, None)
+            loadedSubject = loadAndTileSubjectForInference(*argsForLoading) if argsForLoading <> None else None
+        if loadedSubject == None : # All subjects were taken.
+            break
+        [image_i,
+        imageChannels, #a nparray(channels,dim0,dim1,dim2)
         gtLabelsImage, #only for accurate/correct DICE1-2 calculation
         brainMask, 
-        sampleWeightMaps, #only used in training. Placeholder here.
         allSubsamChannelsOfPatient,  #a nparray(channels,dim0,dim1,dim2)
-        paddingPerAxes #( (padLeftR, padRightR), (padLeftC,padRightC), (padLeftZ,padRightZ)). \
-        # All 0s when no padding.
-        ] = actual_load_patient_imgs(
-                                                    myLogger,
-                                                    2,#flag for "testing"
-                                                    
-                                                    image_i,
-                                                    
-                                                    fpathsToEachChannelOfEachPat,
-                                                    
-                                                    providedGtLabelsBool,
-                                                    fpathsToGtLabelsOfEachPat,
-                                        # Says if weightMaps are provided. If true, must provide all. Placeholder in testing.
-                                                    providedWeightMapsToSampleForEachCategory = False, 
-                                                    forEachSamplingCategory_aListOfFilepathsToWeightMapsOfEachPat = \
-                                                        "placeholder", # Placeholder in testing.
-                                                    
-                                                    providedRoiMaskBool = providedRoiMaskForFastInfBool,
-                                        fpathsToRoiMaskOfEachPat = fpathsToRoiMaskFastInfOfEachPat,
-                                                    
-                                                    useSameSubChannelsAsSingleScale = useSameSubChannelsAsSingleScale,
-                                                    usingSubsampledPathways = cnn3dInst.numSubsPaths > 0,
-                                        fpathsToEachSubsampledChannelOfEachPat = fpathsToEachSubsampledChannelOfEachPat,
-                                                    
-                                                    padInputImgs = padInputImgs,
-                                                    cnnReceptiveField = recFieldCnn, # only used if padInputsBool
-                                        dimsOfPrimeSegmentRcz = \
-                                            cnn3dInst.pathways[0].getShapeOfInput()[2][2:], # only used if padInputsBool
-                                                    
-                                        smoothChannelsWithGaussFilteringStdsForNormalAndSubsampledImage = \
-                                            smoothChannelsWithGaussFilteringStdsForNormalAndSubsampledImage,
-                    #Joe: intensity normalization-augmentation used during training if set. 
-                    #Joe: this call is for "testing", the following flag is useless
-                normAugmFlag= [0, -1,-1,-1],
-                                                    reflectImageWithHalfProb = [0,0,0]
-                                                    )
+        paddingPerAxes, #( (padLeftR, padRightR), (padLeftC,padRightC), (padLeftZ,padRightZ)). All 0s when no padding.
+        sliceCoordsOfSegs, # The slices of the segments that the image fully breaks down to.
+        loadTimePerSubject
+        ] = loadedSubject
+        waitForLoadTimePerSubject = time.time() - start_wait_time
+        myLogger.print3("~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~")
+        myLogger.print3("~~~~~~~~~~~~~~~~~~~~ Segmenting subject with index #"+str(image_i)+" ~~~~~~~~~~~~~~~~~~~~")
+        indicesOfSubjectsSegmented.append(image_i)
+        stageTimers.addToCounter("subjectsInferred")
+        loadTimeTotal += loadTimePerSubject; waitForLoadTimeTotal += waitForLoadTimePerSubject
+        start_inference_time = time.time()
+        
         niiDims = list(imageChannels[0].shape)
-        #for tiny cnn: ('imageChannels', (2, 246, 246, 161))
-        print('debug ---------------------------------------------------------------')
-        print('imageChannels',imageChannels.shape)
-        #The probability-map that will be constructed by the predictions.
-        predLabelImg = np.zeros([NUMBER_OF_CLASSES]+niiDims, dtype = "float32")
+        if segmentationFromLabels :
+            #The segmentation, constructed directly from the labels of the segments.
+            segImg = np.zeros(niiDims, dtype = dtypeOfSegmentation)
+            predLabelImg = "placeholderNothing"
+        else :
+            #The probability-map that will be constructed by the predictions.
+            predLabelImg = np.zeros([NUMBER_OF_CLASSES]+niiDims, dtype = dtypeOfFloatVolumes)
+        #How many segments predicted each voxel. Only needed for averaging overlapping segments.
+        sumOfWeightsImg = np.zeros(niiDims, dtype = "float32") if averageOverlappingPredictions else None
         #create the big array that will hold all the fms (for feature extraction, to save as a big multi-dim image).
         if saveIndividualFmImgsForV or saveMDImgWithAllFms:
-            multidimImg =  np.zeros([totalNumFMs] + niiDims, dtype = "float32")
+            multidimImg =  np.zeros([totalNumFMs] + niiDims, dtype = dtypeOfFloatVolumes)
             
-        # Tile the image and get all slices of the segments that it fully breaks down to.
-        [sliceCoordsOfSegs] = getCoordsOfAllSegmentsOfAnImage(myLogger=myLogger,
-                                                dimsOfPrimarySegment=cnn3dInst.pathways[0].getShapeOfInput()[2][2:],
-                                                strideOfSegmentsPerDimInVoxels=strideImgParts,
-                                                                        batch_size = batch_size,
-                                                channelsOfImageNpArray = imageChannels,#chans,niiDims
-                                                                        brainMask = brainMask
-                                                                        )
-        myLogger.print3("Starting to segment each image-part by calling the cnn.cnnTestModel(i). \
-            This part takes a few mins per volume...")
+        myLogger.print3("Starting to segment each image-part by calling the " + ("cnn.cnnTestAndVisualiseAllFmsFunction(i)" \
+            if saveFms else "cnn.cnnTestModel(i)") + ". This part takes a few mins per volume...")
         
         #In the next part, for each imagePart in a batch I get from the cnn a vector with labels for the central \
         # voxels of the imagepart (9^3 originally).
@@ -1863,74 +2718,78 @@ def performInferForTestOnWholeVols(myLogger,
         totalNumImgParts = len(sliceCoordsOfSegs)
         myLogger.print3("Total number of Segments to process:"+str(totalNumImgParts))
         
-        imagePartOfConstructedProbMap_i = 0
-        imgPartOfConstructedFMs_i = 0
-        num_batches = totalNumImgParts/batch_size
+        num_batches = int(math.ceil(totalNumImgParts*1.0/batch_size)) #The last one may have fewer segments.
         extractTimePerSubject = 0; loadingTimePerSubject = 0; fwdPassTimePerSubject = 0
-        for batch_i in xrange(num_batches) : #batch_size = how many image parts in one batch. Has to be the \
-            # same with the batch_size it was created with. This is no problem for testing. Could do all at once, \
-            # or just 1 image part at time.
+        for batch_i in xrange(num_batches) : #batch_size = how many image parts in one batch. The testing \
+            # functions accept any number up to the batch size the model was given (see setBatchSizeTesting()).
             
             printProgressStep = max(1, num_batches/5)
             if batch_i%printProgressStep == 0:
-                myLogger.print3("Processed "+str(batch_i*batch_size)+"/"+str(num_batches*batch_size)+" Segments.")
+                myLogger.print3("Processed "+str(batch_i*batch_size)+"/"+str(totalNumImgParts)+" Segments.")
                 
             # Extract the data for the segments of this batch. \
             # ( I could modularize extractDataOfASegmentFromImagesUsingSampledSliceCoords() of \
             # training and use it here as well. )
-            start_extract_time = time.clock()
-            coordsOfSegs = sliceCoordsOfSegs[ batch_i*batch_size : (batch_i+1)*batch_size ]
-            [channsOfSegs] = extractDataOfSegmentsUsingSampledSliceCoords(cnn3dInst=cnn3dInst,
-                                                            sliceCoordsOfSegsToExtract=coordsOfSegs,
-                                                            channelsOfImageNpArray=imageChannels,#chans,niiDims
-                                                channelsOfSubsampledImageNpArray=allSubsamChannelsOfPatient,
-                                                            recFieldCnn=recFieldCnn
-                                                                                    )
-            end_extract_time = time.clock()
+            start_extract_time = time.time()
+            with stageTimers.timeStage("inferenceExtracting") :
+                coordsOfSegs = sliceCoordsOfSegs[ batch_i*batch_size : (batch_i+1)*batch_size ]
+                numberOfSegsInBatch = len(coordsOfSegs)
+                coordsOfSegsForCnn = coordsOfSegs if not fillLastBatchOfSubject or numberOfSegsInBatch == batch_size else \
+                        np.concatenate([coordsOfSegs, np.repeat(coordsOfSegs[-1:], batch_size - numberOfSegsInBatch, axis=0)])
+                [channsOfSegs] = extractDataOfSegmentsUsingSampledSliceCoords(cnn3dInst=cnn3dInst,
+                                                                sliceCoordsOfSegsToExtract=coordsOfSegsForCnn,
+                                                                channelsOfImageNpArray=imageChannels,#chans,niiDims
+                                                    channelsOfSubsampledImageNpArray=allSubsamChannelsOfPatient,
+                                                                recFieldCnn=recFieldCnn
+                                                                                        )
+            end_extract_time = time.time()
             extractTimePerSubject += end_extract_time - start_extract_time
             
             # Load the data of the batch on the GPU
-            start_loading_time = time.clock()
-            cnn3dInst.sharedInpXTest.set_value(np.asarray(channsOfSegs[0], dtype='float32'), \
-                                                   borrow=borrowFlag)
-            for index in xrange(len(channsOfSegs[1:])) :
-                cnn3dInst.sharedInpXPerSubsListTest[index].set_value(\
-                                    np.asarray(channsOfSegs[1+index], dtype='float32'), borrow=borrowFlag)
-            end_loading_time = time.clock()
+            start_loading_time = time.time()
+            with stageTimers.timeStage("hostToDevice") :
+                cnn3dInst.sharedInpXTest.set_value(np.asarray(channsOfSegs[0], dtype='float32'), \
+                                                       borrow=borrowFlag)
+                for index in xrange(len(channsOfSegs[1:])) :
+                    cnn3dInst.sharedInpXPerSubsListTest[index].set_value(\
+                                        np.asarray(channsOfSegs[1+index], dtype='float32'), borrow=borrowFlag)
+            end_loading_time = time.time()
             loadingTimePerSubject += end_loading_time - start_loading_time
             
             # Do the inference
-            start_training_time = time.clock()
-            fmsPerLayer_predProbs = cnn3dInst.cnnTestAndVisualiseAllFmsFunction(0)
-            end_training_time = time.clock()
+            start_training_time = time.time()
+            with stageTimers.timeStage("inferenceForwardPass") :
+                if saveFms :
+                    fmsPerLayer_predProbs = cnn3dInst.cnnTestAndVisualiseAllFmsFunction(0)
+                    predForBatch = fmsPerLayer_predProbs[-1]
+                    #Sorted By PathwayType For The Batch
+                    fmsPerLayer = fmsPerLayer_predProbs[:-1]
+                    #No reshape needed, cause I now do it internally. But to dimensions (batchSize, FMs, R,C,Z).
+                else :
+                    predForBatch = cnn3dInst.cnnTestModel(0) #numpy ndarray
+            end_training_time = time.time()
             fwdPassTimePerSubject += end_training_time - start_training_time
-            
-            predForBatch = fmsPerLayer_predProbs[-1]
-            #predForBatch is numpy ndarray
-#             print('debug predForBatch',type(predForBatch))
-            #Sorted By PathwayType For The Batch
-            fmsPerLayer = fmsPerLayer_predProbs[:-1]
-            #No reshape needed, cause I now do it internally. But to dimensions (batchSize, FMs, R,C,Z).
+            stageTimers.addToCounter("segmentsInferred", numberOfSegsInBatch)
+            if len(coordsOfSegsForCnn) > numberOfSegsInBatch : #Discard the outputs of the copies that filled the batch.
+                predForBatch = predForBatch[:numberOfSegsInBatch]
+                if saveFms :
+                    fmsPerLayer = [ fms[:numberOfSegsInBatch] for fms in fmsPerLayer ]
             
             #~~~~~~~~~~~~~~~~CONSTRUCT THE PREDICTED PROBABILITY MAPS~~~~~~~~~~~~~~
             #From the results of this batch, create the prediction image by putting the predictions to the \
             # correct place in the image.
-            for imgPart in xrange(batch_size) :
-                #Now put the label-cube in the new-label-segmentation-image, at the correct position. 
-                #The very first label goes not in index 0,0,0 but half-patch further away! At the position of the \
-                # central voxel of the top-left patch!
-                sliceCoords = sliceCoordsOfSegs[imagePartOfConstructedProbMap_i]
-                coordsOfTopLeftVoxel = [ sliceCoords[0][0], sliceCoords[1][0], sliceCoords[2][0] ]
-                predLabelImg[
-                        :,
-                        coordsOfTopLeftVoxel[0] + rczHalfRecFieldCnn[0] : \
-                            coordsOfTopLeftVoxel[0] + rczHalfRecFieldCnn[0] + strideImgParts[0],
-                        coordsOfTopLeftVoxel[1] + rczHalfRecFieldCnn[1] : \
-                            coordsOfTopLeftVoxel[1] + rczHalfRecFieldCnn[1] + strideImgParts[1],
-                        coordsOfTopLeftVoxel[2] + rczHalfRecFieldCnn[2] : \
-                            coordsOfTopLeftVoxel[2] + rczHalfRecFieldCnn[2] + strideImgParts[2],
-                        ] = predForBatch[imgPart]
-                imagePartOfConstructedProbMap_i += 1
+            #Now put the label-cubes of the whole batch in the new-label-segmentation-image, at the correct position.
+            if segmentationFromLabels : #[batch, r, c, z]. As a single channel.
+                placeBatchOfOutputCubesInImage( imgToConstruct = segImg[np.newaxis],
+                                                outputCubesOfBatch = predForBatch[:, np.newaxis],
+                                                sliceCoordsOfSegsOfBatch = coordsOfSegs,
+                                                rczHalfRecFieldCnn = rczHalfRecFieldCnn)
+            else :
+                placeBatchOfOutputCubesInImage( imgToConstruct = predLabelImg,
+                                                outputCubesOfBatch = predForBatch,
+                                                sliceCoordsOfSegsOfBatch = coordsOfSegs,
+                                                rczHalfRecFieldCnn = rczHalfRecFieldCnn,
+                                                sumOfWeightsImg = sumOfWeightsImg)
             #~~~~~~~~~~~~~FINISHED CONSTRUCTING THE PREDICTED PROBABILITY MAPS~~~~~~~
             
             #~~~~~~~~~~~~~~CONSTRUCT THE FEATURE MAPS FOR VISUALISATION~~~~~~~~~~~~~~~~~
@@ -2028,123 +2887,54 @@ def performInferForTestOnWholeVols(myLogger,
                         else :
                             centerVoxelsOfAllFmsToForV = centerVoxelsOfAllFms
                             
-                        #----For every image part within this batch, reconstruct the corresponding part of the \
-                        # feature maps of the layer we are currently visualising in this loop.
-                        for imgPart in xrange(batch_size) :
-                            #Now put the label-cube in the new-label-segmentation-image, at the correct position. 
-                            #The very first label goes not in index 0,0,0 but half-patch further away! At the \
-                            # position of the central voxel of the top-left patch!
-                            sliceCoords = sliceCoordsOfSegs[imgPartOfConstructedFMs_i + \
-                                                                                    imgPart]
-                            coordsOfTopLeftVoxel = [ sliceCoords[0][0], \
-                                                        sliceCoords[1][0], sliceCoords[2][0] ]
-                            fmImgToReconstruct[ # I put the central-predicted-voxels of \
-                                    #all FMs to the corresponding, newly created images all at once.
-                                    :, #last dimension is the number-of-Fms, I create an image for each.        
-                                    coordsOfTopLeftVoxel[0] + rczHalfRecFieldCnn[0] : \
-                                        coordsOfTopLeftVoxel[0] + rczHalfRecFieldCnn[0] + strideImgParts[0],
-                                    coordsOfTopLeftVoxel[1] + rczHalfRecFieldCnn[1] : \
-                                        coordsOfTopLeftVoxel[1] + rczHalfRecFieldCnn[1] + strideImgParts[1],
-                                    coordsOfTopLeftVoxel[2] + rczHalfRecFieldCnn[2] : \
-                                        coordsOfTopLeftVoxel[2] + rczHalfRecFieldCnn[2] + strideImgParts[2]
-                                    ] = centerVoxelsOfAllFmsToForV[imgPart]
+                        #----Reconstruct the corresponding part of the feature maps of the layer we are currently \
+                        # visualising in this loop, for all the image parts within this batch at once.
+                        placeBatchOfOutputCubesInImage( imgToConstruct = fmImgToReconstruct,
+                                                        outputCubesOfBatch = centerVoxelsOfAllFmsToForV,
+                                                        sliceCoordsOfSegsOfBatch = coordsOfSegs,
+                                                        rczHalfRecFieldCnn = rczHalfRecFieldCnn)
                         curIdxInMDImg = highIdxOfFmsToFillExcluding
-                imgPartOfConstructedFMs_i += batch_size #all the image parts before this were reconstructed \
-                # for all layers and feature maps. Next batch-iteration should start from this 
             #~~~~~~~~~~~~~~~~~~FINISHED CONSTRUCTING THE FEATURE MAPS FOR VISUALISATION~~~~~~~~~~
             
         #Clear GPU from testing data.
         cnn3dInst.freeGpuTestingData()
         
+        if averageOverlappingPredictions :
+            predLabelImg /= np.maximum(sumOfWeightsImg, 1)
+        
         myLogger.print3("TIMING: Segmentation of this subject: [Extracting:] "+ str(extractTimePerSubject) +\
                                                             " [Loading:] " + str(loadingTimePerSubject) +\
                                                             " [ForwardPass:] " + str(fwdPassTimePerSubject) +\
                                                             " [Total:] " + \
                                         str(extractTimePerSubject+loadingTimePerSubject+fwdPassTimePerSubject) + "(s)")
+        myLogger.logRecord("timing", session=valOrTestString, stage="segmentationOfSubject", subject=image_i,
+                           extracting=extractTimePerSubject, loading=loadingTimePerSubject, forwardPass=fwdPassTimePerSubject)
         
         #=================Save Predicted-Probability-Map and Evaluate Dice====================
-        segImg = np.argmax(predLabelImg, axis=0) #The SEGMENTATION.
+        if not segmentationFromLabels :
+            segImg = np.argmax(predLabelImg, axis=0) #The SEGMENTATION.
+            segImg = segImg.astype(dtypeOfSegmentation) if storagePrecisionOfVolumes == "float16" else segImg
+        
+        inferenceTimePerSubject = time.time() - start_inference_time
+        inferenceTimeTotal += inferenceTimePerSubject
         
         #Save Result:
-        if savePredImgsSegAndProbMapsList[0] == True : #save predicted segmentation
-            npDtypeForPredImg = np.dtype(np.int16)
-            suffixToAdd = "_Segm"
-            #Save the image. Pass the filename paths of the normal image so that I can \
-            # dublicate the header info, eg RAS transformation.
-            unpadSegImg = segImg if not padInputImgs else unpadCnnOutputs(segImg, paddingPerAxes)
-            savePredictedImageToANewNiiWithHeaderFromOther( unpadSegImg,
-                                                            namesToGiveToPredsIfSavingResults,
-                                                            fpathsToEachChannelOfEachPat,
-                                                            image_i,
-                                                            suffixToAdd,
-                                                            npDtypeForPredImg,
-                                                            myLogger
-                                                            )
-        for class_i in xrange(0, NUMBER_OF_CLASSES) :
-            if (len(savePredImgsSegAndProbMapsList[1]) >= class_i + 1) and \
-                (savePredImgsSegAndProbMapsList[1][class_i] == True) : #save predicted probMap for class
-                npDtypeForPredImg = np.dtype(np.float32)
-                suffixToAdd = "_ProbMapClass" + str(class_i)
-                #Save the image. Pass the filename paths of the normal image so that I can dublicate \
-                # the header info, eg RAS transformation.
-                predLabelImg_i = predLabelImg[class_i,:,:,:]
-                unpadPredLabelImg_i = predLabelImg_i if not \
-                    padInputImgs else unpadCnnOutputs(predLabelImg_i, paddingPerAxes)
-                savePredictedImageToANewNiiWithHeaderFromOther(unpadPredLabelImg_i,
-                                        namesToGiveToPredsIfSavingResults,
-                                        fpathsToEachChannelOfEachPat,
-                                        image_i,
-                                        suffixToAdd,
-                                        npDtypeForPredImg,
-                                        myLogger
-                                        )
-        #=================Save FEATURE MAPS ====================
-        if saveIndividualFmImgsForV :
-            curIdxInMDImg = 0
-            for pathway_i in xrange( len(cnn3dInst.pathways) ) :
-                pathway = cnn3dInst.pathways[pathway_i]
-                fmsIdxForV = allFmsIdxForV[ pathway.pType() ]
-                if fmsIdxForV<>[] :
-                    for layer_i in xrange( len(pathway.getLayers()) ) :
-                        fmsIdxForV_i = fmsIdxForV[layer_i]
-                        if fmsIdxForV_i<>[] :
-                            #If the user specifies to grab more feature maps than exist (eg 9999), correct it, \
-                            # replacing it with the number of FMs in the layer.
-                            for fmActualNumber in xrange(fmsIdxForV_i[0], fmsIdxForV_i[1]) :
-                                fmToSave = multidimImg[curIdxInMDImg]
-                                unpaddedFmToSave = fmToSave if not padInputImgs else \
-                                    unpadCnnOutputs(fmToSave, paddingPerAxes)
-                                saveFmActivationImageToANewNiiWithHeaderFromOther(  unpaddedFmToSave,
-                                                                        namesToGiveToFmVisualisationsIfSaving,
-                                                                        fpathsToEachChannelOfEachPat,
-                                                                                    image_i,
-                                                                                    pathway_i,
-                                                                                    layer_i,
-                                                                                    fmActualNumber,
-                                                                                    myLogger
-                                                                                    ) 
-                                curIdxInMDImg += 1
-        if saveMDImgWithAllFms :
-            """
-            mDImgWith4thDimAsFms =  \
-                np.zeros(niiDims + [totalNumFMs], dtype = "float32")
-            for fm_i in xrange(0, totalNumFMs) :
-                mDImgWith4thDimAsFms[:,:,:,fm_i] = \
-                multidimImg[fm_i]
-            """
-            mDImgWith4thDimAsFms =  np.transpose(multidimImg, (1,2,3, 0) )
+        multidimImgOrPlaceholder = multidimImg if (saveIndividualFmImgsForV or saveMDImgWithAllFms) else "placeholderNothing"
+        argsForSaving = (myLogger, image_i, cnn3dInst, savePredImgsSegAndProbMapsList, segImg, predLabelImg,
+                         multidimImgOrPlaceholder, padInputImgs, paddingPerAxes, fpathsToEachChannelOfEachPat,
+                         namesToGiveToPredsIfSavingResults, saveIndividualFmImgsForV, saveMDImgWithAllFms, allFmsIdxForV,
+                         namesToGiveToFmVisualisationsIfSaving)
+        if numSubjectsToPrefetch > 0 :
+            start_wait_time = time.time()
+            raiseErrorOfFailedBackgroundJobIfAny(resultsOfSavingJobs)
+            queueOfSavingJobs.put([saveOutputImagesOfSubject, argsForSaving]) #Blocks while the previous is being saved.
+            waitForSaveTimeTotal += time.time() - start_wait_time
+        else :
+            saveTimesPerSubject.append(saveOutputImagesOfSubject(*argsForSaving))
             
-            unpadMDImgWith4thDimAsFms = mDImgWith4thDimAsFms if not padInputImgs else \
-                unpadCnnOutputs(mDImgWith4thDimAsFms, paddingPerAxes)
-                
-            #Save a multidimensional Nii image. 3D Image, with the 4th dimension being all the Fms...
-            saveMDImgWithAllVisualisedFmsToANewNiiWithHeaderFromOther( \
-                                                unpadMDImgWith4thDimAsFms,
-                                                namesToGiveToFmVisualisationsIfSaving,
-                                                fpathsToEachChannelOfEachPat,
-                                                image_i,
-                                                myLogger)
-        #=================IMAGES SAVED. PROBABILITY MAPS AND FEATURE MAPS TOO (if wanted). ====================
+        myLogger.print3("TIMING: Pipeline stages of this subject: [Load+Tile:] " + str(loadTimePerSubject) +\
+                        " [Waited for Load+Tile:] " + str(waitForLoadTimePerSubject) +\
+                        " [Inference:] " + str(inferenceTimePerSubject) + "(s)")
         
         #=================EVALUATE DSC FROM THE PROBABILITY MAPS FOR EACH IMAGE. ====================
         if providedGtLabelsBool : # Ground Truth was provided for calculation of DSC. Do DSC calculation.
@@ -2153,66 +2943,104 @@ def performInferForTestOnWholeVols(myLogger,
             #Unpad all segmentation map, gt, brainmask
             unpadSegImg = segImg if not padInputImgs else unpadCnnOutputs(segImg, paddingPerAxes)
             unpadGtLabelsImg = gtLabelsImage if not padInputImgs else unpadCnnOutputs(gtLabelsImage, paddingPerAxes)
-            #Hack, for it to work for the case that I do not use a brainMask.
-            if isinstance(brainMask, (np.ndarray)) : #If brainmask was given:
-                multiplyWithBrainMaskOr1 = brainMask if not padInputImgs else \
-                unpadCnnOutputs(brainMask, paddingPerAxes)
-            else :
-                multiplyWithBrainMaskOr1 = 1
-            #calculate DSC per class.
+            unpadBrainMask = None if not isinstance(brainMask, (np.ndarray)) else \
+                                brainMask if not padInputImgs else unpadCnnOutputs(brainMask, paddingPerAxes)
+            # One pass over the volume gives the confusion matrices inside and outside the ROI. \
+            # All metrics per class are computed from these.
+            with stageTimers.timeStage("metrics") :
+                confusionMatrices = computeConfusionMatricesOfVolume(NUMBER_OF_CLASSES, unpadSegImg, unpadGtLabelsImg,
+                                                                     unpadBrainMask)
+            dicesPerVariant = confusionMatrices.getDiceCoefficients()
+            [sensitivitiesOfSubject, specificitiesOfSubject] = confusionMatrices.getSensitivitiesAndSpecificities(
+                                                                                            insideRoiOnly=True)
             for class_i in xrange(0, NUMBER_OF_CLASSES) :
-                if class_i == 0 : #in this case, do the evaluation for the WHOLE segmentation (not background)
-                    boolPredLabelImg = unpadSegImg>0 #Whatever is not background
-                    boolGtLesionLabelsForDiceEval_unstrip = unpadGtLabelsImg>0
-                else :
-                    boolPredLabelImg = unpadSegImg==class_i
-                    boolGtLesionLabelsForDiceEval_unstrip = unpadGtLabelsImg==class_i
-                    
-                predLabelImgConvWithBrainMask = boolPredLabelImg*multiplyWithBrainMaskOr1
-                
-                #Calculate the 3 Dices. Dice1 = Allpredicted/allLesions, Dice2 = PredictedWithinBrainMask / AllLesions , \
-                # Dice3 = PredictedWithinBrainMask / LesionsInsideBrainMask.
-                #Dice1 = Allpredicted/allLesions
-                diceCoeff1 = calcDiceCoef(boolPredLabelImg, boolGtLesionLabelsForDiceEval_unstrip)
-                diceCoeffs1[image_i][class_i] = diceCoeff1 if diceCoeff1 <> -1 else NA_PATTERN
-                #Dice2 = PredictedWithinBrainMask / AllLesions
-                diceCoeff2 = calcDiceCoef(predLabelImgConvWithBrainMask, boolGtLesionLabelsForDiceEval_unstrip)
-                diceCoeffs2[image_i][class_i] = diceCoeff2 if diceCoeff2 <> -1 else NA_PATTERN
-                #Dice3 = PredictedWithinBrainMask / LesionsInsideBrainMask
-                diceCoeff3 = calcDiceCoef(predLabelImgConvWithBrainMask, boolGtLesionLabelsForDiceEval_unstrip * \
-                                                      multiplyWithBrainMaskOr1)
-                diceCoeffs3[image_i][class_i] = diceCoeff3 if diceCoeff3 <> -1 else NA_PATTERN
+                diceCoeffs1[image_i][class_i] = dicesPerVariant[0][class_i] if dicesPerVariant[0][class_i] <> -1 else NA_PATTERN
+                diceCoeffs2[image_i][class_i] = dicesPerVariant[1][class_i] if dicesPerVariant[1][class_i] <> -1 else NA_PATTERN
+                diceCoeffs3[image_i][class_i] = dicesPerVariant[2][class_i] if dicesPerVariant[2][class_i] <> -1 else NA_PATTERN
+                sensitivities[image_i][class_i] = sensitivitiesOfSubject[class_i] if sensitivitiesOfSubject[class_i] <> -1 \
+                                                                                                else NA_PATTERN
+                specificities[image_i][class_i] = specificitiesOfSubject[class_i] if specificitiesOfSubject[class_i] <> -1 \
+                                                                                                else NA_PATTERN
                 
             myLogger.print3("ACCURACY: (" + str(valOrTestString) + \
                             ") The Per-Class DICE Coefficients for subject with index #"+str(image_i)+\
                             " equal: DICE1="+strListFl4fNA(diceCoeffs1[image_i],NA_PATTERN)+\
                             " DICE2="+strListFl4fNA(diceCoeffs2[image_i],NA_PATTERN)+" DICE3="+\
                             strListFl4fNA(diceCoeffs3[image_i],NA_PATTERN))
+            myLogger.print3("ACCURACY: (" + str(valOrTestString) + \
+                            ") The Per-Class Sensitivity and Specificity (within the ROI) for subject with index #" + \
+                            str(image_i) + " equal: SENS=" + strListFl4fNA(sensitivities[image_i],NA_PATTERN) + \
+                            " SPEC=" + strListFl4fNA(specificities[image_i],NA_PATTERN))
             printExplanationsAboutDice(myLogger)
+            myLogger.logRecord("metricsOfSubject", session=valOrTestString, subject=image_i,
+                               dice1=replaceNaWithNone(diceCoeffs1[image_i], NA_PATTERN),
+                               dice2=replaceNaWithNone(diceCoeffs2[image_i], NA_PATTERN),
+                               dice3=replaceNaWithNone(diceCoeffs3[image_i], NA_PATTERN),
+                               sensitivity=replaceNaWithNone(sensitivities[image_i], NA_PATTERN),
+                               specificity=replaceNaWithNone(specificities[image_i], NA_PATTERN))
             
+    if numSubjectsToPrefetch > 0 :
+        start_wait_time = time.time()
+        queueOfSavingJobs.put(None) #Signals the saving thread to finish, after the queued jobs.
+        saverThread.join()
+        waitForSaveTimeTotal += time.time() - start_wait_time
+        raiseErrorOfFailedBackgroundJobIfAny(resultsOfSavingJobs)
+        saveTimesPerSubject = resultsOfSavingJobs
+    myLogger.print3("TIMING: Pipeline stages over all subjects (wall-clock): [Load+Tile:] " + str(loadTimeTotal) +\
+                    " [Waited for Load+Tile:] " + str(waitForLoadTimeTotal) +\
+                    " [Inference:] " + str(inferenceTimeTotal) +\
+                    " [Save:] " + str(sum(saveTimesPerSubject)) +\
+                    " [Waited for Save:] " + str(waitForSaveTimeTotal) + "(s)")
+    myLogger.logRecord("timing", session=valOrTestString, stage="pipelineOverAllSubjects", loadAndTile=loadTimeTotal,
+                       waitedForLoadAndTile=waitForLoadTimeTotal, inference=inferenceTimeTotal, save=sum(saveTimesPerSubject),
+                       waitedForSave=waitForSaveTimeTotal)
+    
     #================= Loops for all patients have finished. Now lets just report the average DSC \
     # over all the processed patients. ====================
     # Ground Truth was provided for calculation of DSC. Do DSC calculation.
-    if providedGtLabelsBool and num_images>0 : 
+    if providedGtLabelsBool and len(indicesOfSubjectsSegmented) > 0 :
         myLogger.print3("+++++++++++++++++++++++++++++++ Segmentation of all subjects finished")
-        myLogger.print3("+++++++++++++++++++++ Reporting Average Segmentation Metrics over all subjects")
-        meanDiceCoeffs1 = getMeanPerColOf2dListExclNA(diceCoeffs1, NA_PATTERN)
-        meanDiceCoeffs2 = getMeanPerColOf2dListExclNA(diceCoeffs2, NA_PATTERN)
-        meanDiceCoeffs3 = getMeanPerColOf2dListExclNA(diceCoeffs3, NA_PATTERN)
-        myLogger.print3("ACCURACY: (" + str(valOrTestString) + \
-                        ") The Per-Class average DICE Coefficients over all subjects are: DICE1=" + \
-                        strListFl4fNA(meanDiceCoeffs1, NA_PATTERN) + " DICE2="+\
-                        strListFl4fNA(meanDiceCoeffs2, NA_PATTERN)+" DICE3="+strListFl4fNA(meanDiceCoeffs3, NA_PATTERN))
-        printExplanationsAboutDice(myLogger)
+        reportAverageMetricsOverSubjects(myLogger, valOrTestString,
+                                         [ diceCoeffs1[i] for i in indicesOfSubjectsSegmented ],
+                                         [ diceCoeffs2[i] for i in indicesOfSubjectsSegmented ],
+                                         [ diceCoeffs3[i] for i in indicesOfSubjectsSegmented ],
+                                         [ sensitivities[i] for i in indicesOfSubjectsSegmented ],
+                                         [ specificities[i] for i in indicesOfSubjectsSegmented ])
         
-    end_valOrTest_time = time.clock()
+    end_valOrTest_time = time.time()
     myLogger.print3("TIMING: "+valOrTestString+" process took time: "+str(end_valOrTest_time-start_t)+"(s)")
+    myLogger.logRecord("timing", session=valOrTestString, stage="total", seconds=end_valOrTest_time-start_t)
     
 #     myLogger.print3("###########################################################################################################")
     myLogger.print3("############################# Finished full Segmentation of " + str(valOrTestString) + \
                     " subjects ##########################")
 #     myLogger.print3("###########################################################################################################")
     
+def reportAverageMetricsOverSubjects(myLogger, valOrTestString, diceCoeffs1, diceCoeffs2, diceCoeffs3, sensitivities,
+                                     specificities) :
+    # Each argument has a row per subject, with an entry per class, or the NA_PATTERN where not applicable.
+    NA_PATTERN = AccuracyOfEpochMonitorSegmentation.NA_PATTERN
+    myLogger.print3("+++++++++++++++++++++ Reporting Average Segmentation Metrics over all subjects")
+    meanDiceCoeffs1 = getMeanPerColOf2dListExclNA(diceCoeffs1, NA_PATTERN)
+    meanDiceCoeffs2 = getMeanPerColOf2dListExclNA(diceCoeffs2, NA_PATTERN)
+    meanDiceCoeffs3 = getMeanPerColOf2dListExclNA(diceCoeffs3, NA_PATTERN)
+    myLogger.print3("ACCURACY: (" + str(valOrTestString) + \
+                    ") The Per-Class average DICE Coefficients over all subjects are: DICE1=" + \
+                    strListFl4fNA(meanDiceCoeffs1, NA_PATTERN) + " DICE2="+\
+                    strListFl4fNA(meanDiceCoeffs2, NA_PATTERN)+" DICE3="+strListFl4fNA(meanDiceCoeffs3, NA_PATTERN))
+    meanSensitivities = getMeanPerColOf2dListExclNA(sensitivities, NA_PATTERN)
+    meanSpecificities = getMeanPerColOf2dListExclNA(specificities, NA_PATTERN)
+    myLogger.print3("ACCURACY: (" + str(valOrTestString) + \
+                    ") The Per-Class average Sensitivity and Specificity (within the ROI) over all subjects are: SENS=" + \
+                    strListFl4fNA(meanSensitivities, NA_PATTERN) + " SPEC=" + strListFl4fNA(meanSpecificities, NA_PATTERN))
+    printExplanationsAboutDice(myLogger)
+    myLogger.logRecord("metricsOverAllSubjects", session=valOrTestString, numberOfSubjects=len(diceCoeffs1),
+                       dice1=replaceNaWithNone(meanDiceCoeffs1, NA_PATTERN),
+                       dice2=replaceNaWithNone(meanDiceCoeffs2, NA_PATTERN),
+                       dice3=replaceNaWithNone(meanDiceCoeffs3, NA_PATTERN),
+                       sensitivity=replaceNaWithNone(meanSensitivities, NA_PATTERN),
+                       specificity=replaceNaWithNone(meanSpecificities, NA_PATTERN))
+    
 def printExplanationsAboutDice(myLogger) :
     myLogger.print3("EXPLANATION: DICE1/2/3 are lists with the DICE per class. For Class-0 we calculate DICE for the whole \
         foreground (useful for multi-class problems).")
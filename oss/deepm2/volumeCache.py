@@ -0,0 +1,109 @@
+# Copyright (c) 2016, Konstantinos Kamnitsas
+# All rights reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the BSD license. See the accompanying LICENSE file
+# or read the terms at https://opensource.org/licenses/BSD-3-Clause.
+
+import os
+import hashlib
+import numpy as np
+
+BYTES_PER_GIGABYTE = 1024**3
+
+def getIdentityOfFile(filepath) :
+    # Changes if the file is replaced or modified. To key entries that depend on more files than the original.
+    filepath = os.path.abspath(filepath)
+    statsOfFile = os.stat(filepath)
+    return [filepath, statsOfFile.st_mtime, statsOfFile.st_size]
+
+class PreprocessedVolumeCache(object):
+    # On-disk cache of preprocessed volumes (eg read from .nii.gz and smoothed), as uncompressed .npy files.
+    # An entry is keyed by the absolute path, modification time and size of the original file, and by the \
+    # preprocessing parameters. So a changed file or different preprocessing never give a stale volume.
+    # Entries are loaded memory-mapped. Least recently used entries are deleted when the cache exceeds its budget.
+    # Safe to share between processes: entries are written to a temporary file and renamed when complete.
+    def __init__(self, folderForCache, maxGigabytes, myLogger=None) :
+        self._folderForCache = os.path.abspath(folderForCache)
+        self._maxBytes = int(maxGigabytes * BYTES_PER_GIGABYTE)
+        self._myLogger = myLogger
+        if not os.path.isdir(self._folderForCache) :
+            try :
+                os.makedirs(self._folderForCache)
+            except OSError :
+                if not os.path.isdir(self._folderForCache) : # Else, another process just created it.
+                    raise
+
+    def getFolder(self) :
+        return self._folderForCache
+    def getMaxBytes(self) :
+        return self._maxBytes
+
+    def _print(self, string) :
+        if self._myLogger <> None :
+            self._myLogger.print3(string)
+        else :
+            print string
+
+    def _getFilepathOfEntry(self, filepathOfOriginal, kindOfVolume, preprocessingParameters) :
+        key = repr(getIdentityOfFile(filepathOfOriginal) + [kindOfVolume, preprocessingParameters])
+        return os.path.join(self._folderForCache, kindOfVolume + "_" + hashlib.sha1(key).hexdigest() + ".npy")
+
+    def getOrCompute(self, filepathOfOriginal, kindOfVolume, preprocessingParameters, functionToCompute) :
+        # functionToCompute() is called on a miss and must return the preprocessed volume as a numpy array.
+        # Returns a copy-on-write memory-map of the cached volume: It can be modified, without changing the cache.
+        filepathOfEntry = self._getFilepathOfEntry(filepathOfOriginal, kindOfVolume, preprocessingParameters)
+        if os.path.isfile(filepathOfEntry) :
+            try :
+                volume = np.load(filepathOfEntry, mmap_mode="c")
+                os.utime(filepathOfEntry, None) # Marks it as recently used, for the LRU eviction.
+                return volume
+            except (IOError, OSError, ValueError) : # Evicted meanwhile by another process, or corrupted.
+                pass
+
+        volume = np.ascontiguousarray(functionToCompute())
+        filepathOfTempFile = filepathOfEntry + ".tmp" + str(os.getpid())
+        f = open(filepathOfTempFile, "wb")
+        try :
+            np.save(f, volume)
+        finally :
+            f.close()
+        os.rename(filepathOfTempFile, filepathOfEntry)
+        self.evictLeastRecentlyUsedEntriesToFitBudget(filepathOfEntryToKeep=filepathOfEntry)
+        return np.load(filepathOfEntry, mmap_mode="c")
+
+    def _getEntriesSortedByLastUse(self) :
+        # Returns list of [lastUseTime, numberOfBytes, filepath], least recently used first.
+        entries = []
+        for filename in os.listdir(self._folderForCache) :
+            if not filename.endswith(".npy") :
+                continue
+            filepathOfEntry = os.path.join(self._folderForCache, filename)
+            try :
+                statsOfEntry = os.stat(filepathOfEntry)
+            except OSError : # Deleted meanwhile by another process.
+                continue
+            entries.append([statsOfEntry.st_mtime, statsOfEntry.st_size, filepathOfEntry])
+        entries.sort()
+        return entries
+
+    def getTotalBytes(self) :
+        return sum([ numberOfBytes for [lastUseTime, numberOfBytes, filepathOfEntry] in self._getEntriesSortedByLastUse() ])
+
+    def evictLeastRecentlyUsedEntriesToFitBudget(self, filepathOfEntryToKeep=None) :
+        entries = self._getEntriesSortedByLastUse()
+        totalBytes = sum([ numberOfBytes for [lastUseTime, numberOfBytes, filepathOfEntry] in entries ])
+        for [lastUseTime, numberOfBytes, filepathOfEntry] in entries :
+            if totalBytes <= self._maxBytes :
+                break
+            if filepathOfEntry == filepathOfEntryToKeep :
+                continue
+            try :
+                os.remove(filepathOfEntry) # Processes that have it memory-mapped can still read it.
+            except OSError :
+                pass
+            totalBytes -= numberOfBytes
+        if totalBytes > self._maxBytes :
+            self._print("WARN: The cache of preprocessed volumes at [" + self._folderForCache + "] takes [" + \
+                        str(totalBytes / (1024**2)) + "] MB, more than its budget, even after evicting all other entries.")
+